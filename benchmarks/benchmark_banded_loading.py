@@ -0,0 +1,111 @@
+"""
+Compares loading a whole matrix with hiCMatrix to loading only a band around
+the diagonal with load_banded_matrix, for a synthetic matrix with a distance
+decay of ~1/s stored as h5 and as cool file.
+
+    $ python benchmarks/benchmark_banded_loading.py --bins 200000 --pixels 50000000 --bands 2000000 5000000
+
+The matrices are written and each load runs in a newly started process, such
+that the peak memory of the loads is not the one of a larger parent process. Reported are the load time, the peak resident
+memory of the process on top of the memory before loading and the number of
+loaded pixels. The files are written to --directory, by default a temporary
+directory that is removed afterwards.
+"""
+import argparse
+import os
+import resource
+import shutil
+import tempfile
+import time
+import multiprocessing
+
+import cooler
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix, triu
+
+from hicmatrix import HiCMatrix as hm
+from hicexplorer.lib.bandedMatrix import load_banded_matrix
+
+
+def synthetic_matrix(pNumberOfBins, pNumberOfPixels, pSeed=0):
+    """Upper triangle csr matrix with about pNumberOfPixels values."""
+    random = np.random.RandomState(pSeed)
+    bin1 = random.randint(0, pNumberOfBins, pNumberOfPixels)
+    distance = np.exp(random.rand(pNumberOfPixels) * np.log(pNumberOfBins)).astype(np.int64) - 1
+    bin2 = np.minimum(bin1 + distance, pNumberOfBins - 1)
+    data = random.poisson(5, pNumberOfPixels).astype(np.float64) + 1
+    return coo_matrix((data, (bin1, bin2)), shape=(pNumberOfBins, pNumberOfBins)).tocsr()
+
+
+def write_matrices(pQueue, pDirectory, pNumberOfBins, pNumberOfPixels, pBinSize):
+    upper = synthetic_matrix(pNumberOfBins, pNumberOfPixels)
+    starts = np.arange(pNumberOfBins) * pBinSize
+    cut_intervals = [('chr1', start, start + pBinSize, 1) for start in starts]
+
+    h5_file = os.path.join(pDirectory, 'matrix.h5')
+    hic_ma = hm.hiCMatrix()
+    hic_ma.setMatrix(upper + triu(upper, k=1).T, cut_intervals)
+    hic_ma.save(h5_file)
+
+    cool_file = os.path.join(pDirectory, 'matrix.cool')
+    bins = pd.DataFrame({'chrom': 'chr1', 'start': starts, 'end': starts + pBinSize})
+    upper = upper.tocoo()
+    pixels = pd.DataFrame({'bin1_id': upper.row, 'bin2_id': upper.col, 'count': upper.data})
+    cooler.create_cooler(cool_file, bins, pixels.sort_values(['bin1_id', 'bin2_id']), dtypes={'count': np.float64})
+    pQueue.put([h5_file, cool_file])
+
+
+def max_rss():
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run(pQueue, pMatrixFile, pBand, pChunkSize):
+    start_rss = max_rss()
+    start = time.time()
+    if pBand is None:
+        hic_ma = hm.hiCMatrix(pMatrixFile)
+    else:
+        hic_ma = load_banded_matrix(pMatrixFile, pBand, pChunkSize=pChunkSize)
+    pQueue.put((time.time() - start, max_rss() - start_rss, hic_ma.matrix.nnz))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bins', type=int, default=200000)
+    parser.add_argument('--pixels', type=int, default=50000000)
+    parser.add_argument('--binSize', type=int, default=10000)
+    parser.add_argument('--bands', type=int, nargs='+', default=[2000000, 5000000],
+                        help='Maximal distances in bp of the banded loads.')
+    parser.add_argument('--chunkSize', type=int, default=2**22,
+                        help='Number of pixels read at once by the banded load.')
+    parser.add_argument('--directory', help='Directory for the matrix files.')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    directory = args.directory if args.directory else tempfile.mkdtemp()
+    try:
+        queue = context.Queue()
+        process = context.Process(target=write_matrices,
+                                  args=(queue, directory, args.bins, args.pixels, args.binSize))
+        process.start()
+        matrix_files = queue.get()
+        process.join()
+        for matrix_file in matrix_files:
+            for band in [None] + args.bands:
+                queue = context.Queue()
+                process = context.Process(target=run, args=(queue, matrix_file, band, args.chunkSize))
+                process.start()
+                elapsed, peak, nnz = queue.get()
+                process.join()
+                print("{:<12} {:<22} time {:>7.2f} s  peak RSS on top of start {:>8.1f} MB  pixels {}".format(
+                    os.path.basename(matrix_file), 'whole matrix' if band is None else 'band of {} bp'.format(band),
+                    elapsed, peak / 2**20, nnz))
+    finally:
+        if not args.directory:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
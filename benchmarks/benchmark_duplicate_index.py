@@ -0,0 +1,83 @@
+"""
+Compares the duplicate indices of hicBuildMatrix on synthetic read pairs.
+
+    $ python benchmarks/benchmark_duplicate_index.py --pairs 5000000
+
+For each index the run time and the peak memory (measured with tracemalloc)
+is reported. The pairs are drawn from the human chromosome sizes, a fraction
+of them is repeated to simulate PCR duplicates.
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+
+from hicexplorer.hicBuildMatrix import ReadPositionMatrix, ReadPositionIndex, ReadPositionIndexPartitioned
+
+HG38_SIZES = [248956422, 242193529, 198295559, 190214555, 181538259, 170805979, 159345973, 145138636,
+              138394717, 133797422, 135086622, 133275309, 114364328, 107043718, 101991189, 90338345,
+              83257441, 80373285, 58617616, 64444167, 46709983, 50818468, 156040895, 57227415]
+
+
+def synthetic_pairs(pNumberOfPairs, pDuplicateFraction, pSeed=0):
+    random = np.random.RandomState(pSeed)
+    sizes = np.array(HG38_SIZES)
+    probability = sizes / sizes.sum()
+    ref_id1 = random.choice(len(sizes), pNumberOfPairs, p=probability)
+    # most pairs are intra chromosomal
+    ref_id2 = np.where(random.rand(pNumberOfPairs) < 0.8, ref_id1, random.choice(len(sizes), pNumberOfPairs, p=probability))
+    start1 = (random.rand(pNumberOfPairs) * sizes[ref_id1]).astype(np.int64)
+    start2 = (random.rand(pNumberOfPairs) * sizes[ref_id2]).astype(np.int64)
+    duplicates = np.flatnonzero(random.rand(pNumberOfPairs) < pDuplicateFraction)
+    source = random.randint(0, pNumberOfPairs, len(duplicates))
+    ref_id1[duplicates], ref_id2[duplicates] = ref_id1[source], ref_id2[source]
+    start1[duplicates], start2[duplicates] = start1[source], start2[source]
+    return ref_id1, start1, ref_id2, start2
+
+
+def run_set(pPairs, pBufferSize):
+    index = ReadPositionMatrix()
+    names = [str(i) for i in range(len(HG38_SIZES))]
+    duplicated = 0
+    for chrom1, start1, chrom2, start2 in zip(*[array.tolist() for array in pPairs]):
+        duplicated += index.is_duplicated(names[chrom1], start1, names[chrom2], start2)
+    return index, duplicated
+
+
+def run_index(pIndex, pPairs, pBufferSize):
+    duplicated = 0
+    for i in range(0, len(pPairs[0]), pBufferSize):
+        duplicated += int(pIndex.are_duplicated(*[array[i:i + pBufferSize] for array in pPairs]).sum())
+    return pIndex, duplicated
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pairs', type=int, default=2000000)
+    parser.add_argument('--duplicateFraction', type=float, default=0.1)
+    parser.add_argument('--bufferSize', type=int, default=400000)
+    args = parser.parse_args()
+
+    pairs = synthetic_pairs(args.pairs, args.duplicateFraction)
+    backends = [('set', lambda: run_set(pairs, args.bufferSize)),
+                ('hashed', lambda: run_index(ReadPositionIndex(), pairs, args.bufferSize)),
+                ('partitioned', lambda: run_index(ReadPositionIndexPartitioned(), pairs, args.bufferSize))]
+
+    print("index\tseconds\tpairs/s\tduplicates\tpeak MB\tbytes/pair")
+    for name, function in backends:
+        tracemalloc.start()
+        start = time.time()
+        index, duplicated = function()
+        elapsed = time.time() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("{}\t{:.2f}\t{:.0f}\t{}\t{:.1f}\t{:.1f}".format(name, elapsed, args.pairs / elapsed, duplicated,
+                                                              peak / 1024 ** 2, peak / args.pairs))
+        if hasattr(index, 'close'):
+            index.close()
+        del index
+
+
+if __name__ == "__main__":
+    main()
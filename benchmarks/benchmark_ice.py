@@ -0,0 +1,107 @@
+"""
+Compares the iterative correction of iterativeCorrection with the upper triangle
+engine iterativeCorrectionUpperTriangle on a synthetic symmetric matrix at 1 kb
+resolution of the human genome (~3.1M bins).
+
+    $ python benchmarks/benchmark_ice.py --pixels 200000000 --iterations 20 --threads 1 4
+
+The matrix has --pixels non zero values in the upper triangle, 80% of them
+intra chromosomal with a distance decay of ~1/s. Each engine runs in its own
+process, once with one iteration and once with exactly --iterations iterations.
+Reported are the time per iteration, computed from the difference of both runs,
+the time of everything else (symmetry check, conversions, corrected matrix), the
+peak resident memory of the process and the peak memory on top of the memory of
+the input matrix. The correction factors of all engines are compared with the
+ones of the first engine.
+"""
+import argparse
+import resource
+import time
+from multiprocessing import Process, Queue
+
+import numpy as np
+from scipy.sparse import coo_matrix, dia_matrix
+
+from hicexplorer.iterativeCorrection import iterativeCorrection, iterativeCorrectionUpperTriangle
+
+HG38_SIZES = [248956422, 242193529, 198295559, 190214555, 181538259, 170805979, 159345973, 145138636,
+              138394717, 133797422, 135086622, 133275309, 114364328, 107043718, 101991189, 90338345,
+              83257441, 80373285, 58617616, 64444167, 46709983, 50818468, 156040895, 57227415]
+
+
+def synthetic_matrix(pNumberOfPixels, pBinSize, pSeed=0):
+    """Symmetric csr matrix with about pNumberOfPixels values in the upper triangle."""
+    random = np.random.RandomState(pSeed)
+    bins_per_chrom = np.array(HG38_SIZES) // pBinSize + 1
+    chrom_offset = np.concatenate([[0], np.cumsum(bins_per_chrom)])
+    number_of_bins = chrom_offset[-1]
+    chrom = random.choice(len(bins_per_chrom), pNumberOfPixels, p=bins_per_chrom / bins_per_chrom.sum())
+    bin1 = chrom_offset[chrom] + (random.rand(pNumberOfPixels) * bins_per_chrom[chrom]).astype(np.int64)
+    distance = np.exp(random.rand(pNumberOfPixels) * np.log(bins_per_chrom[chrom])).astype(np.int64) - 1
+    bin2 = np.minimum(bin1 + distance, chrom_offset[chrom + 1] - 1)
+    inter = random.rand(pNumberOfPixels) < 0.2
+    bin2[inter] = random.randint(0, number_of_bins, inter.sum())
+    chrom = distance = inter = None
+    row, col = np.minimum(bin1, bin2), np.maximum(bin1, bin2)
+    bin1 = bin2 = None
+    # all bins get some counts on the diagonal, ICE needs no filtering of empty bins
+    row = np.concatenate([row, np.arange(number_of_bins)])
+    col = np.concatenate([col, np.arange(number_of_bins)])
+    data = random.poisson(5, len(row)).astype(np.float64) + 1
+    upper = coo_matrix((data, (row, col)), shape=(number_of_bins, number_of_bins)).tocsr()
+    row = col = data = None
+    dia = dia_matrix(([upper.diagonal()], [0]), shape=upper.shape)
+    return (upper + upper.T - dia).tocsr()
+
+
+def max_rss():
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run(pQueue, pEngine, pThreads, pDtype, pNumberOfPixels, pBinSize, pIterations):
+    matrix = synthetic_matrix(pNumberOfPixels, pBinSize)
+    input_rss = max_rss()
+    elapsed = []
+    for iterations in [1, pIterations]:
+        start = time.time()
+        if pEngine == 'iterativeCorrection':
+            _, bias = iterativeCorrection(matrix, M=iterations, tolerance=0)
+        else:
+            _, bias = iterativeCorrectionUpperTriangle(matrix, M=iterations, tolerance=0,
+                                                       threads=pThreads, dtype=pDtype)
+        elapsed.append(time.time() - start)
+    per_iteration = (elapsed[1] - elapsed[0]) / (pIterations - 1)
+    pQueue.put((per_iteration, elapsed[0] - per_iteration, input_rss, max_rss(), matrix.shape[0], matrix.nnz, bias))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pixels', type=int, default=200000000)
+    parser.add_argument('--binSize', type=int, default=1000)
+    parser.add_argument('--iterations', type=int, default=20, help='At least 2.')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--skipOriginal', action='store_true',
+                        help='Do not run iterativeCorrection, e.g. if its memory is not available.')
+    args = parser.parse_args()
+
+    runs = [] if args.skipOriginal else [('iterativeCorrection', 1, np.float64)]
+    runs += [('upper triangle', threads, dtype) for dtype in [np.float64, np.float32] for threads in args.threads]
+    reference_bias = None
+    for engine, threads, dtype in runs:
+        queue = Queue()
+        process = Process(target=run, args=(queue, engine, threads, dtype, args.pixels, args.binSize, args.iterations))
+        process.start()
+        per_iteration, setup, input_rss, peak_rss, size, nnz, bias = queue.get()
+        process.join()
+        if reference_bias is None:
+            reference_bias = bias
+        print("{:<20} {:<8} threads {:>2}  bins {}  nnz {}  time per iteration {:>7.2f} s  other {:>7.2f} s  peak RSS {:>8.1f} MB  "
+              "on top of input {:>8.1f} MB  max bias difference {:.2e}".format(engine, np.dtype(dtype).name, threads, size, nnz,
+                                                                               per_iteration, setup, peak_rss / 2**20,
+                                                                               (peak_rss - input_rss) / 2**20,
+                                                                               np.max(np.abs(bias - reference_bias) / reference_bias)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+Compares the observed/expected transforms of hicexplorer.utilities with the
+per pixel python loops they replaced, on a synthetic symmetric chromosome
+matrix with a distance decay of ~1/s.
+
+    $ python benchmarks/benchmark_obs_exp.py --bins 50000 --pixels 20000000 --loopPixels 1000000
+
+The loops are only run on the submatrix of the first bins with about
+--loopPixels values, they become too slow for larger matrices. For each
+transform the run time and the maximal difference of the results is reported,
+followed by the run time of the expected contacts per distance of
+hicexplorer.lib.expected, with 1% of the bins masked, and of the pearson and
+covariance matrices of a submatrix of --denseBins bins compared to
+numpy on the dense matrix, together with the peak memory of both, measured with
+tracemalloc.
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+from scipy.sparse import coo_matrix
+
+from hicmatrix import HiCMatrix as hm
+
+from hicexplorer import utilities
+from hicexplorer.lib.expected import ExpectedContacts, prepare_matrix
+
+
+def synthetic_matrix(pNumberOfBins, pNumberOfPixels, pSeed=0):
+    """Symmetric csr matrix with about pNumberOfPixels values in the upper triangle."""
+    random = np.random.RandomState(pSeed)
+    bin1 = random.randint(0, pNumberOfBins, pNumberOfPixels)
+    distance = np.exp(random.rand(pNumberOfPixels) * np.log(pNumberOfBins)).astype(np.int64) - 1
+    bin2 = np.minimum(bin1 + distance, pNumberOfBins - 1)
+    data = random.poisson(5, pNumberOfPixels).astype(np.float64) + 1
+    upper = coo_matrix((data, (bin1, bin2)), shape=(pNumberOfBins, pNumberOfBins)).tocsr()
+    lower = upper.T.tocsr()
+    lower.setdiag(0)
+    lower.eliminate_zeros()
+    return (upper + lower).tocsr()
+
+
+def expected_interactions_loop(pSubmatrix, pNonZero):
+    expected_interactions = np.zeros(pSubmatrix.shape[0])
+    occurences = np.zeros(pSubmatrix.shape[0])
+    row, col = pSubmatrix.nonzero()
+    distance = np.absolute(row - col)
+    for i, distance_ in enumerate(distance):
+        expected_interactions[distance_] += pSubmatrix.data[i]
+        occurences[distance_] += 1
+    if not pNonZero:
+        occurences = np.arange(pSubmatrix.shape[0] + 1, 1, -1)
+    expected_interactions /= occurences
+    expected_interactions[~np.isfinite(expected_interactions)] = 0
+    return expected_interactions
+
+
+def obs_exp_matrix_loop(pSubmatrix):
+    expected_interactions_in_distance_ = expected_interactions_loop(pSubmatrix, False)
+    row, col = pSubmatrix.nonzero()
+    distance = np.ceil(np.absolute(row - col) / 2).astype(np.int32)
+    pSubmatrix.data = pSubmatrix.data.astype(np.float32)
+    pSubmatrix.data /= expected_interactions_in_distance_[distance]
+    return pSubmatrix
+
+
+def obs_exp_matrix_norm_loop(pSubmatrix):
+    expected_interactions_in_distance = expected_interactions_loop(pSubmatrix, True)
+    row_sums = np.array(pSubmatrix.sum(axis=1).T).flatten()
+    total_interactions = pSubmatrix.sum()
+    row, col = pSubmatrix.nonzero()
+    pSubmatrix.data = pSubmatrix.data.astype(np.float32)
+    for i in range(len(row)):
+        expected = expected_interactions_in_distance[np.absolute(row[i] - col[i])]
+        expected *= row_sums[row[i]] * row_sums[col[i]] / total_interactions
+        pSubmatrix.data[i] /= expected
+    pSubmatrix.data[~np.isfinite(pSubmatrix.data)] = 0
+    pSubmatrix.eliminate_zeros()
+    return pSubmatrix
+
+
+def expected_contacts(pMatrix, pBinSize=10000):
+    """ExpectedContacts of the matrix as one chromosome, after masking every 100th bin."""
+    hic_ma = hm.hiCMatrix()
+    hic_ma.setMatrix(pMatrix, [('chr1', start, start + pBinSize, 1)
+                               for start in range(0, pMatrix.shape[0] * pBinSize, pBinSize)])
+    hic_ma.maskBins(np.arange(0, pMatrix.shape[0], 100))
+    prepare_matrix(hic_ma)
+    return ExpectedContacts.from_matrix(hic_ma)
+
+
+def timed(pFunction, *pArgs):
+    start = time.time()
+    result = pFunction(*pArgs)
+    return time.time() - start, result
+
+
+def traced(pFunction, *pArgs):
+    tracemalloc.start()
+    elapsed, result = timed(pFunction, *pArgs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bins', type=int, default=50000)
+    parser.add_argument('--pixels', type=int, default=20000000)
+    parser.add_argument('--loopPixels', type=int, default=1000000)
+    parser.add_argument('--denseBins', type=int, default=5000,
+                        help='Size of the submatrix for the pearson and covariance matrices.')
+    args = parser.parse_args()
+
+    matrix = synthetic_matrix(args.bins, args.pixels)
+    loop_bins = int(np.searchsorted(matrix.indptr, args.loopPixels))
+    submatrix = matrix[:loop_bins, :loop_bins]
+    print("matrix: bins {} nnz {}, submatrix for the loops: bins {} nnz {}".format(matrix.shape[0], matrix.nnz,
+                                                                                   submatrix.shape[0], submatrix.nnz))
+
+    for name, vectorised, loop in [('obs_exp', utilities.obs_exp_matrix, obs_exp_matrix_loop),
+                                   ('obs_exp_norm', utilities.obs_exp_matrix_norm, obs_exp_matrix_norm_loop)]:
+        loop_time, loop_result = timed(loop, submatrix.copy())
+        sub_time, sub_result = timed(vectorised, submatrix.copy())
+        full_time, _ = timed(vectorised, matrix.copy())
+        print("{:<14} loop {:>8.2f} s  vectorised {:>8.3f} s  speedup {:>8.1f}x  whole matrix {:>8.2f} s  "
+              "max difference {:.2e}".format(name, loop_time, sub_time, loop_time / max(sub_time, 1e-9), full_time,
+                                             abs(loop_result - sub_result).max()))
+
+    expected_time, _ = timed(expected_contacts, matrix.copy())
+    print("{:<14} whole matrix with 1% masked bins {:>8.2f} s".format('expected', expected_time))
+
+    dense_bins = min(args.denseBins, matrix.shape[0])
+    dense_submatrix = matrix[:dense_bins, :dense_bins]
+    for name, vectorised, dense in [('pearson', utilities.pearson_matrix, np.corrcoef),
+                                    ('covariance', utilities.covariance_matrix, np.cov)]:
+        dense_time, dense_peak, dense_result = traced(lambda pMatrix: dense(pMatrix.todense()), dense_submatrix)
+        sparse_time, sparse_peak, sparse_result = traced(vectorised, dense_submatrix)
+        print("{:<14} numpy on dense {:>8.2f} s {:>8.1f} MB  utilities {:>8.2f} s {:>8.1f} MB  max difference {:.2e}".format(
+            name, dense_time, dense_peak / 2**20, sparse_time, sparse_peak / 2**20,
+            np.abs(np.asarray(dense_result) - sparse_result).max()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Compares the accumulation of the hicBuildMatrix buffers with repeated
+coo_matrix additions and with the SparseMatrixAccumulator on a synthetic
+stream of pairs at 1 kb resolution of the human genome (~3.1M bins).
+
+    $ python benchmarks/benchmark_sparse_accumulator.py --pairs 500000000 --cooPairs 20000000
+
+The stream is created in buffers of --bufferSize pairs, like the results of the
+hicBuildMatrix workers. The coo_matrix additions are only run on the first
+--cooPairs pairs, they become too slow for larger numbers. For each method the
+run time, the peak memory (measured with tracemalloc) and the number of distinct
+pixels is reported.
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+from scipy.sparse import coo_matrix
+
+from hicexplorer.lib.accumulator import SparseMatrixAccumulator
+
+HG38_SIZES = [248956422, 242193529, 198295559, 190214555, 181538259, 170805979, 159345973, 145138636,
+              138394717, 133797422, 135086622, 133275309, 114364328, 107043718, 101991189, 90338345,
+              83257441, 80373285, 58617616, 64444167, 46709983, 50818468, 156040895, 57227415]
+
+
+def synthetic_buffers(pNumberOfPairs, pBufferSize, pBinSize, pSeed=0):
+    """Yields (row, col, data) buffers. 80% of the pairs are intra chromosomal with a
+    distance decay of ~1/s, the other pairs are uniformly distributed."""
+    random = np.random.RandomState(pSeed)
+    bins_per_chrom = np.array(HG38_SIZES) // pBinSize + 1
+    chrom_offset = np.concatenate([[0], np.cumsum(bins_per_chrom)])
+    number_of_bins = chrom_offset[-1]
+    probability = bins_per_chrom / bins_per_chrom.sum()
+    for start in range(0, pNumberOfPairs, pBufferSize):
+        length = min(pBufferSize, pNumberOfPairs - start)
+        chrom = random.choice(len(bins_per_chrom), length, p=probability)
+        bin1 = chrom_offset[chrom] + (random.rand(length) * bins_per_chrom[chrom]).astype(np.int64)
+        distance = np.exp(random.rand(length) * np.log(bins_per_chrom[chrom])).astype(np.int64) - 1
+        bin2 = np.minimum(bin1 + distance, chrom_offset[chrom + 1] - 1)
+        inter = random.rand(length) < 0.2
+        bin2[inter] = random.randint(0, number_of_bins, inter.sum())
+        yield bin1.astype(np.uint32), bin2.astype(np.uint32), np.ones(length, dtype=np.uint16), number_of_bins
+
+
+def run_coo(pNumberOfPairs, pBufferSize, pBinSize):
+    hic_matrix = None
+    for row, col, data, number_of_bins in synthetic_buffers(pNumberOfPairs, pBufferSize, pBinSize):
+        if hic_matrix is None:
+            hic_matrix = coo_matrix((number_of_bins, number_of_bins), dtype='uint32')
+        hic_matrix += coo_matrix((data, (row, col)), shape=(number_of_bins, number_of_bins))
+    return hic_matrix.tocsr()
+
+
+def run_accumulator(pNumberOfPairs, pBufferSize, pBinSize):
+    accumulator = None
+    for row, col, data, number_of_bins in synthetic_buffers(pNumberOfPairs, pBufferSize, pBinSize):
+        if accumulator is None:
+            accumulator = SparseMatrixAccumulator((number_of_bins, number_of_bins), pDtype=np.uint32)
+        accumulator.add(row, col, data)
+    return accumulator.tocsr()
+
+
+def measure(pName, pFunction, *pArgs):
+    tracemalloc.start()
+    start = time.time()
+    matrix = pFunction(*pArgs)
+    elapsed = time.time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("{:<12} pairs {:>11}  time {:>9.1f} s  peak memory {:>9.1f} MB  pixels {:>11}  sum {}".format(
+        pName, pArgs[0], elapsed, peak / 2**20, matrix.nnz, matrix.sum()))
+    return matrix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pairs', type=int, default=500000000)
+    parser.add_argument('--cooPairs', type=int, default=20000000)
+    parser.add_argument('--bufferSize', type=int, default=400000)
+    parser.add_argument('--binSize', type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.cooPairs > 0:
+        coo = measure('coo_matrix', run_coo, args.cooPairs, args.bufferSize, args.binSize)
+        accumulated = measure('accumulator', run_accumulator, args.cooPairs, args.bufferSize, args.binSize)
+        assert (coo != accumulated).nnz == 0
+        coo = accumulated = None
+    measure('accumulator', run_accumulator, args.pairs, args.bufferSize, args.binSize)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,10 +9,11 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 import matplotlib.cm as cm
-from hicmatrix import HiCMatrix as hm
 import hicexplorer.utilities
 from .utilities import toString
 from .utilities import check_chrom_str_bytes
+from hicexplorer.lib.expected import convert_to_obs_exp_matrix
+from hicexplorer.lib.bandedMatrix import load_banded_matrix
 from hicexplorer._version import __version__
 
 import logging
@@ -496,7 +497,14 @@ def plot_diagnostic_heatmaps(chrom_diagonals, cluster_ids, M_half, args):
 def main(args=None):
     args = parse_arguments().parse_args(args)
 
-    ma = hm.hiCMatrix(args.matrix)
+    # only the pixels within the band of the z-score / obs/exp matrix or, without a
+    # transformation, of the submatrices around the contacts up to the maximal range are
+    # needed. The distances are counted without the nan bins, which are masked
+    max_range = int(args.range.split(":")[1])
+    if args.transform in ['z-score', 'obs/exp']:
+        ma = load_banded_matrix(args.matrix, max_range * 2.5 * 1.5, pSkipNanBins=True)
+    else:
+        ma = load_banded_matrix(args.matrix, max_range, pSkipNanBins=True, pExtraBins=args.numberOfBins + 1)
     ma.maskBins(ma.nan_bins)
     ma.matrix.data[np.isnan(ma.matrix.data)] = 0
 
@@ -519,11 +527,11 @@ def main(args=None):
     if args.transform == "z-score":
         # use zscore matrix
         log.info("Computing z-score matrix. This may take a while.\n")
-        ma.convert_to_zscore_matrix(maxdepth=max_dist * 2.5, perchr=True)
+        convert_to_obs_exp_matrix(ma, pMaxDepth=max_dist * 2.5, pZscore=True, pPerChromosome=True)
     elif args.transform == "obs/exp":
         # use zscore matrix
         log.info("Computing observed vs. expected matrix. This may take a while.\n")
-        ma.convert_to_obs_exp_matrix(maxdepth=max_dist * 2.5, perchr=True)
+        convert_to_obs_exp_matrix(ma, pMaxDepth=max_dist * 2.5, pPerChromosome=True)
 
     min_dist_in_bins = int(min_dist) // bin_size
     max_dist_in_bins = int(max_dist) // bin_size
@@ -0,0 +1,232 @@
+import argparse
+import numpy as np
+from scipy.sparse import dia_matrix
+from multiprocessing import Pool
+import time
+import warnings
+warnings.simplefilter(action="ignore", category=RuntimeWarning)
+warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
+
+from hicmatrix import HiCMatrix as hm
+from hicmatrix.lib import MatrixFileHandler
+
+from hicexplorer.hicBuildMatrix import get_bins, bed2interval_list, get_rf_bins, enlarge_bins, BinLookup
+from hicexplorer.lib.pairs import PairsReader
+from hicexplorer.lib.accumulator import SparseMatrixAccumulator
+from hicexplorer._version import __version__
+
+import logging
+log = logging.getLogger(__name__)
+
+# bin layouts of the worker processes, set by the initializer of the pool
+layouts_of_worker = None
+
+
+def parse_arguments(args=None):
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        add_help=False,
+        description=('Creates Hi-C matrices from the valid pairs file of hicBuildMatrix (--outPairs). '
+                     'The pairs are read in chunks and binned in parallel, the bam files are not needed. '
+                     'Multiple bin sizes can be created in one pass and stored in a mcool file.'))
+
+    parserRequired = parser.add_argument_group('Required arguments')
+
+    parserRequired.add_argument('--pairs', '-p',
+                                help='Valid pairs file created by hicBuildMatrix --outPairs.',
+                                metavar='FILENAME.h5',
+                                required=True)
+
+    parserRequired.add_argument('--outFileName', '-o',
+                                help='Output file name for the Hi-C matrix. For multiple bin sizes use the .cool or .mcool file ending.',
+                                metavar='FILENAME',
+                                required=True)
+
+    group = parserRequired.add_mutually_exclusive_group(required=True)
+
+    group.add_argument('--binSize', '-bs',
+                       help='Size in bp for the bins. Multiple bin sizes can be given, all resolutions '
+                       'are stored in one mcool file.',
+                       type=int,
+                       nargs='+')
+
+    group.add_argument('--restrictionCutFile', '-rs',
+                       help='BED file with all restriction cut places (output of "findRestSite" command). '
+                       'The bins are set to match the restriction fragments like in hicBuildMatrix.',
+                       type=argparse.FileType('r'),
+                       metavar='BED file')
+
+    parserOpt = parser.add_argument_group('Optional arguments')
+
+    parserOpt.add_argument('--minDistance',
+                           help='Minimum distance between restriction sites. Restriction sites that are closer '
+                           'than this distance are merged into one. Only used with --restrictionCutFile.',
+                           type=int,
+                           default=300)
+
+    parserOpt.add_argument('--maxLibraryInsertSize',
+                           help='Maximum distance of a mate to the next restriction site. Only used with --restrictionCutFile.',
+                           type=int,
+                           default=1000)
+
+    parserOpt.add_argument('--minMappingQuality',
+                           help='Only pairs with a mapping quality of at least this value for both mates are used. '
+                           'The pairs file only contains pairs which passed the filter of hicBuildMatrix, a lower value '
+                           'has no effect.',
+                           type=int,
+                           default=0)
+
+    parserOpt.add_argument('--chromosomes',
+                           help='Only use pairs where both mates are on one of these chromosomes. '
+                           'The matrix contains only bins of these chromosomes.',
+                           nargs='+')
+
+    parserOpt.add_argument('--position',
+                           help='Position of a mate used to assign it to a bin. \'middle\' is the middle of the '
+                           'aligned part of the read as used by hicBuildMatrix, \'fivePrime\' the 5\' end of the read.',
+                           choices=['middle', 'fivePrime'],
+                           default='middle')
+
+    parserOpt.add_argument('--chunkSize',
+                           help='Number of pairs each process reads and bins at once.',
+                           type=int,
+                           default=2000000)
+
+    parserOpt.add_argument('--threads', '-t',
+                           help='Number of processes used to bin the pairs.',
+                           type=int,
+                           default=4)
+
+    parserOpt.add_argument("--help", "-h", action="help",
+                           help="show this help message and exit")
+
+    parserOpt.add_argument('--version', action='version',
+                           version='%(prog)s {}'.format(__version__))
+
+    return parser
+
+
+class BinLayout():
+    """Bins of one resolution and the lookup to find the bin of a position."""
+
+    def __init__(self, pSearchBins, pCutIntervals, pChromNames):
+        self.cutIntervals = pCutIntervals
+        self.size = len(pCutIntervals)
+        self.lookup = BinLookup(pSearchBins, pChromNames)
+
+    def find_bins(self, pChrom, pPositions):
+        return self.lookup.find(pChrom, pPositions)
+
+
+def init_worker(pLayouts):
+    global layouts_of_worker
+    layouts_of_worker = pLayouts
+
+
+def bin_pairs_chunk(pArgs):
+    """Reads the pairs pStart to pEnd and returns for each layout the summed up
+    counts as (row, col, count) and the number of mates per bin."""
+    file_name, start, end, min_mapping_quality, chromosome_mask, position = pArgs
+    reader = PairsReader(file_name)
+    pairs = reader.read(start, end, ['chrom1', position + '1', 'mapq1', 'chrom2', position + '2', 'mapq2'])
+    reader.close()
+
+    mask = (pairs['mapq1'] >= min_mapping_quality) & (pairs['mapq2'] >= min_mapping_quality)
+    if chromosome_mask is not None:
+        mask &= chromosome_mask[pairs['chrom1']] & chromosome_mask[pairs['chrom2']]
+
+    results = []
+    for layout in layouts_of_worker:
+        bin1 = layout.find_bins(pairs['chrom1'][mask], pairs[position + '1'][mask])
+        bin2 = layout.find_bins(pairs['chrom2'][mask], pairs[position + '2'][mask])
+        assigned = (bin1 >= 0) & (bin2 >= 0)
+        bin1, bin2 = bin1[assigned], bin2[assigned]
+        keys, counts = np.unique(bin1 * layout.size + bin2, return_counts=True)
+        mates_per_bin = np.bincount(bin1, minlength=layout.size) + np.bincount(bin2, minlength=layout.size)
+        results.append((keys // layout.size, keys % layout.size, counts, mates_per_bin, int(np.sum(assigned))))
+    return results, end - start
+
+
+def get_layouts(pArgs, pChromSizes):
+    """Creates the bin layouts for all requested resolutions or for the restriction fragments."""
+    chrom_names = [chrom for chrom, _ in pChromSizes]
+    if pArgs.chromosomes:
+        pChromSizes = [(chrom, size) for chrom, size in pChromSizes if chrom in pArgs.chromosomes]
+    layouts = []
+    if pArgs.restrictionCutFile:
+        rf_interval = bed2interval_list(pArgs.restrictionCutFile)
+        if pArgs.chromosomes:
+            rf_interval = [interval for interval in rf_interval if interval[0] in pArgs.chromosomes]
+        search_bins = get_rf_bins(rf_interval, min_distance=pArgs.minDistance,
+                                  max_distance=pArgs.maxLibraryInsertSize)
+        layouts.append(BinLayout(search_bins, enlarge_bins(search_bins[:], pChromSizes), chrom_names))
+    else:
+        for bin_size in pArgs.binSize:
+            bins = get_bins(bin_size, pChromSizes)
+            layouts.append(BinLayout(bins, bins, chrom_names))
+    return layouts
+
+
+def main(args=None):
+
+    args = parse_arguments().parse_args(args)
+    reader = PairsReader(args.pairs)
+    chrom_sizes = reader.chromSizes
+    chunks = reader.chunks(args.chunkSize)
+    number_of_pairs = len(reader)
+    reader.close()
+
+    chromosome_mask = None
+    if args.chromosomes:
+        chromosome_mask = np.array([chrom in args.chromosomes for chrom, _ in chrom_sizes], dtype=bool)
+
+    layouts = get_layouts(args, chrom_sizes)
+    position = 'middle' if args.position == 'middle' else 'pos'
+    tasks = [(args.pairs, start, end, args.minMappingQuality, chromosome_mask, position) for start, end in chunks]
+
+    accumulators = [SparseMatrixAccumulator((layout.size, layout.size), pDtype=np.int64) for layout in layouts]
+    mates_per_bin = [np.zeros(layout.size, dtype=np.int64) for layout in layouts]
+    pairs_used = 0
+    pairs_read = 0
+    start_time = time.time()
+    pool = Pool(processes=max(1, args.threads), initializer=init_worker, initargs=(layouts,))
+    for results, length in pool.imap_unordered(bin_pairs_chunk, tasks):
+        for i, (row, col, counts, mates, assigned) in enumerate(results):
+            accumulators[i].add(row, col, counts)
+            mates_per_bin[i] += mates
+        pairs_used += results[0][4]
+        pairs_read += length
+        elapsed_time = time.time() - start_time
+        log.info("{} of {} pairs binned ({:.1f} pairs per second)\n".format(pairs_read, number_of_pairs,
+                                                                            pairs_read / max(elapsed_time, 1e-9)))
+    pool.close()
+    pool.join()
+    log.info("{} pairs of {} used\n".format(pairs_used, number_of_pairs))
+
+    hic_metadata = {'matrix-generated-by': np.string_('HiCExplorer-' + __version__),
+                    'matrix-generated-by-url': np.string_('https://github.com/deeptools/HiCExplorer')}
+
+    for i, layout in enumerate(layouts):
+        # symmetric matrix as in hicBuildMatrix
+        hic_matrix = accumulators[i].tocsr()
+        dia = dia_matrix(([hic_matrix.diagonal()], [0]), shape=hic_matrix.shape)
+        hic_matrix = (hic_matrix + hic_matrix.T - dia).tocsr()
+        # the coverage column stores the number of mates per bin
+        coverage = np.where(mates_per_bin[i] > 0, mates_per_bin[i], np.nan)
+        cut_intervals = [(chrom, start, end, value) for (chrom, start, end), value
+                         in zip([interval[:3] for interval in layout.cutIntervals], coverage.tolist())]
+        hic_ma = hm.hiCMatrix()
+        hic_ma.setMatrix(hic_matrix, cut_intervals=cut_intervals)
+
+        if len(layouts) > 1:
+            matrixFileHandlerOutput = MatrixFileHandler(pFileType='cool', pAppend=i > 0, pHiCInfo=hic_metadata)
+            matrixFileHandlerOutput.set_matrix_variables(hic_ma.matrix,
+                                                         hic_ma.cut_intervals,
+                                                         hic_ma.nan_bins,
+                                                         hic_ma.correction_factors,
+                                                         hic_ma.distance_counts)
+            matrixFileHandlerOutput.save(args.outFileName + '::/resolutions/' + str(args.binSize[i]),
+                                         pSymmetric=True, pApplyCorrection=False)
+        else:
+            hic_ma.save(args.outFileName, pHiCInfo=hic_metadata)
@@ -1,10 +1,14 @@
 import argparse
+import json
 import numpy as np
-from scipy.sparse import coo_matrix, dia_matrix
+from scipy.sparse import dia_matrix, triu
 import time
 from os import unlink
 import os
+import sys
+import shutil
 from io import StringIO
+from tempfile import mkdtemp
 import warnings
 warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
@@ -12,10 +16,10 @@ warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 import pysam
 from collections import OrderedDict
 
-from copy import deepcopy
 from ctypes import Structure, c_uint, c_ushort
 from multiprocessing import Process, Queue
-from multiprocessing.sharedctypes import Array, RawArray
+from queue import Empty
+from multiprocessing.sharedctypes import RawArray
 
 from intervaltree import IntervalTree, Interval
 
@@ -31,15 +35,18 @@ import hicexplorer.hicPrepareQCreport as QC
 from hicmatrix.lib import MatrixFileHandler
 
 from hicexplorer import hicMergeMatrixBins
+from hicexplorer.lib.pairs import PairsWriter
+from hicexplorer.lib.accumulator import SparseMatrixAccumulator
+from hicexplorer.lib.checkpoint import Checkpoint
 import logging
 log = logging.getLogger(__name__)
 
 
-class C_Interval(Structure):
-    """Struct to map a Interval form intervaltree as a multiprocessing.sharedctype"""
-    _fields_ = [("begin", c_uint),
-                ("end", c_uint),
-                ("data", c_uint)]
+# QC counters of main which are stored in a checkpoint
+CHECKPOINT_COUNTERS = ['iter_num', 'one_mate_unmapped', 'one_mate_low_quality', 'one_mate_not_unique', 'dangling_end',
+                       'self_circle', 'self_ligation', 'same_fragment', 'mate_not_close_to_rf', 'duplicated_pairs',
+                       'count_inward', 'count_outward', 'count_left', 'count_right', 'inter_chromosomal', 'short_range',
+                       'long_range', 'pair_added', 'count_output', 'count_call_of_read_input', 'computed_pairs']
 
 
 class C_Coverage(Structure):
@@ -83,6 +90,358 @@ class ReadPositionMatrix(object):
             self.pos_matrix.add(id_string)
             return False
 
+    def memory_usage(self):
+        """Rough estimate of the memory used by the set in bytes."""
+        if len(self.pos_matrix) == 0:
+            return 0
+        return len(self.pos_matrix) * (sys.getsizeof(next(iter(self.pos_matrix))) + 3 * 8)
+
+    def save_state(self, pDirectory):
+        np.save(os.path.join(pDirectory, 'duplicates.npy'), np.array(list(self.pos_matrix), dtype='S'))
+        return {}
+
+    def restore_state(self, pDirectory, pState):
+        self.pos_matrix = set(np.load(os.path.join(pDirectory, 'duplicates.npy')).astype(str).tolist())
+
+    def log_summary(self):
+        log.info("duplicate index 'set': {} read pairs stored, approx. {:.1f} MB\n".format(len(self.pos_matrix),
+                                                                                           self.memory_usage() / 1024 ** 2))
+
+
+class OpenAddressingTable(object):
+    """Array backed hash set with open addressing and linear probing.
+
+       Each key consists of pNumberOfWords unsigned 64 bit integers which are
+       stored column wise in numpy arrays. Keys are inserted in batches, a
+       batch of keys must not contain the same key twice.
+       If pFilePrefix is given, the arrays are numpy memory maps on disk.
+    """
+
+    EMPTY = np.uint64(np.iinfo(np.uint64).max)
+
+    def __init__(self, pNumberOfWords, pCapacity=2**16, pMaxLoadFactor=0.6, pFilePrefix=None):
+        """
+        >>> table = OpenAddressingTable(1, pCapacity=4)
+        >>> table.insert([np.array([3, 5, 7], dtype=np.uint64)]).tolist()
+        [False, False, False]
+        >>> table.insert([np.array([5, 8], dtype=np.uint64)]).tolist()
+        [True, False]
+        >>> len(table), table.capacity
+        (4, 16)
+        """
+        self.numberOfWords = pNumberOfWords
+        self.maxLoadFactor = pMaxLoadFactor
+        self.filePrefix = pFilePrefix
+        self.fileCounter = 0
+        self.size = 0
+        self.peakBytes = 0
+        self.capacity = 1 << int(np.ceil(np.log2(max(pCapacity, 2))))
+        self.keys = self._allocate(self.capacity)
+
+    def __len__(self):
+        return self.size
+
+    def nbytes(self):
+        return self.capacity * self.numberOfWords * 8
+
+    def _allocate(self, pCapacity):
+        keys = []
+        for i in range(self.numberOfWords):
+            if self.filePrefix is not None:
+                file_name = "{}_{}_{}.npy".format(self.filePrefix, self.fileCounter, i)
+                array = np.lib.format.open_memmap(file_name, mode='w+', dtype=np.uint64, shape=(pCapacity,))
+            else:
+                array = np.empty(pCapacity, dtype=np.uint64)
+            array.fill(self.EMPTY)
+            keys.append(array)
+        self.fileCounter += 1
+        return keys
+
+    def _release(self, pKeys):
+        for array in pKeys:
+            if isinstance(array, np.memmap):
+                file_name = array.filename
+                del array
+                unlink(file_name)
+
+    def _hash(self, pKeys):
+        # splitmix64 finalizer applied to the xor-combined words
+        hash_value = pKeys[0].copy()
+        for word in pKeys[1:]:
+            hash_value ^= word * np.uint64(0x9E3779B97F4A7C15)
+        hash_value ^= hash_value >> np.uint64(30)
+        hash_value *= np.uint64(0xBF58476D1CE4E5B9)
+        hash_value ^= hash_value >> np.uint64(27)
+        hash_value *= np.uint64(0x94D049BB133111EB)
+        hash_value ^= hash_value >> np.uint64(31)
+        return hash_value
+
+    def _grow(self, pNumberOfNewKeys):
+        new_capacity = self.capacity
+        while self.size + pNumberOfNewKeys > new_capacity * self.maxLoadFactor:
+            new_capacity *= 2
+        if new_capacity == self.capacity:
+            return
+        old_keys = self.keys
+        occupied = old_keys[0] != self.EMPTY
+        stored_keys = [array[occupied] for array in old_keys]
+        self.capacity = new_capacity
+        self.keys = self._allocate(self.capacity)
+        self.peakBytes = max(self.peakBytes, self.nbytes() + len(old_keys) * len(old_keys[0]) * 8)
+        self._release(old_keys)
+        self.size = 0
+        self._insert(stored_keys)
+
+    def _insert(self, pKeys):
+        mask = np.uint64(self.capacity - 1)
+        slots = (self._hash(pKeys) & mask).astype(np.int64)
+        found = np.zeros(len(pKeys[0]), dtype=bool)
+        pending = np.arange(len(pKeys[0]))
+        while len(pending):
+            slot = slots[pending]
+            stored = [array[slot] for array in self.keys]
+            hit = np.ones(len(pending), dtype=bool)
+            for stored_word, key_word in zip(stored, pKeys):
+                hit &= stored_word == key_word[pending]
+            found[pending[hit]] = True
+            empty = stored[0] == self.EMPTY
+            candidates = pending[empty & ~hit]
+            # several keys can compete for the same empty slot, the first one wins
+            _, first = np.unique(slots[candidates], return_index=True)
+            winners = candidates[first]
+            for array, key_word in zip(self.keys, pKeys):
+                array[slots[winners]] = key_word[winners]
+            self.size += len(winners)
+
+            resolved = hit.copy()
+            resolved[np.searchsorted(pending, winners)] = True
+            # keys that hit an occupied slot probe the next one, keys that lost
+            # a race re-read their slot in the next round
+            occupied = ~resolved & ~empty
+            slots[pending[occupied]] = (slots[pending[occupied]] + 1) & int(mask)
+            pending = pending[~resolved]
+        return found
+
+    def insert(self, pKeys):
+        """Inserts the keys and returns a boolean array which is True for keys that were already stored."""
+        self._grow(len(pKeys[0]))
+        found = self._insert(pKeys)
+        self.peakBytes = max(self.peakBytes, self.nbytes())
+        return found
+
+    def save_state(self, pDirectory, pName):
+        """Writes the key arrays as numpy files to pDirectory."""
+        for i, array in enumerate(self.keys):
+            np.save(os.path.join(pDirectory, "{}_{}.npy".format(pName, i)), array)
+        return {'size': self.size, 'capacity': self.capacity, 'peakBytes': self.peakBytes}
+
+    def restore_state(self, pDirectory, pName, pState):
+        """Replaces the keys by the ones saved with save_state, memory mapped tables copy the files."""
+        self._release(self.keys)
+        self.keys = []
+        for i in range(self.numberOfWords):
+            file_name = os.path.join(pDirectory, "{}_{}.npy".format(pName, i))
+            if self.filePrefix is not None:
+                table_file_name = "{}_{}_{}.npy".format(self.filePrefix, self.fileCounter, i)
+                shutil.copyfile(file_name, table_file_name)
+                self.keys.append(np.load(table_file_name, mmap_mode='r+'))
+            else:
+                self.keys.append(np.load(file_name))
+        self.fileCounter += 1
+        self.size = pState['size']
+        self.capacity = pState['capacity']
+        self.peakBytes = pState['peakBytes']
+
+    def close(self):
+        self._release(self.keys)
+        self.keys = []
+
+
+class ReadPositionIndex(object):
+    """A class to check for PCR duplicates.
+       The reference ids and start positions of both mates are packed into
+       two 64 bit integers and stored in an array backed open addressing
+       hash table. Needs about 3-4 times less memory than the set of strings
+       of ReadPositionMatrix.
+    """
+
+    def __init__(self, pCapacity=2**20):
+        """
+        >>> rp = ReadPositionIndex()
+        >>> rp.is_duplicated(1, 0, 2, 0)
+        False
+        >>> rp.is_duplicated(2, 0, 1, 0)
+        True
+        >>> rp.are_duplicated(np.array([1, 1, 1]), np.array([5, 6, 5]),
+        ...                   np.array([2, 2, 2]), np.array([0, 0, 0])).tolist()
+        [False, False, True]
+        """
+        self.table = OpenAddressingTable(2, pCapacity=pCapacity)
+
+    def is_duplicated(self, chrom1, start1, chrom2, start2):
+        return bool(self.are_duplicated(np.array([chrom1]), np.array([start1]),
+                                        np.array([chrom2]), np.array([start2]))[0])
+
+    def _pack(self, pRefId1, pStart1, pRefId2, pStart2):
+        ref_id1 = np.asarray(pRefId1, dtype=np.uint64)
+        ref_id2 = np.asarray(pRefId2, dtype=np.uint64)
+        start1 = np.asarray(pStart1, dtype=np.uint64)
+        start2 = np.asarray(pStart2, dtype=np.uint64)
+        shift = np.uint64(32)
+        key_ref = (np.minimum(ref_id1, ref_id2) << shift) | np.maximum(ref_id1, ref_id2)
+        key_pos = (np.minimum(start1, start2) << shift) | np.maximum(start1, start2)
+        return key_ref, key_pos
+
+    def are_duplicated(self, pRefId1, pStart1, pRefId2, pStart2):
+        """Vectorised duplication check of a batch of read pairs.
+        Returns a boolean array, True if a pair was seen before (in a previous batch or
+        earlier in this batch). The first occurrence of a pair is never a duplicate."""
+        key_ref, key_pos = self._pack(pRefId1, pStart1, pRefId2, pStart2)
+        return self._are_duplicated(self.table, [key_ref, key_pos])
+
+    def _are_duplicated(self, pTable, pKeys):
+        duplicated = np.ones(len(pKeys[0]), dtype=bool)
+        if len(pKeys[0]) == 0:
+            return duplicated
+        # remove duplicates inside of the batch
+        if len(pKeys) == 1:
+            _, first = np.unique(pKeys[0], return_index=True)
+        else:
+            _, first = np.unique(np.column_stack(pKeys), axis=0, return_index=True)
+        duplicated[first] = pTable.insert([key[first] for key in pKeys])
+        return duplicated
+
+    def __len__(self):
+        return len(self.table)
+
+    def memory_usage(self):
+        return self.table.nbytes()
+
+    def log_summary(self):
+        log.info("duplicate index 'hashed': {} read pairs stored, {:.1f} MB, "
+                 "memory ceiling {:.1f} MB\n".format(len(self), self.memory_usage() / 1024 ** 2,
+                                                     self.table.peakBytes / 1024 ** 2))
+
+    def save_state(self, pDirectory):
+        return {'table': self.table.save_state(pDirectory, 'duplicates')}
+
+    def restore_state(self, pDirectory, pState):
+        self.table.restore_state(pDirectory, 'duplicates', pState['table'])
+
+    def close(self):
+        self.table.close()
+
+
+class ReadPositionIndexPartitioned(ReadPositionIndex):
+    """A class to check for PCR duplicates.
+       One hash table per pair of chromosomes is used and only the two start
+       positions need to be stored as one 64 bit integer. If the tables of all
+       chromosome pairs need more than pMaxMemory bytes, new and growing tables
+       are memory mapped to files in pTempDir.
+    """
+
+    def __init__(self, pMaxMemory=None, pTempDir=None):
+        """
+        >>> rp = ReadPositionIndexPartitioned(pMaxMemory=0)
+        >>> rp.is_duplicated(1, 0, 2, 0)
+        False
+        >>> rp.is_duplicated(2, 0, 1, 0)
+        True
+        >>> rp.bytes_on_disk() > 0
+        True
+        >>> rp.close()
+        """
+        self.maxMemory = pMaxMemory
+        self.tempDir = pTempDir
+        self.spillDir = None
+        self.tables = {}
+        self.peakBytes = 0
+
+    def _get_table(self, pPair):
+        if pPair not in self.tables:
+            file_prefix = None
+            if self.maxMemory is not None and self.bytes_in_memory() >= self.maxMemory:
+                if self.spillDir is None:
+                    self.spillDir = mkdtemp(prefix="hicBuildMatrix_duplicates_", dir=self.tempDir)
+                file_prefix = os.path.join(self.spillDir, "{}_{}".format(*pPair))
+            self.tables[pPair] = OpenAddressingTable(1, pCapacity=2**12, pFilePrefix=file_prefix)
+        return self.tables[pPair]
+
+    def are_duplicated(self, pRefId1, pStart1, pRefId2, pStart2):
+        key_ref, key_pos = self._pack(pRefId1, pStart1, pRefId2, pStart2)
+        duplicated = np.ones(len(key_ref), dtype=bool)
+        order = np.argsort(key_ref, kind='stable')
+        boundaries = np.flatnonzero(np.diff(key_ref[order])) + 1
+        for group in np.split(order, boundaries):
+            if len(group) == 0:
+                continue
+            key = int(key_ref[group[0]])
+            table = self._get_table((key >> 32, key & 0xFFFFFFFF))
+            duplicated[group] = self._are_duplicated(table, [key_pos[group]])
+        self.peakBytes = max(self.peakBytes, self.bytes_in_memory())
+        return duplicated
+
+    def __len__(self):
+        return sum(len(table) for table in self.tables.values())
+
+    def bytes_in_memory(self):
+        return sum(table.nbytes() for table in self.tables.values() if table.filePrefix is None)
+
+    def bytes_on_disk(self):
+        return sum(table.nbytes() for table in self.tables.values() if table.filePrefix is not None)
+
+    def memory_usage(self):
+        return self.bytes_in_memory()
+
+    def log_summary(self):
+        log.info("duplicate index 'partitioned': {} read pairs stored in {} chromosome pair tables, "
+                 "{:.1f} MB in memory (memory ceiling {:.1f} MB), {:.1f} MB on disk\n".format(len(self), len(self.tables),
+                                                                                              self.bytes_in_memory() / 1024 ** 2,
+                                                                                              self.peakBytes / 1024 ** 2,
+                                                                                              self.bytes_on_disk() / 1024 ** 2))
+
+    def save_state(self, pDirectory):
+        tables = []
+        for pair, table in self.tables.items():
+            name = "duplicates_{}_{}".format(*pair)
+            tables.append([pair[0], pair[1], table.filePrefix is not None, table.save_state(pDirectory, name)])
+        return {'tables': tables, 'peakBytes': self.peakBytes}
+
+    def restore_state(self, pDirectory, pState):
+        """
+        >>> from tempfile import mkdtemp
+        >>> rp = ReadPositionIndexPartitioned(pMaxMemory=0)
+        >>> rp.are_duplicated(np.array([1, 2]), np.array([0, 5]), np.array([2, 2]), np.array([0, 7])).tolist()
+        [False, False]
+        >>> directory = mkdtemp()
+        >>> state = rp.save_state(directory)
+        >>> rp.close()
+        >>> restored = ReadPositionIndexPartitioned(pMaxMemory=0)
+        >>> restored.restore_state(directory, state)
+        >>> restored.are_duplicated(np.array([2, 1]), np.array([0, 9]), np.array([1, 2]), np.array([0, 0])).tolist()
+        [True, False]
+        >>> restored.close()
+        """
+        for table in self.tables.values():
+            table.close()
+        self.tables = {}
+        for ref_id1, ref_id2, on_disk, table_state in pState['tables']:
+            file_prefix = None
+            if on_disk:
+                if self.spillDir is None:
+                    self.spillDir = mkdtemp(prefix="hicBuildMatrix_duplicates_", dir=self.tempDir)
+                file_prefix = os.path.join(self.spillDir, "{}_{}".format(ref_id1, ref_id2))
+            table = OpenAddressingTable(1, pCapacity=2, pFilePrefix=file_prefix)
+            table.restore_state(pDirectory, "duplicates_{}_{}".format(ref_id1, ref_id2), table_state)
+            self.tables[(ref_id1, ref_id2)] = table
+        self.peakBytes = pState['peakBytes']
+
+    def close(self):
+        for table in self.tables.values():
+            table.close()
+        if self.spillDir is not None:
+            shutil.rmtree(self.spillDir, ignore_errors=True)
+
 
 def parse_arguments(args=None):
 
@@ -198,6 +557,15 @@ def parse_arguments(args=None):
                                 'of dangling-end reads in a sample are indicative of a problem with the re-ligation '
                                 'step of the protocol.')
 
+    parserOpt.add_argument('--outPairs',
+                           help='File name to store all valid Hi-C pairs. The pairs are stored column wise '
+                           '(chromosome, 5\' position, position used for binning, strand, bin or restriction fragment id and '
+                           'mapping quality of both mates) in a compressed, chunked HDF5 file. Use hicBinPairs to create '
+                           'matrices of other resolutions or restriction fragment layouts from this file without '
+                           'reading the bam files again.',
+                           metavar='FILENAME.h5',
+                           required=False)
+
     parserOpt.add_argument('--region', '-r',
                            help='Region of the genome to limit the operation to. '
                            'The format is chr:start-end. It is also possible to just '
@@ -261,6 +629,45 @@ def parse_arguments(args=None):
                            default=400000,
                            type=int
                            )
+    parserOpt.add_argument('--coverageResolution',
+                           help='Resolution in bp of the read coverage that is computed for each bin. The maximum coverage '
+                           'of a bin is stored with the matrix. A coarser resolution needs less memory, it needs to be smaller '
+                           'than the read length because a read covers read length // resolution positions of the coverage.',
+                           required=False,
+                           default=10,
+                           type=int
+                           )
+    parserOpt.add_argument('--parallelReading',
+                           help='Decode the two bam files in two dedicated reader processes. The readers send compact '
+                           'records (reference id, position, flag, mapping quality, 5\' end and strand) instead of the full '
+                           'alignments to the main process, the filtering of unmapped, low quality and duplicated pairs is done '
+                           'for a full input buffer at once. These reader processes are not counted by --threads. '
+                           'Can not be combined with --outBam.',
+                           action='store_true')
+    parserOpt.add_argument('--decompressionThreads',
+                           help='Number of threads pysam / htslib uses to decompress each of the two bam files.',
+                           required=False,
+                           default=1,
+                           type=int
+                           )
+    parserOpt.add_argument('--checkpoint',
+                           help='Directory to store checkpoints of a long run. In regular intervals the partial '
+                           'matrix, the coverage, the QC counters, the duplicate index and the position in both bam files '
+                           'are written to this directory. An interrupted run can be continued with --resume. The checkpoints '
+                           'are removed once the matrix is saved. Can not be combined with --outBam.',
+                           metavar='DIRECTORY',
+                           required=False)
+    parserOpt.add_argument('--checkpointInterval',
+                           help='Minutes between two checkpoints.',
+                           required=False,
+                           default=30,
+                           type=float
+                           )
+    parserOpt.add_argument('--resume',
+                           help='Continue an interrupted run from the last checkpoint in the --checkpoint directory. '
+                           'All other parameters need to be the same as for the interrupted run. The result is identical '
+                           'to an uninterrupted run. If no checkpoint exists, the run starts from the beginning.',
+                           action='store_true')
     parserOpt.add_argument('--doTestRun',
                            help='A test run is useful to test the quality '
                            'of a Hi-C experiment quickly. It works by '
@@ -286,6 +693,23 @@ def parse_arguments(args=None):
                            action='store_true'
                            )
 
+    parserOpt.add_argument('--duplicateIndex',
+                           help='Data structure used to identify duplicated read pairs. '
+                           '\'set\' stores for each read pair a string and needs the most memory. '
+                           '\'hashed\' packs the reference ids and start positions of both mates into '
+                           'two 64 bit integers stored in a hash table. '
+                           '\'partitioned\' uses one hash table per chromosome pair and needs only one 64 bit integer '
+                           'per read pair. If --duplicateIndexMaxMemory is reached, new tables of this index are '
+                           'stored as memory mapped files in the temporary directory. All three indices identify the same duplicates.',
+                           choices=['set', 'hashed', 'partitioned'],
+                           default='hashed')
+
+    parserOpt.add_argument('--duplicateIndexMaxMemory',
+                           help='Memory ceiling in MB for the \'partitioned\' duplicate index. Tables allocated after '
+                           'this limit is reached are kept on disk in the directory given by the TMPDIR environment variable.',
+                           type=int,
+                           default=None)
+
     parserOpt.add_argument("--help", "-h", action="help",
                            help="show this help message and exit")
 
@@ -320,6 +744,173 @@ def intervalListToIntervalTree(interval_list):
     return bin_int_tree
 
 
+def get_bin_search_arrays(bin_intervals):
+    r"""
+    Returns the bins sorted per chromosome as arrays of begin, end and bin id,
+    together with a dict that stores for each chromosome the index of the first
+    and the last bin in these arrays. This is the layout used by find_bins
+    and BinLookup.
+
+    >>> bin_list = [('chrX', 50000, 100000), ('chrX', 0, 50000), ('chr2', 0, 10)]
+    >>> begin, end, bin_id, index_dict = get_bin_search_arrays(bin_list)
+    >>> begin.tolist(), end.tolist(), bin_id.tolist()
+    ([0, 50000, 0], [50000, 100000, 10], [1, 0, 2])
+    >>> index_dict
+    {'chrX': (0, 1), 'chr2': (2, 2)}
+    """
+    bin_intval_tree = intervalListToIntervalTree(bin_intervals)
+    shared_array_list = []
+    index_dict = {}
+    end = -1
+    for seq in bin_intval_tree:
+        start = end + 1
+        interval_list = []
+        for interval in bin_intval_tree[seq]:
+            interval_list.append((interval.begin, interval.end, interval.data))
+        end = start + len(bin_intval_tree[seq]) - 1
+        index_dict[seq] = (start, end)
+        interval_list = sorted(interval_list)
+        shared_array_list.extend(interval_list)
+    if len(shared_array_list) == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.int64), index_dict
+    begin, end, bin_id = list(zip(*shared_array_list))
+    return np.array(begin, dtype=np.int64), np.array(end, dtype=np.int64), np.array(bin_id, dtype=np.int64), index_dict
+
+
+def find_bins(pBegin, pEnd, pBinId, pIndexStart, pIndexEnd, pPositions):
+    r"""
+    Vectorised binary search over the bins with an inclusive bin end. For each position
+    the search runs between the indices pIndexStart and pIndexEnd (the bins of its chromosome)
+    of the arrays returned by get_bin_search_arrays. Because the binary search is replicated
+    step by step, a position on the border of two bins is always assigned to the same bin.
+    Returns the bin ids, -1 for positions without a bin.
+
+    >>> begin, end, bin_id, index_dict = get_bin_search_arrays([('chr1', 0, 10), ('chr1', 10, 20), ('chr1', 30, 40)])
+    >>> find_bins(begin, end, bin_id, np.array([0, 0, 0, 0]), np.array([2, 2, 2, 2]), np.array([5, 10, 25, 40])).tolist()
+    [0, 1, -1, 2]
+    """
+    start = np.array(pIndexStart, dtype=np.int64)
+    end = np.array(pIndexEnd, dtype=np.int64)
+    positions = np.asarray(pPositions)
+    result = np.full(len(positions), -1, dtype=np.int64)
+    active = np.flatnonzero(start <= end)
+    while len(active):
+        middle = (start[active] + end[active]) // 2
+        position = positions[active]
+        begin_middle = pBegin[middle]
+        found = (begin_middle <= position) & (position <= pEnd[middle])
+        result[active[found]] = pBinId[middle[found]]
+        left = ~found & (begin_middle > position)
+        right = ~found & ~left
+        end[active[left]] = middle[left] - 1
+        start[active[right]] = middle[right] + 1
+        active = active[~found]
+        active = active[start[active] <= end[active]]
+    return result
+
+
+class BinLookup(object):
+    r"""
+    Finds the bins of whole arrays of positions with np.searchsorted. The bins of all
+    chromosomes are sorted by (chromosome, begin) and searched at once. Positions which
+    are in more than one bin, e.g. on the border of two bins, are resolved with find_bins,
+    such that the result is the same as the binary search of hicBuildMatrix.
+    pRefId2name maps the reference ids used in find() to the chromosome names of the bins.
+
+    >>> lookup = BinLookup([('chr1', 0, 10), ('chr1', 10, 20), ('chr2', 0, 10)], ['chr1', 'chr2', 'chr3'])
+    >>> lookup.find(np.array([0, 0, 0, 1, 1, 2]), np.array([5, 10, 25, 3, 12, 3])).tolist()
+    [0, 0, -1, 2, -1, -1]
+    >>> lookup.binBegin.tolist()
+    [0, 10, 0]
+    """
+
+    def __init__(self, pBinIntervals, pRefId2name):
+        self.begin, self.end, self.binId, index_dict = get_bin_search_arrays(pBinIntervals)
+        # begin of the bins by bin id
+        self.binBegin = np.zeros(len(self.binId), dtype=np.int64)
+        self.binBegin[self.binId] = self.begin
+        # per reference id: position of the chromosome in the sorted arrays, first and last index
+        self.refSlot = np.full(len(pRefId2name), -1, dtype=np.int64)
+        self.refIndexStart = np.zeros(len(pRefId2name), dtype=np.int64)
+        self.refIndexEnd = np.full(len(pRefId2name), -1, dtype=np.int64)
+        slot_of_bin = np.zeros(len(self.begin), dtype=np.int64)
+        chrom_slot = {}
+        for slot, (chrom, (start, end)) in enumerate(index_dict.items()):
+            slot_of_bin[start:end + 1] = slot
+            chrom_slot[chrom] = slot
+        for ref_id, chrom in enumerate(pRefId2name):
+            if chrom in index_dict:
+                self.refSlot[ref_id] = chrom_slot[chrom]
+                self.refIndexStart[ref_id], self.refIndexEnd[ref_id] = index_dict[chrom]
+        # the keys are (chromosome slot << 32) + position, the maximum end is used to
+        # detect positions which are in more than one bin
+        self.keyBegin = (slot_of_bin << 32) + self.begin
+        self.keyMaxEnd = np.maximum.accumulate((slot_of_bin << 32) + self.end) if len(self.end) else self.end
+
+    def find(self, pRefIds, pPositions):
+        """Returns the bin ids of the positions, -1 for positions without a bin."""
+        ref_ids = np.asarray(pRefIds, dtype=np.int64)
+        positions = np.asarray(pPositions, dtype=np.int64)
+        result = np.full(len(positions), -1, dtype=np.int64)
+        slot = self.refSlot[ref_ids]
+        keys = (slot << 32) + positions
+        # the last bin which begins before or at the position
+        index = np.searchsorted(self.keyBegin, keys, side='right') - 1
+        valid = (slot >= 0) & (index >= 0)
+        valid[valid] = index[valid] >= self.refIndexStart[ref_ids[valid]]
+        contained = valid.copy()
+        contained[valid] = positions[valid] <= self.end[index[valid]]
+        result[contained] = self.binId[index[contained]]
+
+        # positions which are in an earlier bin too
+        ambiguous = valid & (index > 0)
+        ambiguous[ambiguous] = self.keyMaxEnd[index[ambiguous] - 1] >= keys[ambiguous]
+        if ambiguous.any():
+            result[ambiguous] = find_bins(self.begin, self.end, self.binId, self.refIndexStart[ref_ids[ambiguous]],
+                                          self.refIndexEnd[ref_ids[ambiguous]], positions[ambiguous])
+        return result
+
+
+class RestrictionSiteLookup(object):
+    r"""
+    Tests for whole arrays of ranges if a restriction site overlaps the range.
+    Like an intervaltree query tree[start:end] a site overlaps if site.begin < end and
+    site.end > start, empty ranges have no overlap. The sites are sorted by
+    (chromosome, begin), a running maximum of the site ends answers the query with one
+    np.searchsorted.
+
+    >>> lookup = RestrictionSiteLookup([('chr1', 10, 14), ('chr1', 50, 54), ('chr2', 5, 9)], ['chr1', 'chr2', 'chr3'])
+    >>> lookup.has_site(np.array([0, 0, 0, 1, 1, 2]), np.array([0, 14, 20, 0, 9, 0]), np.array([11, 50, 15, 6, 20, 100])).tolist()
+    [True, False, False, True, False, False]
+    """
+
+    def __init__(self, pRfIntervals, pRefId2name):
+        chrom_slot = {chrom: slot for slot, chrom in enumerate(OrderedDict.fromkeys(interval[0] for interval in pRfIntervals))}
+        self.refSlot = np.array([chrom_slot.get(chrom, -1) for chrom in pRefId2name], dtype=np.int64)
+        if len(pRfIntervals):
+            chrom, begin, end = list(zip(*[interval[:3] for interval in pRfIntervals]))
+        else:
+            chrom, begin, end = [], [], []
+        slot = np.array([chrom_slot[name] for name in chrom], dtype=np.int64)
+        key_begin = (slot << 32) + np.array(begin, dtype=np.int64)
+        order = np.argsort(key_begin, kind='stable')
+        self.keyBegin = key_begin[order]
+        key_end = (slot << 32) + np.array(end, dtype=np.int64)
+        self.keyMaxEnd = np.maximum.accumulate(key_end[order]) if len(order) else key_end
+
+    def has_site(self, pRefIds, pStart, pEnd):
+        """Returns for each range if it overlaps a restriction site."""
+        slot = self.refSlot[np.asarray(pRefIds, dtype=np.int64)]
+        start = np.maximum(np.asarray(pStart, dtype=np.int64), 0)
+        end = np.asarray(pEnd, dtype=np.int64)
+        # number of sites which begin before the end of the range
+        index = np.searchsorted(self.keyBegin, (slot << 32) + end, side='left')
+        result = (slot >= 0) & (start < end) & (index > 0)
+        # sites of previous chromosomes have smaller keys than the start of the range
+        result[result] = self.keyMaxEnd[index[result] - 1] > (slot[result] << 32) + start[result]
+        return result
+
+
 def get_bins(bin_size, chrom_size, region=None):
     r"""
     Split the chromosomes into even sized bins
@@ -653,7 +1244,9 @@ def enlarge_bins(bin_intervals, chrom_sizes):
 
 def readBamFiles(pFileOneIterator, pFileTwoIterator, pNumberOfItemsPerBuffer, pSkipDuplicationCheck, pReadPosMatrix, pRefId2name, pMinMappingQuality):
     """Read the two bam input files into n buffers each with pNumberOfItemsPerBuffer
-        with n = number of processes. The duplication check is handled here too."""
+        with n = number of processes. The duplication check is handled here too.
+        For the hashed duplicate indices the check is done for the full buffer at once,
+        the returned buffers contain in this case less than pNumberOfItemsPerBuffer pairs."""
     buffer_mate1 = []
     buffer_mate2 = []
     duplicated_pairs = 0
@@ -662,6 +1255,7 @@ def readBamFiles(pFileOneIterator, pFileTwoIterator, pNumberOfItemsPerBuffer, pS
     one_mate_low_quality = 0
 
     all_data_read = False
+    batch_duplication_check = pSkipDuplicationCheck is False and isinstance(pReadPosMatrix, ReadPositionIndex)
     j = 0
     iter_num = 0
     while j < pNumberOfItemsPerBuffer:
@@ -735,7 +1329,7 @@ def readBamFiles(pFileOneIterator, pFileTwoIterator, pNumberOfItemsPerBuffer, pS
             one_mate_low_quality += 1
             continue
 
-        if pSkipDuplicationCheck is False:
+        if pSkipDuplicationCheck is False and not batch_duplication_check:
             if pReadPosMatrix.is_duplicated(pRefId2name[mate1.rname],
                                             mate1.pos,
                                             pRefId2name[mate2.rname],
@@ -746,36 +1340,345 @@ def readBamFiles(pFileOneIterator, pFileTwoIterator, pNumberOfItemsPerBuffer, pS
         buffer_mate2.append(mate2)
         j += 1
 
+    if batch_duplication_check and len(buffer_mate1) > 0:
+        # the duplication check of the hashed indices is done for the whole buffer at once
+        duplicated = pReadPosMatrix.are_duplicated(np.fromiter((mate.rname for mate in buffer_mate1), dtype=np.int64, count=len(buffer_mate1)),
+                                                   np.fromiter((mate.pos for mate in buffer_mate1), dtype=np.int64, count=len(buffer_mate1)),
+                                                   np.fromiter((mate.rname for mate in buffer_mate2), dtype=np.int64, count=len(buffer_mate2)),
+                                                   np.fromiter((mate.pos for mate in buffer_mate2), dtype=np.int64, count=len(buffer_mate2)))
+        duplicated_pairs += int(np.sum(duplicated))
+        buffer_mate1 = [mate for mate, is_duplicated in zip(buffer_mate1, duplicated) if not is_duplicated]
+        buffer_mate2 = [mate for mate, is_duplicated in zip(buffer_mate2, duplicated) if not is_duplicated]
+
     if all_data_read and len(buffer_mate1) != 0 and len(buffer_mate2) != 0:
         return buffer_mate1, buffer_mate2, True, duplicated_pairs, one_mate_unmapped, one_mate_not_unique, one_mate_low_quality, iter_num - len(buffer_mate1)
-    if all_data_read and len(buffer_mate1) == 0 or len(buffer_mate2) == 0:
-        return None, None, True, duplicated_pairs, one_mate_unmapped, one_mate_not_unique, one_mate_low_quality, iter_num - len(buffer_mate1)
+    if len(buffer_mate1) == 0 or len(buffer_mate2) == 0:
+        return None, None, all_data_read, duplicated_pairs, one_mate_unmapped, one_mate_not_unique, one_mate_low_quality, iter_num - len(buffer_mate1)
     return buffer_mate1, buffer_mate2, False, duplicated_pairs, one_mate_unmapped, one_mate_not_unique, one_mate_low_quality, iter_num - len(buffer_mate1)
 
 
+def get_pairs_columns(pMateBuffer1, pMateBuffer2, pIndices, pBins1, pBins2, pRefId2PairsChrom):
+    """Returns the columns of a valid pairs file (see hicexplorer.lib.pairs) for the pairs
+    pIndices of the two mate buffers. pBins1 and pBins2 are the bins of these pairs as computed by process_data."""
+    indices = np.asarray(pIndices, dtype=np.int64)
+    columns = {}
+    for mate, buffer_, bins in [('1', pMateBuffer1, pBins1), ('2', pMateBuffer2, pBins2)]:
+        if isinstance(buffer_, np.ndarray):
+            records = buffer_[indices]
+        else:
+            records = np.array([alignment_to_record(buffer_[index], None) for index in indices.tolist()],
+                               dtype=MATE_RECORD_DTYPE)
+        columns['chrom' + mate] = pRefId2PairsChrom[records['reference_id']]
+        columns['pos' + mate] = records['five_prime']
+        columns['middle' + mate] = records['pos'] + records['qlen'] // 2
+        columns['strand' + mate] = records['is_reverse'].astype(np.int8)
+        columns['frag' + mate] = np.asarray(bins, dtype=np.int64)
+        columns['mapq' + mate] = records['mapq']
+    return columns
+
+
+# compact representation of a mate which is send from the reader processes
+# to the main process and the workers instead of a pickled pysam.AlignedSegment
+MATE_RECORD_DTYPE = np.dtype([('reference_id', np.int32),
+                              ('pos', np.int32),
+                              ('flag', np.uint16),
+                              ('mapq', np.uint8),
+                              ('qlen', np.int32),
+                              ('query_length', np.int32),
+                              ('five_prime', np.int32),
+                              ('is_reverse', np.bool_),
+                              ('dangling_end', np.bool_)])
+
+
+def alignment_to_record(pRead, pDanglingSequences):
+    """Converts a pysam.AlignedSegment to a tuple of MATE_RECORD_DTYPE.
+    The 5' end is the first aligned base of a forward read and the last aligned base of a reverse read."""
+    if pRead.is_unmapped:
+        return (pRead.reference_id, pRead.pos, pRead.flag, pRead.mapq, 0, pRead.query_length, -1, pRead.is_reverse, False)
+    if pRead.is_reverse:
+        five_prime = pRead.reference_end - 1
+    else:
+        five_prime = pRead.reference_start
+    dangling_end = False
+    if pDanglingSequences:
+        dangling_end = check_dangling_end(pRead, pDanglingSequences)
+    return (pRead.reference_id, pRead.pos, pRead.flag, pRead.mapq, pRead.qlen, pRead.query_length,
+            five_prime, pRead.is_reverse, dangling_end)
+
+
+def mates_to_records(pMateBuffer, pDanglingSequences):
+    """Converts a buffer of pysam.AlignedSegments to an array of MATE_RECORD_DTYPE, record arrays are returned unchanged."""
+    if pMateBuffer is None or isinstance(pMateBuffer, np.ndarray):
+        return pMateBuffer
+    return np.array([alignment_to_record(mate, pDanglingSequences) for mate in pMateBuffer], dtype=MATE_RECORD_DTYPE)
+
+
+def readBamFileRecords(pFileName, pQueueOut, pChunkSize, pDecompressionThreads, pDanglingSequences, pStartOffset=None):
+    """Reader process for one bam file. Secondary alignments are skipped and from
+    supplementary alignments the correct mapping is selected (see get_correct_map).
+    For each read one record of MATE_RECORD_DTYPE is created. Chunks of pChunkSize
+    records are put together with the read names and the file offsets after each read
+    into pQueueOut, None signals the end of the file. If pStartOffset is given, reading
+    starts at this virtual file offset.
+    """
+    start_time = time.time()
+    bam_file = pysam.Samfile(pFileName, 'rb', threads=max(1, pDecompressionThreads))
+    if pStartOffset is not None:
+        bam_file.seek(pStartOffset)
+    file_iterator = iter(bam_file)
+    number_of_reads = 0
+    all_data_read = False
+    while not all_data_read:
+        query_names = []
+        records = []
+        offsets = []
+        while len(records) < pChunkSize:
+            try:
+                mate = next(file_iterator)
+                # skip 'not primary' alignments
+                while mate.flag & 256 == 256:
+                    mate = next(file_iterator)
+                mate_supplementary_list = get_supplementary_alignment(mate, file_iterator)
+            except StopIteration:
+                all_data_read = True
+                break
+            if mate_supplementary_list:
+                mate = get_correct_map(mate, mate_supplementary_list)
+            query_names.append(mate.qname)
+            records.append(alignment_to_record(mate, pDanglingSequences))
+            offsets.append(bam_file.tell())
+        number_of_reads += len(records)
+        if len(records):
+            pQueueOut.put((np.array(query_names, dtype=object), np.array(records, dtype=MATE_RECORD_DTYPE),
+                           np.array(offsets, dtype=np.int64)))
+    pQueueOut.put(None)
+    bam_file.close()
+    elapsed_time = time.time() - start_time
+    log.info("reader {}: decoded {} reads in {:.2f} secs ({:.1f} reads per second)\n".format(pFileName, number_of_reads, elapsed_time,
+                                                                                             number_of_reads / max(elapsed_time, 1e-9)))
+
+
+class PairedRecordStream(object):
+    """Starts one reader process per bam file and combines the records of the
+    two files into pairs. The reader processes decode the bam files in parallel to the main
+    process and to the workers. The reading starts at pStartOffsets, the virtual file offsets
+    of the first reads to use, and tell() returns the offsets after the last returned pair."""
+
+    def __init__(self, pFileNames, pChunkSize=100000, pDecompressionThreads=1, pDanglingSequences=None, pMaxChunksInQueue=4,
+                 pStartOffsets=None):
+        self.queues = []
+        self.processes = []
+        self.query_names = []
+        self.records = []
+        self.offsets = []
+        self.file_done = []
+        self.position = [None, None] if pStartOffsets is None else list(pStartOffsets)
+        for i, file_name in enumerate(pFileNames):
+            queue = Queue(maxsize=pMaxChunksInQueue)
+            process = Process(target=readBamFileRecords, kwargs=dict(pFileName=file_name,
+                                                                     pQueueOut=queue,
+                                                                     pChunkSize=pChunkSize,
+                                                                     pDecompressionThreads=pDecompressionThreads,
+                                                                     pDanglingSequences=pDanglingSequences,
+                                                                     pStartOffset=self.position[i]))
+            process.daemon = True
+            process.start()
+            self.queues.append(queue)
+            self.processes.append(process)
+            self.query_names.append(np.array([], dtype=object))
+            self.records.append(np.array([], dtype=MATE_RECORD_DTYPE))
+            self.offsets.append(np.array([], dtype=np.int64))
+            self.file_done.append(False)
+
+    def _fill(self, pIndex, pNumberOfItems):
+        query_names = [self.query_names[pIndex]]
+        records = [self.records[pIndex]]
+        offsets = [self.offsets[pIndex]]
+        available = len(self.records[pIndex])
+        while available < pNumberOfItems and not self.file_done[pIndex]:
+            chunk = self.queues[pIndex].get()
+            if chunk is None:
+                self.file_done[pIndex] = True
+                break
+            query_names.append(chunk[0])
+            records.append(chunk[1])
+            offsets.append(chunk[2])
+            available += len(chunk[1])
+        self.query_names[pIndex] = np.concatenate(query_names)
+        self.records[pIndex] = np.concatenate(records)
+        self.offsets[pIndex] = np.concatenate(offsets)
+
+    def next_pairs(self, pNumberOfItems):
+        """Returns the records of up to pNumberOfItems pairs and True if all data was read."""
+        for i in range(2):
+            self._fill(i, pNumberOfItems)
+        number_of_items = min(pNumberOfItems, len(self.records[0]), len(self.records[1]))
+        query_names1, query_names2 = self.query_names[0][:number_of_items], self.query_names[1][:number_of_items]
+        mismatch = np.flatnonzero(query_names1 != query_names2)
+        assert len(mismatch) == 0, "FATAL ERROR {} {} " \
+            "Be sure that the sam files have the same read order " \
+            "If using Bowtie2 or Hisat2 add " \
+            "the --reorder option".format(query_names1[mismatch[:1]], query_names2[mismatch[:1]])
+        records = []
+        for i in range(2):
+            records.append(self.records[i][:number_of_items])
+            if number_of_items > 0:
+                self.position[i] = int(self.offsets[i][number_of_items - 1])
+            self.query_names[i] = self.query_names[i][number_of_items:]
+            self.records[i] = self.records[i][number_of_items:]
+            self.offsets[i] = self.offsets[i][number_of_items:]
+        all_data_read = any(self.file_done[i] and len(self.records[i]) == 0 for i in range(2))
+        return records[0], records[1], all_data_read
+
+    def tell(self):
+        """Virtual file offsets of the two bam files after the last returned pair."""
+        return list(self.position)
+
+    def close(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+
+def filter_records(pMate1, pMate2, pSkipDuplicationCheck, pReadPosMatrix, pRefId2name, pMinMappingQuality):
+    """Vectorised version of the filters of readBamFiles: removes pairs with an unmapped mate,
+    with a low mapping quality and duplicated pairs.
+    Returns the valid pairs and the counts of duplicated, unmapped, not unique and low quality pairs."""
+    unmapped = (pMate1['flag'] & 0x4 == 4) | (pMate2['flag'] & 0x4 == 4)
+    low_quality = ~unmapped & ((pMate1['mapq'] < pMinMappingQuality) | (pMate2['mapq'] < pMinMappingQuality))
+    # same decision as in readBamFiles: pairs with mapq == 0 for the first mate are counted as not unique
+    not_unique = low_quality & (pMate1['mapq'] == 0)
+    valid = ~unmapped & ~low_quality
+
+    duplicated_pairs = 0
+    if pSkipDuplicationCheck is False and np.any(valid):
+        valid_index = np.flatnonzero(valid)
+        if isinstance(pReadPosMatrix, ReadPositionIndex):
+            duplicated = pReadPosMatrix.are_duplicated(pMate1['reference_id'][valid_index], pMate1['pos'][valid_index],
+                                                       pMate2['reference_id'][valid_index], pMate2['pos'][valid_index])
+        else:
+            duplicated = np.array([pReadPosMatrix.is_duplicated(pRefId2name[ref_id1], pos1, pRefId2name[ref_id2], pos2)
+                                   for ref_id1, pos1, ref_id2, pos2 in zip(pMate1['reference_id'][valid_index].tolist(),
+                                                                           pMate1['pos'][valid_index].tolist(),
+                                                                           pMate2['reference_id'][valid_index].tolist(),
+                                                                           pMate2['pos'][valid_index].tolist())], dtype=bool)
+        duplicated_pairs = int(np.sum(duplicated))
+        valid[valid_index[duplicated]] = False
+
+    return pMate1[valid], pMate2[valid], duplicated_pairs, int(np.sum(unmapped)), \
+        int(np.sum(not_unique)), int(np.sum(low_quality & ~not_unique))
+
+
+def readRecordBuffers(pRecordStream, pNumberOfItemsPerBuffer, pSkipDuplicationCheck, pReadPosMatrix, pRefId2name, pMinMappingQuality):
+    """Counterpart of readBamFiles for the records of a PairedRecordStream. The buffers are filled with
+    up to pNumberOfItemsPerBuffer valid pairs. Returns the same values as readBamFiles, the buffers are arrays of MATE_RECORD_DTYPE."""
+    buffer_mate1 = []
+    buffer_mate2 = []
+    duplicated_pairs = 0
+    one_mate_unmapped = 0
+    one_mate_not_unique = 0
+    one_mate_low_quality = 0
+
+    all_data_read = False
+    iter_num = 0
+    number_of_items = 0
+    while number_of_items < pNumberOfItemsPerBuffer and not all_data_read:
+        mate1, mate2, all_data_read = pRecordStream.next_pairs(pNumberOfItemsPerBuffer - number_of_items)
+        iter_num += len(mate1)
+        mate1, mate2, duplicated_pairs_, one_mate_unmapped_, one_mate_not_unique_, \
+            one_mate_low_quality_ = filter_records(mate1, mate2, pSkipDuplicationCheck, pReadPosMatrix,
+                                                   pRefId2name, pMinMappingQuality)
+        duplicated_pairs += duplicated_pairs_
+        one_mate_unmapped += one_mate_unmapped_
+        one_mate_not_unique += one_mate_not_unique_
+        one_mate_low_quality += one_mate_low_quality_
+        buffer_mate1.append(mate1)
+        buffer_mate2.append(mate2)
+        number_of_items += len(mate1)
+
+    if number_of_items == 0:
+        return None, None, all_data_read, duplicated_pairs, one_mate_unmapped, one_mate_not_unique, one_mate_low_quality, iter_num
+    return np.concatenate(buffer_mate1), np.concatenate(buffer_mate2), all_data_read, duplicated_pairs, \
+        one_mate_unmapped, one_mate_not_unique, one_mate_low_quality, iter_num - number_of_items
+
+
+def get_bin_max_coverage(pCoverage, pBegin, pEnd):
+    r"""
+    Returns for each bin the maximum of the coverage vector from index pBegin to
+    pEnd (excluded), nan if the bin has no coverage.
+
+    >>> get_bin_max_coverage(np.array([1, 3, 0, 0, 2, 5, 7]), np.array([0, 2, 4, 6]), np.array([2, 3, 6, 6])).tolist()
+    [3.0, nan, 5.0, nan]
+    """
+    bin_max = np.zeros(len(pBegin), dtype=np.float64)
+    not_empty = pEnd > pBegin
+    if np.any(not_empty):
+        # every second range of reduceat is a bin, the value appended to the
+        # coverage allows a range which ends at the last element
+        indices = np.column_stack([pBegin[not_empty], pEnd[not_empty]]).ravel()
+        bin_max[not_empty] = np.maximum.reduceat(np.append(pCoverage, 0), indices)[::2]
+    bin_max[bin_max == 0] = np.nan
+    return bin_max
+
+
+def process_data_worker(pTaskQueue, pResultQueue, pRow, pCol, pData, pCoverageStart, pCoverageEnd, pProcessDataArguments):
+    """
+    Persistent worker process of hicBuildMatrix. A task is a tuple of the buffer slot, the two
+    mate buffers and the counter, the result of process_data is written to the row, col, data
+    and coverage arrays of the slot and put into pResultQueue. None in pTaskQueue stops the worker.
+    """
+    while True:
+        task = pTaskQueue.get()
+        if task is None:
+            break
+        slot, mate_buffer1, mate_buffer2, counter = task
+        process_data(pMateBuffer1=mate_buffer1, pMateBuffer2=mate_buffer2, pResultIndex=slot,
+                     pQueueOut=pResultQueue, pCounter=counter,
+                     pRow=pRow[slot], pCol=pCol[slot], pData=pData[slot],
+                     pCoverageStart=pCoverageStart[slot], pCoverageEnd=pCoverageEnd[slot],
+                     **pProcessDataArguments)
+
+
+def get_worker_result(pResultQueue, pProcesses, pWait):
+    """Returns the next result of the workers or None if pWait is False and no result is ready.
+    If a worker died, e.g. because it ran out of memory, the program is stopped."""
+    while True:
+        try:
+            return pResultQueue.get(block=pWait, timeout=5 if pWait else None)
+        except Empty:
+            if not pWait:
+                return None
+            for process in pProcesses:
+                if not process.is_alive():
+                    exit("A worker process stopped unexpectedly with exit code {}. "
+                         "Please check the available memory or reduce --inputBufferSize.".format(process.exitcode))
+
+
 def process_data(pMateBuffer1, pMateBuffer2, pMinMappingQuality,
                  pKeepSelfCircles, pRestrictionSequence, pRemoveSelfLigation, pMatrixSize,
                  pRfPositions, pRefId2name,
                  pDanglingSequences, pBinsize, pResultIndex,
                  pQueueOut, pTemplate, pOutputBamSet, pCounter,
-                 pSharedBinIntvalTree, pDictBinIntervalTreeIndex, pCoverage, pCoverageIndex,
-                 pOutputFileBufferDir, pRow, pCol, pData,
+                 pBinLookup, pCoverageIndex,
+                 pOutputFileBufferDir, pRow, pCol, pData, pCoverageStart, pCoverageEnd,
                  pMaxInsertSize):
     """
     This function computes for a given number of elements in pMateBuffer1 and pMaterBuffer2 a partial interaction matrix.
     This function is used by multiple processes to speed up the computation.
     All partial matrices are merged in the end into one interaction matrix.
+    The whole buffer is classified at once with array operations, the pysam reads are converted to records first.
 
     Parameters
     ----------
-    pMateBuffer1 : List of n reads of type 'pysam.libcalignedsegment.AlignedSegment' of sam input file 1
-    pMateBuffer2 : List of n reads of type 'pysam.libcalignedsegment.AlignedSegment' of sam input file 2
+    pMateBuffer1 : List of n reads of type 'pysam.libcalignedsegment.AlignedSegment' of sam input file 1 or an array of MATE_RECORD_DTYPE
+    pMateBuffer2 : List of n reads of type 'pysam.libcalignedsegment.AlignedSegment' of sam input file 2 or an array of MATE_RECORD_DTYPE
     pMinMappingQuality : integer, minimum mapping quality of a read
     pKeepSelfCircles : boolean, if self circles should be kept
     pRestrictionSequence : String, the restriction sequence
     pRemoveSelfLigation : If self ligations should be removed
     pMatrixSize : integer, the size of the interaction matrix
-    pRfPositions : intervalTree, only used if a restriction cut file and not a bin size was defined.
+    pRfPositions : RestrictionSiteLookup, only used if a restriction cut file and not a bin size was defined.
     pRefId2name : Tuple, Maps a reference id to a name
     pDanglingSequences : dict, dict of dangling sequences
     pBinsize : integer, the size of the bins
@@ -783,267 +1686,197 @@ def process_data(pMateBuffer1, pMateBuffer2, pMinMappingQuality,
     pQueueOut : multiprocessing.Queue, queue to return the computed counting variables:
             one_mate_unmapped, one_mate_low_quality, one_mate_not_unique, dangling_end, self_circle, self_ligation, same_fragment,
             mate_not_close_to_rf, count_inward, count_outward, count_left, count_right, inter_chromosomal, short_range, long_range,
-            pair_added, len(pMateBuffer1), pResultIndex, pCounter
+            pair_added, len(pMateBuffer1), pResultIndex, pCounter, out_bam_index_buffer, time needed by the worker,
+            number of coverage ranges
     pTemplate : The template for the output bam file
     pOutputBamSet : If a output bam file should be written. Depending on the input parameter '--outBam'
     pOutputName : String, Name of the partial bam file
     pCounter : integer, value which is returned to the main process. The main process can than write a pCounter.bam_done file
                 to signal the background process, which is merging the partial bam files into one, that this dataset can be merged.
-    pSharedBinIntvalTree : multiprocessing.sharedctype.RawArray of C_Interval, stores the interval tree in a 1D-RawArray.
-    pDictBinIntervalTreeIndex : dict, stores the information at which index position a given interval starts and ends in the 1D-array 'pSharedBinIntvalTree'
-    pCoverage : multiprocessing.sharedctype.Array of c_uint, Stores the coverage in a 1D-Array
-    pCoverageIndex :  multiprocessing.sharedctype.RawArray of C_Coverage, stores the information in the 1D-array 'pCoverage'
+    pBinLookup : BinLookup, finds the bins of the mates
+    pCoverageIndex :  multiprocessing.sharedctype.RawArray of C_Coverage, stores for each bin the first and last index in the coverage vector
     pOutputFileBufferDir : String, the directory where the partial output bam files are buffered. Default is '/dev/shm/'
     pRow : multiprocessing.sharedctype.RawArray of c_uint, Stores the row index information. It is available for all processes and does not need to be copied.
     pCol : multiprocessing.sharedctype.RawArray of c_uint, stores the column index information. It is available for all processes and does not need to be copied.
     pData : multiprocessing.sharedctype.RawArray of c_ushort, stores a 1 for each row - column pair. It is available for all processes and does not need to be copied.
+    pCoverageStart : multiprocessing.sharedctype.RawArray of c_uint, stores the first index of the coverage vector covered by a mate.
+    pCoverageEnd : multiprocessing.sharedctype.RawArray of c_uint, stores the index after the last index of the coverage vector covered by a mate.
+                The main process adds the ranges to the coverage vector, the workers do not need to lock it.
     pMaxInsertSize : maximum illumina insert size
     """
 
     one_mate_unmapped = 0
     one_mate_low_quality = 0
     one_mate_not_unique = 0
-    dangling_end = 0
-    self_circle = 0
-    self_ligation = 0
-    same_fragment = 0
-    mate_not_close_to_rf = 0
-
-    count_inward = 0
-    count_outward = 0
-    count_left = 0
-    count_right = 0
-    inter_chromosomal = 0
-    short_range = 0
-    long_range = 0
-
-    pair_added = 0
-
-    iter_num = 0
-    hic_matrix = None
-
-    out_bam_index_buffer = []
+    start_time = time.time()
 
     if pMateBuffer1 is None or pMateBuffer2 is None:
-
-        pQueueOut.put([hic_matrix, [one_mate_unmapped, one_mate_low_quality, one_mate_not_unique, dangling_end, self_circle, self_ligation, same_fragment,
-                                    mate_not_close_to_rf, count_inward, count_outward,
-                                    count_left, count_right, inter_chromosomal, short_range, long_range, pair_added, iter_num, pResultIndex, out_bam_index_buffer]])
+        pQueueOut.put([[one_mate_unmapped, one_mate_low_quality, one_mate_not_unique, 0, 0, 0, 0,
+                        0, 0, 0,
+                        0, 0, 0, 0, 0, 0, 0, pResultIndex, pCounter, [],
+                        time.time() - start_time, 0]])
         return
 
-    while iter_num < len(pMateBuffer1) and iter_num < len(pMateBuffer2):
-        mate1 = pMateBuffer1[iter_num]
-        mate2 = pMateBuffer2[iter_num]
-        iter_num += 1
-
-        # check if reads belong to a bin
-        #
-        # pDictBinInterval stores the start and end position for each chromsome in the array 'pSharedBinIntvalTree'
-        # To get to the right interval a binary search is used.
-        mate_bins = []
-        mate_is_unasigned = False
-        for mate in [mate1, mate2]:
-            mate_ref = pRefId2name[mate.rname]
-            # find the middle genomic position of the read. This is used to
-            # find the bin it belongs to.
-            read_middle = mate.pos + int(mate.qlen / 2)
-            try:
-                start, end = pDictBinIntervalTreeIndex[mate_ref]
-                middle_pos = int((start + end) / 2)
-                mate_bin = None
-                while not start > end:
-                    if pSharedBinIntvalTree[middle_pos].begin <= read_middle and read_middle <= pSharedBinIntvalTree[middle_pos].end:
-                        mate_bin = pSharedBinIntvalTree[middle_pos]
-                        mate_is_unasigned = False
-                        break
-                    elif pSharedBinIntvalTree[middle_pos].begin > read_middle:
-                        end = middle_pos - 1
-                        middle_pos = int((start + end) / 2)
-                        mate_is_unasigned = True
-                    else:
-                        start = middle_pos + 1
-                        middle_pos = int((start + end) / 2)
-                        mate_is_unasigned = True
-
-            except KeyError:
-                # for small contigs it can happen that they are not
-                # in the bin_intval_tree keys if no restriction site is found
-                # on the contig.
-                mate_is_unasigned = True
-                break
-
-            # report no match case
-            if mate_bin is None:
-                mate_is_unasigned = True
-                break
-            mate_bin_id = mate_bin.data
-            mate_bins.append(mate_bin_id)
-
-        # if a mate is unassigned, it means it is not close
-        # to a restriction site
-        if mate_is_unasigned is True:
-            mate_not_close_to_rf += 1
-            continue
-
-        # check if mates are in the same chromosome
-        if mate1.reference_id != mate2.reference_id:
-            orientation = 'diff_chromosome'
-        else:
-            # to identify 'inward' and 'outward' orientations
-            # the order or the mates in the genome has to be
-            # known.
-            if mate1.pos < mate2.pos:
-                first_mate = mate1
-                second_mate = mate2
-            else:
-                first_mate = mate2
-                second_mate = mate1
-
-            """
-            outward
-            <---------------              ---------------->
-
-            inward
-            --------------->              <----------------
-
-            same-strand-right
-            --------------->              ---------------->
-
-            same-strand-left
-            <---------------              <----------------
-            """
+    records1 = mates_to_records(pMateBuffer1, pDanglingSequences)
+    records2 = mates_to_records(pMateBuffer2, pDanglingSequences)
+    length = min(len(records1), len(records2))
+    records1 = records1[:length]
+    records2 = records2[:length]
+    ref_id1 = records1['reference_id'].astype(np.int64)
+    ref_id2 = records2['reference_id'].astype(np.int64)
+    pos1 = records1['pos'].astype(np.int64)
+    pos2 = records2['pos'].astype(np.int64)
+    qlen1 = records1['qlen'].astype(np.int64)
+    qlen2 = records2['qlen'].astype(np.int64)
+
+    # check if reads belong to a bin. The middle genomic position
+    # of the read is used to find the bin it belongs to.
+    mate_bin1 = pBinLookup.find(ref_id1, pos1 + qlen1 // 2)
+    mate_bin2 = pBinLookup.find(ref_id2, pos2 + qlen2 // 2)
+    # if a mate is unassigned, it means it is not close
+    # to a restriction site
+    assigned = (mate_bin1 >= 0) & (mate_bin2 >= 0)
+    mate_not_close_to_rf = int(np.sum(~assigned))
+
+    same_chromosome = ref_id1 == ref_id2
+    distance = np.abs(pos2 - pos1)
+    # to identify 'inward' and 'outward' orientations
+    # the order or the mates in the genome has to be
+    # known.
+    mate1_is_first = pos1 < pos2
+    first_is_reverse = np.where(mate1_is_first, records1['is_reverse'], records2['is_reverse'])
+    second_is_reverse = np.where(mate1_is_first, records2['is_reverse'], records1['is_reverse'])
+    """
+    outward
+    <---------------              ---------------->
 
-            if not first_mate.is_reverse and second_mate.is_reverse:
-                orientation = 'inward'
-            elif first_mate.is_reverse and not second_mate.is_reverse:
-                orientation = 'outward'
-            elif first_mate.is_reverse and second_mate.is_reverse:
-                orientation = 'same-strand-left'
-            else:
-                orientation = 'same-strand-right'
-
-            # check self-circles
-            # self circles are defined as outward pairs that do not
-            # have a restriction sequence in between. The distance of < 25kb is
-            # used to only check close outward pairs as far apart pairs can not be self-circles
-            if abs(mate2.pos - mate1.pos) < 25000 and orientation == 'outward':
-                if pRfPositions and pRestrictionSequence:
-                    # check if in between the two mate
-                    # ends the restriction fragment is found.
-
-                    # the interval used is:
-                    # start of fragment + length of restriction sequence
-                    # end of fragment - length of restriction sequence
-                    # the restriction sequence length is subtracted
-                    # such that only fragments internally containing
-                    # the restriction site are identified
-                    frag_start = min(mate1.pos, mate2.pos) + \
-                        len(pRestrictionSequence)
-                    frag_end = max(mate1.pos + mate1.qlen, mate2.pos + mate2.qlen) - len(pRestrictionSequence)
-                    mate_ref = pRefId2name[mate1.rname]
-                    has_rf = sorted(
-                        pRfPositions[mate_ref][frag_start: frag_end])
-
-                    if len(has_rf) == 0:
-                        self_circle += 1
-                        if not pKeepSelfCircles:
-                            continue
-
-            if abs(mate2.pos - mate1.pos) < pMaxInsertSize and orientation == 'inward':
-                # check for dangling ends if the restriction sequence is known and if they look
-                # like 'same fragment'
-                if pRestrictionSequence:
-                    if pDanglingSequences:
-                        if check_dangling_end(mate1, pDanglingSequences) or \
-                                check_dangling_end(mate2, pDanglingSequences):
-                            dangling_end += 1
-                            continue
-                has_rf = []
-
-                if pRfPositions and pRestrictionSequence:
-                    # check if in between the two mate
-                    # ends the restriction fragment is found.
-
-                    # the interval used is:
-                    # start of fragment + length of restriction sequence
-                    # end of fragment - length of restriction sequence
-                    # the restriction sequence length is subtracted
-                    # such that only fragments internally containing
-                    # the restriction site are identified
-                    frag_start = min(mate1.pos, mate2.pos) + \
-                        len(pRestrictionSequence)
-                    frag_end = max(mate1.pos + mate1.qlen, mate2.pos + mate2.qlen) - len(pRestrictionSequence)
-                    mate_ref = pRefId2name[mate1.rname]
-                    has_rf = sorted(
-                        pRfPositions[mate_ref][frag_start: frag_end])
-
-                # case when there is no restriction fragment site between the
-                # mates
-                if len(has_rf) == 0:
-                    same_fragment += 1
-                    continue
-
-                self_ligation += 1
-
-                if pRemoveSelfLigation:
-                    # skip self ligations
-                    continue
-
-            # set insert size to save bam
-            mate1.isize = mate2.pos - mate1.pos
-            mate2.isize = mate1.pos - mate2.pos
-
-        # if mate_bins, which is set in the previous section
-        # does not have size=2, it means that one
-        # of the exceptions happened
-        if len(mate_bins) != 2:
-            continue
+    inward
+    --------------->              <----------------
 
-        # count type of pair (distance, orientation)
-        if mate1.reference_id != mate2.reference_id:
-            inter_chromosomal += 1
+    same-strand-right
+    --------------->              ---------------->
 
-        elif abs(mate2.pos - mate1.pos) < 20000:
-            short_range += 1
-        else:
-            long_range += 1
-
-        if orientation == 'inward':
-            count_inward += 1
-        elif orientation == 'outward':
-            count_outward += 1
-        elif orientation == 'same-strand-left':
-            count_left += 1
-        elif orientation == 'same-strand-right':
-            count_right += 1
-
-        for mate in [mate1, mate2]:
-            # fill in coverage vector
-            vec_start = int(max(0, mate.pos - mate_bin.begin) / pBinsize)
-            length_coverage = pCoverageIndex[mate_bin_id].end - \
-                pCoverageIndex[mate_bin_id].begin
-            vec_end = min(length_coverage, int(
-                vec_start + len(mate.seq) / pBinsize))
-            coverage_index = pCoverageIndex[mate_bin_id].begin + vec_start
-            coverage_end = pCoverageIndex[mate_bin_id].begin + vec_end
-            for i in range(coverage_index, coverage_end, 1):
-                pCoverage[i] += 1
-
-        pRow[pair_added] = mate_bins[0]
-        pCol[pair_added] = mate_bins[1]
-        pData[pair_added] = np.uint8(1)
-
-        pair_added += 1
-        if pOutputBamSet:
-
-            out_bam_index_buffer.append(iter_num - 1)
+    same-strand-left
+    <---------------              <----------------
+    """
+    inward = same_chromosome & ~first_is_reverse & second_is_reverse
+    outward = same_chromosome & first_is_reverse & ~second_is_reverse
+    same_strand_left = same_chromosome & first_is_reverse & second_is_reverse
+    same_strand_right = same_chromosome & ~first_is_reverse & ~second_is_reverse
+
+    # the interval used to check for a restriction site in between the two mate ends is:
+    # start of fragment + length of restriction sequence
+    # end of fragment - length of restriction sequence
+    # the restriction sequence length is subtracted
+    # such that only fragments internally containing
+    # the restriction site are identified
+    check_restriction_site = pRfPositions is not None and bool(pRestrictionSequence)
+    if check_restriction_site:
+        fragment_start = np.minimum(pos1, pos2) + len(pRestrictionSequence)
+        fragment_end = np.maximum(pos1 + qlen1, pos2 + qlen2) - len(pRestrictionSequence)
+
+    def has_restriction_site(pMask):
+        has_rf = np.zeros(length, dtype=bool)
+        if check_restriction_site:
+            has_rf[pMask] = pRfPositions.has_site(ref_id1[pMask], fragment_start[pMask], fragment_end[pMask])
+        return has_rf
+
+    keep = assigned.copy()
+
+    # check self-circles
+    # self circles are defined as outward pairs that do not
+    # have a restriction sequence in between. The distance of < 25kb is
+    # used to only check close outward pairs as far apart pairs can not be self-circles
+    self_circle_candidates = assigned & outward & (distance < 25000)
+    self_circles = np.zeros(length, dtype=bool)
+    if check_restriction_site:
+        self_circles = self_circle_candidates & ~has_restriction_site(self_circle_candidates)
+    self_circle = int(np.sum(self_circles))
+    if not pKeepSelfCircles:
+        keep &= ~self_circles
+
+    close_inward = assigned & inward & (distance < pMaxInsertSize)
+    # check for dangling ends if the restriction sequence is known and if they look
+    # like 'same fragment'
+    dangling_ends = np.zeros(length, dtype=bool)
+    if pRestrictionSequence and pDanglingSequences:
+        dangling_ends = close_inward & (records1['dangling_end'] | records2['dangling_end'])
+    dangling_end = int(np.sum(dangling_ends))
+    close_inward &= ~dangling_ends
+    keep &= ~dangling_ends
+
+    # case when there is no restriction fragment site between the
+    # mates
+    has_rf = has_restriction_site(close_inward)
+    same_fragments = close_inward & ~has_rf
+    same_fragment = int(np.sum(same_fragments))
+    keep &= ~same_fragments
+    self_ligations = close_inward & has_rf
+    self_ligation = int(np.sum(self_ligations))
+    if pRemoveSelfLigation:
+        # skip self ligations
+        keep &= ~self_ligations
+
+    # count type of pair (distance, orientation)
+    inter_chromosomal = int(np.sum(keep & ~same_chromosome))
+    short_range = int(np.sum(keep & same_chromosome & (distance < 20000)))
+    long_range = int(np.sum(keep & same_chromosome & (distance >= 20000)))
+    count_inward = int(np.sum(keep & inward))
+    count_outward = int(np.sum(keep & outward))
+    count_left = int(np.sum(keep & same_strand_left))
+    count_right = int(np.sum(keep & same_strand_right))
+
+    pairs = np.flatnonzero(keep)
+    pair_added = len(pairs)
+
+    # ranges of the coverage vector covered by the mates. The coverage of both
+    # mates is counted relative to the bin of the second mate.
+    coverage_index = np.ctypeslib.as_array(pCoverageIndex)
+    bin_of_coverage = mate_bin2[pairs]
+    coverage_begin = coverage_index['begin'][bin_of_coverage].astype(np.int64)
+    length_coverage = coverage_index['end'][bin_of_coverage].astype(np.int64) - coverage_begin
+    bin_begin = pBinLookup.binBegin[bin_of_coverage]
+    starts = []
+    ends = []
+    for records, positions in [(records1, pos1), (records2, pos2)]:
+        vec_start = np.maximum(0, positions[pairs] - bin_begin) // pBinsize
+        vec_end = np.minimum(length_coverage, vec_start + records['query_length'][pairs].astype(np.int64) // pBinsize)
+        starts.append(coverage_begin + vec_start)
+        ends.append(coverage_begin + vec_end)
+    starts = np.concatenate(starts)
+    ends = np.concatenate(ends)
+    not_empty = ends > starts
+    coverage_ranges = int(np.sum(not_empty))
+    np.frombuffer(pCoverageStart, dtype=np.uint32, count=coverage_ranges)[:] = starts[not_empty]
+    np.frombuffer(pCoverageEnd, dtype=np.uint32, count=coverage_ranges)[:] = ends[not_empty]
+
+    np.frombuffer(pRow, dtype=np.uint32, count=pair_added)[:] = mate_bin1[pairs]
+    np.frombuffer(pCol, dtype=np.uint32, count=pair_added)[:] = mate_bin2[pairs]
+    np.frombuffer(pData, dtype=np.uint16, count=pair_added)[:] = 1
+
+    out_bam_index_buffer = pairs.tolist() if pOutputBamSet else []
 
     pQueueOut.put([[one_mate_unmapped, one_mate_low_quality, one_mate_not_unique, dangling_end, self_circle, self_ligation, same_fragment,
                     mate_not_close_to_rf, count_inward, count_outward,
-                    count_left, count_right, inter_chromosomal, short_range, long_range, pair_added, len(pMateBuffer1), pResultIndex, pCounter, out_bam_index_buffer]])
+                    count_left, count_right, inter_chromosomal, short_range, long_range, pair_added, len(pMateBuffer1), pResultIndex, pCounter, out_bam_index_buffer,
+                    time.time() - start_time, coverage_ranges]])
     return
 
 
+def get_checkpoint_settings(pArgs, pMatrixSize, pCoverageSize):
+    """Parameters which influence the result. A run can only be continued from a
+    checkpoint if they are the same."""
+    settings = {'samFiles': [[os.path.basename(sam_file.name), os.path.getsize(sam_file.name)] for sam_file in pArgs.samFiles],
+                'matrixSize': pMatrixSize,
+                'coverageSize': pCoverageSize,
+                'outPairs': pArgs.outPairs is not None}
+    for name in ['binSize', 'minDistance', 'maxLibraryInsertSize', 'restrictionSequence', 'danglingSequence', 'region',
+                 'keepSelfCircles', 'minMappingQuality', 'skipDuplicationCheck', 'duplicateIndex', 'coverageResolution']:
+        settings[name] = getattr(pArgs, name)
+    # same types as after loading the json file of the checkpoint
+    return json.loads(json.dumps(settings))
+
+
 def main(args=None):
     """
     Reads line by line two bam files that are not sorted.
@@ -1079,11 +1912,21 @@ def main(args=None):
 
     log.info("reading {} and {} to build hic_matrix\n".format(args.samFiles[0].name,
                                                               args.samFiles[1].name))
-    str1 = pysam.Samfile(args.samFiles[0].name, 'rb')
-    str2 = pysam.Samfile(args.samFiles[1].name, 'rb')
+    str1 = pysam.Samfile(args.samFiles[0].name, 'rb', threads=max(1, args.decompressionThreads))
+    str2 = pysam.Samfile(args.samFiles[1].name, 'rb', threads=max(1, args.decompressionThreads))
 
     args.samFiles[0].close()
     args.samFiles[1].close()
+    if args.parallelReading and args.outBam and not args.doTestRun:
+        log.warning("--parallelReading can not be combined with --outBam, reading the bam files in the main process.")
+        args.parallelReading = False
+    if args.checkpoint and args.outBam:
+        exit("\n--checkpoint can not be combined with --outBam.\n")
+    if args.resume and not args.checkpoint:
+        exit("\n--resume needs the --checkpoint directory of the interrupted run.\n")
+    checkpoint = None
+    if args.checkpoint and not args.doTestRun:
+        checkpoint = Checkpoint(args.checkpoint)
     if not args.doTestRun:
         if args.outBam:
             args.outBam.close()
@@ -1091,7 +1934,15 @@ def main(args=None):
 
     chrom_sizes = get_chrom_sizes(str1)
 
-    read_pos_matrix = ReadPositionMatrix()
+    if args.duplicateIndex == 'hashed':
+        read_pos_matrix = ReadPositionIndex()
+    elif args.duplicateIndex == 'partitioned':
+        max_memory = None
+        if args.duplicateIndexMaxMemory is not None:
+            max_memory = args.duplicateIndexMaxMemory * 1024 ** 2
+        read_pos_matrix = ReadPositionIndexPartitioned(pMaxMemory=max_memory)
+    else:
+        read_pos_matrix = ReadPositionMatrix()
 
     # define bins
     rf_positions = None
@@ -1101,29 +1952,17 @@ def main(args=None):
                                     min_distance=args.minDistance,
                                     max_distance=args.maxLibraryInsertSize)
 
-        rf_positions = intervalListToIntervalTree(rf_interval)
     else:
         bin_intervals = get_bins(args.binSize[0], chrom_sizes, args.region)
 
     matrix_size = len(bin_intervals)
-    bin_intval_tree = intervalListToIntervalTree(bin_intervals)
     ref_id2name = str1.references
 
-    # build c_type shared memory for the interval tree
-    shared_array_list = []
-    index_dict = {}
-    end = -1
-    for i, seq in enumerate(bin_intval_tree):
-        start = end + 1
-        interval_list = []
-        for interval in bin_intval_tree[seq]:
-            interval_list.append((interval.begin, interval.end, interval.data))
-        end = start + len(bin_intval_tree[seq]) - 1
-        index_dict[seq] = (start, end)
-        interval_list = sorted(interval_list)
-        shared_array_list.extend(interval_list)
-    shared_build_intval_tree = RawArray(C_Interval, shared_array_list)
-    bin_intval_tree = None
+    # lookup tables for the bins and the restriction sites, the worker
+    # processes share them with the main process
+    bin_lookup = BinLookup(bin_intervals, ref_id2name)
+    if args.restrictionCutFile:
+        rf_positions = RestrictionSiteLookup(rf_interval, ref_id2name)
     dangling_sequences = dict()
     if args.danglingSequence:
         # build a list of dangling sequences
@@ -1140,8 +1979,8 @@ def main(args=None):
     # save the number of reads that overlap
     # a bin.
     # To save memory, coverage is not measured by bp
-    # but by bins of length 10bp
-    binsize = 10
+    # but by bins of length --coverageResolution (10bp)
+    binsize = args.coverageResolution
     number_of_elements_coverage = 0
     start_pos_coverage = []
     end_pos_coverage = []
@@ -1153,19 +1992,43 @@ def main(args=None):
         end_pos_coverage.append(number_of_elements_coverage - 1)
     pos_coverage = RawArray(C_Coverage, list(zip(
         start_pos_coverage, end_pos_coverage)))
-    start_pos_coverage = None
-    end_pos_coverage = None
-    coverage = Array(c_uint, [0] * number_of_elements_coverage)
-
-    # define global shared ctypes arrays for row, col and data
+    start_pos_coverage = np.array(start_pos_coverage, dtype=np.int64)
+    end_pos_coverage = np.array(end_pos_coverage, dtype=np.int64)
+    # only the main process adds the coverage ranges returned by the workers. They
+    # are stored as differences, the coverage is the cumulative sum of this vector.
+    coverage_difference = np.zeros(number_of_elements_coverage + 1, dtype=np.int32)
+
+    checkpoint_path = None
+    checkpoint_state = None
+    if checkpoint is not None:
+        checkpoint_settings = get_checkpoint_settings(args, matrix_size, number_of_elements_coverage)
+        if args.resume:
+            checkpoint_path, checkpoint_state = checkpoint.load()
+            if checkpoint_state is None:
+                log.warning("No checkpoint found in {}, starting from the beginning.".format(args.checkpoint))
+            else:
+                changed = [name for name in checkpoint_settings
+                           if checkpoint_settings[name] != checkpoint_state['settings'].get(name)]
+                if changed:
+                    exit("\nThe checkpoint in {} was created with different parameters or input files: "
+                         "{}\n".format(args.checkpoint, ", ".join(changed)))
+
+    # define global shared ctypes arrays for row, col and data. The arrays are
+    # buffer slots which are reused by the worker processes. There are twice as many
+    # slots as workers, the workers can continue while the main process merges a result.
     args.threads = args.threads - 1
-    row = [None] * args.threads
-    col = [None] * args.threads
-    data = [None] * args.threads
-    for i in range(args.threads):
+    number_of_slots = 2 * args.threads
+    row = [None] * number_of_slots
+    col = [None] * number_of_slots
+    data = [None] * number_of_slots
+    coverage_start = [None] * number_of_slots
+    coverage_end = [None] * number_of_slots
+    for i in range(number_of_slots):
         row[i] = RawArray(c_uint, args.inputBufferSize)
         col[i] = RawArray(c_uint, args.inputBufferSize)
         data[i] = RawArray(c_ushort, args.inputBufferSize)
+        coverage_start[i] = RawArray(c_uint, 2 * args.inputBufferSize)
+        coverage_end[i] = RawArray(c_uint, 2 * args.inputBufferSize)
 
     start_time = time.time()
 
@@ -1193,31 +2056,142 @@ def main(args=None):
 
     pair_added = 0
 
-    # input buffer for bam files
-    buffer_workers1 = [None] * args.threads
-    buffer_workers2 = [None] * args.threads
+    # input buffer for bam files, one per buffer slot
+    buffer_workers1 = [None] * number_of_slots
+    buffer_workers2 = [None] * number_of_slots
+    free_slots = list(range(number_of_slots))
 
-    # output buffer to write bam with mate1 and mate2 pairs
-    process = [None] * args.threads
     all_data_processed = False
-    hic_matrix = coo_matrix((matrix_size, matrix_size), dtype='uint32')
-    queue = [None] * args.threads
-
-    all_threads_done = False
-    thread_done = [False] * args.threads
+    # sums up the counts of all buffers, the matrix is created once all pairs are processed
+    hic_matrix_accumulator = SparseMatrixAccumulator((matrix_size, matrix_size), pDtype=np.uint32)
     count_output = 0
     count_call_of_read_input = 0
     computed_pairs = 0
 
+    if checkpoint_state is not None:
+        iter_num, one_mate_unmapped, one_mate_low_quality, one_mate_not_unique, dangling_end, \
+            self_circle, self_ligation, same_fragment, mate_not_close_to_rf, duplicated_pairs, \
+            count_inward, count_outward, count_left, count_right, inter_chromosomal, short_range, \
+            long_range, pair_added, count_output, count_call_of_read_input, computed_pairs = \
+            [checkpoint_state['counters'][name] for name in CHECKPOINT_COUNTERS]
+        hic_matrix_accumulator.restore_state(checkpoint_path, checkpoint_state['accumulator'])
+        coverage_difference[:] = np.load(os.path.join(checkpoint_path, 'coverage_difference.npy'))
+        if not args.skipDuplicationCheck:
+            read_pos_matrix.restore_state(checkpoint_path, checkpoint_state['duplicateIndex'])
+        str1.seek(checkpoint_state['bamOffsets'][0])
+        str2.seek(checkpoint_state['bamOffsets'][1])
+        log.info("continuing from checkpoint {} after {} read pairs\n".format(checkpoint_path, iter_num))
+
     if args.doTestRun:
         args.inputBufferSize = args.doTestRunLines
 
-    while not all_data_processed or not all_threads_done:
-
-        for i in range(args.threads):
-            if queue[i] is None and not all_data_processed:
-                count_call_of_read_input += 1
-
+    pairs_writer = None
+    if args.outPairs and not args.doTestRun:
+        bins_of_pairs = bin_intervals if args.restrictionCutFile else None
+        pairs_writer = PairsWriter(args.outPairs, chrom_sizes, pBinIntervals=bins_of_pairs,
+                                   pMetadata={'generated-by': 'HiCExplorer-' + __version__,
+                                              'bin-type': 'restriction fragments' if args.restrictionCutFile else 'fixed',
+                                              'min-mapping-quality': args.minMappingQuality,
+                                              'max-library-insert-size': args.maxLibraryInsertSize},
+                                   pResumeAt=checkpoint_state['pairs'] if checkpoint_state is not None else None)
+        ref_id2pairs_chrom = np.array([pairs_writer.chromIndex[name] for name in ref_id2name], dtype=np.int32)
+
+    record_stream = None
+    if args.parallelReading:
+        start_offsets = [str1.tell(), str2.tell()]
+        str1.close()
+        str2.close()
+        record_stream = PairedRecordStream([args.samFiles[0].name, args.samFiles[1].name],
+                                           pChunkSize=min(args.inputBufferSize, 100000),
+                                           pDecompressionThreads=args.decompressionThreads,
+                                           pDanglingSequences=dangling_sequences,
+                                           pStartOffsets=start_offsets)
+
+    # persistent worker processes. The bounded task queue holds at most one buffer per slot,
+    # the main process blocks on the result queue if no slot is free.
+    task_queue = Queue(maxsize=number_of_slots)
+    result_queue = Queue()
+    process = [None] * args.threads
+    for i in range(args.threads):
+        process[i] = Process(target=process_data_worker, kwargs=dict(
+            pTaskQueue=task_queue,
+            pResultQueue=result_queue,
+            pRow=row,
+            pCol=col,
+            pData=data,
+            pCoverageStart=coverage_start,
+            pCoverageEnd=coverage_end,
+            pProcessDataArguments=dict(
+                pMinMappingQuality=args.minMappingQuality,
+                pKeepSelfCircles=args.keepSelfCircles,
+                pRestrictionSequence=args.restrictionSequence,
+                pRemoveSelfLigation=args.removeSelfLigation,
+                pMatrixSize=matrix_size,
+                pRfPositions=rf_positions,
+                pRefId2name=ref_id2name,
+                pDanglingSequences=dangling_sequences,
+                pBinsize=binsize,
+                pTemplate=None,
+                pOutputBamSet=args.outBam or pairs_writer is not None,
+                pBinLookup=bin_lookup,
+                pCoverageIndex=pos_coverage,
+                pOutputFileBufferDir="",
+                pMaxInsertSize=args.maxLibraryInsertSize)
+        ))
+        process[i].start()
+
+    # time spent in the different stages, used to report the throughput
+    time_reading = 0.0
+    time_workers = 0.0
+    time_merging = 0.0
+    time_waiting = 0.0
+
+    # a checkpoint is written once all buffers which are in process are merged
+    checkpoint_time = time.time()
+    checkpoint_pending = False
+
+    while not all_data_processed or len(free_slots) < number_of_slots:
+
+        if checkpoint_pending and len(free_slots) == number_of_slots:
+            checkpoint_path = checkpoint.begin()
+            checkpoint_state = {'settings': checkpoint_settings,
+                                'counters': dict(zip(CHECKPOINT_COUNTERS, [
+                                    iter_num, one_mate_unmapped, one_mate_low_quality, one_mate_not_unique, dangling_end,
+                                    self_circle, self_ligation, same_fragment, mate_not_close_to_rf, duplicated_pairs,
+                                    count_inward, count_outward, count_left, count_right, inter_chromosomal, short_range,
+                                    long_range, pair_added, count_output, count_call_of_read_input, computed_pairs])),
+                                'bamOffsets': record_stream.tell() if record_stream is not None else [str1.tell(), str2.tell()],
+                                'accumulator': hic_matrix_accumulator.save_state(checkpoint_path),
+                                'pairs': 0}
+            np.save(os.path.join(checkpoint_path, 'coverage_difference.npy'), coverage_difference)
+            if not args.skipDuplicationCheck:
+                checkpoint_state['duplicateIndex'] = read_pos_matrix.save_state(checkpoint_path)
+            if pairs_writer is not None:
+                pairs_writer.flush()
+                checkpoint_state['pairs'] = pairs_writer.numberOfPairs
+            checkpoint.commit(checkpoint_path, checkpoint_state)
+            checkpoint_state = None
+            log.info("checkpoint written to {} after {} read pairs\n".format(checkpoint_path, iter_num))
+            checkpoint_pending = False
+            checkpoint_time = time.time()
+
+        wait_for_result = True
+        if free_slots and not all_data_processed and not checkpoint_pending:
+            i = free_slots.pop()
+            count_call_of_read_input += 1
+
+            stage_start = time.time()
+            if record_stream is not None:
+                buffer_workers1[i], buffer_workers2[i], all_data_processed, \
+                    duplicated_pairs_, one_mate_unmapped_, one_mate_not_unique_, \
+                    one_mate_low_quality_, iter_num_ = readRecordBuffers(pRecordStream=record_stream,
+                                                                         pNumberOfItemsPerBuffer=args.inputBufferSize,
+                                                                         pSkipDuplicationCheck=args.skipDuplicationCheck,
+                                                                         pReadPosMatrix=read_pos_matrix,
+                                                                         pRefId2name=ref_id2name,
+                                                                         pMinMappingQuality=args.minMappingQuality
+                                                                         )
+            else:
                 buffer_workers1[i], buffer_workers2[i], all_data_processed, \
                     duplicated_pairs_, one_mate_unmapped_, one_mate_not_unique_, \
                     one_mate_low_quality_, iter_num_ = readBamFiles(pFileOneIterator=str1,
@@ -1228,132 +2202,137 @@ def main(args=None):
                                                                     pRefId2name=ref_id2name,
                                                                     pMinMappingQuality=args.minMappingQuality
                                                                     )
-                duplicated_pairs += duplicated_pairs_
-                one_mate_unmapped += one_mate_unmapped_
-                one_mate_not_unique += one_mate_not_unique_
-                one_mate_low_quality += one_mate_low_quality_
-                iter_num += iter_num_
-                queue[i] = Queue()
-                thread_done[i] = False
+            duplicated_pairs += duplicated_pairs_
+            one_mate_unmapped += one_mate_unmapped_
+            one_mate_not_unique += one_mate_not_unique_
+            one_mate_low_quality += one_mate_low_quality_
+            iter_num += iter_num_
+            if buffer_workers1[i] is not None:
                 computed_pairs += len(buffer_workers1[i])
-                # create process to compute hic matrix for this buffer
-                process[i] = Process(target=process_data, kwargs=dict(
-                    pMateBuffer1=buffer_workers1[i],
-                    pMateBuffer2=buffer_workers2[i],
-                    pMinMappingQuality=args.minMappingQuality,
-                    pKeepSelfCircles=args.keepSelfCircles,
-                    pRestrictionSequence=args.restrictionSequence,
-                    pRemoveSelfLigation=args.removeSelfLigation,
-                    pMatrixSize=matrix_size,
-                    pRfPositions=rf_positions,
-                    pRefId2name=ref_id2name,
-                    pDanglingSequences=dangling_sequences,
-                    pBinsize=binsize,
-                    pResultIndex=i,
-                    pQueueOut=queue[i],
-                    pTemplate=str1,
-                    pOutputBamSet=args.outBam,
-                    pCounter=count_output,
-                    pSharedBinIntvalTree=shared_build_intval_tree,
-                    pDictBinIntervalTreeIndex=index_dict,
-                    pCoverage=coverage,
-                    pCoverageIndex=pos_coverage,
-                    pOutputFileBufferDir="",
-                    pRow=row[i],
-                    pCol=col[i],
-                    pData=data[i],
-                    pMaxInsertSize=args.maxLibraryInsertSize
-                ))
-                process[i].start()
-                count_output += 1
-
-            elif queue[i] is not None and not queue[i].empty():
-                result = queue[i].get()
-
-                if result[0] is not None:
-                    elements = result[0][15]
-                    if hic_matrix is None:
-                        hic_matrix = coo_matrix(
-                            (data[i][:elements], (row[i][:elements], col[i][:elements])), shape=(matrix_size, matrix_size))
-                    else:
-                        hic_matrix += coo_matrix(
-                            (data[i][:elements], (row[i][:elements], col[i][:elements])), shape=(matrix_size, matrix_size))
-
-                    dangling_end += result[0][3]
-                    self_circle += result[0][4]
-                    self_ligation += result[0][5]
-                    same_fragment += result[0][6]
-                    mate_not_close_to_rf += result[0][7]
-
-                    count_inward += result[0][8]
-                    count_outward += result[0][9]
-                    count_left += result[0][10]
-                    count_right += result[0][11]
-                    inter_chromosomal += result[0][12]
-                    short_range += result[0][13]
-                    long_range += result[0][14]
-
-                    pair_added += result[0][15]
-                    iter_num += result[0][16]
-
-                for bam_index in result[0][19]:
-                    mate1 = buffer_workers1[i][bam_index]
-                    mate2 = buffer_workers2[i][bam_index]
-
-                    mate1.flag |= 0x1
-                    mate2.flag |= 0x1
-
-                    # set one read as the first in pair and the
-                    # other as second
-                    mate1.flag |= 0x40
-                    mate2.flag |= 0x80
-
-                    # set chrom of mate
-                    mate1.mrnm = mate2.rname
-                    mate2.mrnm = mate1.rname
-
-                    # set position of mate
-                    mate1.mpos = mate2.pos
-                    mate2.mpos = mate1.pos
-
-                    out_bam_file.write(mate1)
-                    out_bam_file.write(mate2)
-
-                buffer_workers1[i] = None
-                buffer_workers2[i] = None
-                queue[i] = None
-                process[i].join()
-                process[i].terminate()
-                process[i] = None
-                thread_done[i] = True
-
-                # caused by the architecture I try to display this output
-                # information after +-1e5 of 1e6 reads.
-                if iter_num % 1e6 < 100000:
-                    elapsed_time = time.time() - start_time
-                    log.info("processing {} lines took {:.2f} "
-                             "secs ({:.1f} lines per "
-                             "second)\n".format(iter_num,
-                                                elapsed_time,
-                                                iter_num / elapsed_time))
-                    log.info("{} ({:.2f}%) valid pairs added to matrix"
-                             "\n".format(pair_added, float(100 * pair_added) / iter_num))
-                if args.doTestRun and iter_num > args.doTestRunLines:
-                    log.debug(
-                        "\n## *WARNING*. Early exit because of --doTestRun parameter  ##\n\n")
-                    all_data_processed = True
-                    thread_done[i] = True
-                    break
-            elif all_data_processed and queue[i] is None:
-                thread_done[i] = True
-            else:
-                time.sleep(1)
+            # the workers get the buffers as records, pysam.AlignedSegments can not be pickled
+            task_queue.put((i, mates_to_records(buffer_workers1[i], dangling_sequences),
+                            mates_to_records(buffer_workers2[i], dangling_sequences), count_output))
+            count_output += 1
+            time_reading += time.time() - stage_start
+            # continue reading if a slot is free, otherwise wait for a worker
+            wait_for_result = all_data_processed or not free_slots
+
+        # merge all results which are ready
+        while True:
+            stage_start = time.time()
+            result = get_worker_result(result_queue, process, wait_for_result)
+            time_waiting += time.time() - stage_start
+            if result is None:
+                break
+            wait_for_result = False
+            stage_start = time.time()
+            i = result[0][17]
+
+            if result[0] is not None:
+                time_workers += result[0][20]
+                elements = result[0][15]
+                hic_matrix_accumulator.add(np.frombuffer(row[i], dtype=np.uint32, count=elements),
+                                           np.frombuffer(col[i], dtype=np.uint32, count=elements),
+                                           np.frombuffer(data[i], dtype=np.uint16, count=elements))
+                coverage_ranges = result[0][21]
+                np.add.at(coverage_difference, np.frombuffer(coverage_start[i], dtype=np.uint32, count=coverage_ranges), 1)
+                np.add.at(coverage_difference, np.frombuffer(coverage_end[i], dtype=np.uint32, count=coverage_ranges), -1)
+
+                dangling_end += result[0][3]
+                self_circle += result[0][4]
+                self_ligation += result[0][5]
+                same_fragment += result[0][6]
+                mate_not_close_to_rf += result[0][7]
+
+                count_inward += result[0][8]
+                count_outward += result[0][9]
+                count_left += result[0][10]
+                count_right += result[0][11]
+                inter_chromosomal += result[0][12]
+                short_range += result[0][13]
+                long_range += result[0][14]
+
+                pair_added += result[0][15]
+                iter_num += result[0][16]
+
+            if pairs_writer is not None:
+                pairs_writer.append(get_pairs_columns(buffer_workers1[i], buffer_workers2[i], result[0][19],
+                                                      row[i][:result[0][15]], col[i][:result[0][15]],
+                                                      ref_id2pairs_chrom))
+
+            for bam_index in result[0][19] if args.outBam else []:
+                mate1 = buffer_workers1[i][bam_index]
+                mate2 = buffer_workers2[i][bam_index]
+
+                mate1.flag |= 0x1
+                mate2.flag |= 0x1
+
+                # set one read as the first in pair and the
+                # other as second
+                mate1.flag |= 0x40
+                mate2.flag |= 0x80
+
+                # set chrom of mate
+                mate1.mrnm = mate2.rname
+                mate2.mrnm = mate1.rname
+
+                # set position of mate
+                mate1.mpos = mate2.pos
+                mate2.mpos = mate1.pos
+
+                out_bam_file.write(mate1)
+                out_bam_file.write(mate2)
+
+            buffer_workers1[i] = None
+            buffer_workers2[i] = None
+            free_slots.append(i)
+            time_merging += time.time() - stage_start
+
+            # caused by the architecture I try to display this output
+            # information after +-1e5 of 1e6 reads.
+            if iter_num % 1e6 < 100000:
+                elapsed_time = time.time() - start_time
+                log.info("processing {} lines took {:.2f} "
+                         "secs ({:.1f} lines per "
+                         "second)\n".format(iter_num,
+                                            elapsed_time,
+                                            iter_num / elapsed_time))
+                log.info("{} ({:.2f}%) valid pairs added to matrix"
+                         "\n".format(pair_added, float(100 * pair_added) / iter_num))
+            if args.doTestRun and iter_num > args.doTestRunLines and not all_data_processed:
+                log.debug(
+                    "\n## *WARNING*. Early exit because of --doTestRun parameter  ##\n\n")
+                all_data_processed = True
+
+        if checkpoint is not None and not all_data_processed and \
+                time.time() - checkpoint_time >= args.checkpointInterval * 60:
+            checkpoint_pending = True
 
-        if all_data_processed:
-            all_threads_done = True
-            for thread in thread_done:
-                if not thread:
-                    all_threads_done = False
+    for i in range(args.threads):
+        task_queue.put(None)
+    for i in range(args.threads):
+        process[i].join()
+
+    if record_stream is not None:
+        record_stream.close()
+    if pairs_writer is not None:
+        log.info("{} valid pairs written to {}\n".format(pairs_writer.numberOfPairs, args.outPairs))
+        pairs_writer.close()
+    elapsed_time = time.time() - start_time
+    log.info("throughput per stage (pairs per second): reading and filtering {:.1f}, workers {:.1f} "
+             "(per worker, {} workers), merging {:.1f}, total {:.1f}\n".format(iter_num / max(time_reading, 1e-9),
+                                                                               iter_num / max(time_workers, 1e-9),
+                                                                               args.threads,
+                                                                               iter_num / max(time_merging, 1e-9),
+                                                                               iter_num / max(elapsed_time, 1e-9)))
+    log.info("time per stage: reading and filtering {:.2f} secs, workers {:.2f} secs (sum of all workers), merging {:.2f} secs, "
+             "waiting for workers {:.2f} secs\n".format(time_reading, time_workers, time_merging, time_waiting))
+
+    if not args.skipDuplicationCheck:
+        read_pos_matrix.log_summary()
+    if isinstance(read_pos_matrix, ReadPositionIndex):
+        read_pos_matrix.close()
+    read_pos_matrix = None
 
     if not args.doTestRun:
         # the resulting matrix is only filled unevenly with some pairs
@@ -1364,23 +2343,17 @@ def main(args=None):
         if args.outBam:
             out_bam_file.close()
 
+        hic_matrix = hic_matrix_accumulator.tocsr()
+        hic_matrix_accumulator = None
         dia = dia_matrix(([hic_matrix.diagonal()], [0]),
                          shape=hic_matrix.shape)
         hic_matrix = hic_matrix + hic_matrix.T - dia
         # extend bins such that they are next to each other
         bin_intervals = enlarge_bins(bin_intervals[:], chrom_sizes)
         # compute max bin coverage
-        bin_max = []
-
-        for cover in pos_coverage:
-            max_element = 0
-            for i in range(cover.begin, cover.end, 1):
-                if coverage[i] > max_element:
-                    max_element = coverage[i]
-            if max_element == 0:
-                bin_max.append(np.nan)
-            else:
-                bin_max.append(max_element)
+        coverage = np.cumsum(coverage_difference, out=coverage_difference)[:-1]
+        bin_max = get_bin_max_coverage(coverage, start_pos_coverage, end_pos_coverage).tolist()
+        coverage = coverage_difference = None
 
         chr_name_list, start_list, end_list = list(zip(*bin_intervals))
         bin_intervals = list(zip(chr_name_list, start_list, end_list, bin_max))
@@ -1502,7 +2475,7 @@ Max library insert size\t{}\t\t
         hic_metadata['genome-assembly'] = np.string_(args.genomeAssembly)
 
     intermediate_qc_log.close()
-    if args.outFileName.name.endswith('.cool') and args.binSize is not None and len(args.binSize) > 2:
+    if args.outFileName.name.endswith('.cool') and args.binSize is not None and len(args.binSize) > 1:
 
         matrixFileHandlerOutput = MatrixFileHandler(
             pFileType='cool', pHiCInfo=hic_metadata)
@@ -1513,12 +2486,16 @@ Max library insert size\t{}\t\t
                                                      hic_ma.distance_counts)
         matrixFileHandlerOutput.save(args.outFileName.name + '::/resolutions/' + str(
             args.binSize[0]), pSymmetric=True, pApplyCorrection=False)
-
-        for resolution in args.binSize[1:]:
-            hic_matrix_to_merge = deepcopy(hic_ma)
-            _mergeFactor = int(resolution) // args.binSize[0]
-            merged_matrix = hicMergeMatrixBins.merge_bins(
-                hic_matrix_to_merge, _mergeFactor)
+        matrixFileHandlerOutput = None
+
+        # the coarser resolutions are merged from the upper triangle of the finest
+        # matrix, each one is written as soon as it is created
+        cut_intervals = hic_ma.cut_intervals
+        hic_matrix = triu(hic_ma.matrix, format='csr')
+        hic_ma = None
+        merge_factors = [int(resolution) // args.binSize[0] for resolution in args.binSize[1:]]
+        merged_matrices = hicMergeMatrixBins.merge_bins_in_chunks(hic_matrix, cut_intervals, merge_factors)
+        for resolution, merged_matrix in zip(args.binSize[1:], merged_matrices):
             matrixFileHandlerOutput = MatrixFileHandler(
                 pFileType='cool', pAppend=True, pHiCInfo=hic_metadata)
             matrixFileHandlerOutput.set_matrix_variables(merged_matrix.matrix,
@@ -1528,11 +2505,15 @@ Max library insert size\t{}\t\t
                                                          merged_matrix.distance_counts)
             matrixFileHandlerOutput.save(args.outFileName.name + '::/resolutions/' + str(
                 resolution), pSymmetric=True, pApplyCorrection=False)
+            matrixFileHandlerOutput = merged_matrix = None
 
     else:
         if not args.doTestRun:
             hic_ma.save(args.outFileName.name, pHiCInfo=hic_metadata)
 
+    if checkpoint is not None:
+        checkpoint.remove()
+
 
 class Tester(object):
     def __init__(self):
@@ -1,17 +1,28 @@
 import warnings
 import sys
+import os
+from tempfile import NamedTemporaryFile
+import json
+import time
 warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 import argparse
 from past.builtins import zip
-from scipy.sparse import lil_matrix
-
-from hicexplorer.iterativeCorrection import iterativeCorrection
+from scipy.sparse import csr_matrix
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
+
+from hicexplorer.iterativeCorrection import iterativeCorrectionUpperTriangle, start_bias
+from hicexplorer.lib.chunkedBalancing import CoolerPixelChunks, chunk_size_for_budget, marginals
+from hicexplorer.lib.chunkedBalancing import iterativeCorrectionChunked, corrected_pixels
+from hicexplorer.lib.marginals import Marginals, matrix_checksum, sidecar_file_name
 from hicmatrix import HiCMatrix as hm
 from hicexplorer._version import __version__
 from hicexplorer.utilities import toString
 from hicexplorer.utilities import convertNansToZeros, convertInfsToZeros
-from hicexplorer.utilities import check_cooler
+from hicexplorer.utilities import check_cooler, shared_array
+import cooler
+import tables
 
 # Knight-Ruiz algorithm:
 from krbalancing import *
@@ -28,6 +39,11 @@ debug = 0
 import logging
 log = logging.getLogger(__name__)
 
+# shared matrices of the worker processes of --perchr, set by the initializer of the pool
+matrix_of_worker = None
+corrected_of_worker = None
+args_of_worker = None
+
 
 def parse_arguments(args=None):
 
@@ -125,6 +141,13 @@ Statistical Techniques, Edward F. Mykytka, Ph.D., Editor).
         'per chromosome to find the most conservative `filterThreshold`.',
         action='store_true')
 
+    plot_modeOpt.add_argument('--cacheMarginals',
+                              help='Stores the row sums, the diagonal and the per chromosome row sums of the matrix '
+                              'next to the matrix file (<matrix>.marginals.npz), keyed by a checksum of the matrix file, '
+                              'and reuses them in later runs of diagnostic_plot and correct on the same matrix. With '
+                              'cached marginals diagnostic_plot does not load the matrix.',
+                              action='store_true')
+
     plot_modeOpt.add_argument('--verbose',
                               help='Print processing status.',
                               action='store_true')
@@ -230,6 +253,49 @@ def correct_subparser():
                            'of chromosomes and/or translocations.',
                            action='store_true')
 
+    parserOpt.add_argument('--threads',
+                           help='Number of threads used by the ICE correction. With --perchr, the number of '
+                           'chromosomes which are corrected in parallel processes, with ICE or KR.',
+                           type=int,
+                           default=1)
+
+    parserOpt.add_argument('--precision',
+                           help='Floating point precision of the matrix values during the ICE correction and '
+                           'of the corrected matrix. float32 halves the memory, the correction factors are '
+                           'always computed in float64. Only for ICE!',
+                           choices=['float64', 'float32'],
+                           default='float64')
+
+    parserOpt.add_argument('--cacheMarginals',
+                           help='Stores the row sums, the diagonal and the per chromosome row sums of the matrix '
+                           'next to the matrix file (<matrix>.marginals.npz), keyed by a checksum of the matrix file, '
+                           'and reuses them in later runs of diagnostic_plot and correct on the same matrix. With '
+                           'cached marginals diagnostic_plot does not load the matrix.',
+                           action='store_true')
+
+    parserOpt.add_argument('--initialBias',
+                           help='Corrected matrix of a previous hicCorrectMatrix run with the same correction '
+                           'method, h5 or cool. Its correction factors are used to start the correction instead '
+                           'of a vector of ones, a re-balancing after small changes, e.g. of --filterThreshold '
+                           'or after hicSumMatrices, needs only a few iterations. The bins are matched by their '
+                           'position, bins without a factor start with the median factor.',
+                           metavar='FILENAME',
+                           default=None)
+
+    parserOpt.add_argument('--outOfCore',
+                           help='Balances the pixels of a cool file in chunks without loading the matrix '
+                           'into memory. Only the bias vector is kept in memory, each iteration reads the '
+                           'pixels once. The output has the same corrected pixels and weight column as '
+                           'without --outOfCore. Supports --filterThreshold, --iterNum, --skipDiagonal '
+                           'and --precision. Only for ICE!',
+                           action='store_true')
+
+    parserOpt.add_argument('--memoryBudget',
+                           help='Memory in MB used by --outOfCore for the pixel chunks and the vectors of '
+                           'the bins. If all pixels fit, they are kept in memory after the first pass.',
+                           type=int,
+                           default=4096)
+
     parserOpt.add_argument('--verbose',
                            help='Print processing status',
                            action='store_true')
@@ -238,12 +304,231 @@ def correct_subparser():
     return parser
 
 
-def iterative_correction(matrix, args):
-    corrected_matrix, correction_factors = iterativeCorrection(matrix,
-                                                               M=args.iterNum,
-                                                               verbose=args.verbose)
+def iterative_correction(matrix, args, initial_bias=None):
+    corrected_matrix, correction_factors, convergence = iterativeCorrectionUpperTriangle(matrix,
+                                                                                         M=args.iterNum,
+                                                                                         verbose=args.verbose,
+                                                                                         threads=args.threads,
+                                                                                         dtype=np.dtype(args.precision).type,
+                                                                                         initial_bias=initial_bias,
+                                                                                         report=True)
+
+    return corrected_matrix, correction_factors, convergence
+
 
-    return corrected_matrix, correction_factors
+def kr_correction(matrix, args, initial_factors=None):
+    """
+    Knight-Ruiz balancing of the matrix. Returns the normalised matrix, only for h5 output
+    files, the correction factors and a convergence report. With initial factors x0 the
+    matrix x0_i * a_ij * x0_j is balanced and its factors are multiplied by x0, if x0 is
+    close to the result only a few iterations are needed.
+    """
+    start_time = time.time()
+    matrix = csr_matrix(matrix)
+    balanced_matrix = matrix
+    if initial_factors is not None:
+        initial_factors = start_bias(initial_factors, matrix.shape[0])
+        data = matrix.data.astype(np.float64) * np.repeat(initial_factors, np.diff(matrix.indptr))
+        data *= initial_factors[matrix.indices]
+        balanced_matrix = csr_matrix((data, matrix.indices, matrix.indptr), shape=matrix.shape)
+
+    log.debug("Loading a float sparse matrix for KR balancing")
+    kr = kr_balancing(balanced_matrix.shape[0], balanced_matrix.shape[1],
+                      balanced_matrix.count_nonzero(), balanced_matrix.indptr.astype(np.int64, copy=False),
+                      balanced_matrix.indices.astype(np.int64, copy=False),
+                      balanced_matrix.data.astype(np.float64, copy=False))
+    log.debug('passed pointers')
+    kr.computeKR()
+    log.debug('computation done')
+
+    # set it to False since the vector is already normalised
+    # with the previous True
+    correction_factors = np.asarray(kr.get_normalisation_vector(False).todense()).flatten()
+    normalised_matrix = None
+    if args.outFileName.endswith('.h5'):
+        normalised_matrix = kr.get_normalised_matrix(True)
+        if initial_factors is not None:
+            # the normalised matrix keeps the sum of the balanced matrix
+            normalised_matrix = normalised_matrix * (matrix.sum() / balanced_matrix.sum())
+    if initial_factors is not None:
+        correction_factors *= initial_factors
+
+    # krbalancing does not report its iterations, the residual is computed from the result
+    row_sum = correction_factors * matrix.dot(correction_factors)
+    residual = np.abs(row_sum[row_sum != 0] - 1).max() if np.any(row_sum != 0) else 0.0
+    convergence = {'residuals': [float(residual)], 'wall_time': time.time() - start_time}
+    return normalised_matrix, correction_factors, convergence
+
+
+def load_initial_factors(pFileName, pCutIntervals, pCorrectionMethod):
+    """
+    Returns the correction factors of the corrected matrix pFileName, of a previous run with
+    the same correction method, for the bins pCutIntervals. The bins are matched by chromosome,
+    start and end, bins without a factor get nan. The weights of cool files with the attribute
+    divisive_weights set to False, e.g. of cooler balance, are multiplicative and inverted for ICE.
+    """
+    if check_cooler(pFileName):
+        bins = cooler.Cooler(pFileName).bins()[:]
+        if 'weight' not in bins:
+            raise ValueError("{} has no weight column.".format(pFileName))
+        factors = bins['weight'].values.astype(np.float64)
+        file_name, group_path = cooler.util.parse_cooler_uri(pFileName)
+        with cooler.util.open_hdf5(file_name, mode='r') as h5_file:
+            divisive = h5_file[group_path]['bins']['weight'].attrs.get('divisive_weights', True)
+        if pCorrectionMethod == 'ICE' and not divisive:
+            factors = np.divide(1.0, factors, out=np.full(len(factors), np.nan), where=factors != 0)
+        intervals = zip(bins['chrom'].astype(str).values, bins['start'].values, bins['end'].values)
+    else:
+        with tables.open_file(pFileName, 'r') as h5_file:
+            if not hasattr(h5_file.root, 'correction_factors'):
+                raise ValueError("{} has no correction factors.".format(pFileName))
+            factors = np.array(h5_file.root.correction_factors.read(), dtype=np.float64).flatten()
+            intervals = zip([toString(chrom) for chrom in h5_file.root.intervals.chr_list.read()],
+                            h5_file.root.intervals.start_list.read(), h5_file.root.intervals.end_list.read())
+    factor_of_bin = {(chrom, int(start), int(end)): factor for (chrom, start, end), factor in zip(intervals, factors)}
+    return np.array([factor_of_bin.get((toString(chrom), int(start), int(end)), np.nan)
+                     for chrom, start, end, _ in pCutIntervals])
+
+
+def save_correction_report(pFileName, pReport):
+    """
+    Stores the convergence report as json in the metadata of the cool file or as
+    attribute 'correction_report' of the root node of the h5 file.
+    """
+    if check_cooler(pFileName):
+        file_name, group_path = cooler.util.parse_cooler_uri(pFileName)
+        with cooler.util.open_hdf5(file_name, mode='r+') as h5_file:
+            group = h5_file[group_path]
+            metadata = json.loads(group.attrs['metadata']) if 'metadata' in group.attrs else {}
+            metadata['correction_report'] = pReport
+            group.attrs['metadata'] = json.dumps(metadata)
+    else:
+        with tables.open_file(pFileName, 'r+') as h5_file:
+            h5_file.set_node_attr('/', 'correction_report', json.dumps(pReport))
+
+
+def init_correction_worker(pMatrix, pCorrected, pArgs):
+    global matrix_of_worker, corrected_of_worker, args_of_worker
+    matrix_of_worker = pMatrix
+    corrected_of_worker = pCorrected
+    args_of_worker = pArgs
+
+
+def correct_chromosome(pTask):
+    """pTask is (chromosome index, first bin, end bin, offset, initial factors or None). Corrects the
+    bins of the chromosome in the shared matrix and writes the corrected values to the shared block
+    diagonal matrix, starting at the offset. Returns the chromosome index, the correction factors, the
+    number of written values and the convergence report."""
+    chrom_index, start, end, offset, initial_factors = pTask
+    (indptr, indptr_dtype), (indices, indices_dtype), (data, data_dtype), number_of_values = matrix_of_worker
+    indptr = np.frombuffer(indptr, dtype=indptr_dtype)
+    value_range = slice(indptr[start], indptr[end])
+    indices = np.frombuffer(indices, dtype=indices_dtype, count=number_of_values)[value_range]
+    data = np.frombuffer(data, dtype=data_dtype, count=number_of_values)[value_range]
+
+    # same as matrix[start:end, start:end]
+    rows = np.repeat(np.arange(end - start), np.diff(indptr[start:end + 1]))
+    mask = (indices >= start) & (indices < end)
+    chr_indptr = np.concatenate([[0], np.cumsum(np.bincount(rows[mask], minlength=end - start))])
+    chr_submatrix = csr_matrix((data[mask], indices[mask] - start, chr_indptr), shape=(end - start, end - start))
+    rows = mask = None
+
+    args = args_of_worker
+    if args.correctionMethod == 'ICE':
+        corrected_block, correction_factors, convergence = iterative_correction(chr_submatrix, args, initial_factors)
+    else:
+        assert(args.correctionMethod == 'KR')
+        corrected_block, correction_factors, convergence = kr_correction(chr_submatrix, args, initial_factors)
+    chr_submatrix = None
+
+    number_of_written_values = 0
+    if corrected_block is not None:
+        corrected_block = csr_matrix(corrected_block)
+        corrected_block.eliminate_zeros()
+        corrected_block.sort_indices()
+        number_of_written_values = corrected_block.nnz
+        (row_nnz, row_nnz_dtype), (indices, indices_dtype), (data, data_dtype) = corrected_of_worker
+        np.frombuffer(row_nnz, dtype=row_nnz_dtype)[start:end] = np.diff(corrected_block.indptr)
+        np.frombuffer(indices, dtype=indices_dtype)[offset:offset + number_of_written_values] = corrected_block.indices + start
+        np.frombuffer(data, dtype=data_dtype)[offset:offset + number_of_written_values] = corrected_block.data
+    return chrom_index, correction_factors, number_of_written_values, convergence
+
+
+def correct_per_chromosome(hic_ma, args, initial_factors=None):
+    """
+    Corrects each chromosome independently, with --threads chromosomes in parallel. The
+    matrix is moved to shared memory and the corrected chromosomes are written directly
+    into the arrays of a block diagonal csr matrix. Returns the corrected matrix, the
+    correction factors and the convergence reports of the chromosomes.
+    """
+    matrix = hic_ma.matrix.tocsr()
+    matrix_size = matrix.shape[0]
+    chr_names = sorted(list(hic_ma.interval_trees), key=lambda chrname: hic_ma.getChrBinRange(chrname))
+    chr_ranges = [hic_ma.getChrBinRange(chrname) for chrname in chr_names]
+
+    # the corrected matrix has at most the values of the diagonal blocks of the matrix
+    block_values = []
+    for start, end in chr_ranges:
+        indices = matrix.indices[matrix.indptr[start]:matrix.indptr[end]]
+        block_values.append(int(np.sum((indices >= start) & (indices < end))))
+    offsets = np.concatenate([[0], np.cumsum(block_values)]).astype(np.int64).tolist()
+    index_dtype = matrix.indices.dtype
+
+    shared_matrix = []
+    for array in [matrix.indptr, matrix.indices, matrix.data]:
+        shared_matrix.append((shared_array(array), array.dtype))
+    shared_matrix.append(matrix.nnz)
+    # the matrix object uses the shared memory from now on
+    hic_ma.matrix = csr_matrix((np.frombuffer(shared_matrix[2][0], dtype=matrix.data.dtype, count=matrix.nnz),
+                                np.frombuffer(shared_matrix[1][0], dtype=matrix.indices.dtype, count=matrix.nnz),
+                                np.frombuffer(shared_matrix[0][0], dtype=matrix.indptr.dtype)), shape=matrix.shape)
+    matrix = None
+
+    data_dtype = np.dtype(args.precision) if args.correctionMethod == 'ICE' else np.dtype(np.float64)
+    shared_corrected = [(RawArray(np.ctypeslib.as_ctypes_type(np.int64), matrix_size), np.int64),
+                        (RawArray(np.ctypeslib.as_ctypes_type(index_dtype), max(1, offsets[-1])), index_dtype),
+                        (RawArray(np.ctypeslib.as_ctypes_type(data_dtype), max(1, offsets[-1])), data_dtype)]
+
+    # the largest chromosomes first, such that no process is left with a large one at the end
+    tasks = [(i, start, end, offsets[i], None if initial_factors is None else initial_factors[start:end])
+             for i, (start, end) in enumerate(chr_ranges)]
+    tasks = sorted(tasks, key=lambda task: block_values[task[0]], reverse=True)
+    worker_args = argparse.Namespace(**vars(args))
+    worker_args.threads = 1
+    correction_factors = [None] * len(chr_ranges)
+    written_values = [0] * len(chr_ranges)
+    convergence = {}
+    if args.threads > 1 and len(tasks) > 1:
+        pool = Pool(processes=min(args.threads, len(tasks)), initializer=init_correction_worker,
+                    initargs=(shared_matrix, shared_corrected, worker_args))
+        results = pool.imap_unordered(correct_chromosome, tasks)
+    else:
+        pool = None
+        init_correction_worker(shared_matrix, shared_corrected, worker_args)
+        results = map(correct_chromosome, tasks)
+    for chrom_index, chr_correction_factors, number_of_written_values, chr_convergence in results:
+        correction_factors[chrom_index] = chr_correction_factors
+        written_values[chrom_index] = number_of_written_values
+        convergence[toString(chr_names[chrom_index])] = chr_convergence
+        log.debug("chromosome {} of {} corrected".format(chrom_index + 1, len(chr_ranges)))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    correction_factors = np.concatenate(correction_factors)
+
+    row_nnz = np.frombuffer(shared_corrected[0][0], dtype=np.int64)
+    indices = np.frombuffer(shared_corrected[1][0], dtype=index_dtype, count=offsets[-1])
+    data = np.frombuffer(shared_corrected[2][0], dtype=data_dtype, count=offsets[-1])
+    if sum(written_values) != offsets[-1]:
+        # the blocks are written to the start of their reserved range, remove the unused values
+        used = np.zeros(offsets[-1], dtype=bool)
+        for offset, number_of_written_values in zip(offsets, written_values):
+            used[offset:offset + number_of_written_values] = True
+        indices = indices[used]
+        data = data[used]
+    indptr = np.concatenate([[0], np.cumsum(row_nnz)])
+    corrected_matrix = csr_matrix((data, indices, indptr), shape=(matrix_size, matrix_size))
+    return corrected_matrix, correction_factors, convergence
 
 
 def fill_gaps(hic_ma, failed_bins, fill_contiguous=False):
@@ -414,12 +699,29 @@ class MAD(object):
         return (mad * self.med_abs_deviation / self.mad_b_value) + self.median
 
 
-def plot_total_contact_dist(hic_ma, args):
+def suggest_threshold(dist, bin_s):
+    """
+    Returns the lower end of the histogram bin of the first local minimum of the
+    histogram dist with the bin edges bin_s, None if there is no local minimum.
+
+    >>> suggest_threshold(np.array([5, 2, 4, 1, 3]), np.arange(6) * 10)
+    10
+    >>> suggest_threshold(np.array([1, 2, 3]), np.arange(4)) is None
+    True
+    """
+    dist = np.asarray(dist)
+    local_min = np.flatnonzero((dist[1:-1] < dist[:-2]) & (dist[1:-1] < dist[2:])) + 1
+    if len(local_min) > 0:
+        return bin_s[local_min[0]]
+    return None
+
+
+def plot_total_contact_dist(marginals, args):
     """
     Plots the distribution of number of contacts (excluding self contacts)
     Outliers with a high number are removed for the plot
 
-    :param hic_ma: sparse matrix
+    :param marginals: Marginals of the matrix
     :return:
     """
     use('Agg')
@@ -463,13 +765,7 @@ def plot_total_contact_dist(hic_ma, args):
         ax2.set_xlim(mad_values.value_to_mad(np.array(ax1.get_xlim())))
 
         # get first local mininum value
-        local_min = [x for x, y in enumerate(dist) if 1 <= x < len(
-            dist) - 1 and dist[x - 1] > y < dist[x + 1]]
-
-        if len(local_min) > 0:
-            threshold = bin_s[local_min[0]]
-        else:
-            threshold = None
+        threshold = suggest_threshold(dist, bin_s)
 
         if threshold:
             mad_threshold = mad_values.value_to_mad(threshold)
@@ -480,13 +776,8 @@ def plot_total_contact_dist(hic_ma, args):
             else:
                 log.info("mad threshold {}".format(mad_threshold))
 
-    # replace nan by 0
-    # hic_ma.matrix.data[np.isnan(hic_ma.matrix.data)] = 0
-    hic_ma.matrix = convertNansToZeros(hic_ma.matrix)
-    hic_ma.matrix = convertInfsToZeros(hic_ma.matrix)
-
     if args.perchr:
-        chroms = hic_ma.getChrNames()
+        chroms = [chrname for chrname, start, end in marginals.chromosome_ranges() if end > start]
         if len(chroms) > 30:
             log.warning("The matrix contains {} chromosomes. It is not "
                         "practical to plot each. Try using --chromosomes to "
@@ -499,11 +790,7 @@ def plot_total_contact_dist(hic_ma, args):
         for plot_num, chrname in enumerate(chroms):
             log.info("Plotting chromosome {}".format(chrname))
 
-            chr_range = hic_ma.getChrBinRange(chrname)
-            chr_submatrix = hic_ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
-
-            row_sum = np.asarray(chr_submatrix.sum(axis=1)).flatten()
-            row_sum = row_sum - chr_submatrix.diagonal()
+            row_sum = marginals.contacts(chrname)
             mad = MAD(row_sum)
             modified_z_score = mad.get_motified_zscores()
 
@@ -518,8 +805,7 @@ def plot_total_contact_dist(hic_ma, args):
             ax[chrname].set_title(chrname)
     else:
         fig = plt.figure()
-        row_sum = np.asarray(hic_ma.matrix.sum(axis=1)).flatten()
-        row_sum = row_sum - hic_ma.matrix.diagonal()
+        row_sum = marginals.contacts()
         mad = MAD(row_sum)
         modified_z_score = mad.get_motified_zscores()
 
@@ -533,33 +819,30 @@ def plot_total_contact_dist(hic_ma, args):
     plt.close()
 
 
-def filter_by_zscore(hic_ma, lower_threshold, upper_threshold, perchr=False):
+def filter_by_zscore(marginals, lower_threshold, upper_threshold, perchr=False):
     """
     The method defines thresholds per chromosome
-    to avoid introducing bias due to different chromosome numbers
+    to avoid introducing bias due to different chromosome numbers.
+    The row sums are taken from the marginals of the matrix, the returned
+    bins refer to the matrix without the zero bins.
 
     """
     to_remove = []
     if perchr:
-        for chrname in list(hic_ma.interval_trees):
-            chr_range = hic_ma.getChrBinRange(chrname)
-            chr_submatrix = hic_ma.matrix[chr_range[0]:chr_range[1],
-                                          chr_range[0]:chr_range[1]]
-
-            # replace nan values by zero
-            chr_submatrix.data[np.isnan(chr_submatrix.data)] = 0
-            row_sum = np.asarray(chr_submatrix.sum(axis=1)).flatten()
-            # subtract from row sum, the diagonal
+        for chrname, start, end in marginals.chromosome_ranges():
+            if start == end:
+                continue
+            # row sums of the chromosome submatrix without the diagonal
             # to account for interactions with other bins
             # and not only self interactions that are the dominant count
-            row_sum = row_sum - chr_submatrix.diagonal()
+            row_sum = marginals.contacts(chrname)
             mad = MAD(row_sum)
             problematic = np.flatnonzero(
                 mad.is_outlier(lower_threshold, upper_threshold))
 
             # because the problematic indices are specific for the given chromosome
             # they need to be updated to match the large matrix indices
-            problematic += chr_range[0]
+            problematic += start
 
             if len(problematic) == 0:
                 log.warn("Warning. No bins removed for chromosome {} using thresholds {} {}"
@@ -567,23 +850,139 @@ def filter_by_zscore(hic_ma, lower_threshold, upper_threshold, perchr=False):
 
             to_remove.extend(problematic)
     else:
-        row_sum = np.asarray(hic_ma.matrix.sum(axis=1)).flatten()
         # subtract from row sum, the diagonal
         # to account for interactions with other bins
         # and not only self interactions that are the dominant count
-        row_sum = row_sum - hic_ma.matrix.diagonal()
-        mad = MAD(row_sum)
+        mad = MAD(marginals.contacts())
         to_remove = np.flatnonzero(mad.is_outlier(
             lower_threshold, upper_threshold))
 
     return sorted(to_remove)
 
 
+def load_marginals(hic_ma, args):
+    """
+    Returns the marginals of the matrix, with --cacheMarginals from the sidecar file
+    of the matrix if it was stored for the same matrix file and chromosomes. With
+    hic_ma None only the cache is read, None is returned if it has no marginals.
+    """
+    if args.cacheMarginals:
+        cache_file = sidecar_file_name(args.matrix)
+        key = '{}:{}'.format(matrix_checksum(args.matrix), ','.join(toString(args.chromosomes or [])))
+        marginals = Marginals.load(cache_file, key)
+        if marginals is not None:
+            log.info("Using the marginals cached in {}".format(cache_file))
+            return marginals
+    if hic_ma is None:
+        return None
+
+    chrom_names = hic_ma.getChrNames()
+    chrom_borders = [hic_ma.getChrBinRange(chrname)[0] for chrname in chrom_names] + [hic_ma.matrix.shape[0]]
+    marginals = Marginals.from_matrix(hic_ma.matrix, chrom_names, chrom_borders)
+    if args.cacheMarginals:
+        try:
+            marginals.save(cache_file, key)
+            log.info("Marginals cached in {}".format(cache_file))
+        except (IOError, OSError) as error:
+            log.warning("The marginals could not be cached in {}: {}".format(cache_file, error))
+    return marginals
+
+
+def correct_out_of_core(args):
+    """
+    Balances the cool file args.matrix with ICE in chunks of pixels and writes the corrected
+    pixels and the correction factors to args.outFileName, as the in memory correction does.
+    """
+    if args.correctionMethod != 'ICE':
+        log.error('--outOfCore is only supported for ICE')
+        sys.exit(1)
+    if not check_cooler(args.matrix):
+        log.error('--outOfCore needs a cool file as input')
+        sys.exit(1)
+    for option in ['perchr', 'chromosomes', 'transCutoff', 'sequencedCountCutoff', 'inflationCutoff']:
+        if getattr(args, option):
+            log.error('--{} is not supported with --outOfCore'.format(option))
+            sys.exit(1)
+    if not args.filterThreshold:
+        log.error('min and max filtering thresholds should be set')
+        sys.exit(1)
+
+    file_name, group_path = cooler.util.parse_cooler_uri(args.matrix)
+    out_file_name, _ = cooler.util.parse_cooler_uri(args.outFileName)
+    out_uri = args.outFileName
+    if os.path.exists(out_file_name) and os.path.samefile(file_name, out_file_name):
+        # the pixels of the input are read while the output is written
+        temp_file = NamedTemporaryFile(suffix='.cool', dir=os.path.dirname(os.path.realpath(out_file_name)),
+                                       delete=False)
+        temp_file.close()
+        out_uri = args.outFileName.replace(out_file_name, temp_file.name, 1)
+
+    with cooler.util.open_hdf5(file_name, mode='r') as h5_file:
+        group = h5_file[group_path]
+        number_of_bins = group['indexes']['bin1_offset'].shape[0] - 1
+        number_of_pixels = int(group['indexes']['bin1_offset'][-1])
+        try:
+            chunk_size, cache = chunk_size_for_budget(number_of_bins, number_of_pixels, args.memoryBudget * 2**20)
+        except ValueError as error:
+            log.error(str(error))
+            sys.exit(1)
+        chunks = CoolerPixelChunks(group, chunk_size, pCache=cache)
+        log.info("matrix contains {} data points in the upper triangle, read in {} chunks.".format(number_of_pixels,
+                                                                                                   len(chunks)))
+
+        row_sum, diagonal, _ = marginals(chunks, np.ones(number_of_bins))
+        zero_bins = row_sum == 0
+        log.info("Removing {} zero value bins".format(zero_bins.sum()))
+        # same as filter_by_zscore, the row sums without the diagonal of the bins with counts
+        mad = MAD((row_sum - diagonal)[~zero_bins])
+        outlier_regions = np.flatnonzero(~zero_bins)[mad.is_outlier(args.filterThreshold[0], args.filterThreshold[1])]
+        log.info("Bins that are MAD outliers ({:.2f}%): {}".format(100 * float(len(outlier_regions)) / (~zero_bins).sum(),
+                                                                   len(outlier_regions)))
+        mask = zero_bins
+        mask[outlier_regions] = True
+        row_sum = diagonal = None
+
+        cooler_file = cooler.Cooler(args.matrix)
+        bins = cooler_file.bins()[['chrom', 'start', 'end']][:]
+        initial_factors = None
+        if args.initialBias:
+            initial_factors = load_initial_factors(args.initialBias, [(chrom, start, end, None) for chrom, start, end
+                                                                      in bins.itertuples(index=False)], 'ICE')
+        bias, convergence = iterativeCorrectionChunked(chunks, mask, M=args.iterNum, verbose=args.verbose,
+                                                       pSkipDiagonal=args.skipDiagonal, initial_bias=initial_factors,
+                                                       report=True)
+        # the same pixels and weights as the in memory correction saved by hicmatrix: the corrected
+        # values are the counts and the correction factors of the masked bins are 1
+        bins['weight'] = np.where(mask, 1.0, bias)
+        pixels = corrected_pixels(chunks, bias, np.dtype(args.precision), args.skipDiagonal)
+        cooler.create_cooler(out_uri, bins, pixels, dtypes={'count': np.float64}, ordered=True, mode='w',
+                             metadata=cooler_file.info.get('metadata'),
+                             temp_dir=os.path.dirname(os.path.realpath(out_file_name)))
+        chunks = None
+    if out_uri != args.outFileName:
+        os.replace(temp_file.name, out_file_name)
+    convergence.update({'method': 'ICE', 'initialBias': args.initialBias})
+    save_correction_report(args.outFileName, convergence)
+    log.info('Corrected matrix saved to {}'.format(args.outFileName))
+
+
 def main(args=None):
     args = parse_arguments().parse_args(args)
     if args.verbose:
         log.setLevel(logging.INFO)
 
+    if 'outOfCore' in args and args.outOfCore:
+        correct_out_of_core(args)
+        return
+
+    if 'plotName' in args:
+        marginals = load_marginals(None, args)
+        if marginals is not None:
+            log.info("Removing {} zero value bins".format(marginals.zeroBins.sum()))
+            plot_total_contact_dist(marginals, args)
+            log.info("Saving diagnostic plot {}\n".format(args.plotName))
+            return
+
     # args.chromosomes
     if check_cooler(args.matrix) and args.chromosomes is not None and len(args.chromosomes) == 1:
         ma = hm.hiCMatrix(args.matrix, pChrnameList=toString(args.chromosomes))
@@ -594,16 +993,11 @@ def main(args=None):
             ma.reorderChromosomes(toString(args.chromosomes))
 
     # mask all zero value bins
-    if 'correctionMethod' in args:
-        if args.correctionMethod == 'ICE':
-            row_sum = np.asarray(ma.matrix.sum(axis=1)).flatten()
-            log.info("Removing {} zero value bins".format(sum(row_sum == 0)))
-            ma.maskBins(np.flatnonzero(row_sum == 0))
-            matrix_shape = ma.matrix.shape
-    if 'plotName' in args:
-        row_sum = np.asarray(ma.matrix.sum(axis=1)).flatten()
-        log.info("Removing {} zero value bins".format(sum(row_sum == 0)))
-        ma.maskBins(np.flatnonzero(row_sum == 0))
+    if 'plotName' in args or args.correctionMethod == 'ICE':
+        # row sums, diagonal and per chromosome row sums of one pass
+        marginals = load_marginals(ma, args)
+        log.info("Removing {} zero value bins".format(marginals.zeroBins.sum()))
+        ma.maskBins(np.flatnonzero(marginals.zeroBins))
         matrix_shape = ma.matrix.shape
 
     ma.matrix = convertNansToZeros(ma.matrix)
@@ -622,7 +1016,7 @@ def main(args=None):
     # ma.matrix.indices = ma.matrix.indices.astype(np.int32, copy=False)
 
     if 'plotName' in args:
-        plot_total_contact_dist(ma, args)
+        plot_total_contact_dist(marginals, args)
         log.info("Saving diagnostic plot {}\n".format(args.plotName))
         return
 
@@ -639,7 +1033,7 @@ def main(args=None):
             log.error('min and max filtering thresholds should be set')
             sys.exit(1)
         outlier_regions = filter_by_zscore(
-            ma, args.filterThreshold[0], args.filterThreshold[1], perchr=args.perchr)
+            marginals, args.filterThreshold[0], args.filterThreshold[1], perchr=args.perchr)
         # compute and print some statistics
         pct_outlier = 100 * float(len(outlier_regions)) / ma.matrix.shape[0]
         ma.printchrtoremove(outlier_regions, label="Bins that are MAD outliers ({:.2f}%) "
@@ -677,63 +1071,25 @@ def main(args=None):
             ma.truncTrans(high=cutoff)
             pre_row_sum = np.asarray(ma.matrix.sum(axis=1)).flatten()
 
-    correction_factors = []
-    corrected_matrix = lil_matrix(ma.matrix.shape)
+    initial_factors = None
+    if args.initialBias:
+        initial_factors = load_initial_factors(args.initialBias, ma.cut_intervals, args.correctionMethod)
+        log.info("{} of {} bins have an initial correction factor".format(np.sum(np.isfinite(initial_factors)),
+                                                                          len(initial_factors)))
+
     if args.perchr:
         # normalize each chromosome independently
-        for chrname in list(ma.interval_trees):
-            chr_range = ma.getChrBinRange(chrname)
-            chr_submatrix = ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
-            if args.correctionMethod == 'ICE':
-                _matrix, _corr_factors = iterative_correction(
-                    chr_submatrix, args)
-                corrected_matrix[chr_range[0]:chr_range[1],
-                                 chr_range[0]:chr_range[1]] = _matrix
-                correction_factors.append(_corr_factors)
-            else:
-                # Set the kr matrix along with its correction factors vector
-                assert(args.correctionMethod == 'KR')
-                log.debug("Loading a float sparse matrix for KR balancing")
-                kr = kr_balancing(chr_submatrix.shape[0],
-                                  chr_submatrix.shape[1],
-                                  chr_submatrix.count_nonzero(),
-                                  chr_submatrix.indptr.astype(
-                                      np.int64, copy=False),
-                                  chr_submatrix.indices.astype(
-                                      np.int64, copy=False),
-                                  chr_submatrix.data.astype(np.float64, copy=False))
-                kr.computeKR()
-                if args.outFileName.endswith('.h5'):
-                    corrected_matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]] = kr.get_normalised_matrix(True)
-                # correction_factors.append(np.true_divide(1,
-                #                                          kr.get_normalisation_vector(False).todense()))
-                correction_factors.append(
-                    kr.get_normalisation_vector(False).todense())
-
-        correction_factors = np.concatenate(correction_factors)
+        corrected_matrix, correction_factors, convergence = correct_per_chromosome(ma, args, initial_factors)
+        convergence = {'chromosomes': convergence}
 
     else:
         if args.correctionMethod == 'ICE':
-            corrected_matrix, correction_factors = iterative_correction(
-                ma.matrix, args)
+            corrected_matrix, correction_factors, convergence = iterative_correction(
+                ma.matrix, args, initial_factors)
             ma.setMatrixValues(corrected_matrix)
         else:
             assert(args.correctionMethod == 'KR')
-            log.debug("Loading a float sparse matrix for KR balancing")
-            kr = kr_balancing(ma.matrix.shape[0], ma.matrix.shape[1],
-                              ma.matrix.count_nonzero(), ma.matrix.indptr.astype(np.int64, copy=False),
-                              ma.matrix.indices.astype(np.int64, copy=False), ma.matrix.data.astype(np.float64, copy=False))
-            log.debug('passed pointers')
-            kr.computeKR()
-            log.debug('computation done')
-
-            # set it to False since the vector is already normalised
-            # with the previous True
-            # correction_factors = np.true_divide(1, kr.get_normalisation_vector(False).todense())
-            correction_factors = kr.get_normalisation_vector(False).todense()
-
-            if args.outFileName.endswith('.h5'):
-                corrected_matrix = kr.get_normalised_matrix(True)
+            corrected_matrix, correction_factors, convergence = kr_correction(ma.matrix, args, initial_factors)
 
     if args.outFileName.endswith('.h5'):
         ma.setMatrixValues(corrected_matrix)
@@ -756,3 +1112,5 @@ def main(args=None):
                         label="Total regions to be removed", restore_masked_bins=False)
 
     ma.save(args.outFileName, pApplyCorrection=False)
+    convergence.update({'method': args.correctionMethod, 'initialBias': args.initialBias})
+    save_correction_report(args.outFileName, convergence)
@@ -13,6 +13,7 @@ from scipy.stats import pearsonr, spearmanr
 from hicmatrix import HiCMatrix as hm
 from hicexplorer._version import __version__
 from hicexplorer.utilities import check_cooler
+from hicexplorer.lib.bandedMatrix import load_banded_matrix
 # for plotting
 from matplotlib import use as mplt_use
 mplt_use('Agg')
@@ -267,10 +268,18 @@ def main(args=None):
     for i, matrix in enumerate(args.matrices):
         log.debug("loading hic matrix {}\n".format(matrix))
 
+        # with --range only the pixels up to the maximal distance are loaded
+        max_range = int(args.range.split(":")[1]) if args.range else None
         if (check_cooler(args.matrices[i])) and args.chromosomes is not None and len(args.chromosomes) == 1:
-            _mat = hm.hiCMatrix(matrix, pChrnameList=args.chromosomes)
+            if max_range is not None:
+                _mat = load_banded_matrix(matrix, max_range, pChromosome=args.chromosomes[0])
+            else:
+                _mat = hm.hiCMatrix(matrix, pChrnameList=args.chromosomes)
         else:
-            _mat = hm.hiCMatrix(matrix)
+            if max_range is not None:
+                _mat = load_banded_matrix(matrix, max_range)
+            else:
+                _mat = hm.hiCMatrix(matrix)
             if args.chromosomes:
                 _mat.keepOnlyTheseChr(args.chromosomes)
             _mat.filterOutInterChrCounts()
@@ -1,5 +1,5 @@
 import argparse
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Queue, Pool
 from copy import deepcopy
 import logging
 log = logging.getLogger(__name__)
@@ -16,7 +16,9 @@ from hicmatrix import HiCMatrix as hm
 from hicmatrix.lib import MatrixFileHandler
 from hicexplorer._version import __version__
 from hicexplorer.utilities import check_cooler
+from hicexplorer.lib.bandedMatrix import load_banded_matrix
 from hicexplorer.hicPlotMatrix import translate_region
+from hicexplorer.hicFindTADs import ranksums_pvalues
 
 from inspect import currentframe
 
@@ -88,7 +90,9 @@ Computes enriched regions (peaks) or long range contacts on the given contact ma
                            help='The format is chr:start-end.',
                            required=False)
     parserOpt.add_argument('--threads', '-t',
-                           help='Number of threads to use, the parallelization is implemented per chromosome.',
+                           help='Number of processes to use. With several chromosomes, the chromosomes are computed in parallel. '
+                           'With one chromosome or a region, the processes fit the negative binomial distributions '
+                           'of the distances and run the Anderson-Darling tests of the candidates in parallel.',
                            required=False,
                            default=4,
                            type=int
@@ -110,28 +114,41 @@ Computes enriched regions (peaks) or long range contacts on the given contact ma
     return parser
 
 
-def create_distance_distribution(pData, pDistances):
-    pGenomicDistanceDistribution = {}
-    pGenomicDistanceDistributionPosition = {}
-    pGenomicDistanceDistribution_max_value = {}
-    for i, distance in enumerate(pDistances):
+def group_by_distance(pDistances):
+    """
+        Groups the pixels by their genomic distance.
 
-        if distance in pGenomicDistanceDistribution:
-            pGenomicDistanceDistribution[distance].append(pData[i])
-            pGenomicDistanceDistributionPosition[distance].append(i)
-        else:
-            pGenomicDistanceDistribution[distance] = [pData[i]]
-            pGenomicDistanceDistributionPosition[distance] = [i]
+        Input:
+            - pDistances: distance of each pixel in bins
 
-    for key in pGenomicDistanceDistribution:
-        pGenomicDistanceDistribution_max_value[key] = np.max(pGenomicDistanceDistribution[key])
-    return pGenomicDistanceDistribution, pGenomicDistanceDistributionPosition, pGenomicDistanceDistribution_max_value
+        Returns:
+            - the order that sorts the pixels by distance, pixels of the same distance keep their order
+            - the distances with at least one pixel
+            - the start of each of these distances in the sorted pixels, followed by the number of pixels
+
+        >>> group_by_distance(np.array([2, 0, 2, 1, 0]))
+        (array([1, 4, 3, 0, 2]), array([0, 1, 2]), array([0, 2, 3, 5]))
+    """
+    order = np.argsort(pDistances, kind='stable')
+    pixels_per_distance = np.bincount(pDistances)
+    distances = np.flatnonzero(pixels_per_distance)
+    starts = np.concatenate([[0], np.cumsum(pixels_per_distance[distances])])
+    return order, distances, starts
+
+
+def fit_nbinom_distance(pInteractions):
+    """
+        Fits a negative binomial distribution to the interactions of one genomic distance
+        and returns its size and prob parameters.
+    """
+    nbinom_parameters = fit_nbinom.fit(pInteractions)
+    return nbinom_parameters['size'], nbinom_parameters['prob']
 
 
 def compute_long_range_contacts(pHiCMatrix, pWindowSize,
                                 pMaximumInteractionPercentageThreshold, pPValue, pPeakWindowSize,
                                 pPValuePreselection, pStatisticalTest, pMinimumInteractionsThreshold,
-                                pMinLoopDistance, pMaxLoopDistance):
+                                pMinLoopDistance, pMaxLoopDistance, pThreads=1):
     """
         This function computes the loops by:
             - decreasing the search space by removing values with p-values > pPValuePreselection
@@ -149,54 +166,46 @@ def compute_long_range_contacts(pHiCMatrix, pWindowSize,
             - pPValuePreselection: float, p-value for negative binomial
             - pStatisticalTest: str, which statistical test should be used
             - pPeakWindowSize: integer, size of the peak region: (2*pPeakWindowSize)^2. Needs to be smaller than pWindowSize
+            - pThreads: integer, number of processes to fit the negative binomial distributions of the distances and to test the candidates
 
         Returns:
             - A list of detected loops [(x,y)] and x, y are matrix index values
             - An associated list of p-values
     """
     instances, features = pHiCMatrix.matrix.nonzero()
+    if len(instances) == 0:
+        return None, None
     distance = np.absolute(instances - features)
-    mask = [False] * len(distance)
-    genomic_distance_distributions, pGenomicDistanceDistributionPosition, pGenomicDistanceDistribution_max_value = create_distance_distribution(
-        pHiCMatrix.matrix.data, distance)
-    nbinom_parameters = {}
-    for i, key in enumerate(genomic_distance_distributions):
-        nbinom_parameters = fit_nbinom.fit(
-            np.array(genomic_distance_distributions[key]))
-        nbinom_distance = nbinom(
-            nbinom_parameters['size'], nbinom_parameters['prob'])
-        less_than = np.array(
-            genomic_distance_distributions[key]).astype(int) - 1
-        mask_less_than = less_than < 0
-        less_than[mask_less_than] = 1
-        if len(less_than) <= 0:
-            continue
-        max_element = np.max(less_than)
-        if max_element <= 0:
-            continue
-        max_element = np.max(less_than)
-        sum_of_densities = np.zeros(max_element)
 
-        for j in range(max_element):
-            if j >= 1:
-                sum_of_densities[j] += sum_of_densities[j - 1]
-            sum_of_densities[j] += nbinom_distance.pmf(j)
-
-        # if len(sum_of_densities) > less_than - 1:
-        p_value = 1 - sum_of_densities[less_than - 1]
-        mask_distance = p_value < pPValuePreselection
-        # else:
-
-        for j, value in enumerate(mask_distance):
-            if value:
-                mask[pGenomicDistanceDistributionPosition[key][j]] = True
-
-    peak_interaction_threshold_array = np.zeros(len(distance))
-    for i, key in enumerate(distance):
-        peak_interaction_threshold_array[i] = pGenomicDistanceDistribution_max_value[key] * pMaximumInteractionPercentageThreshold
-    mask_interactions = pHiCMatrix.matrix.data > peak_interaction_threshold_array
-
-    mask = np.logical_and(mask, mask_interactions)
+    # all pixels of a distance are consecutive in the sorted interactions
+    order, distances, starts = group_by_distance(distance)
+    interactions = pHiCMatrix.matrix.data[order]
+    interactions_per_distance = np.split(interactions, starts[1:-1])
+    if pThreads > 1 and len(distances) > 1:
+        pool = Pool(min(pThreads, len(distances)))
+        nbinom_parameters = pool.map(fit_nbinom_distance, interactions_per_distance)
+        pool.close()
+        pool.join()
+    else:
+        nbinom_parameters = list(map(fit_nbinom_distance, interactions_per_distance))
+    size, prob = np.array(nbinom_parameters, dtype=np.float64).reshape(len(distances), 2).T
+    distance_of_pixel = np.repeat(np.arange(len(distances)), np.diff(starts))
+
+    # p-value of each pixel: 1 - cdf(interactions - 2) of the distribution of its distance. Pixels
+    # with less than one interaction use cdf(0), pixels with one interaction the cdf of the maximal
+    # interactions - 2 of their distance. Distances without interactions above one are skipped.
+    less_than = interactions.astype(int) - 1
+    less_than[less_than < 0] = 1
+    max_element = np.maximum.reduceat(less_than, starts[:-1])[distance_of_pixel]
+    p_value = nbinom.sf(np.where(less_than > 0, less_than - 1, max_element - 1),
+                        size[distance_of_pixel], prob[distance_of_pixel])
+    mask_distance = (max_element > 0) & (p_value < pPValuePreselection)
+
+    peak_interaction_threshold_array = np.maximum.reduceat(interactions, starts[:-1]) * pMaximumInteractionPercentageThreshold
+    mask_interactions = interactions > peak_interaction_threshold_array[distance_of_pixel]
+
+    mask = np.zeros(len(distance), dtype=bool)
+    mask[order] = mask_distance & mask_interactions
 
     instances = instances[mask]
     features = features[mask]
@@ -218,7 +227,7 @@ def compute_long_range_contacts(pHiCMatrix, pWindowSize,
 
     candidates, p_value_list = candidate_region_test(
         pHiCMatrix.matrix, candidates, pWindowSize, pPValue,
-        pMinimumInteractionsThreshold, pPeakWindowSize, pStatisticalTest)
+        pMinimumInteractionsThreshold, pPeakWindowSize, pStatisticalTest, pThreads=pThreads)
 
     # candidates, p_value_list = candidate_region_test(
     #     pHiCMatrix.matrix, candidates, pWindowSize, pPValue,
@@ -236,22 +245,84 @@ def filter_duplicates(pCandidates):
         Returns:
             - List of candidates without duplicates
     """
-    mask = []
-    seen_values = {}
-    for i, candidate in enumerate(pCandidates):
-        if candidate[0] in seen_values:
-            if candidate[1] in seen_values[candidate[0]]:
-                mask.append(False)
-            else:
-                seen_values[candidate[0]].append(candidate[1])
-                mask.append(True)
-        else:
-            seen_values[candidate[0]] = [candidate[1]]
-            mask.append(True)
+    if len(pCandidates) == 0:
+        return []
+    _, first_occurrence = np.unique(np.asarray(pCandidates), axis=0, return_index=True)
+    mask = np.zeros(len(pCandidates), dtype=bool)
+    mask[first_occurrence] = True
 
     return mask
 
 
+def get_neighborhoods(pMatrix, pRows, pColumns, pSize, pFillValue=0):
+    """
+        Gathers the square submatrices of all candidates at once.
+
+        Input:
+            - pMatrix: csr_matrix
+            - pRows, pColumns: arrays with the first row and column of each submatrix, the submatrices may
+              reach out of the matrix
+            - pSize: integer, number of rows and columns of the submatrices
+            - pFillValue: value of the bins outside of the matrix
+
+        Returns:
+            - array of shape (number of submatrices, pSize, pSize)
+    """
+    matrix = pMatrix
+    if not matrix.has_canonical_format:
+        matrix = matrix.copy()
+        matrix.sum_duplicates()
+    number_of_rows, number_of_columns = matrix.shape
+    # the pixels are sorted by row and column, a pixel is found by searching its key row * columns + column,
+    # the last key marks the missing pixels
+    keys = np.repeat(np.arange(number_of_rows, dtype=np.int64), np.diff(matrix.indptr)) * number_of_columns + matrix.indices
+    keys = np.append(keys, number_of_rows * number_of_columns)
+    values = np.append(matrix.data, 0)
+    offsets = np.arange(pSize)
+
+    neighborhoods = np.empty((len(pRows), pSize, pSize), dtype=np.result_type(matrix.dtype, pFillValue))
+    block_size = max(1, 2**22 // max(1, pSize * pSize))
+    for start in range(0, len(pRows), block_size):
+        rows = np.asarray(pRows[start:start + block_size], dtype=np.int64)[:, None, None] + offsets[None, :, None]
+        columns = np.asarray(pColumns[start:start + block_size], dtype=np.int64)[:, None, None] + offsets[None, None, :]
+        inside = (rows >= 0) & (rows < number_of_rows) & (columns >= 0) & (columns < number_of_columns)
+        query = np.where(inside, rows * number_of_columns + columns, -1)
+        position = np.searchsorted(keys, query)
+        neighborhoods[start:start + block_size] = np.where(keys[position] == query, values[position], 0)
+        neighborhoods[start:start + block_size][~inside] = pFillValue
+    return neighborhoods
+
+
+def smooth_neighborhoods(pNeighborhoods):
+    """
+        Smoothes the rows and then the columns of the neighborhoods (the last two axes of pNeighborhoods) with
+        a sliding window of 5 bins. Each value is replaced by the mean of the up to 2 values before, the value
+        and the up to 2 values after it. The smoothed values keep the type of pNeighborhoods.
+
+        >>> smooth_neighborhoods(np.array([[1., 2., 3., 4., 5., 6.]]))
+        array([[2. , 2.5, 3. , 4. , 4.5, 5. ]])
+    """
+    smoothed = pNeighborhoods
+    for axis in [-1, -2]:
+        data = np.moveaxis(smoothed, axis, -1)
+        length = data.shape[-1]
+        if length < 2:
+            continue
+        if not np.issubdtype(data.dtype, np.floating):
+            data = data.astype(np.float64)
+        average_contacts = np.empty(data.shape, dtype=data.dtype)
+        for i in range(length):
+            start = max(0, i - 2)
+            end = min(length, i + 3)
+            # summed from left to right like np.mean
+            window_sum = data[..., start]
+            for j in range(start + 1, end):
+                window_sum = window_sum + data[..., j]
+            average_contacts[..., i] = window_sum / (end - start)
+        smoothed = np.moveaxis(average_contacts.astype(pNeighborhoods.dtype), -1, axis)
+    return smoothed
+
+
 def neighborhood_merge(pCandidates, pWindowSize, pInteractionCountMatrix, pMinLoopDistance, pMaxLoopDistance):
     """
         Clusters candidates together to one candidate if they share / overlap their neighborhood.
@@ -267,37 +338,33 @@ def neighborhood_merge(pCandidates, pWindowSize, pInteractionCountMatrix, pMinLo
     """
     x_max = pInteractionCountMatrix.shape[0]
     y_max = pInteractionCountMatrix.shape[1]
-    new_candidate_list = []
-
-    for candidate in pCandidates:
-
-        # get neighborhood out of pInteractionCountMatrix matrix
-        start_x = candidate[0] - \
-            pWindowSize if candidate[0] - pWindowSize > 0 else 0
-        end_x = candidate[0] + pWindowSize if candidate[0] + \
-            pWindowSize < x_max else x_max
-        start_y = candidate[1] - \
-            pWindowSize if candidate[1] - pWindowSize > 0 else 0
-        end_y = candidate[1] + pWindowSize if candidate[1] + \
-            pWindowSize < y_max else y_max
-
-        neighborhood = pInteractionCountMatrix[start_x:end_x,
-                                               start_y:end_y].toarray().flatten()
-        if len(neighborhood) == 0:
-            continue
-        argmax = np.argmax(neighborhood)
-        x = argmax // (pWindowSize * 2)
-        y = argmax % (pWindowSize * 2)
-
-        candidate_x = (candidate[0] - pWindowSize) + \
-            x if (candidate[0] - pWindowSize + x) < x_max else x_max - 1
-        candidate_y = (candidate[1] - pWindowSize) + \
-            y if (candidate[1] - pWindowSize + y) < y_max else y_max - 1
-        if candidate_x < 0 or candidate_y < 0:
-            continue
-        if np.absolute(candidate_x - candidate_y) < pMinLoopDistance or np.absolute(candidate_x - candidate_y) > pMaxLoopDistance:
-            continue
-        new_candidate_list.append([candidate_x, candidate_y])
+    if len(pCandidates) == 0 or pWindowSize <= 0:
+        return [], []
+    pCandidates = np.asarray(pCandidates)
+
+    # the neighborhood of a candidate is cut at the matrix borders
+    start_x = np.maximum(pCandidates[:, 0] - pWindowSize, 0)
+    end_x = np.minimum(pCandidates[:, 0] + pWindowSize, x_max)
+    start_y = np.maximum(pCandidates[:, 1] - pWindowSize, 0)
+    end_y = np.minimum(pCandidates[:, 1] + pWindowSize, y_max)
+
+    # first maximum of each neighborhood, the bins outside of the matrix are never the maximum
+    neighborhoods = get_neighborhoods(pInteractionCountMatrix, pCandidates[:, 0] - pWindowSize,
+                                      pCandidates[:, 1] - pWindowSize, pWindowSize * 2, pFillValue=-np.inf)
+    argmax = neighborhoods.reshape(len(pCandidates), -1).argmax(axis=1)
+    # the position of the maximum in the flattened neighborhood as cut at the matrix borders is
+    # converted back to a position in the matrix as if the neighborhood had pWindowSize * 2 columns
+    argmax = (argmax // (pWindowSize * 2) - (start_x - (pCandidates[:, 0] - pWindowSize))) * (end_y - start_y) + \
+        argmax % (pWindowSize * 2) - (start_y - (pCandidates[:, 1] - pWindowSize))
+    x = argmax // (pWindowSize * 2)
+    y = argmax % (pWindowSize * 2)
+
+    candidate_x = np.minimum((pCandidates[:, 0] - pWindowSize) + x, x_max - 1)
+    candidate_y = np.minimum((pCandidates[:, 1] - pWindowSize) + y, y_max - 1)
+    distance = np.absolute(candidate_x - candidate_y)
+    keep = (end_x > start_x) & (end_y > start_y) & (candidate_x >= 0) & (candidate_y >= 0) & \
+        ~(distance < pMinLoopDistance) & ~(distance > pMaxLoopDistance)
+    new_candidate_list = np.column_stack([candidate_x[keep], candidate_y[keep]])
     mask = filter_duplicates(new_candidate_list)
 
     if mask is not None and len(mask) == 0:
@@ -333,8 +400,82 @@ def get_test_data(pNeighborhood, pVertical):
     return return_list
 
 
+def get_peak_and_background(pNeighborhood, pPeakRegion, pPeakWindowSize):
+    """
+        Splits the neighborhood of a candidate in the peak region of (2*pPeakWindowSize)^2 around pPeakRegion
+        and the background: all rows above and below and all columns left and right of the peak region.
+    """
+    peak = pNeighborhood[pPeakRegion[0] - pPeakWindowSize:pPeakRegion[0] + pPeakWindowSize,
+                         pPeakRegion[1] - pPeakWindowSize:pPeakRegion[1] + pPeakWindowSize].flatten()
+
+    background = np.concatenate([pNeighborhood[:pPeakRegion[0] - pPeakWindowSize, :].flatten(),
+                                 pNeighborhood[pPeakRegion[0] + pPeakWindowSize:, :].flatten(),
+                                 pNeighborhood[:, :pPeakRegion[1] - pPeakWindowSize].flatten(),
+                                 pNeighborhood[:, pPeakRegion[1] + pPeakWindowSize:].flatten()])
+    return peak, background
+
+
+def region_test(pTestData):
+    """
+        Tests the peak of one candidate against its background, if the thirds of its neighborhood
+        are different in vertical and horizontal orientation.
+
+        Input:
+            - pTestData: tuple of the smoothed neighborhood, the peak, the background, the p-value and the statistical test
+
+        Returns:
+            - True if the candidate is accepted
+            - the p-value of the peak vs. background test
+    """
+    neighborhood, peak, background, pPValue, pStatisticalTest = pTestData
+    if pStatisticalTest == 'wilcoxon-rank-sum':
+        # test vertical
+        test_list = get_test_data(neighborhood, pVertical=True)
+        statistic, significance_level_test1 = ranksums(sorted(test_list[0]), sorted(test_list[1]))
+        statistic, significance_level_test2 = ranksums(sorted(test_list[1]), sorted(test_list[2]))
+        if significance_level_test1 <= pPValue or significance_level_test2 <= significance_level_test2:
+            test_list = get_test_data(neighborhood, pVertical=False)
+            statistic, significance_level_test1 = ranksums(sorted(test_list[0]), sorted(test_list[1]))
+            statistic, significance_level_test2 = ranksums(sorted(test_list[1]), sorted(test_list[2]))
+            if significance_level_test1 <= pPValue or significance_level_test2 <= significance_level_test2:
+
+                statistic, significance_level = ranksums(sorted(peak), sorted(background))
+                return True, significance_level
+        return False, None
+    else:
+        test_list = get_test_data(neighborhood, pVertical=True)
+        _, _, significance_level_test1 = anderson_ksamp([sorted(test_list[0]), sorted(test_list[1])])
+        _, _, significance_level_test2 = anderson_ksamp([sorted(test_list[1]), sorted(test_list[2])])
+        if significance_level_test1 <= pPValue or significance_level_test2 <= significance_level_test2:
+            test_list = get_test_data(neighborhood, pVertical=False)
+            _, _, significance_level_test1 = anderson_ksamp([sorted(test_list[0]), sorted(test_list[1])])
+            _, _, significance_level_test2 = anderson_ksamp([sorted(test_list[1]), sorted(test_list[2])])
+            if significance_level_test1 <= pPValue or significance_level_test2 <= significance_level_test2:
+
+                _, _, significance_level = anderson_ksamp([sorted(peak), sorted(background)])
+                if significance_level <= pPValue:
+                    return True, significance_level
+        return False, None
+
+
+def thirds_ranksums_pvalues(pNeighborhoods, pAxis):
+    """
+        Wilcoxon rank-sum p-values of the first vs. the second third and of the second vs. the last third
+        of the columns (pAxis=2) or rows (pAxis=1) of each neighborhood.
+    """
+    number_of_neighborhoods = len(pNeighborhoods)
+    third = pNeighborhoods.shape[pAxis] // 3
+    thirds = [np.take(pNeighborhoods, np.arange(start, end), axis=pAxis).reshape(number_of_neighborhoods, -1)
+              for start, end in [(0, third), (third, 2 * third), (2 * third, pNeighborhoods.shape[pAxis])]]
+    pvalues = []
+    for x, y in [(thirds[0], thirds[1]), (thirds[1], thirds[2])]:
+        pvalues.append(ranksums_pvalues(x.ravel(), np.full(number_of_neighborhoods, x.shape[1]),
+                                        y.ravel(), np.full(number_of_neighborhoods, y.shape[1])))
+    return pvalues
+
+
 def candidate_region_test(pHiCMatrix, pCandidates, pWindowSize, pPValue,
-                          pMinimumInteractionsThreshold, pPeakWindowSize, pStatisticalTest=None):
+                          pMinimumInteractionsThreshold, pPeakWindowSize, pStatisticalTest=None, pThreads=1):
     """
         Tests if a candidate is having a significant peak compared to its neighborhood.
             - smoothes neighborhood in x an y orientation
@@ -346,6 +487,9 @@ def candidate_region_test(pHiCMatrix, pCandidates, pWindowSize, pPValue,
                 - Size of background is: (2*pWindowSize)^2 - (2*pPeakWindowSize)^2
             - Apply multi-test Bonferonni based on pPValue
 
+        The neighborhoods of all candidates which are not at the border of the matrix are extracted, smoothed
+        and tested at once, the candidates at the border are tested one by one.
+
         Input:
             - pHiCMatrix: csr_matrix, interaction matrix to extract candidate neighborhood
             - pCandidates: list of candidates to test for enrichment
@@ -353,14 +497,13 @@ def candidate_region_test(pHiCMatrix, pCandidates, pWindowSize, pPValue,
             - pPValue: float, significance level for Mann-Whitney rank test
             - pMinimumInteractionsThreshold: integer, if smoothed candidate interaction count is less, it will be removed
             - pPeakWindowSize: size of peak region (2*pPeakWindowSize)^2
+            - pThreads: integer, number of processes for the Anderson-Darling tests
 
         Returns:
             - List of accepted candidates
             - List of associated p-values
     """
 
-    mask = []
-    pvalues = []
     x_max = pHiCMatrix.shape[0]
     y_max = pHiCMatrix.shape[1]
     log.debug('candidate_region_test initial: {}'.format(len(pCandidates)))
@@ -370,8 +513,50 @@ def candidate_region_test(pHiCMatrix, pCandidates, pWindowSize, pPValue,
 
     pCandidates = np.array(pCandidates)
 
-    mask = []
-    for i, candidate in enumerate(pCandidates):
+    mask = np.zeros(len(pCandidates), dtype=bool)
+    pvalues = np.zeros(len(pCandidates))
+    test_data = []
+    test_candidates = []
+
+    # candidates with a complete neighborhood, their peak is at (pWindowSize - 1, pWindowSize - 1)
+    is_inner = (pCandidates[:, 0] - pWindowSize > 0) & (pCandidates[:, 1] - pWindowSize > 0) & \
+        (pCandidates[:, 0] + pWindowSize < x_max) & (pCandidates[:, 1] + pWindowSize < y_max)
+    if pPeakWindowSize >= pWindowSize:
+        is_inner[:] = False
+    inner = np.flatnonzero(is_inner)
+    if len(inner) > 0:
+        neighborhoods = smooth_neighborhoods(get_neighborhoods(pHiCMatrix, pCandidates[inner, 0] - pWindowSize,
+                                                               pCandidates[inner, 1] - pWindowSize, pWindowSize * 2))
+        if not np.issubdtype(neighborhoods.dtype, np.floating):
+            neighborhoods = neighborhoods.astype(np.float64)
+        peak_start = pWindowSize - 1 - pPeakWindowSize
+        peak_end = pWindowSize - 1 + pPeakWindowSize
+        peak = neighborhoods[:, peak_start:peak_end, peak_start:peak_end].reshape(len(inner), -1)
+        background = np.concatenate([neighborhoods[:, :peak_start, :].reshape(len(inner), -1),
+                                     neighborhoods[:, peak_end:, :].reshape(len(inner), -1),
+                                     neighborhoods[:, :, :peak_start].reshape(len(inner), -1),
+                                     neighborhoods[:, :, peak_end:].reshape(len(inner), -1)], axis=1)
+
+        accepted = ~(neighborhoods[:, pWindowSize - 1, pWindowSize - 1] < pMinimumInteractionsThreshold)
+        if background.shape[1] < pWindowSize or peak.shape[1] < pWindowSize:
+            accepted[:] = False
+        accepted &= ~(peak.mean(axis=1) < background.mean(axis=1))
+        accepted &= ~(peak.max(axis=1) < background.max(axis=1))
+
+        if pStatisticalTest == 'wilcoxon-rank-sum' and np.any(accepted):
+            for axis in [2, 1]:
+                significance_level_test1, significance_level_test2 = thirds_ranksums_pvalues(neighborhoods[accepted], axis)
+                accepted[accepted] = (significance_level_test1 <= pPValue) | (significance_level_test2 <= significance_level_test2)
+            mask[inner[accepted]] = True
+            pvalues[inner[accepted]] = ranksums_pvalues(peak[accepted].ravel(), np.full(np.sum(accepted), peak.shape[1]),
+                                                        background[accepted].ravel(), np.full(np.sum(accepted), background.shape[1]))
+        elif pStatisticalTest != 'wilcoxon-rank-sum':
+            for i in np.flatnonzero(accepted):
+                test_data.append((neighborhoods[i], peak[i], background[i], pPValue, pStatisticalTest))
+                test_candidates.append(inner[i])
+
+    for i in np.flatnonzero(~is_inner):
+        candidate = pCandidates[i]
 
         if (candidate[0] - pWindowSize) > 0:
             start_x = candidate[0] - pWindowSize
@@ -393,24 +578,16 @@ def candidate_region_test(pHiCMatrix, pCandidates, pWindowSize, pPValue,
         end_y = candidate[1] + pWindowSize if candidate[1] + \
             pWindowSize < y_max else y_max
 
-        neighborhood = pHiCMatrix[start_x:end_x,
-                                  start_y:end_y].toarray()
-
-        neighborhood_old = neighborhood
-        for j in range(len(neighborhood)):
-            neighborhood[j, :] = smoothInteractionValues(neighborhood[j, :], 5)
-        for j in range(len(neighborhood_old[0])):
-            neighborhood_old[:, j] = smoothInteractionValues(
-                neighborhood[:, j], 5)
-        neighborhood = (neighborhood + neighborhood_old) / 2
+        neighborhood = smooth_neighborhoods(pHiCMatrix[start_x:end_x,
+                                                       start_y:end_y].toarray())
+        if not np.issubdtype(neighborhood.dtype, np.floating):
+            neighborhood = neighborhood.astype(np.float64)
 
         peak_region = [peak_x, peak_y]
 
         # if neighborhood[peak_region[0], peak_region[1]] < pPeakInteractionsThreshold[i]:
         # if neighborhood[peak_region[0], peak_region[1]] < pPeakInteractionsThreshold:
         if neighborhood[peak_region[0], peak_region[1]] < pMinimumInteractionsThreshold:
-
-            mask.append(False)
             continue
 
         if pPeakWindowSize > pWindowSize:
@@ -418,80 +595,37 @@ def candidate_region_test(pHiCMatrix, pCandidates, pWindowSize, pPValue,
                 pWindowSize, pPeakWindowSize))
             return None, None
 
-        peak = neighborhood[peak_region[0] - pPeakWindowSize:peak_region[0] + pPeakWindowSize,
-                            peak_region[1] - pPeakWindowSize:peak_region[1] + pPeakWindowSize].flatten()
-
-        background = []
-        background.extend(
-            list(neighborhood[:peak_region[0] - pPeakWindowSize, :].flatten()))
-        background.extend(
-            list(neighborhood[peak_region[0] + pPeakWindowSize:, :].flatten()))
-        background.extend(
-            list(neighborhood[:, :peak_region[1] - pPeakWindowSize].flatten()))
-        background.extend(
-            list(neighborhood[:, peak_region[1] + pPeakWindowSize:].flatten()))
-        background = np.array(background)
+        peak, background = get_peak_and_background(neighborhood, peak_region, pPeakWindowSize)
 
         if len(background) < pWindowSize:
-            mask.append(False)
             continue
         if len(peak) < pWindowSize:
-            mask.append(False)
             continue
         if np.mean(peak) < np.mean(background):
-            mask.append(False)
             continue
         if np.max(peak) < np.max(background):
-            mask.append(False)
             continue
         # if np.min(background) * 5 > np.max(peak):
-        #     mask.append(False)
         #     continue
-        if pStatisticalTest == 'wilcoxon-rank-sum':
-            # test vertical
-            test_list = get_test_data(neighborhood, pVertical=True)
-            statistic, significance_level_test1 = ranksums(sorted(test_list[0]), sorted(test_list[1]))
-            statistic, significance_level_test2 = ranksums(sorted(test_list[1]), sorted(test_list[2]))
-            if significance_level_test1 <= pPValue or significance_level_test2 <= significance_level_test2:
-                test_list = get_test_data(neighborhood, pVertical=False)
-                statistic, significance_level_test1 = ranksums(sorted(test_list[0]), sorted(test_list[1]))
-                statistic, significance_level_test2 = ranksums(sorted(test_list[1]), sorted(test_list[2]))
-                if significance_level_test1 <= pPValue or significance_level_test2 <= significance_level_test2:
-
-                    statistic, significance_level = ranksums(sorted(peak), sorted(background))
-                    mask.append(True)
-                    pvalues.append(significance_level)
-
-                    continue
-            mask.append(False)
-            continue
-        else:
-            test_list = get_test_data(neighborhood, pVertical=True)
-            _, _, significance_level_test1 = anderson_ksamp([sorted(test_list[0]), sorted(test_list[1])])
-            _, _, significance_level_test2 = anderson_ksamp([sorted(test_list[1]), sorted(test_list[2])])
-            if significance_level_test1 <= pPValue or significance_level_test2 <= significance_level_test2:
-                test_list = get_test_data(neighborhood, pVertical=False)
-                _, _, significance_level_test1 = anderson_ksamp([sorted(test_list[0]), sorted(test_list[1])])
-                _, _, significance_level_test2 = anderson_ksamp([sorted(test_list[1]), sorted(test_list[2])])
-                if significance_level_test1 <= pPValue or significance_level_test2 <= significance_level_test2:
-
-                    _, _, significance_level = anderson_ksamp([sorted(peak), sorted(background)])
-                    if significance_level <= pPValue:
-                        mask.append(True)
-                        pvalues.append(significance_level)
-                        continue
-                    mask.append(False)
-                    continue
-
-        mask.append(False)
+        test_data.append((neighborhood, peak, background, pPValue, pStatisticalTest))
+        test_candidates.append(i)
+
+    if pThreads > 1 and len(test_data) > 1:
+        pool = Pool(min(pThreads, len(test_data)))
+        test_results = pool.map(region_test, test_data)
+        pool.close()
+        pool.join()
+    else:
+        test_results = list(map(region_test, test_data))
+    for i, (accepted, significance_level) in zip(test_candidates, test_results):
+        if accepted:
+            mask[i] = True
+            pvalues[i] = significance_level
 
     # if pStatisticalTest == 'anderson-darling':
-    if mask is not None and len(mask) == 0:
-        return None, None
-    mask = np.array(mask)
     pCandidates = pCandidates[mask]
     log.debug('candidate_region_test done: {}'.format(len(pCandidates)))
-    pvalues = np.array(pvalues)
+    pvalues = pvalues[mask]
 
     if pStatisticalTest == 'wilcoxon-rank-sum':
         log.debug('len pCandidates: {}'.format(len(pCandidates)))
@@ -650,7 +784,8 @@ def compute_loops(pHiCMatrix, pRegion, pArgs, pQueue=None):
                                                          pArgs.statisticalTest,
                                                          pArgs.peakInteractionsThreshold,
                                                          min_loop_distance,
-                                                         max_loop_distance)
+                                                         max_loop_distance,
+                                                         pThreads=pArgs.threads if pQueue is None else 1)
 
     if candidates is None:
         log.info('Computed loops for {}: 0'.format(pRegion))
@@ -671,39 +806,18 @@ def compute_loops(pHiCMatrix, pRegion, pArgs, pQueue=None):
     return
 
 
-def smoothInteractionValues(pData, pWindowSize):
-    '''
-        Smoothes pData with a sliding window of pWindowSize
-        Adds -pWindowsSize/2 and +pWindowsSize/2 around pData[i] and averages pData[i] by pWindowSize to
-        smooth the interaction values.
-    '''
-
-    if len(pData) < 2:
-        return pData
-    window_size = np.int(np.floor(pWindowSize / 2))
-    window_size_upstream = window_size
-    if pWindowSize % 2 == 0:
-        window_size_upstream -= 1
-
-    average_contacts = np.zeros(len(pData))
-
-    # add upstream and downstream, handle regular case
-    for i in range(window_size_upstream, len(pData) - window_size):
-        start = i - window_size_upstream
-        end = i + window_size + 1
-        average_contacts[i] = np.mean(pData[start:end])
-
-    # handle border conditions
-    for i in range(window_size):
-        start = i - window_size_upstream
-        if start < 0:
-            start = 0
-        end = i + window_size + 1
-
-        average_contacts[i] = np.mean(pData[start:end])
-        average_contacts[-(i + 1)] = np.mean(pData[-end:])
-
-    return average_contacts
+def load_matrix(pMatrixFile, pArgs, pChromosome=None):
+    """
+    Loads the matrix, with pChromosome only the submatrix of this chromosome. With
+    --maxLoopDistance only the pixels up to this distance are loaded, compute_loops
+    removes all other pixels. The distance is counted without the nan bins, such that
+    the band contains all pixels that are kept after masking the nan bins.
+    """
+    if pArgs.maxLoopDistance:
+        return load_banded_matrix(pMatrixFile, pArgs.maxLoopDistance, pSkipNanBins=True, pChromosome=pChromosome)
+    if pChromosome is None:
+        return hm.hiCMatrix(pMatrixFile)
+    return hm.hiCMatrix(pMatrixFile=pMatrixFile, pChrnameList=[pChromosome])
 
 
 def main(args=None):
@@ -724,7 +838,7 @@ def main(args=None):
             hic_matrix = hm.hiCMatrix(
                 pMatrixFile=args.matrix, pChrnameList=[args.region])
         else:
-            hic_matrix = hm.hiCMatrix(args.matrix)
+            hic_matrix = load_matrix(args.matrix, args)
             hic_matrix.keepOnlyTheseChr([chrom])
         mapped_loops = compute_loops(hic_matrix, args.region, args)
         write_bedgraph(mapped_loops, args.outFileName,
@@ -734,7 +848,7 @@ def main(args=None):
         mapped_loops = []
 
         if not is_cooler:
-            hic_matrix = hm.hiCMatrix(args.matrix)
+            hic_matrix = load_matrix(args.matrix, args)
             # hic_matrix.keepOnlyTheseChr([chromosome])
             matrix = deepcopy(hic_matrix.matrix)
             cut_intervals = deepcopy(hic_matrix.cut_intervals)
@@ -756,8 +870,7 @@ def main(args=None):
         if single_core:
             for chromosome in chromosomes_list:
                 if is_cooler:
-                    hic_matrix = hm.hiCMatrix(
-                        pMatrixFile=args.matrix, pChrnameList=[chromosome])
+                    hic_matrix = load_matrix(args.matrix, args, chromosome)
                 else:
                     hic_matrix.setMatrix(
                         deepcopy(matrix), deepcopy(cut_intervals))
@@ -782,8 +895,7 @@ def main(args=None):
                         queue[i] = Queue()
                         thread_done[i] = False
                         if is_cooler:
-                            hic_matrix = hm.hiCMatrix(pMatrixFile=args.matrix, pChrnameList=[
-                                                      chromosomes_list[count_call_of_read_input]])
+                            hic_matrix = load_matrix(args.matrix, args, chromosomes_list[count_call_of_read_input])
                         else:
                             hic_matrix.setMatrix(
                                 deepcopy(matrix), deepcopy(cut_intervals))
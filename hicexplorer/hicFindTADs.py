@@ -6,22 +6,37 @@ import os.path
 import logging
 import argparse
 import json
+import itertools
 from collections import OrderedDict
 from hicmatrix import HiCMatrix as hm
 from hicexplorer.utilities import enlarge_bins
 from scipy import sparse
 import numpy as np
 import multiprocessing
+import tables
+from multiprocessing.sharedctypes import RawArray
 from hicexplorer._version import __version__
-from hicexplorer.utilities import toString, toBytes, check_chrom_str_bytes
+from hicexplorer.utilities import toString, toBytes, check_chrom_str_bytes, shared_array
+from hicexplorer.lib.expected import convert_to_obs_exp_matrix, load_expected, save_expected
+from hicexplorer.lib.bandedMatrix import load_banded_matrix
 
 from past.builtins import zip
 from past.builtins import map
 
 log = logging.getLogger(__name__)
 
-# this is a holder vor the
-hic_ma = None
+# format of the binary TAD-separation score file
+TAD_SCORE_FORMAT = 'hicexplorer-tad-score'
+TAD_SCORE_FORMAT_VERSION = 1
+
+# shared matrix and TAD-separation scores of the worker processes, set by the initializer of the pool
+matrix_of_worker = None
+spectrum_of_worker = None
+
+# TAD finder of the worker processes of a parameter sweep and the boundaries they found
+# per minimum boundary distance
+tad_finder_of_worker = None
+boundaries_of_worker = {}
 
 
 def parse_arguments(args=None):
@@ -61,8 +76,9 @@ of information at certain bins, and depending on the parameters used with this t
                                 required=True)
 
     parserRequired.add_argument('--outPrefix',
-                                help='File prefix to save the resulting files: 1. <prefix>_tad_separation.bm '
+                                help='File prefix to save the resulting files: 1. <prefix>_tad_score.bm '
                                 'The format of the output file is chrom start end TAD-sep1 TAD-sep2 TAD-sep3 .. etc. '
+                                '(or <prefix>_tad_score.h5, see --tadScoreFormat). '
                                 'We call this format a bedgraph matrix and can be plotted using '
                                 '`hicPlotTADs`. Each of the TAD-separation scores in the file corresponds to '
                                 'a different window length starting from --minDepth to --maxDepth. '
@@ -125,6 +141,15 @@ of information at certain bins, and depending on the parameters used with this t
                            'not be used.',
                            required=False)
 
+    parserOpt.add_argument('--tadScoreFormat',
+                           help='Format of the TAD-separation score file. \'bm\' is the text bedgraph matrix '
+                           '<prefix>_tad_score.bm that can be plotted with `hicPlotTADs`, \'h5\' a compressed '
+                           'binary file <prefix>_tad_score.h5 that is faster to save and load and from which single '
+                           'chromosomes can be loaded. \'both\' writes both files. For --TAD_sep_score_prefix and '
+                           'existing files the binary file is used if it exists.',
+                           choices=['bm', 'h5', 'both'],
+                           default='bm')
+
     parserOpt.add_argument('--thresholdComparisons',
                            help='P-value threshold for the bonferroni correction / q-value for FDR. '
                            'The probability of a local minima to be a boundary '
@@ -152,6 +177,30 @@ of information at certain bins, and depending on the parameters used with this t
                            'used to reduce spurious boundaries caused by noise.',
                            type=int)
 
+    parserOpt.add_argument('--sweepDelta',
+                           help='Parameter sweep: call the boundaries for each of the given delta values. '
+                           'The TAD-separation score is computed (or loaded) only once and the boundaries of '
+                           'all combinations of --sweepDelta, --sweepThresholdComparisons and '
+                           '--sweepMinBoundaryDistance are called in parallel. For each combination the '
+                           'boundary, domain and score files are saved with the prefix '
+                           '<prefix>_delta<delta>_threshold<threshold>_minBoundaryDistance<distance> and the '
+                           'number of boundaries of all combinations in <prefix>_sweep_summary.tsv. '
+                           'Parameters without a sweep option use the value of their regular option.',
+                           type=float,
+                           nargs='+')
+
+    parserOpt.add_argument('--sweepThresholdComparisons',
+                           help='Parameter sweep: call the boundaries for each of the given '
+                           '--thresholdComparisons values, see --sweepDelta.',
+                           type=float,
+                           nargs='+')
+
+    parserOpt.add_argument('--sweepMinBoundaryDistance',
+                           help='Parameter sweep: call the boundaries for each of the given '
+                           '--minBoundaryDistance values (in bp), see --sweepDelta.',
+                           type=int,
+                           nargs='+')
+
     parserOpt.add_argument('--chromosomes',
                            help='Chromosomes and order in which the '
                            'chromosomes should be plotted. This option '
@@ -163,6 +212,13 @@ of information at certain bins, and depending on the parameters used with this t
                            type=int,
                            default=1)
 
+    parserOpt.add_argument('--cacheExpected',
+                           help='Store the mean and variance per distance that are used to compute the '
+                           'z-score matrix in a file next to the matrix (<matrix>.expected.npz) and use '
+                           'them in later runs on the same matrix with the same --maxDepth and --chromosomes. '
+                           'The stored values are recomputed if the matrix file changed.',
+                           action='store_true')
+
     parserOpt.add_argument('--help', '-h', action='help', help='show this help message and exit.')
 
     parserOpt.add_argument('--version', action='version',
@@ -170,10 +226,6 @@ of information at certain bins, and depending on the parameters used with this t
     return parser
 
 
-def compute_matrix_wrapper(args):
-    return compute_matrix(*args)
-
-
 def get_cut_weight_by_bin_id(matrix, cut, depth, return_mean=False):
     """
     like get_cut_weight which is the 'diamond' representing the counts
@@ -261,6 +313,207 @@ def get_cut_weight(hic_matrix, cut, window_len, return_mean=False):
         return hic_matrix.matrix[left_idx:cut, cut:right_idx].todense().A1
 
 
+def get_idx_of_bins_at_given_distances(bin_starts, bin_ends, cuts, window_len):
+    """
+    Vectorised get_idx_of_bins_at_given_distance for the bins `cuts` of one
+    chromosome, whose bins start at `bin_starts` and end at `bin_ends`. All
+    indices are relative to the first bin of the chromosome.
+
+    Returns
+    -------
+    tuple, with the arrays of left and right bin indices, -1 if the position at the
+    given distance is not covered by a bin
+
+    >>> get_idx_of_bins_at_given_distances(np.array([0, 10, 20, 30]), np.array([10, 20, 30, 40]),
+    ...                                    np.array([0, 1, 3]), 15)
+    (array([0, 0, 1]), array([2, 3, 3]))
+    """
+    def bin_at(position):
+        idx = np.searchsorted(bin_starts, position, side='right') - 1
+        covered = (idx >= 0) & (position < bin_ends[np.maximum(idx, 0)])
+        return np.where(covered, idx, -1)
+
+    left_idx = bin_at(np.maximum(0, bin_starts[cuts] - window_len))
+    right_idx = bin_at(np.minimum(bin_ends[-1], bin_ends[cuts] + window_len) - 1)
+    return left_idx, right_idx
+
+
+def get_cut_weights(hic_matrix, cuts, window_lens, chunk_size=2**22):
+    """
+    Vectorised get_cut_weight(hic_matrix, cut, window_len, return_mean=True) for
+    all bins `cuts` and all window lengths `window_lens`. The values of each 'diamond'
+    are read from a dense band of the upper triangle of the matrix and summed in the
+    same order as get_cut_weight sums them, so that the means are the same bit by bit.
+    The cuts are processed in blocks such that a band has about `chunk_size` values.
+
+    Returns
+    -------
+    array of shape (len(cuts), len(window_lens)) with the mean of each diamond, nan
+    where get_cut_weight returns None or nan
+    """
+    cuts = np.asarray(cuts, dtype=np.int64)
+    means = np.full((len(cuts), len(window_lens)), np.nan)
+    bin_starts, bin_ends = bin_positions(hic_matrix.cut_intervals)
+
+    for chr_first, chr_last in hic_matrix.chrBinBoundaries.values():
+        in_chrom = np.flatnonzero((cuts >= chr_first) & (cuts < chr_last))
+        if len(in_chrom) == 0:
+            continue
+        means[in_chrom] = get_chromosome_cut_weights(hic_matrix.matrix, bin_starts[chr_first:chr_last],
+                                                     bin_ends[chr_first:chr_last], chr_first, cuts[in_chrom],
+                                                     window_lens, chunk_size)
+    return means
+
+
+def bin_positions(cut_intervals):
+    """
+    Returns the arrays of the start and end positions of the bins.
+    """
+    bin_starts = np.array([interval[1] for interval in cut_intervals], dtype=np.int64)
+    bin_ends = np.array([interval[2] for interval in cut_intervals], dtype=np.int64)
+    return bin_starts, bin_ends
+
+
+def get_chromosome_cut_weights(matrix, bin_starts, bin_ends, chr_first, cuts, window_lens, chunk_size=2**22):
+    """
+    get_cut_weights for the bins `cuts` of the chromosome that starts at bin `chr_first`
+    of the upper triangle csr `matrix`, whose bins start at `bin_starts` and end at
+    `bin_ends`.
+    """
+    chrom_cuts = cuts - chr_first
+    left_idx, right_idx = zip(*[get_idx_of_bins_at_given_distances(bin_starts, bin_ends, chrom_cuts, window_len)
+                                for window_len in window_lens])
+    left_idx = np.vstack(left_idx).T + chr_first
+    right_idx = np.vstack(right_idx).T + chr_first
+    valid = (left_idx >= chr_first) & (right_idx >= chr_first)
+
+    means = np.full(left_idx.shape, np.nan)
+    band_width = max(1, int((right_idx - left_idx)[valid].max())) if valid.any() else 1
+    block_size = max(1, chunk_size // band_width)
+    for block_start in range(0, len(cuts), block_size):
+        block = slice(block_start, block_start + block_size)
+        means[block] = _diamond_means(matrix, cuts[block], left_idx[block], right_idx[block], valid[block],
+                                      chunk_size)
+    return means
+
+
+def _diamond_means(matrix, cuts, left_idx, right_idx, valid, chunk_size=2**22):
+    """
+    Means of the submatrices [left_idx:cut, cut:right_idx] of the upper triangle csr
+    `matrix`, 0 for empty submatrices and nan for the invalid ones. The values of
+    the diamonds of one size are gathered row by row into one array per block of about
+    `chunk_size` values and summed along its rows, i.e. in the same order as
+    matrix[left_idx:cut, cut:right_idx].todense().mean() sums them.
+    """
+    means = np.full(left_idx.shape, np.nan)
+    if not valid.any():
+        return means
+    cuts = np.broadcast_to(cuts[:, np.newaxis], left_idx.shape)
+    heights = np.maximum(cuts - left_idx, 0)
+    widths = np.maximum(right_idx - cuts, 0)
+    sizes = np.where(valid, heights * widths, 0)
+    means[valid] = 0
+    if sizes.max() == 0:
+        return means
+
+    # dense band of the rows first_row:cuts.max(), band[i, d] = matrix[first_row + i, first_row + i + d]
+    first_row = left_idx[sizes > 0].min()
+    band_width = max(1, (right_idx - left_idx)[sizes > 0].max())
+    rows = matrix[first_row:cuts.max()].tocoo()
+    rows.sum_duplicates()
+    offsets = rows.col - rows.row - first_row
+    in_band = (offsets >= 0) & (offsets < band_width)
+    band = np.zeros((rows.shape[0], band_width))
+    band[rows.row[in_band], offsets[in_band]] = rows.data[in_band]
+
+    means = means.ravel()
+    cuts, left_idx, widths, sizes = cuts.ravel(), left_idx.ravel(), widths.ravel(), sizes.ravel()
+    diamonds = np.flatnonzero(sizes)
+    diamonds = diamonds[np.argsort(sizes[diamonds], kind='stable')]
+    size_starts = np.flatnonzero(np.diff(sizes[diamonds], prepend=0))
+    for same_size in np.split(diamonds, size_starts[1:]):
+        size = sizes[same_size[0]]
+        position = np.arange(size)
+        block_size = max(1, chunk_size // size)
+        for block_start in range(0, len(same_size), block_size):
+            block = same_size[block_start:block_start + block_size]
+            width = widths[block][:, np.newaxis]
+            diamond_rows = left_idx[block][:, np.newaxis] + position // width
+            diamond_columns = cuts[block][:, np.newaxis] + position % width
+            means[block] = band[diamond_rows - first_row, diamond_columns - diamond_rows].sum(axis=1) / size
+    return means.reshape(valid.shape)
+
+
+def get_diamond_values(matrix, cuts, left_idx, right_idx):
+    """
+    Vectorised get_cut_weight(hic_matrix, cut, window_len) for many cuts: the values,
+    zeros included, of the submatrices [left_idx:cut, cut:right_idx] of the csr `matrix`,
+    read with one fancy indexing of the matrix. Cuts with a negative left_idx or
+    right_idx have an empty diamond.
+
+    Returns
+    -------
+    tuple, with the concatenated values of all diamonds and the number of values per diamond
+    """
+    valid = (left_idx >= 0) & (right_idx >= 0)
+    heights = np.where(valid, cuts - left_idx, 0)
+    widths = np.where(valid, right_idx - cuts, 0)
+    sizes = np.maximum(heights, 0) * np.maximum(widths, 0)
+    if sizes.sum() == 0:
+        return np.array([]), sizes
+
+    diamond = np.repeat(np.arange(len(cuts)), sizes)
+    position = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    rows = left_idx[diamond] + position // widths[diamond]
+    columns = cuts[diamond] + position % widths[diamond]
+    return np.asarray(matrix[rows, columns], dtype=np.float64).ravel(), sizes
+
+
+def ranksums_pvalues(x_values, x_sizes, y_values, y_sizes):
+    """
+    Two sided p-values of the Wilcoxon rank-sum test of scipy.stats.ranksums for many
+    pairs of samples at once. The samples x and y of all pairs are concatenated in
+    `x_values` and `y_values`, `x_sizes` and `y_sizes` are their lengths. The midranks
+    are computed with one sort of all values, by pair and value. Pairs with an empty
+    sample or with nan values have a nan p-value.
+
+    >>> from scipy.stats import ranksums
+    >>> x, y = np.array([1., 2., 2., 5., 0.5]), np.array([2., 3., 4., 0.])
+    >>> np.allclose(ranksums_pvalues(x, np.array([3, 2]), y, np.array([2, 2])),
+    ...             [ranksums(x[:3], y[:2])[1], ranksums(x[3:], y[2:])[1]])
+    True
+    """
+    from scipy.stats import norm
+
+    number_of_pairs = len(x_sizes)
+    values = np.concatenate([x_values, y_values])
+    pair = np.concatenate([np.repeat(np.arange(number_of_pairs), x_sizes),
+                           np.repeat(np.arange(number_of_pairs), y_sizes)])
+    is_x = np.concatenate([np.ones(len(x_values), dtype=bool), np.zeros(len(y_values), dtype=bool)])
+    has_nan = np.bincount(pair[np.isnan(values)], minlength=number_of_pairs) > 0
+
+    order = np.lexsort((values, pair))
+    values, pair, is_x = values[order], pair[order], is_x[order]
+    pair_sizes = np.bincount(pair, minlength=number_of_pairs)
+    rank = np.arange(1, len(values) + 1) - np.repeat(np.cumsum(pair_sizes) - pair_sizes, pair_sizes)
+
+    # ties get the mean of their ranks
+    new_run = np.ones(len(values), dtype=bool)
+    new_run[1:] = (pair[1:] != pair[:-1]) | (values[1:] != values[:-1])
+    run = np.cumsum(new_run) - 1
+    midrank = (np.bincount(run, weights=rank) / np.bincount(run))[run]
+
+    n1 = x_sizes.astype(np.float64)
+    n2 = y_sizes.astype(np.float64)
+    rank_sum = np.bincount(pair[is_x], weights=midrank[is_x], minlength=number_of_pairs)
+    expected = n1 * (n1 + n2 + 1) / 2.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z_value = (rank_sum - expected) / np.sqrt(n1 * n2 * (n1 + n2 + 1) / 12.0)
+    pvalues = 2 * norm.sf(np.abs(z_value))
+    pvalues[(x_sizes == 0) | (y_sizes == 0) | has_nan] = np.nan
+    return pvalues
+
+
 def get_triangle(hic_matrix, cut, window_len, return_mean=False):
     """
     like get_cut_weight which is the 'diamond' representing the counts
@@ -307,61 +560,162 @@ def get_incremental_step_size(min_win_size, max_win_size, start_step_len):
     return incremental_step
 
 
-def compute_matrix(bins_list, min_win_size=8, max_win_size=50, step_len=2):
+def init_tad_score_worker(pMatrix, pSpectrum):
+    global matrix_of_worker, spectrum_of_worker
+    matrix_of_worker = pMatrix
+    spectrum_of_worker = pSpectrum
+
+
+def compute_tad_scores(pTask):
+    """
+    pTask is (first bin of the chromosome, end bin of the chromosome, first bin, end bin,
+    window lengths). Computes the TAD-separation scores of the bins first bin:end bin
+    for all window lengths from the shared matrix and writes them to their rows of the
+    shared spectrum. Returns the number of bins.
     """
-    Receives a number of bins for which the tad-score should be computed.
+    chr_first, chr_last, start, end, window_lens = pTask
+    (indptr, indptr_dtype), (indices, indices_dtype), (data, data_dtype), number_of_values, shape = matrix_of_worker[:5]
+    bin_starts, bin_ends = [np.frombuffer(positions, dtype=np.int64)[chr_first:chr_last]
+                            for positions in matrix_of_worker[5:]]
+    matrix = sparse.csr_matrix((np.frombuffer(data, dtype=data_dtype, count=number_of_values),
+                                np.frombuffer(indices, dtype=indices_dtype, count=number_of_values),
+                                np.frombuffer(indptr, dtype=indptr_dtype)), shape=shape)
 
-    Parameters
-    ----------
-    hic_ma Hi-C matrix object
-    bins_list list of bins to process
-    min_win_size
-    max_win_size
-    step_len
+    spectrum = np.frombuffer(spectrum_of_worker, dtype=np.float64).reshape(shape[0], len(window_lens))
+    spectrum[start:end] = get_chromosome_cut_weights(matrix, bin_starts, bin_ends, chr_first,
+                                                     np.arange(start, end), window_lens)
+    return end - start
 
-    Returns
-    -------
 
+def get_fdr_pvalue_threshold(pvalues, threshold_comparisons):
     """
+    Returns the largest p-value p_i with p_i <= threshold_comparisons * i / m of the
+    sorted p-values (Benjamini-Hochberg), 0 if there is none.
 
+    >>> get_fdr_pvalue_threshold(np.array([0.01, 0.04, 0.03, 0.5]), 0.1)
+    0.04
     """
-    :param hic_ma: Hi-C matrix object from HiCMatrix
-    :param outfile: String, path of a file to save the conductance
-                matrix in *bedgraph matrix* format
-    :return: (chrom, start, end, matrix)
+    pvalues_ = np.sort(pvalues)
+    below_threshold = pvalues_ <= threshold_comparisons * np.arange(1, len(pvalues_) + 1) / len(pvalues_)
+    return pvalues_[below_threshold].max() if below_threshold.any() else 0
+
+
+def init_sweep_worker(pBedgraphMatrix, pBoundaries, pCorrectForMultipleTesting):
     """
-    global hic_ma
-    positions_array = []
-    cond_matrix = []
-    incremental_step = get_incremental_step_size(min_win_size, max_win_size, step_len)
-    # if type(next(iter(self.interval_trees))) is np.bytes_:
-    #     chrname = toBytes(chrname)
-    # else:
-    #     chrname = toString(chrname)
-    # print("cut_intervals", hic_ma.cut_intervals)
-    for cut in bins_list:
-        chrom, chr_start, chr_end, _ = hic_ma.cut_intervals[cut]
-        # get conductance
-        # for multiple window lengths at a time
-        mult_matrix = [get_cut_weight(hic_ma, cut, depth, return_mean=True) for depth in incremental_step]
-        if any(x is None or np.isnan(x) for x in mult_matrix):
-            # skip problematic cases
-            continue
+    pBedgraphMatrix is (chromosome names, shared chromosome index of each bin, shared bin
+    starts, shared bin ends, shared TAD-separation scores, number of window lengths).
+    pBoundaries maps each minimum boundary distance to its lookahead and its minima.
+    """
+    global tad_finder_of_worker, boundaries_of_worker
+    chromosome_names, chromosome_idx, chr_start, chr_end, spectrum, number_of_windows = pBedgraphMatrix
+    chromosome_idx = np.frombuffer(chromosome_idx, dtype=np.int64)
+    spectrum = np.frombuffer(spectrum, dtype=np.float64).reshape(len(chromosome_idx), number_of_windows)
+    # a TAD finder without a matrix, with what save_domains_and_boundaries needs
+    tad_finder_of_worker = HicFindTads.__new__(HicFindTads)
+    tad_finder_of_worker.bedgraph_matrix = {'chrom': chromosome_names[chromosome_idx],
+                                            'chr_start': np.frombuffer(chr_start, dtype=np.int64),
+                                            'chr_end': np.frombuffer(chr_end, dtype=np.int64),
+                                            'matrix': spectrum}
+    tad_finder_of_worker.correct_for_multiple_testing = pCorrectForMultipleTesting
+    boundaries_of_worker = pBoundaries
+
+
+def find_sweep_boundaries(pTask):
+    """
+    pTask is (output prefix, delta, threshold comparisons, minimum boundary distance).
+    Filters the minima of the minimum boundary distance with the delta and the threshold,
+    with the shared TAD-separation score, and saves the boundaries with the output prefix.
+    Returns the lookahead in bins and the number of boundaries.
+    """
+    prefix, delta, threshold_comparisons, min_boundary_distance = pTask
+    tad_finder = tad_finder_of_worker
+    lookahead, tad_finder.boundaries = boundaries_of_worker[min_boundary_distance]
+    tad_finder.delta = delta
+    tad_finder.threshold_comparisons = threshold_comparisons
+    if tad_finder.correct_for_multiple_testing == 'fdr':
+        tad_finder.pvalueFDR = get_fdr_pvalue_threshold(np.array(list(tad_finder.boundaries['pvalues'].values())),
+                                                        threshold_comparisons)
+    number_of_boundaries = tad_finder.save_domains_and_boundaries(prefix)
+    return lookahead, number_of_boundaries
+
+
+def first_index_above(values, thresholds, segment_ends):
+    """
+    For each position k, the first position j > k with values[j] > thresholds[k] before
+    segment_ends[k], segment_ends[k] if there is none. The blocks of a sparse table of
+    the range maxima of values are skipped from the largest to the smallest one.
+
+    >>> first_index_above(np.array([3., 1., 2., 5., 0.]), np.array([2., 1., 4., 0., 1.]),
+    ...                   np.array([5, 5, 5, 5, 5]))
+    array([3, 2, 3, 5, 5])
+    >>> first_index_above(np.array([3., 1., 2., 5., 0.]), np.array([2., 1., 4., 0., 1.]),
+    ...                   np.array([3, 3, 3, 5, 5]))
+    array([3, 2, 3, 5, 5])
+    """
+    sparse_table = [values]
+    while 2 ** len(sparse_table) <= len(values):
+        half = 2 ** (len(sparse_table) - 1)
+        sparse_table.append(np.maximum(sparse_table[-1][:-half], sparse_table[-1][half:]))
 
-        cond_matrix.append(mult_matrix)
+    position = np.arange(1, len(values) + 1)
+    for level in range(len(sparse_table) - 1, -1, -1):
+        block_end = position + 2 ** level
+        fits = block_end <= segment_ends
+        block_max = sparse_table[level][np.where(fits, position, 0)]
+        position = np.where(fits & (block_max <= thresholds), block_end, position)
+    return position
 
-        positions_array.append((chrom, chr_start, chr_end))
-    chrom, chr_start, chr_end = zip(*positions_array)
-    cond_matrix = np.vstack(cond_matrix)
 
-    return chrom, chr_start, chr_end, cond_matrix
+def smallest_above(values, delta):
+    """
+    For each value the smallest float m for which m - delta > value holds in floating
+    point arithmetic. The floats are bisected in the order of their bit patterns.
+
+    >>> smallest_above(np.array([-0.1, 3.]), 0.5)
+    array([0.4, 3.5])
+    >>> smallest_above(np.array([-0.1, 3.]), 0.) == np.nextafter([-0.1, 3.], np.inf)
+    array([ True,  True])
+    """
+    def to_order(floats):
+        bits = floats.view(np.int64)
+        return bits ^ ((bits >> 63) & np.int64(0x7fffffffffffffff))
+
+    def to_float(order):
+        return (order ^ ((order >> 63) & np.int64(0x7fffffffffffffff))).view(np.float64)
+
+    values = np.asarray(values, dtype=np.float64)
+    if delta == 0:
+        return np.nextafter(values, np.inf)
+    margin = 4 * np.spacing(np.abs(values) + abs(delta))
+    lower = to_order(values + delta - margin)
+    upper = to_order(values + delta + margin)
+    while (upper - lower > 1).any():
+        middle = lower + (upper - lower) // 2
+        is_above = (to_float(middle) - delta) > values
+        upper = np.where(is_above, middle, upper)
+        lower = np.where(is_above, lower, middle)
+    return to_float(upper)
+
+
+def window_extreme(values, window, number_of_windows, function):
+    """
+    function, np.minimum or np.maximum, of values[j:j + window] for the first
+    number_of_windows positions j.
+
+    >>> window_extreme(np.array([3., 1., 2., 5., 0.]), 2, 3, np.minimum)
+    array([1., 1., 2.])
+    """
+    extreme = values[:number_of_windows].copy()
+    for offset in range(1, window):
+        function(extreme, values[offset:offset + number_of_windows], out=extreme)
+    return extreme
 
 
 class HicFindTads(object):
 
     def __init__(self, matrix, num_processors=1, max_depth=None, min_depth=None, step=None, delta=0.01,
                  min_boundary_distance=None, use_zscore=True, p_correct_for_multiple_testing="fdr", p_threshold_comparisons=0.01,
-                 pChromosomes=None):
+                 pChromosomes=None, pCacheExpected=False):
         """
 
         Parameters
@@ -378,11 +732,17 @@ class HicFindTads(object):
         pCorrectForMultipleTesting Multiple comparisons method: FDR, Bonferroni or None
         pThresholdComparisons The threshold for the Multiple comparisons. It is used as p-value for Bonferroni or as q-value for FDR.
         pChromosomes The chromomes that should be included for the analysis.
+        pCacheExpected Store the expected values of the z-score matrix next to the matrix file, if it is a filename
         """
 
-        # if matrix is string, loaded, else, assume is a HiCMatrix object
-
-        self.set_matrix(matrix, pChromosomes)
+        # if matrix is string, loaded, else, assume is a HiCMatrix object.
+        # Only the pixels up to the band of the z-score matrix, 1.5 * 2.5 * max_depth,
+        # are needed. Without a chromosome selection the chromosomes are not reordered
+        # and the matrix can be loaded banded
+        max_distance = None
+        if max_depth is not None and pChromosomes is None:
+            max_distance = max_depth * 2.5 * 1.5
+        self.set_matrix(matrix, pChromosomes, pMaxDistance=max_distance)
         if max_depth is not None and min_depth is not None and max_depth <= min_depth:
             log.error("Please check that maxDepth is larger than minDepth.")
             exit()
@@ -400,12 +760,19 @@ class HicFindTads(object):
         self.set_variables()
         self.correct_for_multiple_testing = p_correct_for_multiple_testing
         self.threshold_comparisons = p_threshold_comparisons
+        self.cache_expected = pCacheExpected
 
-    def set_matrix(self, pMatrix, pChromosomes):
+    def set_matrix(self, pMatrix, pChromosomes, pMaxDistance=None):
         if isinstance(pMatrix, str):
-            self.hic_ma = hm.hiCMatrix(pMatrix)
+            if pMaxDistance is not None:
+                # the distances are counted in the matrix without the nan bins, which are masked
+                self.hic_ma = load_banded_matrix(pMatrix, pMaxDistance, pSkipNanBins=True)
+            else:
+                self.hic_ma = hm.hiCMatrix(pMatrix)
+            self.matrix_file = pMatrix
         else:
             self.hic_ma = pMatrix
+            self.matrix_file = None
 
         if pChromosomes is not None:
             valid_chromosomes = []
@@ -482,7 +849,9 @@ class HicFindTads(object):
 
         function for detecting local maximum and minimum in a signal.
         Discovers peaks by searching for values which are surrounded by lower
-        or larger values for maximum and minimum respectively
+        or larger values for maximum and minimum respectively. The peaks of
+        all chromosomes are searched at once, the search restarts at each
+        chromosome given in chrom.
 
         keyword arguments:
         :param: y_axis -- A list containing the signal over which to find peaks
@@ -504,10 +873,6 @@ class HicFindTads(object):
             results to unpack one of the lists into x, y coordinates do:
             x, y = zip(*tab)
         """
-        max_peaks = []
-        min_peaks = []
-        dump = []   # Used to pop the first hit which almost always is false
-
         # check input data
         if x_axis is None:
             x_axis = np.arange(len(y_axis))
@@ -515,74 +880,104 @@ class HicFindTads(object):
         if len(y_axis) != len(x_axis):
             raise ValueError('Input vectors y_axis and x_axis must have same length')
 
-        # store data length for later use
-
         if not (np.isscalar(delta) and delta >= 0):
             raise ValueError("delta must be a positive number")
 
-        # maximum and minimum candidates are temporarily stored in
-        # min_x and min_y respectively
-        min_y, max_y = np.Inf, -np.Inf
-        max_pos, min_pos = None, None
-        search_for = None
+        y_axis = np.asarray(y_axis)
+        x_axis = np.asarray(x_axis)
         # Only detect peak if there is 'lookahead' amount of points after it
-        prev_chrom = None
-        for index, (x, y) in enumerate(zip(x_axis[:-lookahead], y_axis[:-lookahead])):
-            assert -np.inf < y < np.inf, "Error, infinity value detected for value at position {}".format(index)
-            if prev_chrom is None:
-                prev_chrom = chrom[index]
-            if prev_chrom != chrom[index]:
-                # reset variables at the start of a chromosome
-                min_y, max_y = np.Inf, -np.Inf
-                max_pos, min_pos = None, None
-                search_for = None
-
-            prev_chrom = chrom[index]
-
-            if y > max_y:
-                max_y = y
-                max_pos = x
-            if y < min_y:
-                min_y = y
-                min_pos = x
-
-            # look for max
-            if y < max_y - delta and max_y != np.Inf and search_for != 'min':
-                # Maximum peak candidate found
-                # look ahead in signal to ensure that this is a peak and not jitter
-                if y_axis[index:index + lookahead].max() < max_y:
-                    max_peaks.append([max_pos, max_y])
-                    dump.append(True)
-                    # set algorithm to only find minimum now
-                    max_y = y
-                    min_y = y
-                    min_pos = x
-                    search_for = 'min'
-                    continue
-
-            # look for min
-            if y > min_y + delta and min_y != -np.Inf and search_for != 'max':
-                # Minimum peak candidate found
-                # look ahead in signal to ensure that this is a peak and not jitter
-                if y_axis[index:index + lookahead].min() > min_y:
-                    min_peaks.append([min_pos, min_y])
-                    dump.append(False)
-                    # set algorithm to only find maximum now
-                    min_y = y
-                    max_y = y
-                    max_pos = x
-                    search_for = 'max'
+        length = len(y_axis[:-lookahead])
+        if length == 0:
+            return [[], []]
+        y_values = y_axis[:length]
+        not_finite = ~np.isfinite(y_values)
+        assert not not_finite.any(), \
+            "Error, infinity value detected for value at position {}".format(np.flatnonzero(not_finite)[0])
+
+        # the signal is searched independently on each chromosome
+        if chrom is None:
+            chrom_starts = np.array([0])
+        else:
+            chrom = np.asarray(chrom)[:length]
+            chrom_starts = np.flatnonzero(np.concatenate([[True], chrom[1:] != chrom[:-1]]))
+        chrom_ends = np.append(chrom_starts[1:], length)
+        segment_ends = np.repeat(chrom_ends, chrom_ends - chrom_starts)
+
+        # A minimum candidate y[k] is confirmed at the first position j > k where the
+        # signal rose by more than delta and the look ahead values all stay above y[k].
+        # The minimum started at position r is confirmed at the earliest of those
+        # positions for all k >= r. The same holds for the maxima on the negated signal.
+        min_ahead = np.minimum(window_extreme(y_axis, lookahead, length, np.minimum),
+                               -np.nextafter(smallest_above(-y_values, delta), -np.inf))
+        max_ahead = np.maximum(window_extreme(y_axis, lookahead, length, np.maximum),
+                               np.nextafter(smallest_above(y_values, delta), -np.inf))
+        min_found = np.empty(length, dtype=int)
+        max_found = np.empty(length, dtype=int)
+        # the chromosomes are processed in groups to limit the memory of the sparse tables
+        group_starts = chrom_starts[np.flatnonzero(np.diff(chrom_starts // 2**18, prepend=-1))]
+        for group_start, group_end in zip(group_starts, np.append(group_starts[1:], length)):
+            group = slice(group_start, group_end)
+            min_found[group] = group_start + first_index_above(min_ahead[group], y_values[group],
+                                                               segment_ends[group] - group_start)
+            max_found[group] = group_start + first_index_above(-max_ahead[group], -y_values[group],
+                                                               segment_ends[group] - group_start)
+        min_found = np.minimum.accumulate(min_found[::-1])[::-1]
+        max_found = np.minimum.accumulate(max_found[::-1])[::-1]
+
+        # Each found peak is a node: a maximum found at position j is node j, a minimum node
+        # j + length and the node 2 * length marks the end of a chromosome. After a maximum the
+        # next minimum is searched starting at j and vice versa.
+        end_node = 2 * length
+        next_node = np.concatenate([np.where(min_found < segment_ends, min_found + length, end_node),
+                                    np.where(max_found < segment_ends, max_found, end_node),
+                                    [end_node]])
+        # at the start of a chromosome the first maximum or minimum found is taken
+        first_max = max_found[chrom_starts]
+        first_min = min_found[chrom_starts]
+        nodes = np.where(first_max <= first_min,
+                         np.where(first_max < chrom_ends, first_max, end_node),
+                         np.where(first_min < chrom_ends, first_min + length, end_node))
+        nodes = nodes[nodes != end_node]
+        # follow the nodes of all chromosomes at once, doubling the number of steps each round
+        new_nodes = nodes
+        while len(new_nodes):
+            new_nodes = next_node[nodes]
+            new_nodes = new_nodes[new_nodes != end_node]
+            nodes = np.concatenate([nodes, new_nodes])
+            next_node = next_node[next_node]
+
+        if len(nodes) == 0:
+            return [[], []]
+        is_max = nodes < length
+        found_at = np.where(is_max, nodes, nodes - length)
+        order = np.argsort(found_at)
+        found_at = found_at[order]
+        is_max = is_max[order]
+
+        # the peak is the first maximum (minimum) between the previous and the current peak
+        search_from = np.empty_like(found_at)
+        search_from[0] = 0
+        search_from[1:] = found_at[:-1]
+        first_peak_of_chrom = np.ones(len(found_at), dtype=bool)
+        peak_chrom = np.searchsorted(chrom_starts, found_at, side='right')
+        first_peak_of_chrom[1:] = peak_chrom[1:] != peak_chrom[:-1]
+        search_from[first_peak_of_chrom] = chrom_starts[peak_chrom[first_peak_of_chrom] - 1]
+        bounds = np.column_stack([search_from, found_at]).ravel()
+        peak_value = np.where(is_max, np.maximum.reduceat(y_axis, bounds)[::2],
+                              np.minimum.reduceat(y_axis, bounds)[::2])
+        peak_of_position = np.searchsorted(found_at, np.arange(length), side='right')
+        in_search = peak_of_position < len(found_at)
+        peak_of_position = np.where(in_search, peak_of_position, 0)
+        in_search &= search_from[peak_of_position] <= np.arange(length)
+        is_peak = np.flatnonzero(in_search & (y_values == peak_value[peak_of_position]))
+        _, first_position = np.unique(peak_of_position[is_peak], return_index=True)
+        peak_idx = is_peak[first_position]
 
         # Remove the false hit on the first value of the y_axis
-        try:
-            if dump[0]:
-                max_peaks.pop(0)
-            else:
-                min_peaks.pop(0)
-            del dump
-        except IndexError:
-            # no peaks were found, should the function return empty lists?
-            pass
+        peak_idx = peak_idx[1:]
+        is_max = is_max[1:]
+        max_peaks = [[x, y] for x, y in zip(x_axis[peak_idx[is_max]], y_axis[peak_idx[is_max]])]
+        min_peaks = [[x, y] for x, y in zip(x_axis[peak_idx[~is_max]], y_axis[peak_idx[~is_max]])]
 
         return [max_peaks, min_peaks]
 
@@ -608,30 +1003,30 @@ class HicFindTads(object):
         """
 
         # compute the start and end points of the chromosomes
-        # and store it as tuples in chrom_ranges list (e.g. chrom_ranges = [(0, 29254), (29254, 60006), ...]
+        # (e.g. chr_start_idx = [0, 29254, 60006, ...]), consecutive points define a chromosome range
         unique_chroms, chr_start_idx = np.unique(chrom, return_index=True)
         chr_start_idx = np.concatenate([chr_start_idx, [len(chrom) - 1]])
         chr_start_idx = np.sort(chr_start_idx)
-        chrom_ranges = [(chr_start_idx[x], chr_start_idx[x + 1]) for x in range(len(chr_start_idx) - 1)]
-
-        delta_to_mean = {}
-        for min_idx in min_idx_list:
-            # check that the min_idx is not to close to any of the chromosome boundaries
-            close_to_chrom_border = True
-            for start_range, end_range in chrom_ranges:
-                if start_range < min_idx < end_range:
-                    if min_idx - window_len >= start_range and min_idx + window_len < end_range:
-                        close_to_chrom_border = False
-                        continue
-            if close_to_chrom_border is True:
-                delta_to_mean[min_idx] = np.nan
 
-            else:
-                local_tad_score = np.concatenate([matrix_avg[min_idx - window_len:min_idx + 3],
-                                                  matrix_avg[min_idx + 4: min_idx + window_len]])
-                delta_to_mean[min_idx] = local_tad_score.mean() - matrix_avg[min_idx]
-
-        return delta_to_mean
+        # check that the min_idx is not to close to any of the chromosome boundaries
+        min_idx = np.asarray(min_idx_list, dtype=int)
+        chrom_range = np.searchsorted(chr_start_idx, min_idx, side='right') - 1
+        in_range = (chrom_range >= 0) & (chrom_range < len(chr_start_idx) - 1)
+        chrom_range = np.where(in_range, chrom_range, 0)
+        range_start = chr_start_idx[chrom_range]
+        range_end = chr_start_idx[np.minimum(chrom_range + 1, len(chr_start_idx) - 1)]
+        far_from_chrom_border = in_range & (range_start < min_idx) & (min_idx < range_end) & \
+            (min_idx - window_len >= range_start) & (min_idx + window_len < range_end)
+
+        # the local TAD-separation scores of all minima are averaged at once, row by row
+        # as the mean of the concatenated windows
+        offsets = np.concatenate([np.arange(-window_len, 3), np.arange(4, window_len)])
+        local_min_idx = min_idx[far_from_chrom_border]
+        local_tad_score = matrix_avg[local_min_idx[:, np.newaxis] + offsets]
+        delta = np.full(len(min_idx), np.nan)
+        delta[far_from_chrom_border] = local_tad_score.mean(axis=1) - matrix_avg[local_min_idx]
+
+        return dict(zip(min_idx_list, delta))
 
     @staticmethod
     def find_consensus_minima(tad_score_matrix, lookahead=3, chrom=None):
@@ -901,6 +1296,44 @@ class HicFindTads(object):
                                                   toString(self.bedgraph_matrix['chr_end'][idx]),
                                                   toString(matrix_values)))
 
+    def save_tad_score_matrix(self, outfile, pCompressionLevel=5):
+        """
+        Saves the TAD-separation score matrix in the binary format, a HDF5 file with
+        compressed arrays for the bin positions and the scores. The rows of each
+        chromosome are stored consecutively and the row offsets of the chromosomes
+        allow to read the scores of some chromosomes without reading the whole file.
+        The parameters are attributes of the root node.
+
+        Returns
+        -------
+        None
+        """
+        chrom = toString(self.bedgraph_matrix['chrom'])
+        matrix = self.bedgraph_matrix['matrix']
+        # the rows at which the chromosome changes
+        chrom_start_rows = np.flatnonzero(np.concatenate([[True], chrom[1:] != chrom[:-1]]))
+        chrom_names = [chrom[row] for row in chrom_start_rows]
+        if len(set(chrom_names)) != len(chrom_names):
+            log.error("The rows of the TAD-separation score matrix are not sorted by chromosome.")
+            exit(1)
+
+        filters = tables.Filters(complevel=pCompressionLevel, complib='blosc', shuffle=True)
+        with tables.open_file(outfile, mode='w', title=TAD_SCORE_FORMAT) as h5_file:
+            h5_file.create_array(h5_file.root, 'chrom_names', np.array(chrom_names, dtype='S'))
+            h5_file.create_array(h5_file.root, 'chrom_offsets',
+                                 np.concatenate([chrom_start_rows, [len(chrom)]]).astype(np.int64))
+            for name in ['chr_start', 'chr_end']:
+                h5_file.create_carray(h5_file.root, name, obj=np.asarray(self.bedgraph_matrix[name], dtype=np.int64),
+                                      filters=filters)
+            h5_file.create_carray(h5_file.root, 'matrix', obj=np.asarray(matrix, dtype=np.float64), filters=filters)
+            attributes = h5_file.root._v_attrs
+            attributes.format = TAD_SCORE_FORMAT
+            attributes.format_version = TAD_SCORE_FORMAT_VERSION
+            attributes.step = self.step
+            attributes.minDepth = self.min_depth
+            attributes.maxDepth = self.max_depth
+            attributes.binsize = self.binsize
+
     def save_clusters(clusters, file_prefix):
         """
 
@@ -1044,6 +1477,8 @@ class HicFindTads(object):
                 tad_score.write("{}\t{}\t{}\t{:.12f}\n".format(toString(chrom[idx]), left_bin_center, right_bin_center,
                                                                mean_mat_all[idx]))
 
+        return len(filtered_min_idx)
+
     def compute_spectra_matrix(self, perchr=True):
         """
         Uses multiple processors to compute the TAD-score
@@ -1065,7 +1500,16 @@ class HicFindTads(object):
         if self.use_zscore:
             # use zscore matrix
             log.info("Computing z-score matrix...\n")
-            self.hic_ma.convert_to_zscore_matrix(maxdepth=self.max_depth * 2.5, perchr=perchr)
+            expected = None
+            use_cache = self.cache_expected and self.matrix_file is not None
+            if use_cache:
+                expected_key = 'hicFindTADs z-score maxDepth {} perChromosome {} chromosomes {}'.format(
+                    self.max_depth * 2.5, perchr, ' '.join(self.hic_ma.getChrNames()))
+                expected = load_expected(self.matrix_file, expected_key)
+            _, computed_expected = convert_to_obs_exp_matrix(self.hic_ma, pMaxDepth=self.max_depth * 2.5, pZscore=True,
+                                                             pPerChromosome=perchr, pExpected=expected)
+            if use_cache and expected is None:
+                save_expected(self.matrix_file, expected_key, computed_expected)
 
         # extend remaining bins to remove gaps in
         # the matrix
@@ -1123,42 +1567,55 @@ class HicFindTads(object):
                                                                                               k=limit, format='csr')
         self.hic_ma.matrix.eliminate_zeros()
 
-        func = compute_matrix_wrapper
-        TASKS = []
-        bins_to_consider = []
-        # to speed up parallel computation the self.hic_ma (HiCMatrix object) is converted into a global object.
-        global hic_ma
-        hic_ma = self.hic_ma
-        for chrom in list(self.hic_ma.chrBinBoundaries):
-            bins_to_consider.extend(list(range(*self.hic_ma.chrBinBoundaries[chrom])))
-
-        for idx_array in np.array_split(bins_to_consider, self.num_processors):
-            TASKS.append((idx_array, self.min_depth, self.max_depth, self.step))
-
-        if self.num_processors > 1:
-            pool = multiprocessing.Pool(self.num_processors)
+        # the matrix, the bin positions and the TAD-separation scores are in shared memory,
+        # the bins of each chromosome are split into many small tasks, such that the
+        # processes that are done early take the next ones
+        matrix = self.hic_ma.matrix
+        number_of_bins = matrix.shape[0]
+        bin_starts, bin_ends = bin_positions(self.hic_ma.cut_intervals)
+        shared_matrix = [(shared_array(array), array.dtype) for array in [matrix.indptr, matrix.indices, matrix.data]]
+        shared_matrix += [matrix.nnz, matrix.shape, shared_array(bin_starts), shared_array(bin_ends)]
+        # the matrix object uses the shared memory from now on
+        self.hic_ma.matrix = sparse.csr_matrix((np.frombuffer(shared_matrix[2][0], dtype=matrix.data.dtype, count=matrix.nnz),
+                                                np.frombuffer(shared_matrix[1][0], dtype=matrix.indices.dtype, count=matrix.nnz),
+                                                np.frombuffer(shared_matrix[0][0], dtype=matrix.indptr.dtype)),
+                                               shape=matrix.shape)
+        matrix = None
+        shared_spectrum = RawArray(np.ctypeslib.as_ctypes_type(np.float64), number_of_bins * len(incremental_step))
+        spectrum = np.frombuffer(shared_spectrum, dtype=np.float64).reshape(number_of_bins, len(incremental_step))
+        spectrum[:] = np.nan
+
+        bins_per_task = max(10 * max_depth_in_bins, number_of_bins // (16 * self.num_processors))
+        tasks = []
+        for chr_first, chr_last in self.hic_ma.chrBinBoundaries.values():
+            for start in range(chr_first, chr_last, bins_per_task):
+                tasks.append((chr_first, chr_last, start, min(start + bins_per_task, chr_last), incremental_step))
+
+        if self.num_processors > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(min(self.num_processors, len(tasks)), initializer=init_tad_score_worker,
+                                        initargs=(shared_matrix, shared_spectrum))
             log.info("Using {} processors\n".format(self.num_processors))
-            res = pool.map_async(func, TASKS).get(9999999)
-            pool.close()
+            results = pool.imap_unordered(compute_tad_scores, tasks)
         else:
-            res = map(func, TASKS)
+            pool = None
+            init_tad_score_worker(shared_matrix, shared_spectrum)
+            results = map(compute_tad_scores, tasks)
+        for number_of_processed_bins in results:
+            log.debug("TAD-separation scores of {} bins computed".format(number_of_processed_bins))
+        if pool is not None:
+            pool.close()
+            pool.join()
 
-        chrom = []
-        chr_start = []
-        chr_end = []
-        matrix = []
-        for _chrom, _chr_start, _chr_end, _matrix in res:
-            chrom.extend(toString(_chrom))
-            chr_start.extend(_chr_start)
-            chr_end.extend(_chr_end)
-            matrix.append(_matrix)
+        bins_to_consider = np.concatenate([np.arange(chr_first, chr_last, dtype=np.int64)
+                                           for chr_first, chr_last in self.hic_ma.chrBinBoundaries.values()])
+        # skip problematic cases
+        bins_to_consider = bins_to_consider[~np.isnan(spectrum[bins_to_consider]).any(axis=1)]
+        chrom, chr_start, chr_end = zip(*[self.hic_ma.cut_intervals[idx][:3] for idx in bins_to_consider])
 
-        matrix = np.vstack(matrix)
-
-        self.bedgraph_matrix = {'chrom': np.array(chrom),
+        self.bedgraph_matrix = {'chrom': np.array(toString(list(chrom))),
                                 'chr_start': np.array(chr_start).astype(int),
                                 'chr_end': np.array(chr_end).astype(int),
-                                'matrix': matrix}
+                                'matrix': spectrum[bins_to_consider]}
 
     def load_bedgraph_matrix(self, filename, pChromosomes=None):
         # load spectrum matrix:
@@ -1197,6 +1654,47 @@ class HicFindTads(object):
                                 'chr_end': np.array(end_list).astype(int),
                                 'matrix': matrix}
 
+    def load_tad_score_matrix(self, filename, pChromosomes=None):
+        """
+        Loads a TAD-separation score matrix saved by save_tad_score_matrix. With
+        pChromosomes only the rows of these chromosomes are read.
+        """
+        with tables.open_file(filename, mode='r') as h5_file:
+            attributes = h5_file.root._v_attrs
+            if getattr(attributes, 'format', None) != TAD_SCORE_FORMAT:
+                log.error("{} is not a TAD-separation score file created by hicFindTADs".format(filename))
+                exit(1)
+            chrom_names = toString(h5_file.root.chrom_names.read().tolist())
+            chrom_offsets = h5_file.root.chrom_offsets.read()
+            chrom_list = []
+            arrays = {'chr_start': [], 'chr_end': [], 'matrix': []}
+            for index, chrom in enumerate(chrom_names):
+                if pChromosomes is not None and chrom not in pChromosomes:
+                    continue
+                rows = slice(chrom_offsets[index], chrom_offsets[index + 1])
+                chrom_list.extend([chrom] * (rows.stop - rows.start))
+                for name in arrays:
+                    arrays[name].append(getattr(h5_file.root, name)[rows])
+            self.min_depth = attributes.minDepth
+            self.max_depth = attributes.maxDepth
+            self.step = attributes.step
+            self.binsize = attributes.binsize
+
+        self.bedgraph_matrix = {'chrom': np.array(chrom_list),
+                                'chr_start': np.concatenate(arrays['chr_start']).astype(int),
+                                'chr_end': np.concatenate(arrays['chr_end']).astype(int),
+                                'matrix': np.vstack(arrays['matrix'])}
+
+    def load_tad_score(self, filename, pChromosomes=None):
+        """
+        Loads the TAD-separation score matrix in the binary format if filename ends with
+        .h5, otherwise as bedgraph matrix.
+        """
+        if filename.endswith('.h5'):
+            self.load_tad_score_matrix(filename, pChromosomes)
+        else:
+            self.load_bedgraph_matrix(filename, pChromosomes)
+
     def min_pvalue(self, min_idx):
         """
         For each putative local minima, find the -window_len diammond and the +window_len diamond
@@ -1213,78 +1711,71 @@ class HicFindTads(object):
         """
 
         log.info("Computing p-values for window length: {}\n".format(self.min_depth))
-        pvalues = []
         chrom = self.bedgraph_matrix['chrom']
         chr_start = self.bedgraph_matrix['chr_start']
         chr_end = self.bedgraph_matrix['chr_end']
         window_len = self.min_depth
 
-        from scipy.stats import ranksums
-
         new_min_idx = []
+        matrix_min_idx = []
         for idx in min_idx:
-
             matrix_idx = self.hic_ma.getRegionBinRange(chrom[idx], chr_start[idx], chr_end[idx])
             if matrix_idx is None:
                 continue
-            else:
-                matrix_idx = matrix_idx[0]
-
+            matrix_idx = matrix_idx[0]
             new_min_idx += [idx]
+            matrix_min_idx += [matrix_idx]
             min_chr, min_start, min_end, _ = self.hic_ma.getBinPos(matrix_idx)
             assert toString(chrom[idx]) == toString(min_chr) and chr_start[idx] == min_start and chr_end[idx] == min_end
-            left_idx, right_idx = get_idx_of_bins_at_given_distance(self.hic_ma, matrix_idx, window_len)
-
-            left = get_cut_weight(self.hic_ma, left_idx, window_len)
-            right = get_cut_weight(self.hic_ma, right_idx, window_len)
-            boundary = get_cut_weight(self.hic_ma, matrix_idx, window_len)
-
-            if left is None:
-                left = []
-            if right is None:
-                right = []
-
-            if len(left) == 0 and len(right) == 0:
-                pval = np.nan
 
-            elif boundary is None or len(boundary) == 0 or len(left) == 0 or len(right) == 0:
-                pval = np.nan
-
-            else:
-
-                try:
-                    pval1 = ranksums(boundary, left)[1]
-                    pval2 = ranksums(boundary, right)[1]
-                    pval = min(pval1, pval2)
-                except ValueError:
-                    # this condition happens when boundary, left and right are only composed of 'zeros'
-                    pval = np.nan
-            pvalues += [pval]
+        # the diamonds at the minimum and at window_len to the left and to the right of it
+        matrix_min_idx = np.array(matrix_min_idx, dtype=np.int64)
+        bin_starts, bin_ends = bin_positions(self.hic_ma.cut_intervals)
+
+        def idx_at_given_distance(cuts):
+            # as get_idx_of_bins_at_given_distance, -1 for the cuts and positions without a bin
+            left_idx = np.full(len(cuts), -1, dtype=np.int64)
+            right_idx = np.full(len(cuts), -1, dtype=np.int64)
+            for chr_first, chr_last in self.hic_ma.chrBinBoundaries.values():
+                in_chrom = (cuts >= chr_first) & (cuts < chr_last)
+                left, right = get_idx_of_bins_at_given_distances(bin_starts[chr_first:chr_last],
+                                                                 bin_ends[chr_first:chr_last],
+                                                                 cuts[in_chrom] - chr_first, window_len)
+                left_idx[in_chrom] = np.where(left >= 0, left + chr_first, -1)
+                right_idx[in_chrom] = np.where(right >= 0, right + chr_first, -1)
+            return left_idx, right_idx
+
+        left_idx, right_idx = idx_at_given_distance(matrix_min_idx)
+        diamonds = {}
+        for name, cuts in [('boundary', matrix_min_idx), ('left', left_idx), ('right', right_idx)]:
+            diamonds[name] = get_diamond_values(self.hic_ma.matrix, cuts, *idx_at_given_distance(cuts))
+
+        pval1 = ranksums_pvalues(*(diamonds['boundary'] + diamonds['left']))
+        pval2 = ranksums_pvalues(*(diamonds['boundary'] + diamonds['right']))
+        # as min(pval1, pval2)
+        pvalues = np.where(pval2 < pval1, pval2, pval1)
+        # no p-value if any of the diamonds is empty
+        pvalues[(diamonds['boundary'][1] == 0) | (diamonds['left'][1] == 0) | (diamonds['right'][1] == 0)] = np.nan
 
         assert len(pvalues) == len(new_min_idx)
 
         # fdr
         if self.correct_for_multiple_testing == 'fdr':
 
-            pvalues = np.array([e if ~np.isnan(e) else 1 for e in pvalues])
-            pvalues_ = sorted(pvalues)
-            largest_p_i = 0
-            for i, p in enumerate(pvalues_):
-                if p <= (self.threshold_comparisons * (i + 1) / len(pvalues_)):
-                    if p >= largest_p_i:
-                        largest_p_i = p
-            self.pvalueFDR = largest_p_i
+            pvalues[np.isnan(pvalues)] = 1
+            self.pvalueFDR = get_fdr_pvalue_threshold(pvalues, self.threshold_comparisons)
         elif self.correct_for_multiple_testing == 'bonferroni':
             # bonferroni correction
-            pvalues = np.array(pvalues) * len(pvalues)
-            to_one_index_values = np.array([e > 1 if ~np.isnan(e) else False for e in pvalues])
-            if len(to_one_index_values) > 0:
-                pvalues[to_one_index_values] = 1
+            pvalues = pvalues * len(pvalues)
+            pvalues[pvalues > 1] = 1
 
         return OrderedDict(zip(new_min_idx, pvalues))
 
-    def find_boundaries(self):
-
+    def get_lookahead(self):
+        """
+        Returns the minimum boundary distance in number of bins, the minimum boundary
+        distance is set to four bins if it is not given.
+        """
         # perform some checks
         avg_bin_size = np.median(self.bedgraph_matrix['chr_end'] - self.bedgraph_matrix['chr_start'])
 
@@ -1295,7 +1786,11 @@ class HicFindTads(object):
         lookahead = int(self.min_boundary_distance / avg_bin_size)
         if lookahead < 1:
             raise ValueError("minBoundaryDistance must be '1' or above in value")
+        return lookahead
 
+    def find_boundaries(self):
+
+        lookahead = self.get_lookahead()
         min_idx, delta = HicFindTads.find_consensus_minima(self.bedgraph_matrix['matrix'], lookahead=lookahead,
                                                            chrom=self.bedgraph_matrix['chrom'])
 
@@ -1328,6 +1823,67 @@ class HicFindTads(object):
                            'delta': delta,
                            'pvalues': pvalues}
 
+    def sweep_boundaries(self, prefix, pDeltas, pThresholdComparisons, pMinBoundaryDistances):
+        """
+        Calls and saves the boundaries for all combinations of the given deltas, thresholds
+        and minimum boundary distances. The minima and their p-values are computed once per
+        minimum boundary distance, the combinations are then filtered and saved in parallel
+        by processes that share the TAD-separation score. Saves the number of boundaries of
+        each combination to <prefix>_sweep_summary.tsv.
+        """
+        if None in pMinBoundaryDistances:
+            # the default minimum boundary distance depends on the bin size
+            self.min_boundary_distance = None
+            self.get_lookahead()
+            pMinBoundaryDistances = [self.min_boundary_distance if distance is None else distance
+                                     for distance in pMinBoundaryDistances]
+
+        # the minima and their p-values depend only on the minimum boundary distance
+        boundaries = {}
+        for min_boundary_distance in pMinBoundaryDistances:
+            if min_boundary_distance in boundaries:
+                continue
+            self.min_boundary_distance = min_boundary_distance
+            lookahead = self.get_lookahead()
+            min_idx, delta_of_min = HicFindTads.find_consensus_minima(self.bedgraph_matrix['matrix'], lookahead=lookahead,
+                                                                      chrom=self.bedgraph_matrix['chrom'])
+            pvalues = self.min_pvalue(min_idx) if len(min_idx) else OrderedDict()
+            boundaries[min_boundary_distance] = (lookahead, {'min_idx': min_idx,
+                                                             'delta': delta_of_min,
+                                                             'pvalues': pvalues})
+
+        tasks = []
+        for min_boundary_distance, delta, threshold_comparisons in itertools.product(pMinBoundaryDistances, pDeltas,
+                                                                                     pThresholdComparisons):
+            tasks.append(("{}_delta{}_threshold{}_minBoundaryDistance{}".format(prefix, delta, threshold_comparisons,
+                                                                                int(min_boundary_distance)),
+                          delta, threshold_comparisons, min_boundary_distance))
+        log.info("Calling the boundaries of {} parameter combinations\n".format(len(tasks)))
+
+        # the processes share the TAD-separation scores and the bins, the matrix is not needed
+        chromosome_names, chromosome_idx = np.unique(self.bedgraph_matrix['chrom'], return_inverse=True)
+        spectrum = self.bedgraph_matrix['matrix']
+        shared_bedgraph_matrix = (chromosome_names, shared_array(chromosome_idx.astype(np.int64)),
+                                  shared_array(self.bedgraph_matrix['chr_start'].astype(np.int64)),
+                                  shared_array(self.bedgraph_matrix['chr_end'].astype(np.int64)),
+                                  shared_array(np.ascontiguousarray(spectrum, dtype=np.float64).ravel()), spectrum.shape[1])
+        if self.num_processors > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(min(self.num_processors, len(tasks)), initializer=init_sweep_worker,
+                                        initargs=(shared_bedgraph_matrix, boundaries, self.correct_for_multiple_testing))
+            results = pool.map(find_sweep_boundaries, tasks, chunksize=1)
+            pool.close()
+            pool.join()
+        else:
+            init_sweep_worker(shared_bedgraph_matrix, boundaries, self.correct_for_multiple_testing)
+            results = list(map(find_sweep_boundaries, tasks))
+
+        with open(prefix + '_sweep_summary.tsv', 'w') as summary:
+            summary.write("#delta\tthresholdComparisons\tminBoundaryDistance\tlookahead\tboundaries\tprefix\n")
+            for (task_prefix, delta, threshold_comparisons, min_boundary_distance), (lookahead, number_of_boundaries) \
+                    in zip(tasks, results):
+                summary.write("{}\t{}\t{}\t{}\t{}\t{}\n".format(delta, threshold_comparisons, int(min_boundary_distance),
+                                                                lookahead, number_of_boundaries, task_prefix))
+
 
 def print_args(args):
     """
@@ -1344,6 +1900,17 @@ def print_args(args):
         log.info("{}:\t{}\n".format(key, value))
 
 
+def existing_tad_score_file(pPrefix):
+    """
+    Returns the binary TAD-separation score file of pPrefix if it exists, else the
+    bedgraph matrix file if it exists, else None.
+    """
+    for suffix in ['_tad_score.h5', '_tad_score.bm']:
+        if os.path.isfile(pPrefix + suffix):
+            return pPrefix + suffix
+    return None
+
+
 def main(args=None):
 
     args = parse_arguments().parse_args(args)
@@ -1351,18 +1918,18 @@ def main(args=None):
                      min_depth=args.minDepth, step=args.step, delta=args.delta,
                      min_boundary_distance=args.minBoundaryDistance, use_zscore=True,
                      p_correct_for_multiple_testing=args.correctForMultipleTesting, p_threshold_comparisons=args.thresholdComparisons,
-                     pChromosomes=args.chromosomes)
+                     pChromosomes=args.chromosomes, pCacheExpected=args.cacheExpected)
 
-    tad_score_file = args.outPrefix + "_tad_score.bm"
+    tad_score_file = existing_tad_score_file(args.outPrefix)
     zscore_matrix_file = args.outPrefix + "_zscore_matrix.h5"
 
     if args.TAD_sep_score_prefix is not None:
-        tad_score_file = args.TAD_sep_score_prefix + "_tad_score.bm"
+        tad_score_file = existing_tad_score_file(args.TAD_sep_score_prefix)
         zscore_matrix_file = args.TAD_sep_score_prefix + "_zscore_matrix.h5"
         # check that the given file exists
-        if not os.path.isfile(tad_score_file):
+        if tad_score_file is None:
             log.error("The given TAD_sep_score_prefix does not contain a valid TAD-separation score. Please check.\n"
-                      "Could not find file {}".format(tad_score_file))
+                      "Could not find file {0}_tad_score.bm or {0}_tad_score.h5".format(args.TAD_sep_score_prefix))
             exit(1)
         if not os.path.isfile(zscore_matrix_file):
             log.error("The given TAD_sep_score_prefix does not contain a valid z-score matrix. Please check.\n"
@@ -1370,22 +1937,30 @@ def main(args=None):
             exit(1)
         log.info("\nUsing existing TAD-separation score file: {}\n".format(tad_score_file))
         ft.set_matrix(zscore_matrix_file, args.chromosomes)
-        ft.load_bedgraph_matrix(tad_score_file, args.chromosomes)
+        ft.load_tad_score(tad_score_file, args.chromosomes)
 
-    elif not os.path.isfile(tad_score_file):
+    elif tad_score_file is None:
         ft.compute_spectra_matrix()
         # save z-score matrix that is needed for find TADs algorithm
         ft.hic_ma.save(args.outPrefix + "_zscore_matrix.h5")
-        ft.save_bedgraph_matrix(tad_score_file)
+        if args.tadScoreFormat in ['bm', 'both']:
+            ft.save_bedgraph_matrix(args.outPrefix + "_tad_score.bm")
+        if args.tadScoreFormat in ['h5', 'both']:
+            ft.save_tad_score_matrix(args.outPrefix + "_tad_score.h5")
     else:
         log.info("\nFound existing TAD-separation score file: {}\n".format(tad_score_file))
         log.info("This file will be used\n")
         ft.set_matrix(zscore_matrix_file, args.chromosomes)
         # ft.hic_ma = hm.hiCMatrix(zscore_matrix_file)
-        ft.load_bedgraph_matrix(tad_score_file, args.chromosomes)
+        ft.load_tad_score(tad_score_file, args.chromosomes)
 
-    ft.find_boundaries()
-    ft.save_domains_and_boundaries(args.outPrefix)
+    if args.sweepDelta or args.sweepThresholdComparisons or args.sweepMinBoundaryDistance:
+        ft.sweep_boundaries(args.outPrefix, args.sweepDelta or [args.delta],
+                            args.sweepThresholdComparisons or [args.thresholdComparisons],
+                            args.sweepMinBoundaryDistance or [args.minBoundaryDistance])
+    else:
+        ft.find_boundaries()
+        ft.save_domains_and_boundaries(args.outPrefix)
 
     # turn of hierarchical clustering which is apparently not working.
 
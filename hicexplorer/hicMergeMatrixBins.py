@@ -233,8 +233,34 @@ def merge_bins(hic, num_bins):
     """
 
     hic = remove_nans_if_needed(hic)
-    # get the bins to merge
-    ref_name_list, start_list, end_list, coverage_list = zip(*hic.cut_intervals)
+    new_bins, bins_to_merge = get_bins_to_merge(hic.cut_intervals, num_bins)
+
+    hic.matrix = reduce_matrix(hic.matrix, bins_to_merge, diagonal=True)
+    hic.matrix.eliminate_zeros()
+    hic.setCutIntervals(new_bins)
+    hic.nan_bins = np.flatnonzero(hic.matrix.sum(0).A == 0)
+
+    return hic
+
+
+def get_bins_to_merge(cut_intervals, num_bins):
+    """
+    Groups num_bins consecutive bins of each chromosome. The last group of
+    a chromosome is skipped if it has less than num_bins / 2 bins, except for
+    the last chromosome.
+
+    Returns
+    -------
+
+    The new intervals, with the mean coverage of the merged bins, and
+    the list of bin indices merged into each new interval.
+
+    >>> cut_intervals = [('a', 0, 10, 0.5), ('a', 10, 20, 1),
+    ... ('a', 20, 30, 1), ('a', 30, 40, 0.1), ('b', 40, 50, 1)]
+    >>> get_bins_to_merge(cut_intervals, 3)
+    ([('a', 0, 30, 0.8333333333333334), ('b', 40, 50, 1.0)], [[0, 1, 2], [4]])
+    """
+    ref_name_list, start_list, end_list, coverage_list = zip(*cut_intervals)
     new_bins = []
     bins_to_merge = []
     prev_ref = ref_name_list[0]
@@ -261,12 +287,71 @@ def merge_bins(hic, num_bins):
     new_bins.append((ref, new_start, end_list[idx], coverage))
     bins_to_merge.append(list(range(idx_start, idx + 1)))
 
-    hic.matrix = reduce_matrix(hic.matrix, bins_to_merge, diagonal=True)
-    hic.matrix.eliminate_zeros()
-    hic.setCutIntervals(new_bins)
-    hic.nan_bins = np.flatnonzero(hic.matrix.sum(0).A == 0)
+    return new_bins, bins_to_merge
 
-    return hic
+
+def merge_bins_in_chunks(matrix, cut_intervals, num_bins_list, chunk_size=10000000):
+    """
+    Yields for each value of num_bins_list the merged matrix like
+    merge_bins, but without copying the input matrix. The matrix needs to
+    contain only the upper triangle of a symmetric matrix without NaN bins.
+    It is read in blocks of rows with about chunk_size non zero values and the
+    merged values are summed up in a sparse accumulator, such that only the
+    input matrix and the merged matrix of one resolution are held in memory.
+
+    >>> from scipy.sparse import csr_matrix, triu
+    >>> cut_intervals = [('a', 0, 10, 0.5), ('a', 10, 20, 1),
+    ... ('a', 20, 30, 1), ('a', 30, 40, 0.1), ('b', 40, 50, 1)]
+    >>> matrix = csr_matrix(np.array([
+    ... [ 50, 10,  5,  3,   0],
+    ... [  0, 60, 15,  5,   1],
+    ... [  0,  0, 80,  7,   3],
+    ... [  0,  0,  0, 90,   1],
+    ... [  0,  0,  0,  0, 100]], dtype=np.int32))
+    >>> for merged in merge_bins_in_chunks(matrix, cut_intervals, [2, 4], chunk_size=2):
+    ...     print(merged.cut_intervals)
+    ...     print(merged.matrix.todense())
+    [('a', 0, 20, 0.75), ('a', 20, 40, 0.55), ('b', 40, 50, 1.0)]
+    [[120  28   1]
+     [ 28 177   4]
+     [  1   4 100]]
+    [('a', 0, 40, 0.65), ('b', 40, 50, 1.0)]
+    [[325   5]
+     [  5 100]]
+    """
+    from scipy.sparse import dia_matrix
+    from hicexplorer.lib.accumulator import SparseMatrixAccumulator
+
+    number_of_rows = matrix.shape[0]
+    rows_per_chunk = max(1, int(number_of_rows * chunk_size // max(matrix.nnz, 1)))
+    for num_bins in num_bins_list:
+        new_bins, bins_to_merge = get_bins_to_merge(cut_intervals, num_bins)
+        number_of_new_bins = len(new_bins)
+        # new index of each bin, -1 for the skipped bins
+        map_ = np.full(number_of_rows, -1, dtype=np.int64)
+        for k, v in enumerate(bins_to_merge):
+            map_[v[0]:v[-1] + 1] = k
+
+        accumulator = SparseMatrixAccumulator((number_of_new_bins, number_of_new_bins), pDtype=matrix.dtype)
+        for start in range(0, number_of_rows, rows_per_chunk):
+            chunk = matrix[start:start + rows_per_chunk].tocoo()
+            new_row = map_[chunk.row + start]
+            new_col = map_[chunk.col]
+            keep = (new_row > -1) & (new_col > -1)
+            accumulator.add(new_row[keep], new_col[keep], chunk.data[keep])
+            chunk = new_row = new_col = keep = None
+        merged_matrix = accumulator.tocsr()
+        accumulator = None
+
+        # the bins are merged in order, the merged matrix is an upper triangle as well
+        dia = dia_matrix(([merged_matrix.diagonal()], [0]), shape=merged_matrix.shape)
+        merged_matrix = (merged_matrix + merged_matrix.T - dia).tocsr()
+        merged_matrix.eliminate_zeros()
+
+        hic = hm.hiCMatrix()
+        hic.setMatrix(merged_matrix, new_bins)
+        hic.nan_bins = np.flatnonzero(hic.matrix.sum(0).A == 0)
+        yield hic
 
 
 def main(args=None):
@@ -11,7 +11,7 @@ import pyBigWig
 
 from hicmatrix import HiCMatrix as hm
 from hicexplorer._version import __version__
-from hicexplorer.utilities import obs_exp_matrix_lieberman, obs_exp_matrix_norm
+from hicexplorer.utilities import obs_exp_matrix_lieberman, obs_exp_matrix_norm, pearson_matrix
 from hicexplorer.utilities import convertNansToZeros, convertInfsToZeros
 from hicexplorer.utilities import enlarge_bins
 from hicexplorer.parserCommon import CustomFormatter
@@ -252,15 +252,13 @@ def main(args=None):
             obs_exp_matrix_ = obs_exp_matrix_lieberman(submatrix,
                                                        length_chromosome,
                                                        chromosome_count)
-        obs_exp_matrix_ = convertNansToZeros(csr_matrix(obs_exp_matrix_)).todense()
-        obs_exp_matrix_ = convertInfsToZeros(csr_matrix(obs_exp_matrix_)).todense()
+        obs_exp_matrix_ = convertNansToZeros(obs_exp_matrix_)
+        obs_exp_matrix_ = convertInfsToZeros(obs_exp_matrix_)
 
         if args.obsexpMatrix:
             trasf_matrix_obsexp[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]] = lil_matrix(obs_exp_matrix_)
 
-        pearson_correlation_matrix = np.corrcoef(obs_exp_matrix_)
-        pearson_correlation_matrix = convertNansToZeros(csr_matrix(pearson_correlation_matrix)).todense()
-        pearson_correlation_matrix = convertInfsToZeros(csr_matrix(pearson_correlation_matrix)).todense()
+        pearson_correlation_matrix = pearson_matrix(obs_exp_matrix_)
 
         if args.pearsonMatrix:
             trasf_matrix_pearson[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]] = lil_matrix(pearson_correlation_matrix)
@@ -321,7 +319,7 @@ def main(args=None):
             with open(outfile, 'w') as fh:
                 for i, value in enumerate(vecs_list):
                     if len(value) == args.numberOfEigenvectors:
-                        if isinstance(value[idx], np.complex):
+                        if isinstance(value[idx], complex):
                             value[idx] = value[idx].real
                         fh.write("{}\t{}\t{}\t{:.12f}\n".format(toString(chrom_list[i]), start_list[i], end_list[i], value[idx]))
 
@@ -355,7 +353,7 @@ def main(args=None):
             for i, value in enumerate(vecs_list):
                 # it can happen that some 'value' is having less dimensions than it should
                 if len(value) == args.numberOfEigenvectors:
-                    if isinstance(value[idx], np.complex):
+                    if isinstance(value[idx], complex):
                         value[idx] = value[idx].real
                     values.append(value[idx])
                     _chrom_list.append(toString(chrom_list[i]))
@@ -8,6 +8,7 @@ import argparse
 
 from hicmatrix import HiCMatrix
 from hicexplorer._version import __version__
+from hicexplorer.lib.expected import ExpectedContacts, prepare_matrix, load_expected, save_expected
 
 import matplotlib
 matplotlib.use('Agg')
@@ -16,8 +17,6 @@ import matplotlib.pyplot as plt
 from collections import OrderedDict
 from past.builtins import zip
 
-from scipy.sparse import triu
-
 
 import logging
 log = logging.getLogger(__name__)
@@ -89,6 +88,12 @@ def parse_arguments(args=None):
                            type=float
                            )
 
+    parserOpt.add_argument('--cacheExpected',
+                           help='If set, the mean contacts per distance are stored next to each matrix file and reused '
+                           'by later runs with the same --maxdepth, --perchr and --chromosomeExclude, as long as the '
+                           'matrix file does not change.',
+                           action='store_true')
+
     parserOpt.add_argument('--help', '-h', action='help', help='show this help message and exit')
 
     parserOpt.add_argument('--version', action='version',
@@ -163,132 +168,57 @@ def compute_distance_mean(hicmat, maxdepth=None, perchr=False):
     nans occur where the standard deviation is zero
     """
 
+    return distance_mean(compute_expected(hicmat, maxdepth, perchr), hicmat.getBinSize(), maxdepth)
+
+
+def compute_expected(hicmat, maxdepth=None, perchr=False):
+    """
+    Returns the sum and mean of the contacts per distance of the matrix, per chromosome if perchr is set.
+    The matrix is reduced to its upper triangle up to 1.5 * maxdepth.
+    """
     binsize = hicmat.getBinSize()
 
     if maxdepth:
         if maxdepth < binsize:
             exit("Please specify a maxDepth larger than bin size ({})".format(binsize))
 
-        max_depth_in_bins = int(float(maxdepth * 1.5) / binsize)
-        # work only with the upper matrix
-        # and remove all pixels that are beyond
-        # max_depth_in_bis
-        # (this is done by subtracting a second sparse matrix
-        # that contains only the upper matrix that wants to be removed.
-        hicmat.matrix = triu(hicmat.matrix, k=0, format='csr') - \
-            triu(hicmat.matrix, k=max_depth_in_bins, format='csr')
-    else:
-        hicmat.matrix = triu(hicmat.matrix, k=0, format='csr')
-
-    hicmat.matrix.eliminate_zeros()
-
-    chr_submatrix = OrderedDict()
-    cut_intervals = OrderedDict()
-    chrom_sizes = OrderedDict()
-    chrom_range = OrderedDict()
-    if perchr:
-        for chrname in hicmat.getChrNames():
-            chr_range = hicmat.getChrBinRange(chrname)
-            chr_submatrix[chrname] = hicmat.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]].tocoo()
-            cut_intervals[chrname] = [hicmat.cut_intervals[x] for x in range(chr_range[0], chr_range[1])]
-            chrom_sizes[chrname] = [chr_submatrix[chrname].shape[0]]
-            chrom_range[chrname] = (chr_range[0], chr_range[1])
+    prepare_matrix(hicmat, maxdepth)
+    return ExpectedContacts.from_matrix(hicmat, pMaxDepth=maxdepth, pPerChromosome=perchr)
 
-    else:
-        chr_submatrix['all'] = hicmat.matrix.tocoo()
-        cut_intervals['all'] = hicmat.cut_intervals
-        chrom_sizes['all'] = np.array([v[1] - v[0] for k, v in hicmat.chrBinBoundaries.items()])
-        chrom_range['all'] = (0, hicmat.matrix.shape[0])
 
+def distance_mean(pExpected, pBinSize, pMaxDepth=None):
+    """
+    Returns the mean per distance of each table of pExpected as dictionary of
+    distance in bp: mean, up to pMaxDepth. The distances after more than 10
+    consecutive distances without counts are skipped.
+    """
     mean_dict = {}
-
-    for chrname, submatrix in chr_submatrix.items():
-        log.info("processing chromosome {}\n".format(chrname))
-
-        dist_list, chrom_list = hicmat.getDistList(submatrix.row, submatrix.col, HiCMatrix.hiCMatrix.fit_cut_intervals(cut_intervals[chrname]))
-
-        # to get the sum of all values at a given distance I use np.bincount which
-        # is quite fast. However, the input of bincount is positive integers. Moreover
-        # it returns the sum for every consecutive integer, even if this is not on the list.
-        # Thus, dist_list, which contains the distance in bp between any two bins is
-        # converted to bin distance.
-
-        # Because positive integers are needed we add +1 to all bin distances
-        # such that the value of -1 (which means different chromosomes) can now be used
-
-        dist_list[dist_list == -1] = -binsize
-        # divide by binsize to get a list of bin distances and add +1 to remove negative values
-        dist_list = (np.array(dist_list).astype(float) / binsize).astype(int) + 1
-
-        # for each distance, return the sum of all values
-        sum_counts = np.bincount(dist_list, weights=submatrix.data)
-        distance_len = np.bincount(dist_list)
-        # compute the average for each distance
-        mat_size = submatrix.shape[0]
-        # compute mean value for each distance
+    for chrname in pExpected.chromosomes():
+        # the index of the tables is the bin distance + 1
+        sum_counts = pExpected.sum(chrname)
+        mean = pExpected.mean(chrname)
         mu = {}
         zero_value_bins = []
         for bin_dist_plus_one, sum_value in enumerate(sum_counts):
-            if maxdepth and bin_dist_plus_one == 0:  # this is for intra chromosomal counts
-                # when max depth is set, the computation
-                # of the total_intra is not accurate and is safer to
-                # output np.nan
-                mu[bin_dist_plus_one] = np.nan
+            mu[bin_dist_plus_one] = mean[bin_dist_plus_one]
+            if (pMaxDepth and bin_dist_plus_one == 0) or pExpected.pixels(chrname)[bin_dist_plus_one] == 0:
                 continue
-
-            if bin_dist_plus_one == 0:
-                total_intra = mat_size ** 2 - sum([size ** 2 for size in chrom_sizes[chrname]])
-                diagonal_length = total_intra / 2
-            else:
-                # to compute the average counts per distance we take the sum_counts and divide
-                # by the number of values on the respective diagonal
-                # which is equal to the size of each chromosome - the diagonal offset (for those
-                # chromosome larger than the offset)
-                # In the following example with two chromosomes
-                # the first (main) diagonal has a size equal to the matrix (6),
-                # while the next has 1 value less for each chromosome (4) and the last one has only 2 values
-
-                # 0 1 2 . . .
-                # - 0 1 . . .
-                # - - 0 . . .
-                # . . . 0 1 2
-                # . . . - 0 1
-                # . . . - - 0
-
-                # idx - 1 because earlier the values where
-                # shifted.
-                diagonal_length = sum([size - (bin_dist_plus_one - 1) for size in chrom_sizes[chrname]
-                                       if size > (bin_dist_plus_one - 1)])
-
-            # the diagonal length should contain the number of values at a certain distance.
-            # If the matrix is dense, the distance_len[bin_dist_plus_one] correctly contains the number of values
-            # If the matrix is equally spaced, then, the diagonal_length as computed before is accurate.
-            # But, if the matrix is both sparse and with unequal bins, then none of the above methods is
-            # accurate but the the diagonal_length as computed before will be closer.
-            diagonal_length = max(diagonal_length, distance_len[bin_dist_plus_one])
-
-            if diagonal_length == 0:
-                mu[bin_dist_plus_one] = np.nan
-            else:
-                mu[bin_dist_plus_one] = np.float64(sum_value) / diagonal_length
-                if sum_value == 0:
-                    zero_value_bins.append(bin_dist_plus_one)
-                    log.info("zero value for {}, diagonal len: {}\n".format(bin_dist_plus_one, diagonal_length))
-                if len(zero_value_bins) > 10:
-                    diff = np.diff(zero_value_bins)
-                    if len(diff[diff == 1]) > 10:
-                        # if too many consecutive bins with zero are found that means that probably no
-                        # further counts will be found
-                        log.info("skipping rest of chromosome {}. Too many emtpy diagonals\n".format(chrname))
-                        break
+            if sum_value == 0:
+                zero_value_bins.append(bin_dist_plus_one)
+                log.info("zero value for {}, diagonal len: {}\n".format(bin_dist_plus_one, pExpected.pixels(chrname)[bin_dist_plus_one]))
+            if len(zero_value_bins) > 10:
+                diff = np.diff(zero_value_bins)
+                if len(diff[diff == 1]) > 10:
+                    # if too many consecutive bins with zero are found that means that probably no
+                    # further counts will be found
+                    log.info("skipping rest of chromosome {}. Too many emtpy diagonals\n".format(chrname))
+                    break
             if np.isnan(sum_value):
-                log.info("nan value found for distance {}\n".format((bin_dist_plus_one - 1) * binsize))
+                log.info("nan value found for distance {}\n".format((bin_dist_plus_one - 1) * pBinSize))
 
-        if maxdepth is None:
-            maxdepth = np.inf
-        mean_dict[chrname] = OrderedDict([((k - 1) * binsize, v) for k, v in mu.items() if k > 0 and
-                                          (k - 1) * binsize <= maxdepth])
-        # mean_dict[chrname]['intra_chr'] = mu[0]
+        max_depth = np.inf if pMaxDepth is None else pMaxDepth
+        mean_dict[chrname] = OrderedDict([((k - 1) * pBinSize, v) for k, v in mu.items() if k > 0 and
+                                          (k - 1) * pBinSize <= max_depth])
 
     return mean_dict
 
@@ -308,17 +238,30 @@ def main(args=None):
     else:
         labels = OrderedDict(zip(args.matrices, args.labels))
 
+    if args.chromosomeExclude is None:
+        args.chromosomeExclude = []
+    expected_key = 'hicPlotDistVsCounts maxdepth {} perchr {} chromosomeExclude {}'.format(args.maxdepth, args.perchr,
+                                                                                           sorted(args.chromosomeExclude))
     chroms = set()
     for matrix_file in args.matrices:
-        hic_ma = HiCMatrix.hiCMatrix(matrix_file)
-        matrix_sum[matrix_file] = hic_ma.matrix.sum()
-        if args.chromosomeExclude is None:
-            args.chromosomeExclude = []
-
-        chrtokeep = [x for x in list(hic_ma.interval_trees) if x not in args.chromosomeExclude]
-        hic_ma.keepOnlyTheseChr(chrtokeep)
-
-        mean_dict[matrix_file] = compute_distance_mean(hic_ma, maxdepth=args.maxdepth, perchr=args.perchr)
+        expected = load_expected(matrix_file, expected_key) if args.cacheExpected else None
+        if expected is not None:
+            matrix_sum[matrix_file] = expected.attributes['matrixSum']
+            mean_dict[matrix_file] = distance_mean(expected, expected.attributes['binSize'], args.maxdepth)
+        else:
+            hic_ma = HiCMatrix.hiCMatrix(matrix_file)
+            matrix_sum[matrix_file] = hic_ma.matrix.sum()
+
+            chrtokeep = [x for x in list(hic_ma.interval_trees) if x not in args.chromosomeExclude]
+            hic_ma.keepOnlyTheseChr(chrtokeep)
+
+            binsize = hic_ma.getBinSize()
+            expected = compute_expected(hic_ma, maxdepth=args.maxdepth, perchr=args.perchr)
+            if args.cacheExpected:
+                expected.attributes['matrixSum'] = float(matrix_sum[matrix_file])
+                expected.attributes['binSize'] = int(binsize)
+                save_expected(matrix_file, expected_key, expected)
+            mean_dict[matrix_file] = distance_mean(expected, binsize, args.maxdepth)
         chroms = chroms.union([k for k in list(mean_dict[matrix_file]) if len(mean_dict[matrix_file][k]) > 1])
 
     # compute scale factors such that values are comparable
@@ -402,3 +345,5 @@ def main(args=None):
     plt.tight_layout()
     plt.savefig(args.plotFile.name, bbox_inches='tight', bbox_extra_artists=(lgd,))
     plt.close(fig)
+    if args.outFileData is not None:
+        args.outFileData.close()
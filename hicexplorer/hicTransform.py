@@ -3,12 +3,13 @@ warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 import argparse
 
-from scipy.sparse import csr_matrix, lil_matrix
+from scipy.sparse import csr_matrix
 import numpy as np
 
 from hicmatrix import HiCMatrix as hm
 from hicexplorer._version import __version__
 from hicexplorer.utilities import obs_exp_matrix_lieberman, obs_exp_matrix_norm, obs_exp_matrix_non_zero, obs_exp_matrix
+from hicexplorer.utilities import pearson_matrix, covariance_matrix
 from hicexplorer.utilities import convertNansToZeros, convertInfsToZeros
 
 
@@ -65,43 +66,63 @@ def parse_arguments(args=None):
     return parser
 
 
+def _convert_nans_infs(pMatrix):
+    pMatrix = convertNansToZeros(pMatrix)
+    pMatrix = convertInfsToZeros(pMatrix)
+    pMatrix.eliminate_zeros()
+    return pMatrix
+
+
 def _obs_exp_lieberman(pSubmatrix, pLengthChromosome, pChromosomeCount):
 
     obs_exp_matrix_ = obs_exp_matrix_lieberman(pSubmatrix, pLengthChromosome, pChromosomeCount)
-    obs_exp_matrix_ = convertNansToZeros(csr_matrix(obs_exp_matrix_))
-    obs_exp_matrix_ = convertInfsToZeros(csr_matrix(obs_exp_matrix_)).todense()
-    return obs_exp_matrix_
+    return _convert_nans_infs(obs_exp_matrix_)
 
 
 def _pearson(pSubmatrix):
-    pearson_correlation_matrix = np.corrcoef(pSubmatrix)
-    pearson_correlation_matrix = convertNansToZeros(csr_matrix(pearson_correlation_matrix))
-    pearson_correlation_matrix = convertInfsToZeros(csr_matrix(pearson_correlation_matrix)).todense()
-    return pearson_correlation_matrix
+    return _convert_nans_infs(csr_matrix(pearson_matrix(pSubmatrix)))
+
+
+def _covariance(pSubmatrix):
+    return csr_matrix(covariance_matrix(pSubmatrix))
 
 
 def _obs_exp_norm(pSubmatrix):
 
     obs_exp_matrix_ = obs_exp_matrix_norm(pSubmatrix)
-    obs_exp_matrix_ = convertNansToZeros(csr_matrix(obs_exp_matrix_))
-    obs_exp_matrix_ = convertInfsToZeros(csr_matrix(obs_exp_matrix_)).todense()
-    return obs_exp_matrix_
+    return _convert_nans_infs(obs_exp_matrix_)
 
 
 def _obs_exp(pSubmatrix):
 
     obs_exp_matrix_ = obs_exp_matrix(pSubmatrix)
-    obs_exp_matrix_ = convertNansToZeros(csr_matrix(obs_exp_matrix_))
-    obs_exp_matrix_ = convertInfsToZeros(csr_matrix(obs_exp_matrix_)).todense()
-    return obs_exp_matrix_
+    return _convert_nans_infs(obs_exp_matrix_)
 
 
 def _obs_exp_non_zero(pSubmatrix):
 
     obs_exp_matrix_ = obs_exp_matrix_non_zero(pSubmatrix)
-    obs_exp_matrix_ = convertNansToZeros(csr_matrix(obs_exp_matrix_))
-    obs_exp_matrix_ = convertInfsToZeros(csr_matrix(obs_exp_matrix_)).todense()
-    return obs_exp_matrix_
+    return _convert_nans_infs(obs_exp_matrix_)
+
+
+def _per_chromosome(pHiCMatrix, pTransform, *pArgs):
+    """
+    Applies pTransform to the submatrix of each chromosome, one chromosome at a time,
+    and returns the block diagonal csr matrix of the results. Inter-chromosomal
+    interactions are removed.
+    """
+    row, col, data = [], [], []
+    for chrname in pHiCMatrix.getChrNames():
+        chr_range = pHiCMatrix.getChrBinRange(chrname)
+        submatrix = pHiCMatrix.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
+        transformed = pTransform(submatrix, *pArgs).tocoo()
+        row.append(transformed.row + chr_range[0])
+        col.append(transformed.col + chr_range[0])
+        data.append(transformed.data)
+    if not data:
+        return csr_matrix(pHiCMatrix.matrix.shape)
+    return csr_matrix((np.concatenate(data).astype(np.float64), (np.concatenate(row), np.concatenate(col))),
+                      shape=pHiCMatrix.matrix.shape)
 
 
 def main(args=None):
@@ -121,90 +142,44 @@ def main(args=None):
         if args.chromosomes:
             hic_ma.keepOnlyTheseChr(args.chromosomes)
 
-    trasf_matrix = lil_matrix(hic_ma.matrix.shape)
-
     if args.method == 'obs_exp_norm':
-        # trasf_matrix = lil_matrix(hic_ma.matrix.shape)
         if args.perChromosome:
-            for chrname in hic_ma.getChrNames():
-                chr_range = hic_ma.getChrBinRange(chrname)
-                submatrix = hic_ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
-                submatrix.astype(float)
-                submatrix = _obs_exp_norm(submatrix)
-                trasf_matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]] = lil_matrix(submatrix)
+            trasf_matrix = _per_chromosome(hic_ma, _obs_exp_norm)
         else:
-            submatrix = _obs_exp_norm(hic_ma.matrix)
-            trasf_matrix = csr_matrix(submatrix)
+            trasf_matrix = _obs_exp_norm(hic_ma.matrix)
 
     elif args.method == 'obs_exp':
         if args.perChromosome:
-
-            for chrname in hic_ma.getChrNames():
-                chr_range = hic_ma.getChrBinRange(chrname)
-                submatrix = hic_ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
-                submatrix.astype(float)
-                trasf_matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]] = lil_matrix(_obs_exp(submatrix))
+            trasf_matrix = _per_chromosome(hic_ma, _obs_exp)
         else:
-            submatrix = _obs_exp(hic_ma.matrix)
-            trasf_matrix = csr_matrix(submatrix)
+            trasf_matrix = _obs_exp(hic_ma.matrix)
 
     elif args.method == 'obs_exp_non_zero':
         if args.perChromosome:
-
-            for chrname in hic_ma.getChrNames():
-                chr_range = hic_ma.getChrBinRange(chrname)
-                submatrix = hic_ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
-                submatrix.astype(float)
-                trasf_matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]] = lil_matrix(_obs_exp_non_zero(submatrix))
+            trasf_matrix = _per_chromosome(hic_ma, _obs_exp_non_zero)
         else:
-            submatrix = _obs_exp(hic_ma.matrix)
-            trasf_matrix = csr_matrix(submatrix)
+            trasf_matrix = _obs_exp(hic_ma.matrix)
     elif args.method == 'obs_exp_lieberman':
         length_chromosome = 0
         chromosome_count = len(hic_ma.getChrNames())
         for chrname in hic_ma.getChrNames():
             chr_range = hic_ma.getChrBinRange(chrname)
             length_chromosome += chr_range[1] - chr_range[0]
-        for chrname in hic_ma.getChrNames():
-            chr_range = hic_ma.getChrBinRange(chrname)
-            submatrix = hic_ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
-            submatrix.astype(float)
-            trasf_matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]] = lil_matrix(_obs_exp_lieberman(submatrix, length_chromosome, chromosome_count))
-        trasf_matrix = trasf_matrix.tocsr()
-        # log.debug('type: {}'.format(type(trasf_matrix)))
+        trasf_matrix = _per_chromosome(hic_ma, _obs_exp_lieberman, length_chromosome, chromosome_count)
     elif args.method == 'pearson':
         if args.perChromosome:
-            for chrname in hic_ma.getChrNames():
-                chr_range = hic_ma.getChrBinRange(chrname)
-                submatrix = hic_ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
-
-                submatrix.astype(float)
-
-                trasf_matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]] = lil_matrix(_pearson(submatrix.todense()))
+            trasf_matrix = _per_chromosome(hic_ma, _pearson)
         else:
-            trasf_matrix = csr_matrix(_pearson(hic_ma.matrix.todense()))
+            trasf_matrix = _pearson(hic_ma.matrix)
 
     elif args.method == 'covariance':
         if args.perChromosome:
-
-            for chrname in hic_ma.getChrNames():
-                chr_range = hic_ma.getChrBinRange(chrname)
-                submatrix = hic_ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
-
-                submatrix.astype(float)
-
-                corrmatrix = np.cov(submatrix.todense())
-                trasf_matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]] = lil_matrix(corrmatrix)
+            trasf_matrix = _per_chromosome(hic_ma, _covariance)
         else:
-            corrmatrix = np.cov(hic_ma.matrix.todense())
-            trasf_matrix = csr_matrix(corrmatrix)
+            trasf_matrix = _covariance(hic_ma.matrix)
 
     # log.debug('trasf_matrix {}'.format(trasf_matrix))
 
-    if args.perChromosome:
-        hic_ma.setMatrix(trasf_matrix.tocsr(), cut_intervals=hic_ma.cut_intervals)
-    else:
-
-        hic_ma.setMatrix(trasf_matrix, cut_intervals=hic_ma.cut_intervals)
+    hic_ma.setMatrix(trasf_matrix, cut_intervals=hic_ma.cut_intervals)
 
     hic_ma.save(args.outFileName, pSymmetric=True, pApplyCorrection=False)
@@ -2,6 +2,8 @@ import warnings
 warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 import numpy as np
+from scipy.sparse import csr_matrix
+from multiprocessing.pool import ThreadPool
 import time
 import logging
 log = logging.getLogger(__name__)
@@ -84,3 +86,245 @@ def iterativeCorrection(matrix, v=None, M=50, tolerance=1e-5, verbose=False):
         exit(1)
 
     return W.tocsr(), total_bias
+
+
+class UpperTriangleMatrix(object):
+    """
+    Stores the upper triangle, including the main diagonal, of a symmetric
+    sparse matrix in blocks of rows with about the same number of non zero
+    values. The product with the full symmetric matrix is computed from the
+    blocks, each block contributes the product of its rows and of its
+    transpose. With threads > 1 the blocks are processed in parallel, the
+    scipy sparse kernels release the GIL.
+
+    >>> from scipy.sparse import csr_matrix
+    >>> matrix = csr_matrix(np.array([[1, 2, 0], [2, 0, 3], [0, 3, 4]], dtype=float))
+    >>> upper = UpperTriangleMatrix(matrix, threads=2)
+    >>> upper.dot(np.array([1., 1., 1.]))
+    array([3., 5., 7.])
+    >>> upper.max_scaled(np.array([1., 2., 0.5]))
+    4.0
+    >>> upper.close()
+    """
+
+    def __init__(self, matrix, dtype=np.float64, threads=1, blocks_per_thread=4):
+        matrix = csr_matrix(matrix)
+        self.size = matrix.shape[0]
+        self.dtype = dtype
+        self.diagonal = matrix.diagonal().astype(np.float64)
+        number_of_blocks = max(1, min(self.size, threads * blocks_per_thread))
+        borders = np.searchsorted(matrix.indptr, np.linspace(0, matrix.nnz, number_of_blocks + 1)[1:-1])
+        borders = np.unique(np.concatenate([[0], borders, [self.size]]))
+        # each block is stored with the columns shifted by its first row, the
+        # upper triangle has no values left of it
+        self.blocks = []
+        for start, end in zip(borders[:-1], borders[1:]):
+            indices = matrix.indices[matrix.indptr[start]:matrix.indptr[end]]
+            rows = np.repeat(np.arange(end - start), np.diff(matrix.indptr[start:end + 1]))
+            upper = indices >= rows + start
+            indptr = np.concatenate([[0], np.cumsum(np.bincount(rows[upper], minlength=end - start))])
+            data = matrix.data[matrix.indptr[start]:matrix.indptr[end]][upper].astype(dtype)
+            self.blocks.append((start, end, csr_matrix((data, indices[upper] - start, indptr),
+                                                       shape=(end - start, self.size - start))))
+            rows = upper = None
+        self.pool = ThreadPool(threads) if threads > 1 else None
+
+    def _map(self, function):
+        if self.pool is None:
+            return [function(block) for block in self.blocks]
+        return self.pool.map(function, self.blocks)
+
+    def dot(self, x):
+        """Product of the full symmetric matrix with the vector x."""
+        x_typed = x.astype(self.dtype, copy=False)
+
+        def block_product(block):
+            start, end, matrix = block
+            return matrix.dot(x_typed[start:]), matrix.T.dot(x_typed[start:end])
+
+        result = -self.diagonal * x
+        for (start, end, _), (rows, columns) in zip(self.blocks, self._map(block_product)):
+            result[start:end] += rows
+            result[start:] += columns
+        return result
+
+    def max_scaled(self, x):
+        """Maximum of the values a_ij * x_i * x_j."""
+        def block_max(block):
+            start, end, matrix = block
+            if matrix.nnz == 0:
+                return 0
+            row = np.repeat(np.arange(start, end), np.diff(matrix.indptr))
+            return np.max(matrix.data * x[row] * x[matrix.indices + start])
+
+        return max(self._map(block_max))
+
+    def max(self):
+        return max([block.data.max() if block.nnz else 0 for _, _, block in self.blocks])
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+def is_symmetric(matrix, tolerance=1e-10):
+    """
+    Same test as np.abs(matrix - matrix.T).mean() / np.abs(matrix.mean()) <= tolerance
+    for a csr matrix. If the matrix and its transpose have the same sparsity structure, only
+    the data arrays are compared.
+
+    >>> from scipy.sparse import csr_matrix
+    >>> is_symmetric(csr_matrix(np.array([[1, 2], [2, 0]], dtype=float)))
+    True
+    >>> is_symmetric(csr_matrix(np.array([[1, 2], [1, 0]], dtype=float)))
+    False
+    >>> is_symmetric(csr_matrix(np.array([[1, 2], [0, 0]], dtype=float)))
+    False
+
+    The matrix itself is not changed, unsorted indices are sorted on a copy.
+
+    >>> matrix = csr_matrix((np.array([2., 1., 2.]), np.array([1, 0, 0]), np.array([0, 2, 3])))
+    >>> is_symmetric(matrix), matrix.indices.tolist()
+    (True, [1, 0, 0])
+    """
+    if not matrix.has_sorted_indices:
+        matrix = matrix.copy()
+        matrix.sort_indices()
+    transposed = matrix.T.tocsr()
+    if np.array_equal(matrix.indptr, transposed.indptr) and np.array_equal(matrix.indices, transposed.indices):
+        difference = np.abs(matrix.data - transposed.data).sum()
+    else:
+        difference = np.abs(matrix - transposed).sum()
+    return difference / np.abs(matrix.sum()) <= tolerance
+
+
+def start_bias(initial_bias, size):
+    """
+    Bias vector to start the iterative correction with. Without an initial bias all
+    values are 1, otherwise the invalid values of the initial bias, not finite or not
+    positive, e.g. of bins that were masked before, are replaced by the median of
+    the valid ones.
+
+    >>> start_bias(None, 2)
+    array([1., 1.])
+    >>> start_bias(np.array([2., 0., np.nan, 4.]), 4)
+    array([2., 3., 3., 4.])
+    """
+    if initial_bias is None:
+        return np.ones(size, 'float64')
+    bias = np.array(initial_bias, dtype=np.float64).flatten()
+    if len(bias) != size:
+        raise ValueError("The initial bias has {} values, the matrix {} bins.".format(len(bias), size))
+    valid = np.isfinite(bias) & (bias > 0)
+    bias[~valid] = np.median(bias[valid]) if valid.any() else 1.0
+    return bias
+
+
+def iterativeCorrectionUpperTriangle(matrix, M=50, tolerance=1e-5, verbose=False, threads=1, dtype=np.float64,
+                                     initial_bias=None, report=False):
+    """
+    Iterative correction with the same results as iterativeCorrection, but with less
+    memory and in parallel. Only the upper triangle of the matrix is stored. The data is not
+    changed during the iterations, only the bias vector is updated: the marginals of the
+    corrected matrix W_ij / (b_i * b_j) are computed as 1 / b_i * sum_j(W_ij / b_j) with a
+    symmetric sparse matrix vector product. The corrected matrix is created once at the end.
+    With dtype np.float32 the matrix values are stored in single precision, the bias
+    vector is always computed in double precision.
+
+    :param matrix: a symmetric scipy sparse matrix
+    :param M: maximum number of iterations
+    :param tolerance: Tolerance is the maximum allowed relative
+                      deviation of the marginals.
+    :param threads: number of threads used for the matrix vector products
+    :param initial_bias: bias vector to start with, e.g. of a previous correction of a similar
+                         matrix, instead of a vector of ones
+    :param report: if True, a convergence report is returned as third value, a dict with the
+                   number of iterations, if the tolerance was reached, the maximal deviation
+                   of the marginals after each iteration and the wall time in seconds
+
+    >>> from scipy.sparse import csr_matrix
+    >>> matrix = csr_matrix(np.array([[10, 2, 1], [2, 5, 3], [1, 3, 1]], dtype=float))
+    >>> corrected, bias = iterativeCorrectionUpperTriangle(matrix, M=500, threads=2)
+    >>> expected, expected_bias = iterativeCorrection(matrix, M=500)
+    >>> np.allclose(corrected.toarray(), expected.toarray()), np.allclose(bias, expected_bias)
+    (True, True)
+    >>> _, _, convergence = iterativeCorrectionUpperTriangle(matrix, M=500, initial_bias=bias, report=True)
+    >>> convergence['iterations'], convergence['converged']
+    (1, True)
+    """
+    if verbose:
+        log.setLevel(logging.INFO)
+
+    if np.isnan(matrix.sum()):
+        log.warn("[iterative correction] the matrix contains nans, they will be replaced by zeros.")
+        matrix.data[np.isnan(matrix.data)] = 0
+
+    matrix = csr_matrix(matrix)
+    if not is_symmetric(matrix):
+        raise ValueError("Please provide symmetric matrix!")
+
+    start_time = time.time()
+    upper = UpperTriangleMatrix(matrix, dtype=dtype, threads=threads)
+    max_value = upper.max()
+    total_bias = start_bias(initial_bias, matrix.shape[0])
+    inverse_bias = 1.0 / total_bias
+    residuals = []
+
+    log.info("starting iterative correction")
+    for iternum in range(M):
+        iternum += 1
+        iteration_start = time.time()
+        s = inverse_bias * upper.dot(inverse_bias)
+        mask = (s == 0)
+        s = s / np.mean(s[~mask])
+
+        total_bias *= s
+        deviation = np.abs(s - 1).max()
+        residuals.append(float(deviation))
+        inverse_bias = np.divide(1.0, total_bias, out=np.zeros_like(total_bias), where=total_bias != 0)
+
+        # the largest corrected value is only computed if the bound of it is too large
+        if max_value * inverse_bias.max() ** 2 > 1e100 and upper.max_scaled(inverse_bias) > 1e100:
+            upper.close()
+            log.error("*Error* matrix correction is producing extremely large values. "
+                      "This is often caused by bins of low counts. Use a more stringent "
+                      "filtering of bins.")
+            exit(1)
+        log.debug("iteration {} took {:.3f} secs".format(iternum, time.time() - iteration_start))
+        if verbose:
+            if iternum % 5 == 0:
+                end_time = time.time()
+                estimated = (float(M - iternum) * (end_time - start_time)) / iternum
+                m, sec = divmod(estimated, 60)
+                h, m = divmod(m, 60)
+                log.info("pass {} Estimated time {:.0f}:{:.0f}:{:.0f}".format(iternum, h, m, sec))
+                log.info("max delta - 1 = {} ".format(deviation))
+
+        if deviation < tolerance:
+            log.info("[iterative correction] {} iterations used\n".format(iternum + 1))
+            break
+    upper.close()
+    upper = None
+
+    # scale the total bias such that the sum is 1.0
+    corr = total_bias[total_bias != 0].mean()
+    total_bias /= corr
+    inverse_bias = np.divide(1.0, total_bias, out=np.zeros_like(total_bias), where=total_bias != 0)
+
+    data = matrix.data.astype(dtype)
+    data *= np.repeat(inverse_bias, np.diff(matrix.indptr)).astype(dtype)
+    data *= inverse_bias[matrix.indices].astype(dtype)
+    if np.any(data > 1e10):
+        log.error("*Error* matrix correction produced extremely large values. "
+                  "This is often caused by bins of low counts. Use a more stringent "
+                  "filtering of bins.")
+        exit(1)
+
+    corrected_matrix = csr_matrix((data, matrix.indices.copy(), matrix.indptr.copy()), shape=matrix.shape)
+    if report:
+        convergence = {'iterations': len(residuals), 'converged': bool(residuals and residuals[-1] < tolerance),
+                       'residuals': residuals, 'wall_time': time.time() - start_time}
+        return corrected_matrix, total_bias, convergence
+    return corrected_matrix, total_bias
@@ -0,0 +1,159 @@
+import os
+import numpy as np
+from scipy.sparse import csr_matrix
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class SparseMatrixAccumulator():
+    """
+    Sums up (row, col, count) triplets of a sparse matrix. The triplets are
+    buffered and merged in bulk into sorted runs of unique pixels, stored as
+    linear index row * number of columns + col and the summed up count.
+    The rows are split into blocks with one sorted run each, a merge copies only
+    one block at a time. A merge is done if the buffer holds at least 1/16 of the
+    merged pixels, which keeps the total costs linear in the number of added
+    triplets and the memory proportional to the number of distinct pixels.
+
+    >>> accumulator = SparseMatrixAccumulator((3, 3), pFlushSize=2, pNumberOfBlocks=2)
+    >>> accumulator.add([0, 2, 0], [1, 2, 1])
+    >>> accumulator.add(np.array([2, 1]), np.array([2, 0]), np.array([5, 1]))
+    >>> len(accumulator)
+    3
+    >>> accumulator.tocsr().toarray()
+    array([[0, 2, 0],
+           [1, 0, 0],
+           [0, 0, 6]], dtype=uint32)
+    """
+
+    def __init__(self, pShape, pDtype=np.uint32, pFlushSize=2**20, pNumberOfBlocks=64):
+        self.shape = pShape
+        self.dtype = pDtype
+        self.flushSize = pFlushSize
+        number_of_blocks = max(1, min(pNumberOfBlocks, pShape[0]))
+        # first linear index of each block
+        self.blockStart = np.linspace(0, pShape[0], number_of_blocks + 1).astype(np.int64)[:-1] * pShape[1]
+        self.keys = [np.zeros(0, dtype=np.int64) for _ in range(number_of_blocks)]
+        self.counts = [np.zeros(0, dtype=pDtype) for _ in range(number_of_blocks)]
+        self.numberOfPixels = 0
+        self.bufferKeys = []
+        self.bufferCounts = []
+        self.bufferLength = 0
+
+    def add(self, pRow, pCol, pCount=None):
+        """Adds the triplets, if pCount is None each (row, col) pair is counted once."""
+        row = np.asarray(pRow, dtype=np.int64)
+        if len(row) == 0:
+            return
+        self.bufferKeys.append(row * self.shape[1] + np.asarray(pCol, dtype=np.int64))
+        self.bufferCounts.append(None if pCount is None else np.asarray(pCount, dtype=self.dtype))
+        self.bufferLength += len(row)
+        if self.bufferLength >= max(self.flushSize, self.numberOfPixels // 16):
+            self.flush()
+
+    def flush(self):
+        """Merges the buffered triplets into the sorted runs."""
+        if self.bufferLength == 0:
+            return
+        keys = np.concatenate(self.bufferKeys)
+        if all(counts is None for counts in self.bufferCounts):
+            unique_keys, counts = np.unique(keys, return_counts=True)
+        else:
+            counts = np.concatenate([np.ones(len(key), dtype=self.dtype) if count is None else count
+                                     for key, count in zip(self.bufferKeys, self.bufferCounts)])
+            order = np.argsort(keys)
+            keys = keys[order]
+            starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+            unique_keys = keys[starts]
+            counts = np.add.reduceat(counts[order], starts)
+            order = None
+        counts = counts.astype(self.dtype, copy=False)
+        keys = None
+        self.bufferKeys = []
+        self.bufferCounts = []
+        self.bufferLength = 0
+
+        block_borders = np.append(np.searchsorted(unique_keys, self.blockStart), len(unique_keys))
+        for block in range(len(self.keys)):
+            start, end = block_borders[block], block_borders[block + 1]
+            if start == end:
+                continue
+            block_keys = self.keys[block]
+            # add the counts of known pixels, insert the new ones at their sorted position
+            position = np.searchsorted(block_keys, unique_keys[start:end])
+            known = position < len(block_keys)
+            known[known] = block_keys[position[known]] == unique_keys[start:end][known]
+            self.counts[block][position[known]] += counts[start:end][known]
+            new = ~known
+            self.keys[block] = np.insert(block_keys, position[new], unique_keys[start:end][new])
+            block_keys = None
+            self.counts[block] = np.insert(self.counts[block], position[new], counts[start:end][new])
+            self.numberOfPixels += int(new.sum())
+
+    def __len__(self):
+        """Number of distinct pixels, the buffer is merged first."""
+        self.flush()
+        return self.numberOfPixels
+
+    def nbytes(self):
+        return sum(keys.nbytes + counts.nbytes for keys, counts in zip(self.keys, self.counts)) + \
+            sum(key.nbytes for key in self.bufferKeys) + \
+            sum(count.nbytes for count in self.bufferCounts if count is not None)
+
+    def save_state(self, pDirectory, pName='accumulator'):
+        """Merges the buffer and writes the sorted runs as numpy files to pDirectory.
+        Returns the information restore_state needs besides the files."""
+        self.flush()
+        for block in range(len(self.keys)):
+            np.save(os.path.join(pDirectory, '{}_keys_{}.npy'.format(pName, block)), self.keys[block])
+            np.save(os.path.join(pDirectory, '{}_counts_{}.npy'.format(pName, block)), self.counts[block])
+        return {'shape': [int(size) for size in self.shape], 'numberOfBlocks': len(self.keys),
+                'numberOfPixels': self.numberOfPixels}
+
+    def restore_state(self, pDirectory, pState, pName='accumulator'):
+        """Replaces the content by the sorted runs saved with save_state.
+
+        >>> from tempfile import mkdtemp
+        >>> accumulator = SparseMatrixAccumulator((3, 3), pNumberOfBlocks=2)
+        >>> accumulator.add([0, 2], [1, 2])
+        >>> directory = mkdtemp()
+        >>> state = accumulator.save_state(directory)
+        >>> restored = SparseMatrixAccumulator((3, 3), pNumberOfBlocks=2)
+        >>> restored.restore_state(directory, state)
+        >>> restored.add([2], [2])
+        >>> restored.tocsr().toarray()
+        array([[0, 1, 0],
+               [0, 0, 0],
+               [0, 0, 2]], dtype=uint32)
+        """
+        if list(pState['shape']) != list(self.shape) or pState['numberOfBlocks'] != len(self.keys):
+            raise ValueError("The saved accumulator has a different shape or number of blocks.")
+        self.bufferKeys = []
+        self.bufferCounts = []
+        self.bufferLength = 0
+        for block in range(len(self.keys)):
+            self.keys[block] = np.load(os.path.join(pDirectory, '{}_keys_{}.npy'.format(pName, block)))
+            self.counts[block] = np.load(os.path.join(pDirectory, '{}_counts_{}.npy'.format(pName, block))).astype(self.dtype, copy=False)
+        self.numberOfPixels = pState['numberOfPixels']
+
+    def tocsr(self):
+        """Returns the summed up matrix. The pixels are already sorted by row and column,
+        the csr matrix is created without sorting. The sorted runs are released."""
+        self.flush()
+        indptr = np.zeros(self.shape[0] + 1, dtype=np.int64)
+        col = np.empty(self.numberOfPixels, dtype=np.int64 if self.shape[1] > np.iinfo(np.int32).max else np.int32)
+        counts = np.empty(self.numberOfPixels, dtype=self.dtype)
+        start = 0
+        for block in range(len(self.keys)):
+            row = self.keys[block] // self.shape[1]
+            end = start + len(row)
+            col[start:end] = self.keys[block] - row * self.shape[1]
+            counts[start:end] = self.counts[block]
+            indptr[1:] += np.bincount(row, minlength=self.shape[0])
+            self.keys[block] = np.zeros(0, dtype=np.int64)
+            self.counts[block] = np.zeros(0, dtype=self.dtype)
+            start = end
+        self.numberOfPixels = 0
+        np.cumsum(indptr, out=indptr)
+        return csr_matrix((counts, col, indptr), shape=self.shape)
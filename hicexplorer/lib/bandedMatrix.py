@@ -0,0 +1,231 @@
+import numpy as np
+import tables
+import cooler
+from scipy.sparse import csr_matrix, triu
+
+from hicmatrix import HiCMatrix as hm
+from hicmatrix.utilities import toString
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def row_block_borders(pIndptr, pChunkSize):
+    """
+    First row of each block of rows with about pChunkSize pixels, given the
+    row pointer of a csr matrix or the bin1_offset index of a cooler, and the
+    number of rows.
+
+    >>> row_block_borders(np.array([0, 2, 4, 4, 7, 8]), 3)
+    array([0, 1, 3, 5])
+    """
+    number_of_rows = len(pIndptr) - 1
+    targets = np.arange(0, pIndptr[-1], max(1, int(pChunkSize)))
+    borders = np.searchsorted(pIndptr, targets, side='right') - 1
+    return np.unique(np.concatenate([[0], borders, [number_of_rows]]))
+
+
+def bin_ranks(pNumberOfBins, pSkippedBins=None):
+    """
+    Position of each bin in the matrix without pSkippedBins, the distance of two
+    bins in that matrix is the difference of their ranks.
+
+    >>> bin_ranks(5, [1, 2])
+    array([0, 1, 1, 1, 2])
+    """
+    valid = np.ones(pNumberOfBins, dtype=bool)
+    if pSkippedBins is not None and len(pSkippedBins):
+        valid[np.asarray(pSkippedBins, dtype=np.int64)] = False
+    return np.cumsum(valid) - valid
+
+
+def in_band(pRows, pColumns, pMaxBinDistance, pRanks=None):
+    """
+    True for the pixels with at most pMaxBinDistance bins between row and column,
+    with pRanks counted without the skipped bins, see bin_ranks.
+
+    >>> in_band(np.array([0, 0, 1, 3]), np.array([0, 4, 3, 1]), 2)
+    array([ True, False,  True,  True])
+    >>> in_band(np.array([0, 0]), np.array([3, 4]), 1, bin_ranks(5, [1, 2]))
+    array([ True, False])
+    """
+    if pRanks is not None:
+        pRows, pColumns = pRanks[pRows], pRanks[pColumns]
+    return np.abs(pColumns.astype(np.int64) - pRows) <= pMaxBinDistance
+
+
+def max_bin_distance(pCutIntervals, pMaxDistance, pExtraBins=0, pSkippedBins=None):
+    """
+    Number of bins of the bin size of the matrix, as estimated by hiCMatrix.getBinSize,
+    that cover pMaxDistance bp, plus pExtraBins. With pSkippedBins the bin size is the
+    one of the matrix after maskBins(pSkippedBins), which the distances in bins of the
+    masked matrix are computed with.
+
+    >>> intervals = [('chr1', start, start + 1000, 1) for start in range(0, 20000, 1000)]
+    >>> intervals += [('chr1', start, start + 5000, 1) for start in range(20000, 170000, 5000)]
+    >>> max_bin_distance(intervals, 10000), max_bin_distance(intervals, 10000, pSkippedBins=range(20, 50))
+    (2, 10)
+    """
+    if pSkippedBins is not None and 0 < len(pSkippedBins) < len(pCutIntervals):
+        valid = np.ones(len(pCutIntervals), dtype=bool)
+        valid[np.asarray(pSkippedBins, dtype=np.int64)] = False
+        pCutIntervals = [interval for interval, is_valid in zip(pCutIntervals, valid) if is_valid]
+    hic_ma = hm.hiCMatrix()
+    hic_ma.cut_intervals = pCutIntervals
+    return int(np.ceil(float(pMaxDistance) / hic_ma.getBinSize())) + pExtraBins
+
+
+def chromosome_bin_range(pCutIntervals, pChromosome=None):
+    """
+    First and last + 1 bin of pChromosome, of all bins if pChromosome is None.
+
+    >>> chromosome_bin_range([('chr1', 0, 10, 1), ('chr2', 0, 10, 1), ('chr2', 10, 20, 1)], 'chr2')
+    (1, 3)
+    """
+    if pChromosome is None:
+        return 0, len(pCutIntervals)
+    bins = [index for index, interval in enumerate(pCutIntervals) if interval[0] == pChromosome]
+    if len(bins) == 0:
+        raise ValueError("Chromosome {} not found in the matrix".format(pChromosome))
+    return bins[0], bins[-1] + 1
+
+
+def _band_blocks(pIndptr, pFirstBin, pLastBin, pChunkSize, pReadBlock):
+    """
+    Yields the rows, columns and values of the pixels of the submatrix pFirstBin:pLastBin
+    in blocks of rows, pReadBlock(start, end) returns the columns and values of the pixels
+    start:end of the csr arrays or the cooler pixel table.
+    """
+    indptr = pIndptr[pFirstBin:pLastBin + 1]
+    borders = row_block_borders(indptr - indptr[0], pChunkSize) + pFirstBin
+    for start_row, end_row in zip(borders[:-1], borders[1:]):
+        rows = np.repeat(np.arange(start_row, end_row), np.diff(pIndptr[start_row:end_row + 1]))
+        columns, data = pReadBlock(pIndptr[start_row], pIndptr[end_row])
+        in_submatrix = (columns >= pFirstBin) & (columns < pLastBin)
+        yield rows[in_submatrix] - pFirstBin, columns[in_submatrix] - pFirstBin, data[in_submatrix]
+
+
+def _band_matrix(pBlocks, pSize, pMaxBinDistance, pRanks):
+    """
+    csr matrix of the pixels of pBlocks within the band. The blocks are in the order
+    of the rows, as the csr arrays and the pixel table of a cooler. If there are no
+    pixels below the diagonal, the matrix is made symmetric, as by
+    hiCMatrix.fillLowerTriangle.
+    """
+    pixels_per_row = np.zeros(pSize, dtype=np.int64)
+    columns, data = [], []
+    lower_triangle = False
+    for block_rows, block_columns, block_data in pBlocks:
+        keep = in_band(block_rows, block_columns, pMaxBinDistance, pRanks)
+        block_rows = block_rows[keep]
+        pixels_per_row += np.bincount(block_rows, minlength=pSize)
+        columns.append(block_columns[keep])
+        data.append(block_data[keep])
+        lower_triangle = lower_triangle or bool(np.any(columns[-1] < block_rows))
+    indptr = np.concatenate([[0], np.cumsum(pixels_per_row)])
+    matrix = csr_matrix((np.concatenate(data), np.concatenate(columns), indptr), shape=(pSize, pSize))
+    columns = data = None
+    matrix.sort_indices()
+    if not lower_triangle:
+        matrix = matrix + triu(matrix, k=1, format='csr').T
+    return matrix
+
+
+def _load_h5_band(pMatrixFile, pMaxDistance, pSkipNanBins, pChromosome, pExtraBins, pChunkSize):
+    with tables.open_file(pMatrixFile, 'r') as h5_file:
+        intervals = {}
+        for interval_part in ('chr_list', 'start_list', 'end_list', 'extra_list'):
+            intervals[interval_part] = getattr(h5_file.root.intervals, interval_part).read()
+        cut_intervals = list(zip(toString(intervals['chr_list']), intervals['start_list'],
+                                 intervals['end_list'], intervals['extra_list']))
+        nan_bins = h5_file.root.nan_bins.read() if hasattr(h5_file.root, 'nan_bins') else np.array([])
+        first_bin, last_bin = chromosome_bin_range(cut_intervals, pChromosome)
+        cut_intervals = cut_intervals[first_bin:last_bin]
+        nan_bins = nan_bins[(nan_bins >= first_bin) & (nan_bins < last_bin)] - first_bin
+        size = last_bin - first_bin
+        ranks = bin_ranks(size, nan_bins) if pSkipNanBins else None
+
+        matrix = h5_file.root.matrix
+        blocks = _band_blocks(matrix.indptr.read(), first_bin, last_bin, pChunkSize,
+                              lambda start, end: (matrix.indices[start:end], matrix.data[start:end]))
+        band = max_bin_distance(cut_intervals, pMaxDistance, pExtraBins, nan_bins if pSkipNanBins else None)
+        matrix = _band_matrix(blocks, size, band, ranks)
+    return matrix, cut_intervals, nan_bins
+
+
+def _load_cool_band(pMatrixFile, pMaxDistance, pSkipNanBins, pChromosome, pExtraBins, pChunkSize):
+    bins = cooler.Cooler(pMatrixFile).bins()[:]
+    cut_intervals = [(toString(chrom), start, end, 1.0) for chrom, start, end in bins[['chrom', 'start', 'end']].values]
+    first_bin, last_bin = chromosome_bin_range(cut_intervals, pChromosome)
+    cut_intervals = cut_intervals[first_bin:last_bin]
+    size = last_bin - first_bin
+    weights = None
+    # as hiCMatrix, the weights are applied unless they are all nan
+    if 'weight' in bins and not np.isnan(bins['weight'].values).all():
+        weights = bins['weight'].values[first_bin:last_bin]
+
+    file_name, group_path = cooler.util.parse_cooler_uri(pMatrixFile)
+    with cooler.util.open_hdf5(file_name, mode='r') as h5_file:
+        group = h5_file[group_path]
+        bin1_offset = group['indexes']['bin1_offset'][:]
+
+        def blocks():
+            for rows, columns, data in _band_blocks(bin1_offset, first_bin, last_bin, pChunkSize,
+                                                    lambda start, end: (group['pixels']['bin2_id'][start:end],
+                                                                        group['pixels']['count'][start:end])):
+                if weights is not None:
+                    data = data * (weights[rows] * weights[columns])
+                # pixels that are zero or nan after the correction are removed, as by hiCMatrix
+                keep = (data != 0) & ~np.isnan(data)
+                yield rows[keep], columns[keep], data[keep]
+
+        # the nan bins of a cool file are the bins without any pixel
+        has_pixels = np.zeros(size, dtype=bool)
+
+        def mark_bins_with_pixels(pBlocks):
+            for rows, columns, data in pBlocks:
+                has_pixels[rows] = True
+                has_pixels[columns] = True
+                yield rows, columns, data
+
+        ranks = None
+        if pSkipNanBins:
+            for _ in mark_bins_with_pixels(blocks()):
+                pass
+            ranks = bin_ranks(size, np.flatnonzero(~has_pixels))
+            band = max_bin_distance(cut_intervals, pMaxDistance, pExtraBins, np.flatnonzero(~has_pixels))
+            matrix = _band_matrix(blocks(), size, band, ranks)
+        else:
+            matrix = _band_matrix(mark_bins_with_pixels(blocks()), size,
+                                  max_bin_distance(cut_intervals, pMaxDistance, pExtraBins), ranks)
+    return matrix, cut_intervals, np.flatnonzero(~has_pixels)
+
+
+def load_banded_matrix(pMatrixFile, pMaxDistance, pSkipNanBins=False, pChromosome=None, pExtraBins=0,
+                       pChunkSize=2**22):
+    """
+    Loads only the pixels of the h5 or cool file pMatrixFile that are at most
+    pMaxDistance bp, rounded up to full bins, plus pExtraBins bins away from the
+    diagonal. The pixels are read in blocks of rows with about pChunkSize pixels,
+    such that the whole matrix is never in memory. Returns a hiCMatrix with the
+    same values and nan bins as hiCMatrix(pMatrixFile) in the band, and zeros
+    outside. The correction factors are not loaded.
+
+    With pSkipNanBins the distance is counted without the nan bins, i.e. the band
+    is the band of the matrix after maskBins(nan_bins), with the bin size of that
+    matrix. With pChromosome only the
+    submatrix of this chromosome is loaded, as hiCMatrix(pMatrixFile,
+    pChrnameList=[pChromosome]) does for cool files.
+    """
+    if pMatrixFile.endswith('.h5'):
+        matrix, cut_intervals, nan_bins = _load_h5_band(pMatrixFile, pMaxDistance, pSkipNanBins, pChromosome,
+                                                        pExtraBins, pChunkSize)
+    else:
+        matrix, cut_intervals, nan_bins = _load_cool_band(pMatrixFile, pMaxDistance, pSkipNanBins, pChromosome,
+                                                          pExtraBins, pChunkSize)
+    log.info("{} pixels loaded in a band of {} bp".format(matrix.nnz, pMaxDistance))
+
+    hic_ma = hm.hiCMatrix()
+    hic_ma.setMatrix(matrix, cut_intervals)
+    hic_ma.nan_bins = nan_bins
+    return hic_ma
@@ -0,0 +1,106 @@
+import os
+import json
+import shutil
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class Checkpoint():
+    """
+    Versioned checkpoints in a directory. Each checkpoint is a sub directory
+    with numpy files written by the caller and a json file with the state.
+    The file 'latest' names the last complete checkpoint, it is replaced
+    atomically once all files of a new checkpoint are written. A crash while
+    writing leaves the previous checkpoint intact.
+
+    >>> from tempfile import mkdtemp
+    >>> checkpoint = Checkpoint(mkdtemp())
+    >>> checkpoint.load()
+    (None, None)
+    >>> path = checkpoint.begin()
+    >>> checkpoint.commit(path, {'pairs': 10})
+    >>> checkpoint.load()[1]
+    {'pairs': 10}
+    >>> checkpoint.commit(checkpoint.begin(), {'pairs': 20})
+    >>> sorted(os.listdir(checkpoint.directory))
+    ['checkpoint_2', 'latest']
+    >>> checkpoint.remove()
+    >>> os.path.exists(checkpoint.directory)
+    False
+    """
+
+    def __init__(self, pDirectory):
+        self.directory = pDirectory
+        if not os.path.isdir(pDirectory):
+            os.makedirs(pDirectory)
+
+    def _latest_name(self):
+        latest_file = os.path.join(self.directory, 'latest')
+        if not os.path.exists(latest_file):
+            return None
+        with open(latest_file) as file:
+            return file.read().strip()
+
+    def _checkpoint_names(self):
+        return [name for name in os.listdir(self.directory) if name.startswith('checkpoint_')]
+
+    def load(self):
+        """Returns the path and the state of the last complete checkpoint, (None, None) if there is none."""
+        name = self._latest_name()
+        if name is None:
+            return None, None
+        path = os.path.join(self.directory, name)
+        with open(os.path.join(path, 'state.json')) as file:
+            return path, json.load(file)
+
+    def begin(self):
+        """Returns an empty directory for the files of the next checkpoint."""
+        latest_name = self._latest_name()
+        number = 1 if latest_name is None else int(latest_name.split('_')[-1]) + 1
+        path = os.path.join(self.directory, 'checkpoint_{}'.format(number))
+        # left over of an interrupted checkpoint
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        return path
+
+    def commit(self, pPath, pState):
+        """Writes the state, syncs all files of the checkpoint to disk and marks it as the latest one.
+        The previous checkpoints are removed afterwards."""
+        with open(os.path.join(pPath, 'state.json'), 'w') as file:
+            json.dump(pState, file)
+        for name in os.listdir(pPath):
+            with open(os.path.join(pPath, name), 'rb') as file:
+                os.fsync(file.fileno())
+        _fsync_directory(pPath)
+
+        latest_file = os.path.join(self.directory, 'latest')
+        with open(latest_file + '.tmp', 'w') as file:
+            file.write(os.path.basename(pPath))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(latest_file + '.tmp', latest_file)
+        _fsync_directory(self.directory)
+
+        for name in self._checkpoint_names():
+            if name != os.path.basename(pPath):
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    def remove(self):
+        """Removes all checkpoints and the directory if it is empty afterwards."""
+        for name in self._checkpoint_names():
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+        for name in ['latest', 'latest.tmp']:
+            if os.path.exists(os.path.join(self.directory, name)):
+                os.unlink(os.path.join(self.directory, name))
+        if not os.listdir(self.directory):
+            os.rmdir(self.directory)
+
+
+def _fsync_directory(pPath):
+    file_descriptor = os.open(pPath, os.O_RDONLY)
+    try:
+        os.fsync(file_descriptor)
+    finally:
+        os.close(file_descriptor)
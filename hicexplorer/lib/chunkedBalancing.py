@@ -0,0 +1,229 @@
+import time
+import numpy as np
+import pandas as pd
+
+from hicexplorer.iterativeCorrection import start_bias
+
+import logging
+log = logging.getLogger(__name__)
+
+# bytes per pixel of a chunk during a pass over the pixels: the read columns, the row ids,
+# the gathered weights and the corrected values
+BYTES_PER_PIXEL = 64
+# bytes per pixel of the pixels kept in memory between the passes: row, column and count
+BYTES_PER_CACHED_PIXEL = 16
+# number of float64 vectors with one value per bin: the bin1 offsets, the bias, the
+# marginals and the temporaries of the passes
+VECTORS_PER_BIN = 8
+
+
+class CoolerPixelChunks():
+    """
+    Reads the pixels table of a cooler group, e.g. an open h5py group, in blocks of rows
+    with at most about pChunkSize pixels. Only the bin2_id and count columns are read,
+    the row ids are created from the bin1_offset index. The pixels can be iterated any
+    number of times, with pCache the chunks are kept in memory after the first pass.
+    Each chunk is (bin1, bin2, count) with the counts as float64 and nans replaced by zeros.
+    The pixel table stores the upper triangle of the symmetric matrix.
+    """
+
+    def __init__(self, pGroup, pChunkSize, pCache=False):
+        self.group = pGroup
+        self.bin1Offset = pGroup['indexes']['bin1_offset'][:]
+        self.size = len(self.bin1Offset) - 1
+        self.nnz = int(self.bin1Offset[-1])
+        # first row of each chunk
+        targets = np.arange(0, self.nnz, max(1, int(pChunkSize)))
+        row_borders = np.searchsorted(self.bin1Offset, targets, side='right') - 1
+        self.rowBorders = np.unique(np.concatenate([[0], row_borders, [self.size]]))
+        self.cache = [] if pCache else None
+        self.cacheComplete = False
+        self.index_dtype = np.int32 if self.size < np.iinfo(np.int32).max else np.int64
+
+    def __len__(self):
+        return len(self.rowBorders) - 1
+
+    def _read(self, pStartRow, pEndRow):
+        start, end = self.bin1Offset[pStartRow], self.bin1Offset[pEndRow]
+        bin1 = np.repeat(np.arange(pStartRow, pEndRow, dtype=self.index_dtype),
+                         np.diff(self.bin1Offset[pStartRow:pEndRow + 1]))
+        bin2 = self.group['pixels']['bin2_id'][start:end].astype(self.index_dtype, copy=False)
+        count = self.group['pixels']['count'][start:end].astype(np.float64, copy=False)
+        count[~np.isfinite(count)] = 0
+        return bin1, bin2, count
+
+    def __iter__(self):
+        if self.cacheComplete:
+            for chunk in self.cache:
+                yield chunk
+            return
+        for start_row, end_row in zip(self.rowBorders[:-1], self.rowBorders[1:]):
+            chunk = self._read(start_row, end_row)
+            if self.cache is not None:
+                self.cache.append(chunk)
+            yield chunk
+        if self.cache is not None:
+            self.cacheComplete = True
+
+
+def chunk_size_for_budget(pNumberOfBins, pNumberOfPixels, pMemoryBudget):
+    """
+    Returns the number of pixels per chunk and if all pixels can be cached in memory
+    with a memory budget of pMemoryBudget bytes.
+
+    >>> chunk_size_for_budget(1000, 10**6, 2**30)
+    (16776216, True)
+    >>> chunk_size_for_budget(1000, 10**9, 2**30)
+    (16776216, False)
+    """
+    vectors = VECTORS_PER_BIN * 8 * pNumberOfBins
+    if pMemoryBudget <= vectors:
+        raise ValueError("The memory budget of {:.0f} MB is too small for the vectors of the {} bins, "
+                         "at least {:.0f} MB are needed.".format(pMemoryBudget / 2**20, pNumberOfBins,
+                                                                 (vectors + 2**20) / 2**20))
+    chunk_size = (pMemoryBudget - vectors) // BYTES_PER_PIXEL
+    cache = pNumberOfPixels * (BYTES_PER_PIXEL + BYTES_PER_CACHED_PIXEL) <= pMemoryBudget - vectors
+    return int(chunk_size), cache
+
+
+def marginals(pChunks, pWeights, pSkipDiagonal=False):
+    """
+    One pass over the pixels. Returns the row sums of the symmetric matrix with the values
+    a_ij * w_i * w_j, its diagonal and its maximum value.
+
+    >>> chunks = [(np.array([0, 0, 1]), np.array([0, 1, 1]), np.array([1., 2., 3.]))]
+    >>> marginals(chunks, np.array([1., 2.]))
+    (array([ 5., 16.]), array([ 1., 12.]), 12.0)
+    >>> marginals(chunks, np.array([1., 2.]), pSkipDiagonal=True)[0]
+    array([4., 4.])
+    """
+    size = len(pWeights)
+    row_sum = np.zeros(size, dtype=np.float64)
+    diagonal = np.zeros(size, dtype=np.float64)
+    max_value = 0.0
+    for bin1, bin2, count in pChunks:
+        values = count * pWeights[bin1]
+        values *= pWeights[bin2]
+        on_diagonal = bin1 == bin2
+        if pSkipDiagonal:
+            values[on_diagonal] = 0
+        if len(values):
+            max_value = max(max_value, float(values.max()))
+        row_sum += np.bincount(bin1, values, minlength=size)
+        row_sum += np.bincount(bin2, values, minlength=size)
+        diagonal += np.bincount(bin1[on_diagonal], values[on_diagonal], minlength=size)
+    # the diagonal is counted as row and as column
+    row_sum -= diagonal
+    return row_sum, diagonal, max_value
+
+
+def iterativeCorrectionChunked(pChunks, pMask, M=50, tolerance=1e-5, verbose=False, pSkipDiagonal=False,
+                               initial_bias=None, report=False):
+    """
+    Iterative correction of the pixels of pChunks with the same results as
+    iterativeCorrectionUpperTriangle on the matrix without the masked bins, but
+    only the bias vector is kept in memory. Each iteration is one pass over the
+    pixels. The bias of the masked bins is 0.
+
+    :param pChunks: iterable over (bin1, bin2, count) of the upper triangle, e.g. CoolerPixelChunks
+    :param pMask: boolean array, True for the bins that are not corrected
+    :param M: maximum number of iterations
+    :param tolerance: Tolerance is the maximum allowed relative
+                      deviation of the marginals.
+    :param initial_bias: bias vector of all bins to start with, see iterativeCorrectionUpperTriangle
+    :param report: if True, the convergence report of iterativeCorrectionUpperTriangle is returned as
+                   second value
+
+    >>> from scipy.sparse import csr_matrix, triu
+    >>> from hicexplorer.iterativeCorrection import iterativeCorrectionUpperTriangle
+    >>> matrix = csr_matrix(np.array([[10, 2, 1], [2, 5, 3], [1, 3, 1]], dtype=float))
+    >>> upper = triu(matrix).tocoo()
+    >>> bias = iterativeCorrectionChunked([(upper.row, upper.col, upper.data)], np.zeros(3, dtype=bool), M=500)
+    >>> np.allclose(bias, iterativeCorrectionUpperTriangle(matrix, M=500)[1])
+    True
+    """
+    if verbose:
+        log.setLevel(logging.INFO)
+
+    start_time = time.time()
+    valid = ~pMask
+    total_bias = np.zeros(len(valid), dtype=np.float64)
+    total_bias[valid] = start_bias(None if initial_bias is None else np.asarray(initial_bias)[valid], valid.sum())
+    inverse_bias = np.divide(1.0, total_bias, out=np.zeros_like(total_bias), where=total_bias != 0)
+    residuals = []
+
+    log.info("starting iterative correction")
+    for iternum in range(M):
+        iternum += 1
+        iteration_start = time.time()
+        row_sum, _, max_value = marginals(pChunks, inverse_bias, pSkipDiagonal)
+        if max_value > 1e100:
+            log.error("*Error* matrix correction is producing extremely large values. "
+                      "This is often caused by bins of low counts. Use a more stringent "
+                      "filtering of bins.")
+            exit(1)
+        s = row_sum[valid]
+        mask = (s == 0)
+        s = s / np.mean(s[~mask])
+
+        total_bias[valid] *= s
+        deviation = np.abs(s - 1).max()
+        residuals.append(float(deviation))
+        inverse_bias = np.divide(1.0, total_bias, out=np.zeros_like(total_bias), where=total_bias != 0)
+        log.debug("iteration {} took {:.3f} secs".format(iternum, time.time() - iteration_start))
+        if verbose:
+            if iternum % 5 == 0:
+                end_time = time.time()
+                estimated = (float(M - iternum) * (end_time - start_time)) / iternum
+                m, sec = divmod(estimated, 60)
+                h, m = divmod(m, 60)
+                log.info("pass {} Estimated time {:.0f}:{:.0f}:{:.0f}".format(iternum, h, m, sec))
+                log.info("max delta - 1 = {} ".format(deviation))
+
+        if deviation < tolerance:
+            log.info("[iterative correction] {} iterations used\n".format(iternum + 1))
+            break
+
+    # scale the total bias such that the sum is 1.0
+    corr = total_bias[total_bias != 0].mean()
+    total_bias /= corr
+    inverse_bias = np.divide(1.0, total_bias, out=np.zeros_like(total_bias), where=total_bias != 0)
+    if marginals(pChunks, inverse_bias, pSkipDiagonal)[2] > 1e10:
+        log.error("*Error* matrix correction produced extremely large values. "
+                  "This is often caused by bins of low counts. Use a more stringent "
+                  "filtering of bins.")
+        exit(1)
+    if report:
+        return total_bias, {'iterations': len(residuals), 'converged': bool(residuals and residuals[-1] < tolerance),
+                            'residuals': residuals, 'wall_time': time.time() - start_time}
+    return total_bias
+
+
+def corrected_pixels(pChunks, pBias, pDtype=np.float64, pSkipDiagonal=False):
+    """
+    Yields the pixels of pChunks corrected with the bias vector as data frames for
+    cooler.create_cooler, the values are count / (bias_i * bias_j) computed in the
+    precision pDtype as in iterativeCorrectionUpperTriangle and stored as float64.
+    The pixels of bins with a bias of 0, e.g. the masked bins, and the zero values
+    are dropped, with pSkipDiagonal also the diagonal.
+
+    >>> chunks = [(np.array([0, 0, 1, 2]), np.array([0, 1, 2, 2]), np.array([1., 2., 3., 0.]))]
+    >>> for pixels in corrected_pixels(chunks, np.array([0.5, 2., 0.])):
+    ...     print(pixels)
+       bin1_id  bin2_id  count
+    0        0        0    4.0
+    1        0        1    2.0
+    >>> next(corrected_pixels(chunks, np.array([0.5, 2., 0.]), pSkipDiagonal=True))
+       bin1_id  bin2_id  count
+    0        0        1    2.0
+    """
+    inverse_bias = np.divide(1.0, pBias, out=np.zeros(len(pBias), dtype=np.float64), where=pBias != 0)
+    for bin1, bin2, count in pChunks:
+        values = count.astype(pDtype)
+        values *= inverse_bias[bin1].astype(pDtype)
+        values *= inverse_bias[bin2].astype(pDtype)
+        keep = values != 0
+        if pSkipDiagonal:
+            keep &= bin1 != bin2
+        yield pd.DataFrame({'bin1_id': bin1[keep], 'bin2_id': bin2[keep],
+                            'count': values[keep].astype(np.float64, copy=False)})
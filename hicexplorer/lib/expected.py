@@ -0,0 +1,359 @@
+import os
+import json
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+from scipy.sparse import triu, diags, csr_matrix
+from hicmatrix import HiCMatrix as hm
+
+from hicexplorer.lib.marginals import matrix_checksum, sidecar_file_name
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def diagonal_lengths(pChromSizes, pNumberOfDistances):
+    """
+    Number of pixels of the upper triangle at each distance d < pNumberOfDistances
+    summed over all chromosomes: sum(size - d) of all chromosomes with size > d.
+
+    >>> diagonal_lengths([3, 1], 4)
+    array([4, 2, 1, 0])
+    """
+    sizes = np.sort(np.asarray(pChromSizes, dtype=np.int64))
+    distances = np.arange(pNumberOfDistances, dtype=np.int64)
+    # sizes larger than the distance
+    first = np.searchsorted(sizes, distances, side='right')
+    sum_of_larger = np.concatenate([np.cumsum(sizes[::-1])[::-1], [0]])[first]
+    return sum_of_larger - distances * (len(sizes) - first)
+
+
+class ExpectedContacts():
+    """
+    Per chromosome and per distance table of the contacts of a Hi-C matrix: the sum
+    of the contacts, the number of pixels, the mean and the variance. Index i of the
+    arrays of a chromosome is the distance in bins + 1, index 0 holds the
+    inter-chromosomal contacts of the table 'all' of the whole genome.
+
+    The definitions are the ones of hiCMatrix.convert_to_obs_exp_matrix: the distance
+    is the genomic distance of the bins divided by the bin size, the number of pixels
+    at distance d is the number of pixels of the upper triangle of the matrix at this
+    distance, or the number of non zero pixels if it is larger. The variance includes
+    the zeros that are not stored in the sparse matrix.
+
+    The tables can be stored next to the matrix file, keyed by the checksum of the file
+    and the parameters that were used to compute them, see save_expected and load_expected.
+    """
+
+    def __init__(self, pTables, pAttributes=None):
+        self.tables = OrderedDict(pTables)
+        self.attributes = {} if pAttributes is None else dict(pAttributes)
+
+    def chromosomes(self):
+        return list(self.tables)
+
+    def sum(self, pChrom):
+        return self.tables[pChrom]['sum']
+
+    def pixels(self, pChrom):
+        return self.tables[pChrom]['pixels']
+
+    def mean(self, pChrom):
+        return self.tables[pChrom]['mean']
+
+    def variance(self, pChrom):
+        return self.tables[pChrom]['variance']
+
+    @classmethod
+    def from_matrix(cls, pHiCMatrix, pMaxDepth=None, pPerChromosome=False, pVariance=False):
+        """
+        Computes the tables of the matrix of pHiCMatrix, which has to be prepared with
+        prepare_matrix. The variance is only computed with pVariance.
+        """
+        tables = OrderedDict()
+        for chrname, _, submatrix, distance, chrom_sizes in _submatrices(pHiCMatrix, pPerChromosome):
+            tables[chrname] = _statistics(submatrix.data, distance, submatrix.shape[0], chrom_sizes,
+                                          pMaxDepth, pVariance)
+        return cls(tables)
+
+    def save(self, pFileName, pKey):
+        """
+        Adds the tables to the file with pKey as name, the tables of other keys are kept
+        if they are of the same matrix, i.e. have the same checksum attribute.
+        """
+        stored = {}
+        if os.path.exists(pFileName):
+            with np.load(pFileName) as stored_file:
+                stored = {name: stored_file[name] for name in stored_file.files}
+        prefix = _key_prefix(pKey)
+        checksum = self.attributes.get('checksum')
+        for name in [name for name in stored if name.endswith('_attributes')]:
+            if json.loads(str(stored[name])).get('checksum') != checksum or name.startswith(prefix):
+                other_prefix = name[:-len('attributes')]
+                stored = {key: value for key, value in stored.items() if not key.startswith(other_prefix)}
+
+        stored[prefix + 'attributes'] = np.array(json.dumps(dict(self.attributes, key=pKey)))
+        stored[prefix + 'chromosomes'] = np.array(self.chromosomes())
+        lengths = [len(self.sum(chrom)) for chrom in self.chromosomes()]
+        stored[prefix + 'offsets'] = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        for column in ['sum', 'pixels', 'mean', 'variance']:
+            if any(self.tables[chrom][column] is None for chrom in self.chromosomes()):
+                continue
+            stored[prefix + column] = np.concatenate([self.tables[chrom][column] for chrom in self.chromosomes()])
+        np.savez(pFileName, **stored)
+
+    @classmethod
+    def load(cls, pFileName, pKey, pChecksum):
+        """
+        Returns the tables stored in pFileName with pKey, None if there are none or
+        if they are of a matrix with a different checksum.
+
+        >>> from tempfile import mkdtemp
+        >>> table = {'sum': np.array([0., 4.]), 'pixels': np.array([0, 2]), 'mean': np.array([np.nan, 2.]), 'variance': None}
+        >>> expected = ExpectedContacts({'chr1': table}, {'checksum': 'checksum', 'matrixSum': 4.0})
+        >>> file_name = os.path.join(mkdtemp(), 'matrix.h5.expected.npz')
+        >>> expected.save(file_name, 'perchr')
+        >>> ExpectedContacts.load(file_name, 'perchr', 'other checksum') is None
+        True
+        >>> ExpectedContacts.load(file_name, 'all', 'checksum') is None
+        True
+        >>> loaded = ExpectedContacts.load(file_name, 'perchr', 'checksum')
+        >>> loaded.mean('chr1'), loaded.variance('chr1'), loaded.attributes['matrixSum']
+        (array([nan,  2.]), None, 4.0)
+        """
+        if not os.path.exists(pFileName):
+            return None
+        prefix = _key_prefix(pKey)
+        with np.load(pFileName) as stored:
+            if prefix + 'attributes' not in stored.files:
+                return None
+            attributes = json.loads(str(stored[prefix + 'attributes']))
+            if attributes.get('checksum') != pChecksum or attributes.get('key') != pKey:
+                log.info("The cached expected contacts in {} are of a different matrix".format(pFileName))
+                return None
+            offsets = stored[prefix + 'offsets']
+            tables = OrderedDict()
+            for index, chrom in enumerate(stored[prefix + 'chromosomes']):
+                tables[str(chrom)] = {column: stored[prefix + column][offsets[index]:offsets[index + 1]]
+                                      if prefix + column in stored.files else None
+                                      for column in ['sum', 'pixels', 'mean', 'variance']}
+        attributes.pop('key')
+        return cls(tables, attributes)
+
+
+def _key_prefix(pKey):
+    return hashlib.sha1(pKey.encode('utf-8')).hexdigest()[:16] + '_'
+
+
+@lru_cache(maxsize=8)
+def _checksum(pFileName, pModificationTime, pSize):
+    return matrix_checksum(pFileName)
+
+
+def checksum(pFileName):
+    """Checksum of the matrix file, computed once per version of the file."""
+    status = os.stat(pFileName.split('::')[0])
+    return _checksum(pFileName, status.st_mtime_ns, status.st_size)
+
+
+def load_expected(pFileName, pKey):
+    """
+    Returns the expected contacts stored next to the matrix file pFileName with
+    save_expected for the parameters described by pKey, None if there are none or
+    if the matrix file changed since.
+    """
+    file_name = sidecar_file_name(pFileName, 'expected')
+    expected = ExpectedContacts.load(file_name, pKey, checksum(pFileName))
+    if expected is not None:
+        log.info("Using the expected contacts cached in {}".format(file_name))
+    return expected
+
+
+def save_expected(pFileName, pKey, pExpected):
+    """
+    Stores the expected contacts next to the matrix file pFileName, keyed by its
+    checksum and pKey. A file that cannot be written only gives a warning.
+    """
+    file_name = sidecar_file_name(pFileName, 'expected')
+    pExpected.attributes['checksum'] = checksum(pFileName)
+    try:
+        pExpected.save(file_name, pKey)
+    except OSError as error:
+        log.warning("The expected contacts could not be cached in {}: {}".format(file_name, error))
+
+
+def prepare_matrix(pHiCMatrix, pMaxDepth=None, pZscore=False):
+    """
+    Keeps the upper triangle of the matrix up to 1.5 * pMaxDepth, as
+    hiCMatrix.convert_to_obs_exp_matrix. For z-scores all pixels of this band are added
+    to the sparse matrix, with the value + 1. Returns the depth in bins, None if all
+    distances are used.
+    """
+    binsize = pHiCMatrix.getBinSize()
+    max_depth_in_bins = None
+
+    if pMaxDepth:
+        if pMaxDepth < binsize:
+            raise ValueError("Please specify a maxDepth larger than bin size ({})".format(binsize))
+
+        max_depth_in_bins = int(float(pMaxDepth * 1.5) / binsize)
+        pHiCMatrix.matrix = triu(pHiCMatrix.matrix, k=0, format='csr') - \
+            triu(pHiCMatrix.matrix, k=max_depth_in_bins, format='csr')
+    else:
+        pHiCMatrix.matrix = triu(pHiCMatrix.matrix, k=0, format='csr')
+
+    pHiCMatrix.matrix.eliminate_zeros()
+    depth = None
+    if pZscore:
+        m_size = pHiCMatrix.matrix.shape[0]
+        if max_depth_in_bins is not None:
+            depth = max_depth_in_bins
+        else:
+            depth = m_size
+            estimated_size_dense_matrix = m_size ** 2 * 8
+            if estimated_size_dense_matrix > 100e6:
+                log.info("To compute z-scores a dense matrix is required. This will use \n"
+                         "{} Mb of memory.\n To reduce memory use the maxdeph option.".format(estimated_size_dense_matrix / 1e6))
+        # the zeros of the band are part of the z-scores, the band is made dense by
+        # adding ones, which are subtracted again in _submatrices
+        diag_mat_ones = diags(np.repeat([1], m_size * depth).reshape(depth, m_size), list(range(depth)))
+        pHiCMatrix.matrix += diag_mat_ones
+    return depth
+
+
+def _submatrices(pHiCMatrix, pPerChromosome, pZscore=False):
+    """
+    Yields the name, bin range, coo submatrix, distance index and chromosome sizes of
+    each chromosome, or once for the whole matrix with the name 'all'.
+    """
+    binsize = pHiCMatrix.getBinSize()
+    if pPerChromosome:
+        parts = []
+        for chrname in pHiCMatrix.getChrNames():
+            chr_range = pHiCMatrix.getChrBinRange(chrname)
+            parts.append((chrname, chr_range, [chr_range[1] - chr_range[0]]))
+    else:
+        parts = [('all', (0, pHiCMatrix.matrix.shape[0]),
+                  np.array([v[1] - v[0] for k, v in pHiCMatrix.chrBinBoundaries.items()]))]
+
+    for chrname, chr_range, chrom_sizes in parts:
+        log.info("processing chromosome {}\n".format(chrname))
+        submatrix = pHiCMatrix.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]].tocoo()
+        if pZscore:
+            submatrix.data -= 1
+        cut_intervals = pHiCMatrix.cut_intervals[chr_range[0]:chr_range[1]]
+        dist_list, _ = pHiCMatrix.getDistList(submatrix.row, submatrix.col, hm.hiCMatrix.fit_cut_intervals(cut_intervals))
+        # bin distance + 1, 0 for inter chromosomal pixels
+        dist_list[dist_list == -1] = -binsize
+        dist_list = (np.array(dist_list).astype(float) / binsize).astype(int) + 1
+        yield chrname, chr_range, submatrix, dist_list, chrom_sizes
+
+
+def _statistics(pData, pDistance, pMatrixSize, pChromSizes, pMaxDepth, pVariance):
+    """
+    Sum, number of pixels, mean and variance per distance index, with the same floating
+    point operations as hiCMatrix.convert_to_obs_exp_matrix.
+    """
+    sum_counts = np.bincount(pDistance, weights=pData, minlength=1).astype(np.float64, copy=False)
+    distance_len = np.bincount(pDistance, minlength=1)
+    number_of_distances = len(sum_counts)
+
+    diagonal_length = np.zeros(number_of_distances, dtype=np.int64)
+    total_intra = pMatrixSize ** 2 - sum([size ** 2 for size in pChromSizes])
+    diagonal_length[0] = int(total_intra / 2)
+    diagonal_length[1:] = diagonal_lengths(pChromSizes, number_of_distances - 1)
+    diagonal_length = np.maximum(diagonal_length, distance_len)
+
+    mean = np.full(number_of_distances, np.nan)
+    non_empty = diagonal_length != 0
+    mean[non_empty] = sum_counts[non_empty] / diagonal_length[non_empty]
+    if pMaxDepth:
+        # the number of inter chromosomal pixels is not known if the matrix is cut at max depth
+        mean[0] = np.nan
+
+    variance = None
+    if pVariance:
+        variance = np.full(number_of_distances, np.nan)
+        order = np.argsort(pDistance, kind='stable')
+        sorted_data = pData[order]
+        borders = np.searchsorted(pDistance[order], np.arange(number_of_distances + 1))
+        order = None
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for distance in range(int(bool(pMaxDepth)), number_of_distances):
+                # the values of one distance are summed in the order of the matrix, as numpy
+                # sums them pairwise this gives the same value as hiCMatrix
+                values_sqrt_diff = np.abs((sorted_data[borders[distance]:borders[distance + 1]] - mean[distance]) ** 2)
+                # the zeros that are not stored in the sparse matrix differ by mean from the mean
+                zero_values_sqrt_diff_sum = (diagonal_length[distance] - len(values_sqrt_diff)) * mean[distance] ** 2
+                variance[distance] = (values_sqrt_diff.sum() + zero_values_sqrt_diff_sum) / diagonal_length[distance]
+
+    return {'sum': sum_counts, 'pixels': diagonal_length, 'mean': mean, 'variance': variance}
+
+
+def convert_to_obs_exp_matrix(pHiCMatrix, pMaxDepth=None, pZscore=False, pPerChromosome=False, pExpected=None):
+    """
+    Vectorised version of hiCMatrix.convert_to_obs_exp_matrix with the same results:
+    replaces the matrix of pHiCMatrix by the upper triangle of the obs/exp matrix, or of
+    the z-score matrix with pZscore. The matrix is cut at 1.5 * pMaxDepth, with z-scores
+    all pixels of this band are part of the matrix. If pExpected is given its tables are
+    used, they have to be computed with the same parameters. Returns the transformed
+    matrix and the expected contacts.
+
+    >>> from scipy.sparse import csr_matrix
+    >>> cut_intervals = [('a', 0, 10, 1), ('a', 10, 20, 1), ('a', 20, 30, 1), ('a', 30, 40, 1), ('b', 40, 50, 1)]
+    >>> hic = hm.hiCMatrix()
+    >>> hic.nan_bins = []
+    >>> matrix = np.array([[1, 8, 5, 3, 0], [0, 4, 15, 5, 1], [0, 0, 0, 7, 2], [0, 0, 0, 0, 1], [0, 0, 0, 0, 0]])
+    >>> hic.setMatrix(csr_matrix(matrix), cut_intervals)
+    >>> convert_to_obs_exp_matrix(hic)[0].todense()
+    matrix([[1. , 0.8, 1. , 1. , 0. ],
+            [0. , 4. , 1.5, 1. , 1. ],
+            [0. , 0. , 0. , 0.7, 2. ],
+            [0. , 0. , 0. , 0. , 1. ],
+            [0. , 0. , 0. , 0. , 0. ]])
+    >>> hic.setMatrix(csr_matrix(matrix), cut_intervals)
+    >>> matrix, expected = convert_to_obs_exp_matrix(hic, pZscore=True)
+    >>> matrix.todense()[0]
+    matrix([[ 0.        , -0.56195149,         nan,         nan, -1.41421356]])
+    >>> expected.mean('all')
+    array([ 1.,  1., 10.,  5.,  3.])
+    """
+    depth = prepare_matrix(pHiCMatrix, pMaxDepth, pZscore)
+
+    tables = OrderedDict()
+    row, col, data = [], [], []
+    for chrname, chr_range, submatrix, dist_list, chrom_sizes in _submatrices(pHiCMatrix, pPerChromosome, pZscore):
+        if pExpected is None:
+            tables[chrname] = _statistics(submatrix.data, dist_list, submatrix.shape[0], chrom_sizes,
+                                          pMaxDepth, pZscore)
+        else:
+            tables[chrname] = pExpected.tables[chrname]
+        mean = tables[chrname]['mean']
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if pZscore:
+                std = np.sqrt(tables[chrname]['variance'])
+                transf_ma = (submatrix.data - mean[dist_list]) / std[dist_list]
+                transf_ma[std[dist_list] == 0] = np.nan
+            else:
+                transf_ma = submatrix.data / mean[dist_list]
+        if depth is not None:
+            transf_ma[dist_list > depth + 1] = 0
+
+        row.append(submatrix.row + chr_range[0])
+        col.append(submatrix.col + chr_range[0])
+        data.append(transf_ma)
+
+    if data:
+        trasf_matrix = csr_matrix((np.concatenate(data), (np.concatenate(row), np.concatenate(col))),
+                                  shape=pHiCMatrix.matrix.shape)
+    else:
+        trasf_matrix = csr_matrix(pHiCMatrix.matrix.shape)
+    trasf_matrix.eliminate_zeros()
+    pHiCMatrix.matrix = trasf_matrix
+
+    if pExpected is None:
+        pExpected = ExpectedContacts(tables)
+    return pHiCMatrix.matrix, pExpected
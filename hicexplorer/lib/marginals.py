@@ -0,0 +1,151 @@
+import os
+import hashlib
+import numpy as np
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def matrix_checksum(pFileName, pBlockSize=2**24):
+    """
+    sha1 checksum of the content of the matrix file, for cooler uris of the whole file.
+    """
+    file_name = pFileName.split('::')[0]
+    checksum = hashlib.sha1()
+    with open(file_name, 'rb') as file:
+        for block in iter(lambda: file.read(pBlockSize), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def sidecar_file_name(pFileName, pSuffix='marginals'):
+    """
+    Name of the file next to the matrix file the marginals, or other data with
+    pSuffix, are cached in.
+
+    >>> sidecar_file_name('matrix.h5')
+    'matrix.h5.marginals.npz'
+    >>> sidecar_file_name('matrix.mcool::/resolutions/10000', 'expected')
+    'matrix.mcool.resolutions_10000.expected.npz'
+    """
+    if '::' in pFileName:
+        file_name, group = pFileName.split('::', 1)
+        group = group.strip('/').replace('/', '_')
+        if group:
+            return '{}.{}.{}.npz'.format(file_name, group, pSuffix)
+        return '{}.{}.npz'.format(file_name, pSuffix)
+    return '{}.{}.npz'.format(pFileName, pSuffix)
+
+
+def row_sums(pData, pIndptr):
+    """
+    Sums of the values of each row of a csr matrix given by its data and indptr arrays.
+
+    >>> row_sums(np.array([1., 2., 3.]), np.array([0, 2, 2, 3]))
+    array([3., 0., 3.])
+    """
+    sums = np.zeros(len(pIndptr) - 1, dtype=np.float64)
+    non_empty = np.diff(pIndptr) > 0
+    if len(pData):
+        sums[non_empty] = np.add.reduceat(pData, pIndptr[:-1][non_empty])
+    return sums
+
+
+class Marginals():
+    """
+    Row sums, diagonal and intra chromosomal row sums of a symmetric matrix,
+    computed in one pass over the csr arrays, and the bins of each chromosome.
+    The bins with a row sum of zero are not used by the filters, the values
+    returned by contacts() and the chromosome borders of chromosome_ranges()
+    refer to the matrix without these bins. The marginals can be stored next
+    to the matrix file, keyed by the checksum of the file.
+
+    >>> from scipy.sparse import csr_matrix
+    >>> matrix = csr_matrix(np.array([[1, 2, 0, 1], [2, 0, 0, 3], [0, 0, 0, 0], [1, 3, 0, 4]], dtype=float))
+    >>> marginals = Marginals.from_matrix(matrix, ['chr1', 'chr2'], [0, 2, 4])
+    >>> marginals.zeroBins
+    array([False, False,  True, False])
+    >>> marginals.contacts()
+    array([3., 5., 4.])
+    >>> marginals.contacts('chr1'), marginals.contacts('chr2')
+    (array([2., 2.]), array([0.]))
+    >>> marginals.chromosome_ranges()
+    [('chr1', 0, 2), ('chr2', 2, 3)]
+    """
+
+    def __init__(self, pRowSum, pDiagonal, pIntraRowSum, pZeroBins, pChromNames, pChromBorders):
+        self.rowSum = pRowSum
+        self.diagonal = pDiagonal
+        self.intraRowSum = pIntraRowSum
+        self.zeroBins = pZeroBins
+        self.chromNames = list(pChromNames)
+        self.chromBorders = np.asarray(pChromBorders, dtype=np.int64)
+
+    @classmethod
+    def from_matrix(cls, pMatrix, pChromNames, pChromBorders):
+        """
+        Computes the marginals of the csr matrix, pChromBorders are the first bin of each
+        chromosome and the number of bins. Bins with nans are not zero bins, as with the
+        row sums of scipy, nans and infs are counted as zero for the marginals.
+        """
+        matrix = pMatrix.tocsr()
+        size = matrix.shape[0]
+        zero_bins = row_sums(matrix.data, matrix.indptr) == 0
+        data = np.where(np.isfinite(matrix.data), matrix.data, 0).astype(np.float64, copy=False)
+        row_sum = row_sums(data, matrix.indptr)
+
+        # values in the diagonal block of the chromosome of the row
+        chrom_of_bin = np.repeat(np.arange(len(pChromNames)), np.diff(pChromBorders))
+        rows = np.repeat(np.arange(size), np.diff(matrix.indptr))
+        diagonal = np.bincount(rows[matrix.indices == rows], data[matrix.indices == rows], minlength=size)
+        intra_data = np.where(chrom_of_bin[matrix.indices] == chrom_of_bin[rows], data, 0)
+        rows = None
+        intra_row_sum = row_sums(intra_data, matrix.indptr)
+        return cls(row_sum, diagonal, intra_row_sum, zero_bins, pChromNames, pChromBorders)
+
+    def _nonzero(self, pValues):
+        return pValues[~self.zeroBins]
+
+    def chromosome_ranges(self):
+        """(name, start, end) of each chromosome in the matrix without the zero bins."""
+        borders = np.concatenate([[0], np.cumsum(~self.zeroBins)])[self.chromBorders]
+        return [(name, int(start), int(end)) for name, start, end in zip(self.chromNames, borders[:-1], borders[1:])]
+
+    def contacts(self, pChrom=None):
+        """
+        Row sums without the diagonal of the bins that are not zero, with pChrom of the
+        chromosome submatrix. These are the values of the MAD filter and of the diagnostic plot.
+        """
+        if pChrom is None:
+            return self._nonzero(self.rowSum - self.diagonal)
+        start, end = [(start, end) for name, start, end in self.chromosome_ranges() if name == pChrom][0]
+        return self._nonzero(self.intraRowSum - self.diagonal)[start:end]
+
+    def save(self, pFileName, pKey):
+        np.savez(pFileName, key=np.array(pKey), rowSum=self.rowSum, diagonal=self.diagonal,
+                 intraRowSum=self.intraRowSum, zeroBins=self.zeroBins,
+                 chromNames=np.array(self.chromNames), chromBorders=self.chromBorders)
+
+    @classmethod
+    def load(cls, pFileName, pKey):
+        """
+        Returns the marginals stored in pFileName, None if there is no such file or it was
+        stored with a different key.
+
+        >>> from tempfile import mkdtemp
+        >>> marginals = Marginals(np.ones(2), np.zeros(2), np.ones(2), np.zeros(2, dtype=bool), ['chr1'], [0, 2])
+        >>> file_name = os.path.join(mkdtemp(), 'matrix.h5.marginals.npz')
+        >>> marginals.save(file_name, 'checksum')
+        >>> Marginals.load(file_name, 'other checksum') is None
+        True
+        >>> Marginals.load(file_name, 'checksum').chromosome_ranges()
+        [('chr1', 0, 2)]
+        """
+        if not os.path.exists(pFileName):
+            return None
+        with np.load(pFileName) as stored:
+            if str(stored['key']) != pKey:
+                log.info("The cached marginals in {} are of a different matrix".format(pFileName))
+                return None
+            return cls(stored['rowSum'], stored['diagonal'], stored['intraRowSum'], stored['zeroBins'],
+                       [str(name) for name in stored['chromNames']], stored['chromBorders'])
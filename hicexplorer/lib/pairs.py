@@ -0,0 +1,136 @@
+import numpy as np
+import tables
+
+import logging
+log = logging.getLogger(__name__)
+
+# columns of a valid pairs file. The chromosomes are stored as index into the
+# chromosome list of the file, the strand is 0 for forward and 1 for reverse reads.
+# 'pos' is the 5' end of the mate, 'middle' the position hicBuildMatrix uses to assign
+# the mate to a bin and 'frag' the id of the bin / restriction fragment of the hicBuildMatrix run.
+PAIRS_COLUMNS = [('chrom', np.int32),
+                 ('pos', np.int32),
+                 ('middle', np.int32),
+                 ('strand', np.int8),
+                 ('frag', np.int64),
+                 ('mapq', np.uint8)]
+
+PAIRS_FORMAT = 'hicexplorer-pairs'
+PAIRS_FORMAT_VERSION = 1
+
+
+def pairs_column_names():
+    """
+    >>> pairs_column_names()[:3]
+    ['chrom1', 'pos1', 'middle1']
+    """
+    return [name + mate for mate in ['1', '2'] for name, _ in PAIRS_COLUMNS]
+
+
+class PairsWriter():
+    """
+    Stores valid Hi-C pairs column wise in a HDF5 file. Each column is a
+    compressed and chunked extendable array, pairs can be appended in
+    arbitrary large blocks. If pResumeAt is given, an existing file is
+    opened, truncated to its first pResumeAt pairs and new pairs are
+    appended after them.
+    """
+
+    def __init__(self, pFileName, pChromSizes, pBinIntervals=None, pMetadata=None,
+                 pChunkSize=2**18, pCompressionLevel=5, pResumeAt=None):
+        self.fileName = pFileName
+        self.chromNames = [chrom for chrom, _ in pChromSizes]
+        self.chromIndex = {chrom: i for i, chrom in enumerate(self.chromNames)}
+        if pResumeAt is not None:
+            self.file = tables.open_file(pFileName, mode='a')
+            self.columns = {name: getattr(self.file.root, name) for name in pairs_column_names()}
+            for column in self.columns.values():
+                column.truncate(pResumeAt)
+            self.numberOfPairs = pResumeAt
+            return
+        self.file = tables.open_file(pFileName, mode='w', title=PAIRS_FORMAT)
+        filters = tables.Filters(complevel=pCompressionLevel, complib='blosc', shuffle=True)
+        self.columns = {}
+        for mate in ['1', '2']:
+            for name, dtype in PAIRS_COLUMNS:
+                self.columns[name + mate] = self.file.create_earray(self.file.root, name + mate,
+                                                                    atom=tables.Atom.from_dtype(np.dtype(dtype)),
+                                                                    shape=(0,), filters=filters,
+                                                                    chunkshape=(pChunkSize,))
+        self.file.create_array(self.file.root, 'chrom_names', np.array(self.chromNames, dtype='S'))
+        self.file.create_array(self.file.root, 'chrom_sizes', np.array([size for _, size in pChromSizes], dtype=np.int64))
+        if pBinIntervals is not None and len(pBinIntervals) > 0:
+            chrom, start, end = list(zip(*[interval[:3] for interval in pBinIntervals]))
+            self.file.create_array(self.file.root, 'bins_chrom', np.array([self.chromIndex[name] for name in chrom], dtype=np.int32))
+            self.file.create_array(self.file.root, 'bins_start', np.array(start, dtype=np.int64))
+            self.file.create_array(self.file.root, 'bins_end', np.array(end, dtype=np.int64))
+        self.file.root._v_attrs.format = PAIRS_FORMAT
+        self.file.root._v_attrs.format_version = PAIRS_FORMAT_VERSION
+        if pMetadata:
+            for key, value in pMetadata.items():
+                self.file.root._v_attrs[key] = value
+        self.numberOfPairs = 0
+
+    def append(self, pColumns):
+        """Appends a block of pairs, pColumns is a dict with an array for each column."""
+        length = len(pColumns['chrom1'])
+        if length == 0:
+            return
+        for name, dtype in PAIRS_COLUMNS:
+            for mate in ['1', '2']:
+                self.columns[name + mate].append(np.asarray(pColumns[name + mate], dtype=dtype))
+        self.numberOfPairs += length
+
+    def flush(self):
+        """Writes all appended pairs to disk."""
+        self.file.flush()
+
+    def close(self):
+        self.file.root._v_attrs.number_of_pairs = self.numberOfPairs
+        self.file.close()
+
+
+class PairsReader():
+    """
+    Reads a valid pairs file written by PairsWriter. The pairs can be read in
+    blocks, e.g. by different processes, without loading the full file.
+    """
+
+    def __init__(self, pFileName):
+        self.fileName = pFileName
+        self.file = tables.open_file(pFileName, mode='r')
+        if getattr(self.file.root._v_attrs, 'format', None) != PAIRS_FORMAT:
+            self.file.close()
+            raise ValueError("{} is not a valid pairs file created by hicBuildMatrix --outPairs".format(pFileName))
+        self.chromNames = [name.decode('utf-8') for name in self.file.root.chrom_names.read()]
+        self.chromSizes = list(zip(self.chromNames, self.file.root.chrom_sizes.read().tolist()))
+
+    def __len__(self):
+        return self.file.root.chrom1.nrows
+
+    def metadata(self):
+        attributes = self.file.root._v_attrs
+        return {name: attributes[name] for name in attributes._v_attrnamesuser}
+
+    def bin_intervals(self):
+        """Returns the bins / restriction fragments of the hicBuildMatrix run the pairs were created with."""
+        if 'bins_chrom' not in self.file.root:
+            return None
+        return list(zip([self.chromNames[chrom] for chrom in self.file.root.bins_chrom.read()],
+                        self.file.root.bins_start.read().tolist(),
+                        self.file.root.bins_end.read().tolist()))
+
+    def read(self, pStart=0, pEnd=None, pColumns=None):
+        """Returns a dict with the requested columns for the pairs pStart to pEnd."""
+        if pEnd is None:
+            pEnd = len(self)
+        if pColumns is None:
+            pColumns = pairs_column_names()
+        return {name: getattr(self.file.root, name)[pStart:pEnd] for name in pColumns}
+
+    def chunks(self, pChunkSize):
+        """Returns (start, end) tuples which cover all pairs."""
+        return [(start, min(start + pChunkSize, len(self))) for start in range(0, len(self), pChunkSize)]
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,65 @@
+import os.path
+from tempfile import NamedTemporaryFile
+import numpy as np
+import numpy.testing as nt
+from scipy.sparse import csr_matrix, triu
+
+from hicmatrix import HiCMatrix as hm
+from hicexplorer.lib.bandedMatrix import load_banded_matrix
+
+ROOT = os.path.join(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))), "test_data/")
+
+
+def assert_band_equal(pFullMatrix, pBandedMatrix, pSkipNanBins, pMaxDistance):
+    """
+    The banded matrix has the pixels of the full matrix up to the distance in bins that
+    pMaxDistance has in the full matrix, masked with maskBins(nan_bins) for
+    pSkipNanBins, and no pixels beyond the band.
+    """
+    assert [interval[:3] for interval in pBandedMatrix.cut_intervals] == [interval[:3] for interval in pFullMatrix.cut_intervals]
+    nt.assert_equal(np.sort(pBandedMatrix.nan_bins), np.sort(pFullMatrix.nan_bins))
+    if pSkipNanBins:
+        pFullMatrix.maskBins(pFullMatrix.nan_bins)
+        pBandedMatrix.maskBins(pBandedMatrix.nan_bins)
+    band = int(np.ceil(float(pMaxDistance) / pFullMatrix.getBinSize()))
+
+    full = triu(pFullMatrix.matrix, format='csr') - triu(pFullMatrix.matrix, k=band + 1, format='csr')
+    full = full + triu(full, k=1).T
+    banded = pBandedMatrix.matrix
+    full.eliminate_zeros()
+    banded.eliminate_zeros()
+    assert (abs(full - banded) > 1e-10 * abs(full).max()).nnz == 0
+    rows, columns = banded.nonzero()
+    assert np.abs(rows - columns).max() <= band
+
+
+def test_load_banded_matrix():
+    for matrix in ['small_test_matrix.h5', 'small_test_matrix.cool']:
+        for skip_nan_bins in [False, True]:
+            for max_distance in [20000, 100000]:
+                banded = load_banded_matrix(ROOT + matrix, max_distance, pSkipNanBins=skip_nan_bins, pChunkSize=1000)
+                assert_band_equal(hm.hiCMatrix(ROOT + matrix), banded, skip_nan_bins, max_distance)
+
+    banded = load_banded_matrix(ROOT + 'small_test_matrix.cool', 50000, pSkipNanBins=True, pChromosome='chr3L')
+    assert_band_equal(hm.hiCMatrix(ROOT + 'small_test_matrix.cool', pChrnameList=['chr3L']), banded, True, 50000)
+
+
+def test_load_banded_matrix_masked_bin_size():
+    # bins of 1 kb, followed by masked bins of 5 kb: the bin size of all bins is 5 kb, the one of
+    # the masked matrix 1 kb, the band is computed with the bin size of the masked matrix
+    cut_intervals = [('chr1', start, start + 1000, 1) for start in range(0, 20000, 1000)]
+    cut_intervals += [('chr1', start, start + 5000, 1) for start in range(20000, 170000, 5000)]
+    size = len(cut_intervals)
+    random = np.random.RandomState(0)
+    values = random.randint(1, 10, (size, size)).astype(float)
+    hic_ma = hm.hiCMatrix()
+    hic_ma.setMatrix(csr_matrix(triu(values)), cut_intervals)
+    hic_ma.nan_bins = np.arange(20, 50)
+    matrix_file = NamedTemporaryFile(suffix='.h5', delete=False)
+    matrix_file.close()
+    hic_ma.save(matrix_file.name)
+
+    banded = load_banded_matrix(matrix_file.name, 10000, pSkipNanBins=True)
+    assert_band_equal(hm.hiCMatrix(matrix_file.name), banded, True, 10000)
+    os.unlink(matrix_file.name)
@@ -6,6 +6,10 @@ from hicmatrix import HiCMatrix as hm
 from tempfile import NamedTemporaryFile
 import os
 import numpy.testing as nt
+import cooler
+import tables
+import json
+import shutil
 from matplotlib.testing.compare import compare_images
 
 
@@ -26,7 +30,7 @@ def test_correct_matrix_ICE():
     test = hm.hiCMatrix(
         ROOT + "hicCorrectMatrix/small_test_matrix_ICEcorrected_chrUextra_chr3LHet.h5")
     new = hm.hiCMatrix(outfile.name)
-    nt.assert_equal(test.matrix.data, new.matrix.data)
+    nt.assert_almost_equal(test.matrix.data, new.matrix.data, decimal=10)
     nt.assert_equal(test.cut_intervals, new.cut_intervals)
 
     os.unlink(outfile.name)
@@ -100,3 +104,158 @@ def test_correct_matrix_diagnostic_plot():
                          '/diagnostic_plot.png', outfile.name, tol=40)
     assert res is None, res
     os.remove(outfile.name)
+
+
+def test_correct_matrix_ICE_threads_float32():
+    outfile = NamedTemporaryFile(suffix='.ICE.h5', delete=False)
+    outfile.close()
+
+    args = "correct --matrix {} --correctionMethod ICE --chromosomes "\
+           "chrUextra chr3LHet --iterNum 500  --outFileName {} "\
+           "--filterThreshold -1.5 5.0 --threads 2 --precision float32".format(ROOT + "small_test_matrix.h5",
+                                                                               outfile.name).split()
+    hicCorrectMatrix.main(args)
+
+    test = hm.hiCMatrix(
+        ROOT + "hicCorrectMatrix/small_test_matrix_ICEcorrected_chrUextra_chr3LHet.h5")
+    new = hm.hiCMatrix(outfile.name)
+    nt.assert_allclose(test.matrix.data, new.matrix.data, rtol=1e-5)
+    nt.assert_equal(test.cut_intervals, new.cut_intervals)
+
+    os.unlink(outfile.name)
+
+
+def test_correct_matrix_ICE_perchr_threads():
+    outfile_serial = NamedTemporaryFile(suffix='.ICE.h5', delete=False)
+    outfile_serial.close()
+    outfile_parallel = NamedTemporaryFile(suffix='.ICE.h5', delete=False)
+    outfile_parallel.close()
+
+    for outfile, threads in [(outfile_serial, 1), (outfile_parallel, 2)]:
+        args = "correct --matrix {} --correctionMethod ICE --chromosomes "\
+               "chr2L chr2R chr3L chr3R --perchr --outFileName {} "\
+               "--filterThreshold -1.5 5.0 --threads {}".format(ROOT + "small_test_matrix_50kb_res.h5",
+                                                                outfile.name, threads).split()
+        hicCorrectMatrix.main(args)
+
+    serial = hm.hiCMatrix(outfile_serial.name)
+    parallel = hm.hiCMatrix(outfile_parallel.name)
+    nt.assert_equal(serial.matrix.indptr, parallel.matrix.indptr)
+    nt.assert_equal(serial.matrix.indices, parallel.matrix.indices)
+    nt.assert_equal(serial.matrix.data, parallel.matrix.data)
+    nt.assert_equal(serial.cut_intervals, parallel.cut_intervals)
+
+    # the chromosomes are corrected independently, no inter chromosomal counts are left
+    start, end = parallel.getChrBinRange('chr2L')
+    assert parallel.matrix[start:end, :start].nnz == 0
+    assert parallel.matrix[start:end, end:].nnz == 0
+
+    os.unlink(outfile_serial.name)
+    os.unlink(outfile_parallel.name)
+
+
+def test_correct_matrix_ICE_out_of_core():
+    outfile_in_memory = NamedTemporaryFile(suffix='.cool', delete=False)
+    outfile_in_memory.close()
+    outfile = NamedTemporaryFile(suffix='.cool', delete=False)
+    outfile.close()
+    outfile_in_place = NamedTemporaryFile(suffix='.cool', delete=False)
+    outfile_in_place.close()
+    shutil.copyfile(ROOT + "small_test_matrix.cool", outfile_in_place.name)
+
+    args = "correct --matrix {} --correctionMethod ICE --outFileName {} "\
+           "--filterThreshold -1.5 5.0 --iterNum 5".format(ROOT + "small_test_matrix.cool",
+                                                           outfile_in_memory.name).split()
+    hicCorrectMatrix.main(args)
+    # a budget of 3 MB splits the pixels in three chunks
+    args = "correct --matrix {} --correctionMethod ICE --outFileName {} --filterThreshold -1.5 5.0 "\
+           "--iterNum 5 --outOfCore --memoryBudget 3".format(ROOT + "small_test_matrix.cool", outfile.name).split()
+    hicCorrectMatrix.main(args)
+    args = "correct --matrix {} --correctionMethod ICE --outFileName {} --filterThreshold -1.5 5.0 "\
+           "--iterNum 5 --outOfCore --memoryBudget 3".format(outfile_in_place.name, outfile_in_place.name).split()
+    hicCorrectMatrix.main(args)
+
+    # the same corrected pixels and weights as the in memory correction
+    test = cooler.Cooler(outfile_in_memory.name)
+    for new in [cooler.Cooler(outfile.name), cooler.Cooler(outfile_in_place.name)]:
+        nt.assert_equal(test.pixels()[['bin1_id', 'bin2_id']][:].values, new.pixels()[['bin1_id', 'bin2_id']][:].values)
+        assert new.pixels()[:]['count'].dtype == test.pixels()[:]['count'].dtype
+        nt.assert_allclose(test.pixels()['count'][:].values, new.pixels()['count'][:].values, rtol=1e-10)
+        nt.assert_allclose(test.bins()['weight'][:].values, new.bins()['weight'][:].values, rtol=1e-10)
+        assert new.info['metadata']['correction_report']['method'] == 'ICE'
+
+    os.unlink(outfile_in_memory.name)
+    os.unlink(outfile.name)
+    os.unlink(outfile_in_place.name)
+
+
+def test_correct_matrix_ICE_initial_bias():
+    outfile_first = NamedTemporaryFile(suffix='.ICE.h5', delete=False)
+    outfile_first.close()
+    outfile = NamedTemporaryFile(suffix='.ICE.h5', delete=False)
+    outfile.close()
+
+    args = "correct --matrix {} --correctionMethod ICE --chromosomes "\
+           "chr2L chr2R chr3L chr3R --outFileName {} "\
+           "--filterThreshold -1.5 5.0".format(ROOT + "small_test_matrix_50kb_res.h5", outfile_first.name)
+    hicCorrectMatrix.main(args.split())
+    # the correction factors of the same correction are already the result
+    hicCorrectMatrix.main(args.replace(outfile_first.name, outfile.name).split() + ['--initialBias', outfile_first.name])
+
+    test = hm.hiCMatrix(outfile_first.name)
+    new = hm.hiCMatrix(outfile.name)
+    nt.assert_allclose(test.matrix.data, new.matrix.data, rtol=1e-4)
+    nt.assert_equal(test.cut_intervals, new.cut_intervals)
+
+    with tables.open_file(outfile_first.name) as h5_file:
+        report_first = json.loads(h5_file.root._v_attrs.correction_report)
+    with tables.open_file(outfile.name) as h5_file:
+        report = json.loads(h5_file.root._v_attrs.correction_report)
+    assert report['method'] == 'ICE'
+    assert report_first['converged'] and report['converged']
+    assert report['iterations'] <= 2 < report_first['iterations']
+    assert len(report['residuals']) == report['iterations']
+
+    os.unlink(outfile_first.name)
+    os.unlink(outfile.name)
+
+
+def test_correct_matrix_cache_marginals(monkeypatch):
+    matrix = NamedTemporaryFile(suffix='.h5', delete=False)
+    matrix.close()
+    shutil.copyfile(ROOT + "small_test_matrix.h5", matrix.name)
+    plot = NamedTemporaryFile(suffix='.png', prefix='hicexplorer_test', delete=False)
+    plot.close()
+    outfile = NamedTemporaryFile(suffix='.ICE.h5', delete=False)
+    outfile.close()
+
+    args = "diagnostic_plot --matrix {} --chromosomes chrUextra chr3LHet " \
+        " --plotName {} --cacheMarginals".format(matrix.name, plot.name).split()
+    hicCorrectMatrix.main(args)
+    assert os.path.exists(matrix.name + '.marginals.npz')
+
+    # the second plot and the correction use the cached marginals, the plot does not load the matrix
+    os.remove(plot.name)
+
+    def load_matrix(*args, **kwargs):
+        raise AssertionError('the matrix is loaded')
+
+    with monkeypatch.context() as context:
+        context.setattr(hm, 'hiCMatrix', load_matrix)
+        hicCorrectMatrix.main(args)
+    res = compare_images(ROOT + "hicCorrectMatrix/diagnostic_plot.png", plot.name, tol=40)
+    assert res is None, res
+
+    args = "correct --matrix {} --correctionMethod ICE --chromosomes "\
+           "chrUextra chr3LHet --iterNum 500  --outFileName {} "\
+           "--filterThreshold -1.5 5.0 --cacheMarginals".format(matrix.name, outfile.name).split()
+    hicCorrectMatrix.main(args)
+
+    test = hm.hiCMatrix(
+        ROOT + "hicCorrectMatrix/small_test_matrix_ICEcorrected_chrUextra_chr3LHet.h5")
+    new = hm.hiCMatrix(outfile.name)
+    nt.assert_almost_equal(test.matrix.data, new.matrix.data, decimal=10)
+    nt.assert_equal(test.cut_intervals, new.cut_intervals)
+
+    for file_name in [matrix.name, matrix.name + '.marginals.npz', plot.name, outfile.name]:
+        os.unlink(file_name)
@@ -4,6 +4,9 @@ from psutil import virtual_memory
 import logging
 log = logging.getLogger(__name__)
 
+import numpy as np
+from scipy.sparse import csr_matrix
+
 from hicexplorer import hicDetectLoops
 
 mem = virtual_memory()
@@ -56,3 +59,20 @@ def test_main_cool_chromosomes():
     hicDetectLoops.main(args)
     assert are_files_equal(
         ROOT + "hicDetectLoops/loops.bedgraph", outfile_loop_cool.name, delta=0)
+
+
+def test_get_neighborhoods():
+    matrix = csr_matrix(np.arange(1, 37).reshape(6, 6) * (np.arange(36).reshape(6, 6) % 4 != 0))
+    rows = np.array([0, 2, -1, 4])
+    columns = np.array([1, 2, 3, 5])
+    neighborhoods = hicDetectLoops.get_neighborhoods(matrix, rows, columns, 3, pFillValue=-1)
+    dense = np.pad(matrix.toarray(), 3, constant_values=-1)
+    for i in range(len(rows)):
+        assert np.array_equal(neighborhoods[i], dense[rows[i] + 3:rows[i] + 6, columns[i] + 3:columns[i] + 6])
+
+    smoothed = hicDetectLoops.smooth_neighborhoods(neighborhoods[:, :2, :].astype(np.float64))
+    for i in range(len(rows)):
+        expected = neighborhoods[i, :2, :].astype(np.float64)
+        expected = np.array([[row[max(0, j - 2):j + 3].mean() for j in range(3)] for row in expected])
+        expected = np.array([[column[max(0, j - 2):j + 3].mean() for j in range(2)] for column in expected.T]).T
+        assert np.array_equal(smoothed[i], expected)
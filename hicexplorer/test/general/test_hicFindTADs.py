@@ -7,6 +7,7 @@ from tempfile import mkdtemp
 import shutil
 import os
 import numpy.testing as nt
+import numpy as np
 
 
 ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_data/")
@@ -42,10 +43,10 @@ def test_find_TADs_fdr():
     nt.assert_equal(test.cut_intervals, new.cut_intervals)
 
     print(tad_folder + "/test_multiFDR_boundaries.bed")
-    assert are_files_equal(ROOT + "find_TADs/FDR/multiFDR_boundaries.bed", tad_folder + "/test_multiFDR_boundaries.bed")
-    assert are_files_equal(ROOT + "find_TADs/FDR/multiFDR_domains.bed", tad_folder + "/test_multiFDR_domains.bed")
-    assert are_files_equal(ROOT + "find_TADs/FDR/multiFDR_tad_score.bm", tad_folder + "/test_multiFDR_tad_score.bm")
-    assert are_files_equal(ROOT + "find_TADs/FDR/multiFDR_boundaries.gff", tad_folder + "/test_multiFDR_boundaries.gff")
+    assert are_files_equal(ROOT + "find_TADs/FDR/multiFDR_boundaries.bed", tad_folder + "/test_multiFDR_boundaries.bed", pDifference=0)
+    assert are_files_equal(ROOT + "find_TADs/FDR/multiFDR_domains.bed", tad_folder + "/test_multiFDR_domains.bed", pDifference=0)
+    assert are_files_equal(ROOT + "find_TADs/FDR/multiFDR_tad_score.bm", tad_folder + "/test_multiFDR_tad_score.bm", pDifference=0)
+    assert are_files_equal(ROOT + "find_TADs/FDR/multiFDR_boundaries.gff", tad_folder + "/test_multiFDR_boundaries.gff", pDifference=0)
     # assert are_files_equal
     assert are_files_equal(ROOT + "find_TADs/FDR/multiFDR_score.bedgraph", tad_folder + "/test_multiFDR_score.bedgraph")
 
@@ -117,3 +118,151 @@ def test_find_TADs_none():
     assert are_files_equal(ROOT + "find_TADs/None/multiNone_score.bedgraph", tad_folder + "/test_multiNone_score.bedgraph")
 
     shutil.rmtree(tad_folder)
+
+
+def test_get_cut_weights():
+    # the vectorised diamond means are the same as the ones of get_cut_weight, bit by bit
+    hic_ma = hm.hiCMatrix(ROOT + 'find_TADs/FDR/multiFDR_zscore_matrix.h5')
+    window_lens = hicFindTADs.get_incremental_step_size(60000, 180000, 20000)
+    cuts = np.concatenate([np.arange(0, 300), np.arange(hic_ma.matrix.shape[0] - 300, hic_ma.matrix.shape[0])])
+
+    expected = np.array([[get_cut_weight_or_nan(hic_ma, cut, window_len) for window_len in window_lens]
+                         for cut in cuts])
+    for chunk_size in [100, 2**22]:
+        weights = hicFindTADs.get_cut_weights(hic_ma, cuts, window_lens, chunk_size=chunk_size)
+        nt.assert_array_equal(weights, expected)
+
+
+def get_cut_weight_or_nan(pHiCMatrix, pCut, pWindowLen):
+    weight = hicFindTADs.get_cut_weight(pHiCMatrix, pCut, pWindowLen, return_mean=True)
+    return np.nan if weight is None else weight
+
+
+def test_ranksums_pvalues():
+    from scipy.stats import ranksums
+    # samples with ties and empty samples
+    random = np.random.RandomState(0)
+    x_sizes = random.randint(0, 30, 50)
+    y_sizes = random.randint(0, 30, 50)
+    x_values = random.randint(0, 10, x_sizes.sum()).astype(float)
+    y_values = random.randint(0, 10, y_sizes.sum()).astype(float)
+
+    pvalues = hicFindTADs.ranksums_pvalues(x_values, x_sizes, y_values, y_sizes)
+    x_samples = np.split(x_values, np.cumsum(x_sizes)[:-1])
+    y_samples = np.split(y_values, np.cumsum(y_sizes)[:-1])
+    for pvalue, x, y in zip(pvalues, x_samples, y_samples):
+        if len(x) == 0 or len(y) == 0:
+            assert np.isnan(pvalue)
+        else:
+            nt.assert_allclose(pvalue, ranksums(x, y)[1], rtol=1e-12)
+
+
+def test_find_TADs_tad_score_h5():
+    matrix = ROOT + "small_test_matrix.h5"
+    tad_folder = mkdtemp(prefix="test_case_find_tads_h5")
+    args = "--matrix {} --minDepth 60000 --maxDepth 180000 --numberOfProcessors 2 --step 20000 \
+    --outPrefix {}/test_multiFDR --minBoundaryDistance 20000 --tadScoreFormat both \
+    --correctForMultipleTesting fdr --thresholdComparisons 0.1".format(matrix, tad_folder).split()
+
+    hicFindTADs.main(args)
+    assert are_files_equal(ROOT + "find_TADs/FDR/multiFDR_tad_score.bm", tad_folder + "/test_multiFDR_tad_score.bm")
+
+    text = hicFindTADs.HicFindTads(tad_folder + "/test_multiFDR_zscore_matrix.h5")
+    text.load_bedgraph_matrix(tad_folder + "/test_multiFDR_tad_score.bm")
+    binary = hicFindTADs.HicFindTads(tad_folder + "/test_multiFDR_zscore_matrix.h5")
+    binary.load_tad_score(tad_folder + "/test_multiFDR_tad_score.h5")
+    for name in ['chrom', 'chr_start', 'chr_end']:
+        nt.assert_equal(binary.bedgraph_matrix[name], text.bedgraph_matrix[name])
+    nt.assert_allclose(binary.bedgraph_matrix['matrix'], text.bedgraph_matrix['matrix'], atol=1e-6)
+    assert (binary.min_depth, binary.max_depth, binary.step) == (text.min_depth, text.max_depth, text.step)
+
+    # only the rows of the given chromosomes are loaded
+    binary.load_tad_score(tad_folder + "/test_multiFDR_tad_score.h5", ['chr3R', 'chr2L'])
+    keep = np.isin(text.bedgraph_matrix['chrom'], ['chr3R', 'chr2L'])
+    nt.assert_equal(binary.bedgraph_matrix['chr_start'], text.bedgraph_matrix['chr_start'][keep])
+    nt.assert_allclose(binary.bedgraph_matrix['matrix'], text.bedgraph_matrix['matrix'][keep], atol=1e-6)
+
+    shutil.rmtree(tad_folder)
+
+
+def peakdetect_loop(pSignal, pLookahead, pDelta, pChrom):
+    # element wise look ahead peak detection, the first peak found is dropped
+    peaks = []
+    search_for = None
+    for index in range(len(pSignal) - pLookahead):
+        if index == 0 or pChrom[index] != pChrom[index - 1]:
+            min_pos, max_pos = index, index
+            search_for = None
+        if pSignal[index] > pSignal[max_pos]:
+            max_pos = index
+        if pSignal[index] < pSignal[min_pos]:
+            min_pos = index
+        ahead = pSignal[index:index + pLookahead]
+        if search_for != 'min' and pSignal[index] < pSignal[max_pos] - pDelta and ahead.max() < pSignal[max_pos]:
+            peaks.append((True, max_pos))
+            min_pos, search_for = index, 'min'
+        elif search_for != 'max' and pSignal[index] > pSignal[min_pos] + pDelta and ahead.min() > pSignal[min_pos]:
+            peaks.append((False, min_pos))
+            max_pos, search_for = index, 'max'
+    return [[[pos, pSignal[pos]] for is_max, pos in peaks[1:] if is_max == find_max] for find_max in [True, False]]
+
+
+def test_peakdetect():
+    random = np.random.RandomState(0)
+    for delta in [0, 0.5]:
+        # signal with ties on several chromosomes
+        signal = np.round(np.cumsum(random.normal(size=500)), 1)
+        chrom = np.repeat(['chr1', 'chr2', 'chr3'], [200, 50, 250])
+        for lookahead in [1, 3, 10]:
+            peaks = hicFindTADs.HicFindTads.peakdetect(signal, lookahead=lookahead, delta=delta, chrom=chrom)
+            assert peaks == peakdetect_loop(signal, lookahead, delta, chrom)
+
+
+def test_delta_wrt_window():
+    random = np.random.RandomState(0)
+    signal = random.normal(size=100)
+    chrom = np.repeat(['chr1', 'chr2'], [60, 40])
+    delta = hicFindTADs.HicFindTads.delta_wrt_window([5, 30, 55, 65, 80], signal, chrom)
+    assert list(delta) == [5, 30, 55, 65, 80]
+    assert np.isnan([delta[5], delta[55], delta[65]]).all()
+    for min_idx in [30, 80]:
+        local_tad_score = np.concatenate([signal[min_idx - 10:min_idx + 3], signal[min_idx + 4:min_idx + 10]])
+        nt.assert_equal(delta[min_idx], local_tad_score.mean() - signal[min_idx])
+
+
+def test_find_TADs_sweep():
+    matrix = ROOT + "small_test_matrix.h5"
+    tad_folder = mkdtemp(prefix="test_case_find_tads_sweep")
+    args = "--matrix {} --minDepth 60000 --maxDepth 180000 --numberOfProcessors 2 --step 20000 \
+    --outPrefix {}/test_multiFDR --correctForMultipleTesting fdr --sweepDelta 0.01 0.05 \
+    --sweepThresholdComparisons 0.1 0.01 --sweepMinBoundaryDistance 20000 40000".format(matrix, tad_folder).split()
+
+    hicFindTADs.main(args)
+    assert are_files_equal(ROOT + "find_TADs/FDR/multiFDR_tad_score.bm", tad_folder + "/test_multiFDR_tad_score.bm")
+
+    # the combination of test_find_TADs_fdr gives the same boundaries
+    prefix = tad_folder + "/test_multiFDR_delta0.01_threshold0.1_minBoundaryDistance20000"
+    assert are_files_equal(ROOT + "find_TADs/FDR/multiFDR_boundaries.bed", prefix + "_boundaries.bed")
+    assert are_files_equal(ROOT + "find_TADs/FDR/multiFDR_domains.bed", prefix + "_domains.bed")
+    assert are_files_equal(ROOT + "find_TADs/FDR/multiFDR_boundaries.gff", prefix + "_boundaries.gff")
+
+    summary = np.genfromtxt(tad_folder + "/test_multiFDR_sweep_summary.tsv", dtype=None, encoding='utf-8')
+    assert len(summary) == 8
+    for delta, threshold, min_boundary_distance, lookahead, number_of_boundaries, prefix in summary:
+        assert lookahead == min_boundary_distance // 5000
+        with open(prefix + "_boundaries.gff") as gff:
+            # boundaries at the end of a chromosome are not saved
+            assert sum(1 for _ in gff) <= number_of_boundaries
+    # more conservative parameters call fewer boundaries
+    for column in [0, 1, 2]:
+        number_of_boundaries = {}
+        for row in summary:
+            number_of_boundaries.setdefault(tuple(row[i] for i in [0, 1, 2] if i != column), []).append((row[column], row[4]))
+        for counts in number_of_boundaries.values():
+            counts = [count for _, count in sorted(counts)]
+            if column == 1:
+                assert counts == sorted(counts)
+            else:
+                assert counts == sorted(counts, reverse=True)
+
+    shutil.rmtree(tad_folder)
@@ -6,6 +6,7 @@ from hicmatrix import HiCMatrix as hm
 from tempfile import NamedTemporaryFile
 import os
 import numpy.testing as nt
+from scipy.sparse import triu
 
 
 ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_data/")
@@ -26,3 +27,18 @@ def test_correct_matrix():
     nt.assert_equal(test.cut_intervals, new.cut_intervals)
 
     os.unlink(outfile.name)
+
+
+def test_merge_bins_in_chunks():
+    hic = hm.hiCMatrix(ROOT + "small_test_matrix.h5")
+    hic = hicMergeMatrixBins.remove_nans_if_needed(hic)
+    merged_matrices = list(hicMergeMatrixBins.merge_bins_in_chunks(triu(hic.matrix, format='csr'),
+                                                                   hic.cut_intervals, [5, 2], chunk_size=1000))
+
+    test = hm.hiCMatrix(ROOT + "hicMergeMatrixBins/result.h5")
+    nt.assert_equal(test.matrix.data, merged_matrices[0].matrix.data)
+    nt.assert_equal(test.cut_intervals, merged_matrices[0].cut_intervals)
+
+    expected = hicMergeMatrixBins.merge_bins(hic, 2)
+    nt.assert_equal(expected.matrix.toarray(), merged_matrices[1].matrix.toarray())
+    nt.assert_equal(expected.cut_intervals, merged_matrices[1].cut_intervals)
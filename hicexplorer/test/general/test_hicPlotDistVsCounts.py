@@ -8,6 +8,7 @@ import os
 import matplotlib as mpl
 mpl.use('agg')
 import os.path
+import shutil
 import pytest
 
 
@@ -61,3 +62,26 @@ def test_trivial_run(matrices, plotFile, labels, plotsize1, plotsize2, perchr, o
     ).split()
 
     hicPlotDistVsCounts.main(args)
+
+
+def test_cache_expected(tmpdir):
+    """
+        The second run uses the mean contacts per distance stored by the first one.
+    """
+    matrix_copy = str(tmpdir.join('matrix.h5'))
+    shutil.copy(matrix, matrix_copy)
+    data_files = [str(tmpdir.join('data_{}.txt'.format(run))) for run in range(3)]
+    for data_file in data_files[:2]:
+        args = "--matrices {} --plotFile {} --outFileData {} --labels matrix --perchr --maxdepth 2000000 --cacheExpected".format(
+            matrix_copy, str(tmpdir.join('plot.png')), data_file).split()
+        hicPlotDistVsCounts.main(args)
+        assert os.path.exists(matrix_copy + '.expected.npz')
+    args = "--matrices {} --plotFile {} --outFileData {} --labels matrix --perchr --maxdepth 2000000".format(
+        matrix, str(tmpdir.join('plot.png')), data_files[2]).split()
+    hicPlotDistVsCounts.main(args)
+
+    with open(data_files[2]) as reference:
+        reference = reference.read()
+    for data_file in data_files[:2]:
+        with open(data_file) as data:
+            assert data.read() == reference
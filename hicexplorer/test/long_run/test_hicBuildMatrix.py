@@ -1,11 +1,14 @@
 import warnings
 warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
-from hicexplorer import hicBuildMatrix, hicInfo
+from hicexplorer import hicBuildMatrix, hicInfo, hicBinPairs
+from hicexplorer.lib.pairs import PairsReader
+from hicexplorer.lib.checkpoint import Checkpoint
 from hicmatrix import HiCMatrix as hm
 from tempfile import NamedTemporaryFile, mkdtemp
 import shutil
 import os
+import numpy as np
 import numpy.testing as nt
 
 
@@ -214,3 +217,161 @@ def test_build_matrix_rf():
 
     os.unlink(outfile.name)
     shutil.rmtree(qc_folder)
+
+
+def test_duplicate_index_backends():
+    # identical duplicates for the set of strings and both hashed indices
+    np.random.seed(42)
+    size = 50000
+    ref_id1 = np.random.randint(0, 4, size)
+    ref_id2 = np.random.randint(0, 4, size)
+    start1 = np.random.randint(0, 2000, size)
+    start2 = np.random.randint(0, 2000, size)
+
+    read_position_matrix = hicBuildMatrix.ReadPositionMatrix()
+    expected = [read_position_matrix.is_duplicated(str(chrom1), pos1, str(chrom2), pos2)
+                for chrom1, pos1, chrom2, pos2 in zip(ref_id1, start1, ref_id2, start2)]
+    assert sum(expected) > 0
+
+    for read_position_index in [hicBuildMatrix.ReadPositionIndex(pCapacity=16),
+                                hicBuildMatrix.ReadPositionIndexPartitioned(),
+                                hicBuildMatrix.ReadPositionIndexPartitioned(pMaxMemory=0)]:
+        duplicated = []
+        for i in range(0, size, 3000):
+            duplicated.extend(read_position_index.are_duplicated(ref_id1[i:i + 3000], start1[i:i + 3000],
+                                                                 ref_id2[i:i + 3000], start2[i:i + 3000]))
+        nt.assert_equal(duplicated, expected)
+        assert len(read_position_index) == size - sum(expected)
+        read_position_index.close()
+
+
+def test_build_matrix_duplicate_index():
+    bam_R1 = ROOT + "R1_1000.bam"
+    bam_R2 = ROOT + "R2_1000.bam"
+    matrices = []
+    qc_folders = []
+    for duplicate_index in ['set', 'hashed', 'partitioned']:
+        outfile = NamedTemporaryFile(suffix='.h5', delete=False)
+        outfile.close()
+        qc_folder = mkdtemp(prefix="testQC_")
+        args = "-s {} {} --outFileName {} -bs 50000 --QCfolder {} --threads 3 " \
+               "--inputBufferSize 200 --duplicateIndex {} " \
+               "--duplicateIndexMaxMemory 0".format(bam_R1, bam_R2, outfile.name,
+                                                    qc_folder, duplicate_index).split()
+        hicBuildMatrix.main(args)
+        matrices.append(hm.hiCMatrix(outfile.name))
+        qc_folders.append(qc_folder)
+        os.unlink(outfile.name)
+
+    for matrix, qc_folder in zip(matrices[1:], qc_folders[1:]):
+        nt.assert_equal(matrices[0].matrix.todense(), matrix.matrix.todense())
+        nt.assert_equal(matrices[0].cut_intervals, matrix.cut_intervals)
+        assert are_files_equal(qc_folders[0] + "/QC.log", qc_folder + "/QC.log")
+
+    for qc_folder in qc_folders:
+        shutil.rmtree(qc_folder)
+
+
+def test_build_matrix_parallel_reading():
+    bam_R1 = ROOT + "R1_1000.bam"
+    bam_R2 = ROOT + "R2_1000.bam"
+    matrices = []
+    qc_folders = []
+    for parallel_reading in ['', '--parallelReading --decompressionThreads 2']:
+        outfile = NamedTemporaryFile(suffix='.h5', delete=False)
+        outfile.close()
+        qc_folder = mkdtemp(prefix="testQC_")
+        args = "-s {} {} --outFileName {} -bs 50000 --QCfolder {} --threads 3 " \
+               "--inputBufferSize 200 {}".format(bam_R1, bam_R2, outfile.name,
+                                                 qc_folder, parallel_reading).split()
+        hicBuildMatrix.main(args)
+        matrices.append(hm.hiCMatrix(outfile.name))
+        qc_folders.append(qc_folder)
+        os.unlink(outfile.name)
+
+    nt.assert_equal(matrices[0].matrix.todense(), matrices[1].matrix.todense())
+    nt.assert_equal(matrices[0].cut_intervals, matrices[1].cut_intervals)
+    assert are_files_equal(qc_folders[0] + "/QC.log", qc_folders[1] + "/QC.log")
+
+    for qc_folder in qc_folders:
+        shutil.rmtree(qc_folder)
+
+
+def test_build_matrix_out_pairs():
+    bam_R1 = ROOT + "R1_1000.bam"
+    bam_R2 = ROOT + "R2_1000.bam"
+    outfile = NamedTemporaryFile(suffix='.h5', delete=False)
+    outfile.close()
+    pairs_file = NamedTemporaryFile(suffix='.h5', delete=False)
+    pairs_file.close()
+    binned_file = NamedTemporaryFile(suffix='.h5', delete=False)
+    binned_file.close()
+    os.unlink(binned_file.name)
+    qc_folder = mkdtemp(prefix="testQC_")
+    args = "-s {} {} --outFileName {} -bs 50000 --QCfolder {} --threads 3 " \
+           "--outPairs {}".format(bam_R1, bam_R2, outfile.name, qc_folder, pairs_file.name).split()
+    hicBuildMatrix.main(args)
+
+    reader = PairsReader(pairs_file.name)
+    number_of_pairs = len(reader)
+    pairs = reader.read()
+    reader.close()
+    test = hm.hiCMatrix(outfile.name)
+    # each pair is counted once in the upper or lower triangle of the matrix
+    assert number_of_pairs == np.triu(test.matrix.todense()).sum()
+    assert np.all(pairs['strand1'] <= 1)
+
+    args = "--pairs {} -o {} -bs 50000 --chunkSize 100 --threads 2".format(pairs_file.name, binned_file.name).split()
+    hicBinPairs.main(args)
+    binned = hm.hiCMatrix(binned_file.name)
+    nt.assert_equal(test.matrix.todense(), binned.matrix.todense())
+    nt.assert_equal([interval[:3] for interval in test.cut_intervals],
+                    [interval[:3] for interval in binned.cut_intervals])
+
+    os.unlink(outfile.name)
+    os.unlink(pairs_file.name)
+    os.unlink(binned_file.name)
+    shutil.rmtree(qc_folder)
+
+
+def test_build_matrix_resume(monkeypatch):
+    bam_R1 = ROOT + "R1_1000.bam"
+    bam_R2 = ROOT + "R2_1000.bam"
+    outfile = NamedTemporaryFile(suffix='.h5', delete=False)
+    outfile.close()
+    outfile_resumed = NamedTemporaryFile(suffix='.h5', delete=False)
+    outfile_resumed.close()
+    qc_folder = mkdtemp(prefix="testQC_")
+    checkpoint_folder = mkdtemp(prefix="testCheckpoint_")
+    args = "-s {} {} -bs 50000 --QCfolder {} --threads 3 --inputBufferSize 50".format(bam_R1, bam_R2, qc_folder).split()
+    hicBuildMatrix.main(args + ['--outFileName', outfile.name])
+
+    # simulate an interrupted run: only the first two checkpoints are kept
+    commit = Checkpoint.commit
+    number_of_commits = []
+
+    def commit_first_two(self, pPath, pState):
+        number_of_commits.append(pPath)
+        if len(number_of_commits) <= 2:
+            commit(self, pPath, pState)
+        else:
+            shutil.rmtree(pPath)
+    monkeypatch.setattr(Checkpoint, 'commit', commit_first_two)
+    monkeypatch.setattr(Checkpoint, 'remove', lambda self: None)
+    checkpoint_args = ['--checkpoint', checkpoint_folder, '--checkpointInterval', '0']
+    hicBuildMatrix.main(args + checkpoint_args + ['--outFileName', outfile_resumed.name])
+    assert len(number_of_commits) > 2
+    _, state = Checkpoint(checkpoint_folder).load()
+    assert 0 < state['counters']['iter_num'] < 1000
+    monkeypatch.undo()
+
+    hicBuildMatrix.main(args + checkpoint_args + ['--resume', '--outFileName', outfile_resumed.name])
+    test = hm.hiCMatrix(outfile.name)
+    resumed = hm.hiCMatrix(outfile_resumed.name)
+    nt.assert_equal(test.matrix.todense(), resumed.matrix.todense())
+    nt.assert_equal(test.cut_intervals, resumed.cut_intervals)
+    assert not os.path.exists(checkpoint_folder)
+
+    os.unlink(outfile.name)
+    os.unlink(outfile_resumed.name)
+    shutil.rmtree(qc_folder)
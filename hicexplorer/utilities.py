@@ -4,6 +4,7 @@ warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 import sys
 import numpy as np
 import argparse
+from multiprocessing.sharedctypes import RawArray
 from matplotlib import use as mplt_use
 mplt_use('Agg')
 from unidecode import unidecode
@@ -13,6 +14,13 @@ import logging
 log = logging.getLogger(__name__)
 
 
+def shared_array(array):
+    """Copies the array to shared memory which is inherited by the worker processes."""
+    shared = RawArray(np.ctypeslib.as_ctypes_type(array.dtype), max(1, len(array)))
+    np.frombuffer(shared, dtype=array.dtype, count=len(array))[:] = array
+    return shared
+
+
 def readBed(pBedFile):
     viewpoints = []
     with open(pBedFile, 'r') as file:
@@ -231,23 +239,50 @@ def getUserRegion(chromSizes, regionString, max_chunk_size=1e6):
     return (chromSizes, regionStart, regionEnd, int(chunkSize))
 
 
+def pixel_distances(pSubmatrix, pStartRow=0, pEndRow=None):
+    """
+    Returns the row and the distance col - row of each value of the rows pStartRow to
+    pEndRow of the csr matrix, in the order of its data.
+
+    >>> from scipy.sparse import csr_matrix
+    >>> pixel_distances(csr_matrix(np.array([[1, 2], [3, 0]])))
+    (array([0, 0, 1]), array([ 0,  1, -1]))
+    """
+    if pEndRow is None:
+        pEndRow = pSubmatrix.shape[0]
+    indptr = pSubmatrix.indptr[pStartRow:pEndRow + 1]
+    rows = np.repeat(np.arange(pStartRow, pEndRow), np.diff(indptr))
+    return rows, pSubmatrix.indices[indptr[0]:indptr[-1]] - rows
+
+
+def row_blocks(pSubmatrix, pChunkSize=2**24):
+    """
+    Borders of blocks of rows of the csr matrix with about pChunkSize values each.
+
+    >>> from scipy.sparse import csr_matrix
+    >>> row_blocks(csr_matrix(np.eye(5)), pChunkSize=2)
+    [(0, 2), (2, 4), (4, 5)]
+    """
+    targets = np.arange(0, pSubmatrix.indptr[-1], max(1, int(pChunkSize)))
+    borders = np.searchsorted(pSubmatrix.indptr, targets, side='right') - 1
+    borders = np.unique(np.concatenate([[0], borders, [pSubmatrix.shape[0]]]))
+    return list(zip(borders[:-1].tolist(), borders[1:].tolist()))
+
+
 def expected_interactions_in_distance(pLength_chromosome, pChromosome_count, pSubmatrix):
     """
         Computes the function I_chrom(s) for a given chromosome.
     """
-    expected_interactions = np.zeros(pSubmatrix.shape[0])
-    row, col = pSubmatrix.nonzero()
-    distance = np.absolute(row - col)
-
-    for i, distance_ in enumerate(distance):
-        expected_interactions[distance_] += pSubmatrix.data[i]
+    pSubmatrix = pSubmatrix.tocsr()
+    distance = np.absolute(pixel_distances(pSubmatrix)[1])
+    expected_interactions = np.bincount(distance, pSubmatrix.data, minlength=pSubmatrix.shape[0]).astype(np.float64)
 
     count_times_i = np.arange(float(len(expected_interactions)))
-    pChromosome_count = np.int(pChromosome_count)
-    pLength_chromosome = np.int(pLength_chromosome)
+    pChromosome_count = int(pChromosome_count)
+    pLength_chromosome = int(pLength_chromosome)
     count_times_i *= pChromosome_count
     count_times_i -= pLength_chromosome
-    count_times_i *= np.int(-1)
+    count_times_i *= -1
 
     expected_interactions /= count_times_i
     # log.debug('exp_obs_matrix_lieberman {}'.format(expected_interactions))
@@ -258,17 +293,15 @@ def expected_interactions_in_distance(pLength_chromosome, pChromosome_count, pSu
 def expected_interactions_non_zero(pSubmatrix):
     """
         Computes the expected number of interactions per distance
-    """
-
-    expected_interactions = np.zeros(pSubmatrix.shape[0])
-    row, col = pSubmatrix.nonzero()
-    distance = np.absolute(row - col)
 
-    occurences = np.zeros(pSubmatrix.shape[0])
-    # data_type = type(pSubmatrix.data[0])
-    for i, distance_ in enumerate(distance):
-        expected_interactions[distance_] += pSubmatrix.data[i]
-        occurences[distance_] += 1
+    >>> from scipy.sparse import csr_matrix
+    >>> expected_interactions_non_zero(csr_matrix(np.array([[1, 2, 0], [2, 3, 4], [0, 4, 0]])))
+    array([2., 3., 0.])
+    """
+    pSubmatrix = pSubmatrix.tocsr()
+    distance = np.absolute(pixel_distances(pSubmatrix)[1])
+    expected_interactions = np.bincount(distance, pSubmatrix.data, minlength=pSubmatrix.shape[0]).astype(np.float64)
+    occurences = np.bincount(distance[pSubmatrix.data != 0], minlength=pSubmatrix.shape[0])
     expected_interactions /= occurences
 
     mask = np.isnan(expected_interactions)
@@ -283,15 +316,10 @@ def expected_interactions(pSubmatrix):
     """
         Computes the expected number of interactions per distance
     """
-
-    expected_interactions = np.zeros(pSubmatrix.shape[0])
-    row, col = pSubmatrix.nonzero()
-    distance = np.absolute(row - col)
+    pSubmatrix = pSubmatrix.tocsr()
+    distance = np.absolute(pixel_distances(pSubmatrix)[1])
+    expected_interactions = np.bincount(distance, pSubmatrix.data, minlength=pSubmatrix.shape[0]).astype(np.float64)
     occurrences = np.arange(pSubmatrix.shape[0] + 1, 1, -1)
-    # occurences = np.zeros(pSubmatrix.shape[0])
-    for i, distance_ in enumerate(distance):
-        expected_interactions[distance_] += pSubmatrix.data[i]
-        # occurences[distance_] += 1
     expected_interactions /= occurrences
 
     mask = np.isnan(expected_interactions)
@@ -315,6 +343,19 @@ def expected_interactions(pSubmatrix):
 #     return sum_per_distance / binary_interactions_per_distance
 
 
+def _divide_by_expected(pSubmatrix, pExpectedInteractions):
+    """Divides each value of the csr matrix in place by the expected value of ceil(distance / 2)."""
+    if len(pSubmatrix.data) > 0:
+        distance = np.ceil(np.absolute(pixel_distances(pSubmatrix)[1]) / 2).astype(np.int32)
+        data_type = type(pSubmatrix.data[0])
+
+        expected = pExpectedInteractions[distance]
+        pSubmatrix.data = pSubmatrix.data.astype(np.float32)
+        pSubmatrix.data /= expected
+        pSubmatrix.data = convertInfsToZeros_ArrayFloat(pSubmatrix.data).astype(data_type)
+    return pSubmatrix
+
+
 def obs_exp_matrix_lieberman(pSubmatrix, pLength_chromosome, pChromosome_count):
     """
         Creates normalized contact matrix M* by
@@ -322,22 +363,12 @@ def obs_exp_matrix_lieberman(pSubmatrix, pLength_chromosome, pChromosome_count):
         expected contacts for loci at
         that genomic distance. Method: Lieberman-Aiden 2009
     """
-
+    pSubmatrix = pSubmatrix.tocsr()
     expected_interactions_in_distance_ = expected_interactions_in_distance(pLength_chromosome, pChromosome_count, pSubmatrix)
-    row, col = pSubmatrix.nonzero()
-    distance = np.ceil(np.absolute(row - col) / 2).astype(np.int32)
+    return _divide_by_expected(pSubmatrix, expected_interactions_in_distance_)
 
-    if len(pSubmatrix.data) > 0:
-        data_type = type(pSubmatrix.data[0])
 
-        expected = expected_interactions_in_distance_[distance]
-        pSubmatrix.data = pSubmatrix.data.astype(np.float32)
-        pSubmatrix.data /= expected
-        pSubmatrix.data = convertInfsToZeros_ArrayFloat(pSubmatrix.data).astype(data_type)
-    return pSubmatrix
-
-
-def obs_exp_matrix_norm(pSubmatrix):
+def obs_exp_matrix_norm(pSubmatrix, pChunkSize=2**24):
     """
         Creates normalized contact matrix M* by
         dividing each entry by the gnome-wide
@@ -346,21 +377,27 @@ def obs_exp_matrix_norm(pSubmatrix):
         Method from: Homer Software
         exp_i,j = expected_interactions_distance(abs(i-j)) * sum(row(i)) * sum(row(j)) / sum(matrix)
         m_i,j = interaction_i,j / exp_i,j
-    """
+        The values are divided in blocks of about pChunkSize values.
 
+    >>> from scipy.sparse import csr_matrix
+    >>> obs_exp_matrix_norm(csr_matrix(np.array([[1, 2], [2, 4]], dtype=float)), pChunkSize=2).toarray()
+    array([[0.4, 0.5],
+           [0.5, 0.4]], dtype=float32)
+    """
+    pSubmatrix = pSubmatrix.tocsr()
     expected_interactions_in_distance = expected_interactions_non_zero(pSubmatrix)
 
     row_sums = np.array(pSubmatrix.sum(axis=1).T).flatten()
     total_interactions = pSubmatrix.sum()
 
-    row, col = pSubmatrix.nonzero()
-    # data = pSubmatrix.data.tolist()
     pSubmatrix.data = pSubmatrix.data.astype(np.float32)
-    for i in range(len(row)):
-        expected = expected_interactions_in_distance[np.absolute(row[i] - col[i])]
-        expected *= row_sums[row[i]] * row_sums[col[i]] / total_interactions
+    for start_row, end_row in row_blocks(pSubmatrix, pChunkSize):
+        rows, distance = pixel_distances(pSubmatrix, start_row, end_row)
+        cols = rows + distance
+        expected = expected_interactions_in_distance[np.absolute(distance)]
+        expected *= row_sums[rows] * row_sums[cols] / total_interactions
 
-        pSubmatrix.data[i] /= expected
+        pSubmatrix.data[pSubmatrix.indptr[start_row]:pSubmatrix.indptr[end_row]] /= expected
     mask = np.isnan(pSubmatrix.data)
     pSubmatrix.data[mask] = 0
     mask = np.isinf(pSubmatrix.data)
@@ -377,19 +414,9 @@ def obs_exp_matrix_non_zero(pSubmatrix):
         that genomic distance.
         exp_i,j = sum(interactions at distance abs(i-j)) / number of non-zero interactions at abs(i-j)
     """
-
+    pSubmatrix = pSubmatrix.tocsr()
     expected_interactions_in_distance_ = expected_interactions_non_zero(pSubmatrix)
-    row, col = pSubmatrix.nonzero()
-    distance = np.ceil(np.absolute(row - col) / 2).astype(np.int32)
-
-    if len(pSubmatrix.data) > 0:
-        data_type = type(pSubmatrix.data[0])
-
-        expected = expected_interactions_in_distance_[distance]
-        pSubmatrix.data = pSubmatrix.data.astype(np.float32)
-        pSubmatrix.data /= expected
-        pSubmatrix.data = convertInfsToZeros_ArrayFloat(pSubmatrix.data).astype(data_type)
-    return pSubmatrix
+    return _divide_by_expected(pSubmatrix, expected_interactions_in_distance_)
 
 
 def obs_exp_matrix(pSubmatrix):
@@ -400,19 +427,48 @@ def obs_exp_matrix(pSubmatrix):
         that genomic distance.
         exp_i,j = sum(interactions at distance abs(i-j)) / number of non-zero interactions at abs(i-j)
     """
-
+    pSubmatrix = pSubmatrix.tocsr()
     expected_interactions_in_distance_ = expected_interactions(pSubmatrix)
-    row, col = pSubmatrix.nonzero()
-    distance = np.ceil(np.absolute(row - col) / 2).astype(np.int32)
+    return _divide_by_expected(pSubmatrix, expected_interactions_in_distance_)
 
-    if len(pSubmatrix.data) > 0:
-        data_type = type(pSubmatrix.data[0])
 
-        expected = expected_interactions_in_distance_[distance]
-        pSubmatrix.data = pSubmatrix.data.astype(np.float32)
-        pSubmatrix.data /= expected
-        pSubmatrix.data = convertInfsToZeros_ArrayFloat(pSubmatrix.data).astype(data_type)
-    return pSubmatrix
+def covariance_matrix(pSubmatrix):
+    """
+    Covariance of the rows of the sparse matrix as dense array, the same values as
+    np.cov(pSubmatrix.todense()). The rows are centered in place in a single dense
+    copy of the matrix, np.cov needs a second one.
+
+    >>> from scipy.sparse import csr_matrix
+    >>> matrix = np.array([[1, 2, 0], [2, 3, 4], [0, 4, 0]], dtype=float)
+    >>> np.array_equal(covariance_matrix(csr_matrix(matrix)), np.cov(matrix))
+    True
+    """
+    matrix = pSubmatrix.toarray().astype(np.float64, copy=False)
+    matrix -= matrix.mean(axis=1)[:, None]
+    covariance = np.dot(matrix, matrix.T)
+    matrix = None
+    covariance *= np.true_divide(1, pSubmatrix.shape[1] - 1)
+    return covariance
+
+
+def pearson_matrix(pSubmatrix):
+    """
+    Pearson correlation of the rows of the sparse matrix as dense array, the same values as
+    np.corrcoef(pSubmatrix.todense()), computed in place on the covariance matrix.
+    Nans, e.g. of empty rows, are set to 0.
+
+    >>> from scipy.sparse import csr_matrix
+    >>> matrix = np.array([[1, 2, 0], [2, 3, 4], [0, 0, 0]], dtype=float)
+    >>> np.array_equal(pearson_matrix(csr_matrix(matrix)), np.nan_to_num(np.corrcoef(matrix)))
+    True
+    """
+    pearson = covariance_matrix(pSubmatrix)
+    deviation = np.sqrt(np.diag(pearson))
+    pearson /= deviation[:, None]
+    pearson /= deviation[None, :]
+    np.clip(pearson, -1, 1, out=pearson)
+    pearson[~np.isfinite(pearson)] = 0
+    return pearson
 
 
 def toString(s):